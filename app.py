@@ -1,19 +1,19 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, make_response, send_from_directory
-from models import db, Ad, Batch, UserGkach, GkachRate, Delivery, Message, User, CartItem, Ads_Owner
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, make_response, send_from_directory, send_file, g, Response, stream_with_context
+from models import db, Ad, Batch, UserGkach, GkachRequest, GkachLedgerEntry, GkachRate, Delivery, Message, User, CartItem, Ads_Owner, MediaJob
+import hmac
 import uuid
 import os
+import time
 import json
 import random
 import csv
 import urllib.parse
-from datetime import datetime
+from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
 from werkzeug.security import check_password_hash, generate_password_hash
 from dotenv import load_dotenv
 from src.logger import setup_logger
-from moviepy.editor import VideoFileClip
-from PIL import Image
-from image_search import find_similar_ads
+from image_search import find_similar_ads, index_ad, remove_ad_from_index
 from utils import format_whatsapp_number, sanitize_input, validate_file_upload, generate_secure_filename, validate_whatsapp_number, calculate_cart_total, generate_receipt
 from src.notifications import (
     notify_admin_new_gkach_request,
@@ -30,7 +30,6 @@ from src.notifications import (
     notify_user_gkach_request_approved,
     notify_user_gkach_request_rejected,
     notify_user_balance_added,
-    notify_admin_traffic_alert,
     notify_admin_otp,
     notify_seller_delivery_request,
     notify_buyer_delivery_updated,
@@ -40,9 +39,30 @@ from src.notifications import (
     notify_buyer_awaiting_delivery,
     notify_admin_delivery_completed
 )
-from src.communication import send_message, get_messages, get_delivery_participants
-from src.gif_utils import generate_ad_gif
+from src.communication import send_message, get_messages, get_delivery_participants, get_participants_or_raise
+from src.message_bus import message_bus
 from src.facebook_publisher import facebook_publisher
+from src.facebook_queue import enqueue_publish, get_publish_results, resolve_unconfirmed
+from src.search import init_search_index, index_ad_text, remove_ad_text, search_ads
+from src.cart import get_cart_items, parse_delivery_items, hydrate_delivery_items
+from src.gkach_requests import get_pending_requests
+from src.ledger import transfer, InsufficientGkach, MINT_ACCOUNT, ESCROW_ACCOUNT
+from src.responsive_images import (responsive_image, image_variant_url, image_srcset, get_variant_path,
+                                   video_url, video_poster_url, get_rendition_path)
+from src.media_jobs import enqueue, start_worker, get_job_status, job_to_dict, retry_job
+from src.schema import ensure_schema, register_migrate_cli
+from src.ad_media import set_ad_images, set_ad_video, load_ad_media
+from src.batches import set_batch_ads, get_batch_ads, get_ad_batch_id, unbatched_ads, batch_open_graph_data
+from src.exports import EXPORTS, FORMATS, stream_export, gzip_chunks
+from src.admin_dashboard import (get_dashboard_counts, get_ads_page, get_batches_page, get_gkach_users_page,
+                                 page_to_dict, ads_to_dicts, batches_to_dicts, gkach_users_to_dicts,
+                                 AD_STATUSES, PAYMENT_STATUSES)
+from src.receipts import (queue_receipt, receipt_url, check_receipt_token, get_receipt_path, receipt_data,
+                          statement_deliveries, render_missing_receipts, render_statement, stream_zip)
+from src.page_cache import cached_page, render_fragment, bump_content_version
+from src.cache import init_cache, get_ad, get_rate, invalidate_ad, invalidate_gkach_rate, load_approved_ad
+from src.instrumentation import init_instrumentation
+from src.metrics import init_metrics, record_request, start_ticker, flush as flush_metrics, render_prometheus
 
 # Load environment variables
 load_dotenv()
@@ -53,6 +73,49 @@ ADMIN_WHATSAPP = os.environ.get('ADMIN_WHATSAPP', '+50942882076')
 ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'StanGlory2YahPub0886')  # Should be changed in production
 app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'static/uploads')
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB for video uploads
+app.config['IMAGE_INDEX_FOLDER'] = os.environ.get('IMAGE_INDEX_FOLDER', os.path.join('instance', 'image_index'))
+app.config['IMAGE_SEARCH_MODE'] = os.environ.get('IMAGE_SEARCH_MODE', 'vector')  # 'vector' or 'orb'
+app.config['IMAGE_SEARCH_CANDIDATES'] = int(os.environ.get('IMAGE_SEARCH_CANDIDATES', 50))
+app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'auto')  # 'auto', 'postgres', 'fts5' or 'python'
+app.config['SEARCH_PER_PAGE'] = int(os.environ.get('SEARCH_PER_PAGE', 24))
+app.config['ACHTE_PAGE_SIZE'] = int(os.environ.get('ACHTE_PAGE_SIZE', 24))
+app.config['MEDIA_WORKER'] = os.environ.get('MEDIA_WORKER', 'thread')  # 'thread', or 'off' when media_worker.py runs separately
+app.config['MEDIA_PROCESS_WORKERS'] = int(os.environ.get('MEDIA_PROCESS_WORKERS', 1))  # 0 runs image work inline
+app.config['MEDIA_VARIANTS_FOLDER'] = os.environ.get('MEDIA_VARIANTS_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'variants'))
+app.config['IMAGE_VARIANT_WIDTHS'] = [int(w) for w in os.environ.get('IMAGE_VARIANT_WIDTHS', '320,640,1280').split(',')]
+app.config['IMAGE_VARIANT_FORMATS'] = os.environ.get('IMAGE_VARIANT_FORMATS', 'webp,jpeg').split(',')  # add 'avif' with pillow-avif-plugin
+app.config['MEDIA_JOB_TIMEOUT'] = int(os.environ.get('MEDIA_JOB_TIMEOUT', 1800))  # Seconds before a running job counts as dead
+app.config['VIDEO_MAX_SIZE'] = int(os.environ.get('VIDEO_MAX_SIZE', 1280))  # Longest side of the transcoded video
+app.config['VIDEO_MAX_BITRATE'] = os.environ.get('VIDEO_MAX_BITRATE', '2M')
+app.config['VIDEO_PREVIEW_SIZE'] = int(os.environ.get('VIDEO_PREVIEW_SIZE', 480))
+app.config['VIDEO_PREVIEW_BITRATE'] = os.environ.get('VIDEO_PREVIEW_BITRATE', '400k')
+app.config['VIDEO_TRANSCODE_TIMEOUT'] = int(os.environ.get('VIDEO_TRANSCODE_TIMEOUT', 600))
+app.config['ANIMATION_SIZE'] = int(os.environ.get('ANIMATION_SIZE', 480))  # Longest side of multi-image ad animations
+app.config['ANIMATION_FRAME_SECONDS'] = float(os.environ.get('ANIMATION_FRAME_SECONDS', 1.0))
+app.config['ANIMATION_FORMATS'] = os.environ.get('ANIMATION_FORMATS', 'webp,gif').split(',')  # add 'mp4' for a looping H.264 clip
+app.config['RECEIPTS_FOLDER'] = os.environ.get('RECEIPTS_FOLDER', os.path.join('instance', 'receipts'))  # Private: served by /receipts/<delivery_id>
+app.config['METRICS_DB'] = os.environ.get('METRICS_DB', os.path.join('instance', 'metrics.db'))  # Shared by the workers of a host
+app.config['METRICS_BUFFER_SIZE'] = int(os.environ.get('METRICS_BUFFER_SIZE', 10000))
+app.config['METRICS_FLUSH_INTERVAL'] = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))  # Seconds; 0 disables the tick thread
+app.config['METRICS_RATE_RETENTION'] = int(os.environ.get('METRICS_RATE_RETENTION', 60))  # Minutes of rate windows kept
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')  # Bearer token for Prometheus scrapes of /admin/metrics
+app.config['TRAFFIC_ALERT_THRESHOLD'] = int(os.environ.get('TRAFFIC_ALERT_THRESHOLD', 600))  # Requests per minute; 0 disables
+app.config['TRAFFIC_ALERT_COOLDOWN'] = int(os.environ.get('TRAFFIC_ALERT_COOLDOWN', 900))  # Seconds between alerts
+app.config['INSTRUMENTATION'] = os.environ.get('INSTRUMENTATION', 'off') == 'on'  # Query timing, Server-Timing, slow-request log
+app.config['SLOW_REQUEST_THRESHOLD_MS'] = int(os.environ.get('SLOW_REQUEST_THRESHOLD_MS', 500))
+app.config['PROFILE_SAMPLE_INTERVAL_MS'] = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', 5))  # 0 disables stack sampling
+app.config['SLOW_REQUEST_LOG'] = os.environ.get('SLOW_REQUEST_LOG', os.path.join('instance', 'slow_requests.log'))
+app.config['CACHE_SIZE'] = int(os.environ.get('CACHE_SIZE', 1024))  # Entries per cache (ads, Gkach rates) in each worker
+app.config['CACHE_TTL'] = float(os.environ.get('CACHE_TTL', 300))  # Seconds before a cached row is loaded again
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', '')  # '' (in-process only) or 'sqlite' (shared by the workers of a host)
+app.config['CACHE_DB'] = os.environ.get('CACHE_DB', os.path.join('instance', 'cache.db'))
+app.config['CACHE_SYNC_INTERVAL'] = float(os.environ.get('CACHE_SYNC_INTERVAL', 1))  # Seconds between reads of the shared invalidation log
+app.config['MESSAGE_POLL_INTERVAL'] = float(os.environ.get('MESSAGE_POLL_INTERVAL', 1))  # Seconds between checks for messages sent through other workers
+app.config['MESSAGE_STREAM_MAX_SECONDS'] = int(os.environ.get('MESSAGE_STREAM_MAX_SECONDS', 300))  # An event stream is closed (and reconnected by the browser) after this
+app.config['MESSAGE_KEEPALIVE_SECONDS'] = float(os.environ.get('MESSAGE_KEEPALIVE_SECONDS', 15))
+app.config['MESSAGE_LONG_POLL_MAX_SECONDS'] = float(os.environ.get('MESSAGE_LONG_POLL_MAX_SECONDS', 30))  # Upper bound for ?wait=
+app.config['MESSAGE_MAX_WAITING'] = int(os.environ.get('MESSAGE_MAX_WAITING', 4))  # Streams and long polls held at once per worker; keep well below gunicorn --threads
+app.config['MESSAGE_RETRY_AFTER'] = int(os.environ.get('MESSAGE_RETRY_AFTER', 5))  # Seconds a client waits before asking again when they are all taken
 
 # Database configuration - Handle both Render's DATABASE_URL and custom DATABASE_URI
 database_url = os.environ.get('DATABASE_URL') or os.environ.get('DATABASE_URI', 'sqlite:///glory2yahpub.db')
@@ -66,13 +129,25 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'pool_recycle': 300,
 }
 
+app.config['AUTO_MIGRATE'] = os.environ.get('AUTO_MIGRATE', 'on') != 'off'  # 'off' when deploys run `flask db upgrade`
+
 db.init_app(app)
+register_migrate_cli(app)
 
 # Set up logger
 logger = setup_logger()
 
-# Traffic tracking
-traffic_log = []
+# Request metrics (ring buffer flushed to the shared sink by a background tick)
+init_metrics(app)
+
+# Per-request query timing and profiling, only when INSTRUMENTATION=on
+init_instrumentation(app)
+
+# Read-through cache for ad and Gkach rate lookups
+init_cache(app)
+
+# Pub/sub waking the delivery message streams and long polls
+message_bus.init_app(app)
 
 # Custom Jinja2 filter for fromjson
 def fromjson(value):
@@ -87,104 +162,71 @@ def fromjson(value):
 
 app.jinja_env.filters['fromjson'] = fromjson
 
+# Responsive <picture>/srcset helpers for uploaded images
+app.jinja_env.globals.update(responsive_image=responsive_image, image_variant_url=image_variant_url, image_srcset=image_srcset,
+                             video_url=video_url, video_poster_url=video_poster_url)
+
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf'}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def encode_ad_cursor(ad):
+    """Keyset cursor pointing just after the given ad in the (created_at, ad_id) ordering."""
+    return f"{ad.created_at.isoformat()}|{ad.ad_id}"
+
+def get_approved_ads_page(cursor=None, limit=24):
+    """
+    Fetch one page of approved ads, newest first, using keyset pagination.
+
+    :param cursor: Cursor returned by the previous page, or None for the first page
+    :param limit: Number of ads per page
+    :return: (ads, next_cursor) where next_cursor is None on the last page
+    """
+    query = Ad.query.filter_by(admin_status='approved')
+    if cursor:
+        try:
+            created_at, ad_id = cursor.split('|', 1)
+            created_at = datetime.fromisoformat(created_at)
+        except ValueError:
+            raise ValueError('Invalid cursor')
+        query = query.filter(db.or_(
+            Ad.created_at < created_at,
+            db.and_(Ad.created_at == created_at, Ad.ad_id < ad_id)
+        ))
+    ads = query.order_by(Ad.created_at.desc(), Ad.ad_id.desc()).limit(limit + 1).all()
+    next_cursor = encode_ad_cursor(ads[limit - 1]) if len(ads) > limit else None
+    return ads[:limit], next_cursor
+
 def generate_otp():
     """Generate a 4-digit random OTP"""
     return str(random.randint(1000, 9999))
 
 with app.app_context():
-    db.create_all()
-    # Add missing columns if not exists
-    from sqlalchemy import text, inspect
-    
-    inspector = inspect(db.engine)
-    
-    # Check and add ads columns
-    ads_columns = [col['name'] for col in inspector.get_columns('ads')]
-    
-    if 'media_type' not in ads_columns:
-        try:
-            db.session.execute(text("ALTER TABLE ads ADD COLUMN media_type VARCHAR(10) DEFAULT 'images'"))
-            db.session.commit()
-            logger.info("Added media_type column to ads table")
-        except Exception as e:
-            db.session.rollback()
-            logger.warning(f"Could not add media_type column: {e}")
-    
-    if 'video' not in ads_columns:
-        try:
-            db.session.execute(text("ALTER TABLE ads ADD COLUMN video VARCHAR(255)"))
-            db.session.commit()
-            logger.info("Added video column to ads table")
-        except Exception as e:
-            db.session.rollback()
-            logger.warning(f"Could not add video column: {e}")
-    
-    # Check and add delivery columns
-    try:
-        delivery_columns = [col['name'] for col in inspector.get_columns('deliveries')]
-        
-        if 'delivered_at' not in delivery_columns:
-            try:
-                db.session.execute(text("ALTER TABLE deliveries ADD COLUMN delivered_at TIMESTAMP"))
-                db.session.commit()
-                logger.info("Added delivered_at column to deliveries table")
-            except Exception as e:
-                db.session.rollback()
-                logger.warning(f"Could not add delivered_at column: {e}")
-        
-        if 'delivery_date' not in delivery_columns:
-            try:
-                db.session.execute(text("ALTER TABLE deliveries ADD COLUMN delivery_date TIMESTAMP"))
-                db.session.commit()
-                logger.info("Added delivery_date column to deliveries table")
-            except Exception as e:
-                db.session.rollback()
-                logger.warning(f"Could not add delivery_date column: {e}")
-        
-        if 'delivery_date_set_at' not in delivery_columns:
-            try:
-                db.session.execute(text("ALTER TABLE deliveries ADD COLUMN delivery_date_set_at TIMESTAMP"))
-                db.session.commit()
-                logger.info("Added delivery_date_set_at column to deliveries table")
-            except Exception as e:
-                db.session.rollback()
-                logger.warning(f"Could not add delivery_date_set_at column: {e}")
-        
-        if 'delivery_notes' not in delivery_columns:
-            try:
-                db.session.execute(text("ALTER TABLE deliveries ADD COLUMN delivery_notes TEXT"))
-                db.session.commit()
-                logger.info("Added delivery_notes column to deliveries table")
-            except Exception as e:
-                db.session.rollback()
-                logger.warning(f"Could not add delivery_notes column: {e}")
-    except Exception as e:
-        logger.warning(f"Could not inspect deliveries table: {e}")
+    # Schema migrations (migrations/), a single version query when already up to date.
+    # They also create the full-text index and backfill legacy Gkach requests, ledger and search documents.
+    ensure_schema(app)
+
+    # Full-text search backend for /achte, picked without touching the database
+    init_search_index(app)
 
 @app.before_request
-def log_traffic():
-    if request.endpoint not in ['static']:
-        traffic_entry = {
-            'timestamp': datetime.now().isoformat(),
-            'ip': request.remote_addr,
-            'method': request.method,
-            'path': request.path,
-            'user_agent': request.headers.get('User-Agent', ''),
-            'referrer': request.headers.get('Referer', '')
-        }
-        traffic_log.append(traffic_entry)
-        # Keep only last 1000 entries
-        if len(traffic_log) > 1000:
-            traffic_log.pop(0)
+def ensure_media_worker():
+    # Started lazily so each gunicorn worker (forked after --preload) gets its own thread
+    start_worker(app)
 
-        # Notify admin if traffic exceeds threshold
-        if len(traffic_log) > 10:  # Example threshold
-            notify_admin_traffic_alert(len(traffic_log))
+@app.before_request
+def start_request_timer():
+    # Per-process tick thread, started lazily like the media worker
+    start_ticker(app)
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None and request.endpoint != 'static':
+        record_request(request.endpoint, request.method, response.status_code, time.perf_counter() - started)
+    return response
 
 @app.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
@@ -201,19 +243,13 @@ def admin_login():
 
 @app.route('/')
 def index():
-    # Fetch the latest batch
-    latest_batch = Batch.query.order_by(Batch.created_at.desc()).first()
-    batch = None
-    ads = []
-    if latest_batch:
-        batch = latest_batch
-        ad_ids = batch.ads.split(',')
-        ads = Ad.query.filter(Ad.ad_id.in_(ad_ids)).all()
-    response = make_response(render_template('index.html', batch=batch, ads=ads))
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
-    return response
+    def render_fragments():
+        # Fetch the latest batch
+        batch = Batch.query.order_by(Batch.created_at.desc()).first()
+        ads = get_batch_ads(batch.batch_id) if batch else []
+        return {'content': render_fragment('index_content.html', batch=batch, ads=ads)}
+
+    return cached_page('index.html', ['index_content.html'], render_fragments)
 
 @app.route('/welcome', methods=['GET'])
 def welcome():
@@ -309,20 +345,8 @@ def submit_ad():
                 filename = f"{uuid.uuid4()}_{secure_filename(file.filename)}"
                 filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
                 try:
+                    # Saved as uploaded; compression and variants run in the media job queue
                     file.save(filepath)
-                    # Compress the image
-                    try:
-                        img = Image.open(filepath)
-                        if img.format in ['JPEG', 'JPG']:
-                            img.save(filepath, 'JPEG', quality=80, optimize=True)
-                        elif img.format == 'PNG':
-                            img.save(filepath, 'PNG', optimize=True)
-                        # GIF and others left uncompressed
-                        img.close()
-                        logger.info(f"Image compressed successfully: {filename}")
-                    except Exception as compress_e:
-                        logger.warning(f"Error compressing image {filename}: {str(compress_e)}")
-                        # Continue without compression
                     saved_images.append(filename)
                     logger.info(f"File saved successfully: {filename}")
                 except Exception as e:
@@ -349,14 +373,17 @@ def submit_ad():
                 ad_id=ad_id,
                 user_whatsapp=user_whatsapp,
                 media_type=media_type,
-                images=','.join(saved_images) if saved_images else '',
-                video=saved_video,
                 description=description,
                 title=title,
                 ad_type=ad_type,
                 price_gkach=price_gkach,
                 created_at=datetime.utcnow()
             )
+            # Media rows, with the first image's dimensions for the list pages
+            if saved_video:
+                set_ad_video(new_ad, saved_video)
+            else:
+                set_ad_images(new_ad, saved_images)
             db.session.add(new_ad)
 
             # Create Ads_Owner entry
@@ -366,8 +393,14 @@ def submit_ad():
                 created_at=datetime.utcnow()
             )
             db.session.add(new_ads_owner)
+            index_ad_text(new_ad, commit=False)
             db.session.commit()
             logger.info(f"Ad submitted successfully: {ad_id}")
+            if saved_images:
+                try:
+                    enqueue('process_images', ad_id=ad_id)
+                except Exception as e:
+                    logger.error(f"Could not queue media processing for ad {ad_id}: {e}")
             # Notify admin of new ad submission
             notify_admin_new_ad_submission(user_whatsapp, ad_id)
             flash('Piblisite w la soumèt avèk siksè! Kounye a, telechaje prèv pèman w la.', 'success')
@@ -414,6 +447,7 @@ def upload_payment(ad_id):
                     ad.payment_proof = filename
                     ad.payment_status = 'pending'
                     db.session.commit()
+                    invalidate_ad(ad_id)
                     logger.info(f"Payment proof updated for ad: {ad_id}")
                     # Notify admin of payment proof upload
                     notify_admin_payment_proof_uploaded(ad.user_whatsapp, ad_id)
@@ -464,23 +498,14 @@ def upload_gkach_approval(request_id):
                 return redirect(url_for('upload_gkach_approval', request_id=request_id))
 
             try:
-                # Find the user and update the specific request
-                users_gkach = UserGkach.query.all()
-                for user_gkach in users_gkach:
-                    try:
-                        requests = json.loads(user_gkach.gkach_requests or '[]')
-                    except (json.JSONDecodeError, TypeError):
-                        logger.error(f"Error parsing gkach_requests for user {user_gkach.user_whatsapp}")
-                        requests = []
-                    
-                    for req in requests:
-                        if req.get('request_id') == request_id and req['status'] == 'pending':
-                            req['document'] = filename
-                            user_gkach.gkach_requests = json.dumps(requests)
-                            db.session.commit()
-                            logger.info(f"Gkach approval document updated for request: {request_id}")
-                            flash('Dokiman apwobasyon w la telechaje avèk siksè! Administratè a pral revize li byento.', 'success')
-                            return redirect(url_for('success'))
+                # Find the pending request and attach the document
+                gkach_request = GkachRequest.query.filter_by(request_id=request_id, status='pending').first()
+                if gkach_request:
+                    gkach_request.document = filename
+                    db.session.commit()
+                    logger.info(f"Gkach approval document updated for request: {request_id}")
+                    flash('Dokiman apwobasyon w la telechaje avèk siksè! Administratè a pral revize li byento.', 'success')
+                    return redirect(url_for('success'))
                 logger.error(f"Gkach request not found: {request_id}")
                 flash('Demann Gkach pa jwenn.', 'error')
                 return redirect(url_for('upload_gkach_approval', request_id=request_id))
@@ -514,29 +539,182 @@ def admin():
     if 'admin' not in session:
         return redirect(url_for('admin_login'))
     try:
-        ads = Ad.query.order_by(Ad.created_at.desc()).all()
-        batches = Batch.query.order_by(Batch.created_at.desc()).all()
-        users_gkach = UserGkach.query.all()
-        gkach_rates = GkachRate.query.all()
+        counts = get_dashboard_counts()
+        pending_requests = get_pending_requests(page=request.args.get('requests_page', 1, type=int))
     except Exception as e:
         logger.error(f"Error fetching admin data: {str(e)}")
-        ads = []
-        batches = []
-        users_gkach = []
-        gkach_rates = []
+        counts = None
+        pending_requests = None
 
-    return render_template('admin.html', ads=ads, batches=batches, users_gkach=users_gkach, gkach_rates=gkach_rates)
+    # The ad, batch and user tables are loaded by the page from the JSON endpoints below
+    return render_template('admin.html', counts=counts, pending_requests=pending_requests,
+                           ad_statuses=AD_STATUSES, payment_statuses=PAYMENT_STATUSES)
+
+def _admin_page_args():
+    return request.args.get('page', 1, type=int), request.args.get('per_page', 20, type=int)
+
+@app.route('/admin/api/ads')
+def admin_api_ads():
+    if 'admin' not in session:
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    page, per_page = _admin_page_args()
+    ads = get_ads_page(status=request.args.get('status'), payment_status=request.args.get('payment_status'),
+                       q=request.args.get('q', '').strip(), page=page, per_page=per_page)
+    return jsonify(page_to_dict(ads, ads_to_dicts(ads.items)))
+
+@app.route('/admin/api/batches')
+def admin_api_batches():
+    if 'admin' not in session:
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    page, per_page = _admin_page_args()
+    batches = get_batches_page(unpublished=request.args.get('unpublished') == '1', page=page, per_page=per_page)
+    return jsonify(page_to_dict(batches, batches_to_dicts(batches.items)))
+
+@app.route('/admin/api/gkach_users')
+def admin_api_gkach_users():
+    if 'admin' not in session:
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    page, per_page = _admin_page_args()
+    users = get_gkach_users_page(q=request.args.get('q', '').strip(), page=page, per_page=per_page)
+    return jsonify(page_to_dict(users, gkach_users_to_dicts(users.items)))
+
+@app.route('/media/<int:width>/<fmt>/<filename>')
+def media_variant(width, fmt, filename):
+    filename = secure_filename(filename)
+    path = get_variant_path(filename, width, fmt)
+    if not path:
+        if os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+            # Not resizable (e.g. corrupt or unsupported): fall back to the original
+            return redirect(url_for('static', filename='uploads/' + filename))
+        return jsonify({'success': False, 'error': 'Image not found'}), 404
+    response = send_from_directory(os.path.abspath(os.path.dirname(path)), os.path.basename(path), max_age=31536000)
+    # Upload filenames are unique, so a variant never changes
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/media/video/<kind>/<filename>')
+def media_video(kind, filename):
+    filename = secure_filename(filename)
+    path = get_rendition_path(filename, kind)
+    if not path:
+        if kind != 'poster' and os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+            # Not transcoded yet: serve the upload as-is
+            return redirect(url_for('static', filename='uploads/' + filename))
+        return jsonify({'success': False, 'error': 'Video not found'}), 404
+    response = send_from_directory(os.path.abspath(os.path.dirname(path)), os.path.basename(path), max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/admin/metrics')
+def admin_metrics():
+    token = app.config['METRICS_TOKEN']
+    # Constant-time comparison, so response timing does not reveal how much of the token matched.
+    # As bytes: compare_digest rejects non-ASCII str
+    authorized = 'admin' in session or bool(token and hmac.compare_digest(
+        request.headers.get('Authorization', '').encode(), f"Bearer {token}".encode()))
+    if not authorized:
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    # Include this worker's latest requests without waiting for the next tick
+    flush_metrics(app)
+    response = make_response(render_prometheus(app))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/admin/media_jobs')
+def admin_media_jobs():
+    if 'admin' not in session:
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    query = MediaJob.query
+    if request.args.get('ad_id'):
+        query = query.filter_by(ad_id=request.args['ad_id'])
+    if request.args.get('status'):
+        query = query.filter_by(status=request.args['status'])
+    jobs = query.order_by(MediaJob.created_at.desc()).limit(request.args.get('limit', 50, type=int)).all()
+    return jsonify({'success': True, 'jobs': [job_to_dict(job) for job in jobs]})
+
+@app.route('/admin/media_jobs/<job_id>')
+def admin_media_job(job_id):
+    if 'admin' not in session:
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    job = get_job_status(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/admin/media_jobs/<job_id>/retry', methods=['POST'])
+def admin_retry_media_job(job_id):
+    if 'admin' not in session:
+        return redirect(url_for('admin_login'))
+    if retry_job(job_id):
+        flash('Travay medya a relanse.', 'success')
+    else:
+        flash('Travay medya pa jwenn oubyen li pa echwe.', 'error')
+    return redirect(url_for('admin'))
+
+def _export_response(chunks, filename, mimetype):
+    """Stream an export, gzipped on the fly when the client accepts it."""
+    gzipped = 'gzip' in request.headers.get('Accept-Encoding', '')
+    response = Response(stream_with_context(gzip_chunks(chunks) if gzipped else chunks), mimetype=mimetype)
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 @app.route('/admin/csv/<ad_id>')
 def download_csv(ad_id):
     if 'admin' not in session:
         return redirect(url_for('admin_login'))
-    csv_path = f'csv/{ad_id}.csv'
-    if os.path.exists(csv_path):
-        return send_from_directory('csv', f'{ad_id}.csv', as_attachment=True)
-    else:
-        flash('CSV pa jwenn.', 'error')
+    if not db.session.get(Ad, ad_id):
+        flash('Piblisite pa jwenn.', 'error')
         return redirect(url_for('admin'))
+    return _export_response(stream_export('ads', ad_id=ad_id), f'{ad_id}.csv', FORMATS['csv'])
+
+@app.route('/admin/export/<name>')
+def admin_export(name):
+    if 'admin' not in session:
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    fmt = request.args.get('format', 'csv')
+    if name not in EXPORTS or fmt not in FORMATS:
+        return jsonify({'success': False, 'error': 'Unknown export or format'}), 404
+    try:
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d') if request.args.get('start') else None
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1) if request.args.get('end') else None
+        chunks = stream_export(name, fmt, start=start, end=end, status=request.args.get('status'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return _export_response(chunks, f"{name}_{datetime.utcnow():%Y%m%d}.{fmt}", FORMATS[fmt])
+
+@app.route('/admin/receipts/statement')
+def admin_receipt_statement():
+    if 'admin' not in session:
+        return redirect(url_for('admin_login'))
+    seller_whatsapp = format_whatsapp_number(request.args.get('seller', ''))
+    try:
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d')
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1)  # End day included
+    except (KeyError, ValueError):
+        return jsonify({'success': False, 'error': 'seller, start and end (YYYY-MM-DD) are required'}), 400
+    if not seller_whatsapp:
+        return jsonify({'success': False, 'error': 'seller, start and end (YYYY-MM-DD) are required'}), 400
+
+    datas = [receipt_data(delivery) for delivery in statement_deliveries(seller_whatsapp, start, end)]
+    if not datas:
+        return jsonify({'success': False, 'error': 'No completed deliveries in this period'}), 404
+    paths = render_missing_receipts(datas)
+    name = f"resi_{seller_whatsapp.lstrip('+')}_{request.args['start']}_{request.args['end']}"
+
+    if request.args.get('format') == 'pdf':
+        path = render_statement(datas, app.config['RECEIPTS_FOLDER'])
+        return send_file(os.path.abspath(path), mimetype='application/pdf', download_name=f'{name}.pdf',
+                         as_attachment=True, etag=os.path.splitext(os.path.basename(path))[0], conditional=True)
+
+    files = [(f"resi_{data['delivery_id']}.pdf", path) for data, path in zip(datas, paths)]
+    response = Response(stream_with_context(stream_zip(files)), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{name}.zip"'
+    return response
 
 @app.route('/admin/update_ad_status', methods=['POST'])
 def update_ad_status():
@@ -551,13 +729,30 @@ def update_ad_status():
         if ad:
             ad.admin_status = status
             ad.payment_status = payment_status
+            index_ad_text(ad, commit=False)
             db.session.commit()
-            # Generate GIF if approved and has multiple images
+            invalidate_ad(ad_id)
             if status == 'approved':
-                generate_ad_gif(ad)
+                if ad.media_type == 'images' and len(ad.image_filenames) > 1:
+                    # Animated preview, rendered by the media worker (cached by image content)
+                    try:
+                        enqueue('render_animation', ad_id=ad_id)
+                    except Exception as e:
+                        logger.error(f"Could not queue the animation for ad {ad_id}: {e}")
+                if ad.media_type == 'video' and ad.video and not get_rendition_path(ad.video, 'full'):
+                    try:
+                        enqueue('transcode_video', ad_id=ad_id)
+                    except Exception as e:
+                        logger.error(f"Could not queue transcoding for ad {ad_id}: {e}")
+                try:
+                    index_ad(ad)
+                except Exception as e:
+                    logger.error(f"Error indexing ad {ad_id} for image search: {str(e)}")
                 notify_user_ad_approved(ad.user_whatsapp, ad_id)
-            elif status == 'rejected':
-                notify_user_ad_rejected(ad.user_whatsapp, ad_id)
+            else:
+                remove_ad_from_index(ad_id)
+                if status == 'rejected':
+                    notify_user_ad_rejected(ad.user_whatsapp, ad_id)
             flash('Estati piblisite a mete ajou avèk siksè!', 'success')
         else:
             flash('Piblisite pa jwenn.', 'error')
@@ -572,7 +767,7 @@ def create_batch():
     if 'admin' not in session:
         return redirect(url_for('admin_login'))
     try:
-        available_ads = Ad.query.filter_by(admin_status='approved', batch_id=None).all()
+        available_ads = unbatched_ads().all()
 
         if len(available_ads) < 5:
             flash(f'Pa ase piblisite apwouve. Bezwen 5, gen {len(available_ads)} disponib.', 'error')
@@ -583,30 +778,15 @@ def create_batch():
         batch_id = str(uuid.uuid4())
         ad_ids = [ad.ad_id for ad in selected_ads]
 
-        # Generate Open Graph data for carousel
-        og_data = {
-            'title': 'Glory2yahPub Ad Batch',
-            'description': 'Check out these amazing ads from Glory2yahPub!',
-            'url': url_for('view_batch', batch_id=batch_id, _external=True),
-            'images': []
-        }
-        for ad in selected_ads:
-            first_image = ad.images.split(',')[0]
-            image_url = url_for('static', filename='uploads/' + first_image, _external=True)
-            og_data['images'].append(image_url)
-        og_json = json.dumps(og_data)
-
         new_batch = Batch(
             batch_id=batch_id,
-            ads=','.join(ad_ids),
-            open_graph_data=og_json,
+            open_graph_data=batch_open_graph_data(batch_id, selected_ads),  # Open Graph data for the carousel
             created_at=datetime.utcnow()
         )
+        set_batch_ads(new_batch, ad_ids)
         db.session.add(new_batch)
 
-        for ad in selected_ads:
-            ad.batch_id = batch_id
-
+        bump_content_version()
         db.session.commit()
 
         flash(f'Nouvo gwoup {batch_id} kreye avèk siksè!', 'success')
@@ -618,48 +798,75 @@ def create_batch():
 
 @app.route('/batch/<batch_id>')
 def view_batch(batch_id):
-    batch = Batch.query.filter_by(batch_id=batch_id).first()
+    def render_fragments():
+        batch = Batch.query.filter_by(batch_id=batch_id).first()
+        if not batch:
+            return None
+        ads = get_batch_ads(batch_id)
+        return {
+            'head': render_fragment('batch_head.html', batch=batch),
+            'content': render_fragment('batch_content.html', batch=batch, ads=ads)
+        }
 
-    if not batch:
+    response = cached_page('batch.html', ['batch_head.html', 'batch_content.html'], render_fragments, key=batch_id)
+    if response is None:
         flash('Gwoup sa pa egziste.', 'error')
         return redirect(url_for('index'))
-
-    ad_ids = batch.ads.split(',')
-    ads = Ad.query.filter(Ad.ad_id.in_(ad_ids)).all()
-
-    response = make_response(render_template('batch.html', batch=batch, ads=ads))
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
     return response
 
 @app.route('/achte')
 def achte():
     # Get search query from URL parameters
     search_query = request.args.get('search', '').strip()
+    page = request.args.get('page', 1, type=int)
+    total = None
+    next_cursor = None
+
+    if search_query.startswith('image_search:'):
+        # Handle image search results
+        ad_ids_str = search_query.replace('image_search:', '')
+        ad_ids = ad_ids_str.split(',') if ad_ids_str else []
+        approved_ads = Ad.query.filter(
+            Ad.ad_id.in_(ad_ids),
+            Ad.admin_status == 'approved'
+        ).order_by(Ad.created_at.desc()).all()
+    elif search_query:
+        # Ranked full-text search, one page at a time
+        approved_ads, total = search_ads(search_query, page=page, per_page=app.config['SEARCH_PER_PAGE'])
+    else:
+        # First page of approved ads; the rest load on scroll through /api/achte/ads
+        approved_ads, next_cursor = get_approved_ads_page(limit=app.config['ACHTE_PAGE_SIZE'])
+
+    pagination = None
+    if total is not None:
+        per_page = app.config['SEARCH_PER_PAGE']
+        pagination = {
+            'page': page,
+            'has_prev': page > 1,
+            'has_next': page * per_page < total,
+            'total': total
+        }
 
-    # Fetch all approved ads
-    approved_ads = Ad.query.filter_by(admin_status='approved').order_by(Ad.created_at.desc()).all()
+    load_ad_media(approved_ads)  # One query for the media of the whole page
+    return render_template('achte.html', ads=approved_ads, search_query=search_query, pagination=pagination, next_cursor=next_cursor)
 
-    # Filter ads based on search query
-    if search_query:
-        if search_query.startswith('image_search:'):
-            # Handle image search results
-            ad_ids_str = search_query.replace('image_search:', '')
-            ad_ids = ad_ids_str.split(',') if ad_ids_str else []
-            approved_ads = [ad for ad in approved_ads if ad.ad_id in ad_ids]
-        else:
-            # Regular text search
-            filtered_ads = []
-            for ad in approved_ads:
-                title = ad.title or ""
-                description = ad.description or ""
-                if (search_query.lower() in title.lower() or
-                    search_query.lower() in description.lower()):
-                    filtered_ads.append(ad)
-            approved_ads = filtered_ads
-
-    return render_template('achte.html', ads=approved_ads, search_query=search_query)
+@app.route('/api/achte/ads', methods=['GET'])
+def achte_ads_page():
+    """Next page of the /achte catalog for infinite scroll."""
+    cursor = request.args.get('cursor')
+    try:
+        ads, next_cursor = get_approved_ads_page(cursor, limit=app.config['ACHTE_PAGE_SIZE'])
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Kurseur envalid.'}), 400
+
+    load_ad_media(ads)
+    html = ''.join(render_template('achte_ad_card.html', ad=ad) for ad in ads)
+    return jsonify({
+        'success': True,
+        'ad_ids': [ad.ad_id for ad in ads],
+        'html': html,
+        'next_cursor': next_cursor
+    })
 
 @app.route('/search_by_image', methods=['POST'])
 def search_by_image():
@@ -725,7 +932,7 @@ def add_to_cart():
         db.session.commit()
 
     # Check if ad exists
-    ad = Ad.query.filter_by(ad_id=product_id, admin_status='approved').first()
+    ad = load_approved_ad(product_id)
     if not ad:
         flash('Piblisite pa jwenn.', 'error')
         return redirect(url_for('achte'))
@@ -762,14 +969,14 @@ def view_cart():
         flash('Itilizatè pa jwenn.', 'error')
         return redirect(url_for('achte'))
 
-    cart_items = CartItem.query.filter_by(user_id=user.id).all()
+    cart_items = get_cart_items(user.id)
     cart_data = []
     total_price = 0
     all_shipping_set = True
     all_negotiated = True
 
     for item in cart_items:
-        ad = Ad.query.filter_by(ad_id=item.product_id).first()
+        ad = item.ad
         if ad:
             subtotal = ad.price_gkach * item.quantity
             total_price += subtotal
@@ -812,7 +1019,7 @@ def set_shipping():
 
     # Notify buyer
     user = User.query.filter_by(id=cart_item.user_id).first()
-    ad = Ad.query.filter_by(ad_id=cart_item.product_id).first()
+    ad = get_ad(cart_item.product_id)
     if user and ad:
         from src.notifications import notify_buyer_shipping_set
         notify_buyer_shipping_set(user.whatsapp, ad.title, shipping_fee)
@@ -836,7 +1043,7 @@ def checkout():
         flash('Itilizatè pa jwenn.', 'error')
         return redirect(url_for('achte'))
 
-    cart_items = CartItem.query.filter_by(user_id=user.id).all()
+    cart_items = get_cart_items(user.id)
     if not cart_items:
         flash('Panier ou vid.', 'error')
         return redirect(url_for('achte'))
@@ -849,29 +1056,21 @@ def checkout():
         if item.negotiation_status != 'seller_updated':
             flash('Ou dwe fini negosyasyon ak vandè a anvan ou ka peye.', 'error')
             return redirect(url_for('view_cart', whatsapp=whatsapp))
+        if item.ad and item.ad.admin_status != 'approved':
+            flash(f"Piblisite '{item.ad.title}' pa disponib ankò. Retire l nan panier ou.", 'error')
+            return redirect(url_for('view_cart', whatsapp=whatsapp))
 
-    # Calculate total
+    # Create deliveries and the postings paying each seller
     total_gkach = 0
-    for item in cart_items:
-        ad = Ad.query.filter_by(ad_id=item.product_id).first()
-        if ad:
-            total_gkach += ad.price_gkach * item.quantity + item.shipping_fee
-
-    # Check balance
-    user_gkach = UserGkach.query.filter_by(user_whatsapp=whatsapp).first()
-    if not user_gkach or user_gkach.gkach_balance < total_gkach:
-        flash('Ou pa gen ase Gkach.', 'error')
-        return redirect(url_for('achte_gkach'))
-
-    # Deduct balance
-    user_gkach.gkach_balance -= total_gkach
-    db.session.commit()
-
-    # Create deliveries
+    postings = []
     delivery_ids = []
     for item in cart_items:
-        ad = Ad.query.filter_by(ad_id=item.product_id).first()
+        ad = item.ad
         if ad:
+            amount = int(round(ad.price_gkach * item.quantity + item.shipping_fee))
+            total_gkach += amount
+            postings.append((ad.user_whatsapp, amount))
+
             delivery_id = str(uuid.uuid4())
             delivery = Delivery(
                 delivery_id=delivery_id,
@@ -890,16 +1089,25 @@ def checkout():
             )
             db.session.add(delivery)
             delivery_ids.append(delivery_id)
+    postings.append((whatsapp, -total_gkach))
+
+    # Clear exactly the items we are paying for; if another request already
+    # checked them out, fewer rows go and the whole purchase is rolled back
+    cleared = CartItem.query.filter(
+        CartItem.id.in_([item.id for item in cart_items])
+    ).delete(synchronize_session=False)
+    if cleared != len(cart_items):
+        db.session.rollback()
+        flash('Panier ou vid.', 'error')
+        return redirect(url_for('achte'))
 
-            # Credit seller
-            seller_gkach = UserGkach.query.filter_by(user_whatsapp=ad.user_whatsapp).first()
-            if seller_gkach:
-                seller_gkach.gkach_balance += ad.price_gkach * item.quantity + item.shipping_fee
-
-    db.session.commit()
-
-    # Clear cart
-    CartItem.query.filter_by(user_id=user.id).delete()
+    # Debit the buyer and credit the sellers in the same transaction
+    try:
+        transfer(postings, 'checkout')
+    except InsufficientGkach:
+        db.session.rollback()
+        flash('Ou pa gen ase Gkach.', 'error')
+        return redirect(url_for('achte_gkach'))
     db.session.commit()
 
     # Notify buyer
@@ -934,18 +1142,7 @@ def cart_success_page():
         total_cart_price += delivery.total_price
 
     # Get cart items for display
-    cart_items = []
-    for delivery in deliveries:
-        if delivery.cart_items:
-            items = json.loads(delivery.cart_items)
-            for item in items:
-                ad = Ad.query.filter_by(ad_id=item['ad_id']).first()
-                if ad:
-                    cart_items.append({
-                        'ad': ad,
-                        'quantity': item['quantity'],
-                        'subtotal': item['price'] * item['quantity']
-                    })
+    cart_items = hydrate_delivery_items(deliveries)
 
     return render_template('cart_success.html', deliveries=deliveries, seller_deliveries=seller_deliveries, cart_items=cart_items, total_cart_price=total_cart_price)
 
@@ -966,7 +1163,7 @@ def check_balance(ad_id):
         flash('Erè nan sesyon. Eseye ankò.', 'error')
         return redirect(url_for('achte'))
 
-    ad = Ad.query.filter_by(ad_id=ad_id, admin_status='approved').first()
+    ad = load_approved_ad(ad_id)
     if not ad:
         flash('Piblisite pa jwenn.', 'error')
         return redirect(url_for('achte'))
@@ -981,7 +1178,7 @@ def check_balance(ad_id):
 
 @app.route('/shopping_cart/<ad_id>', methods=['GET', 'POST'])
 def shopping_cart(ad_id):
-    ad = Ad.query.filter_by(ad_id=ad_id, admin_status='approved').first()
+    ad = load_approved_ad(ad_id)
     if not ad:
         flash('Piblisite pa jwenn.', 'error')
         return redirect(url_for('achte'))
@@ -1086,15 +1283,14 @@ def achte_gkach():
 
         # Add request to pending WITHOUT document (will be uploaded in next step)
         request_id = str(uuid.uuid4())
-        requests = json.loads(user_gkach.gkach_requests or '[]')
-        requests.append({
-            'request_id': request_id,
-            'amount': amount,
-            'status': 'pending',
-            'document': None,  # No document yet
-            'requested_at': datetime.now().isoformat()
-        })
-        user_gkach.gkach_requests = json.dumps(requests)
+        db.session.add(GkachRequest(
+            request_id=request_id,
+            user_whatsapp=user_whatsapp,
+            amount=amount,
+            status='pending',
+            document=None,  # No document yet
+            requested_at=datetime.utcnow()
+        ))
         db.session.commit()
 
         # Send WhatsApp notification to admin
@@ -1119,7 +1315,8 @@ def buy_ad(ad_id):
         flash('Erè nan sesyon. Eseye ankò.', 'error')
         return redirect(url_for('achte'))
 
-    ad = Ad.query.filter_by(ad_id=ad_id, admin_status='approved').first()
+    # Read and locked in the transaction that moves the Gkach: a cached snapshot may be stale
+    ad = load_approved_ad(ad_id, lock=True)
     if not ad:
         flash('Piblisite pa jwenn.', 'error')
         return redirect(url_for('achte'))
@@ -1127,23 +1324,24 @@ def buy_ad(ad_id):
     # Total price includes ad price + delivery cost
     total_price = delivery.total_price + delivery.delivery_cost
 
-    user_gkach = UserGkach.query.filter_by(user_whatsapp=delivery.buyer_whatsapp).first()
-    if not user_gkach or user_gkach.gkach_balance < total_price:
+    # Complete the delivery only once, even if the form is submitted twice
+    completed = Delivery.query.filter(
+        Delivery.delivery_id == delivery_id,
+        Delivery.status != 'completed'
+    ).update({'status': 'completed'}, synchronize_session=False)
+    if not completed:
+        session.pop('delivery_id', None)
+        flash('Acha sa a deja fèt.', 'info')
+        return redirect(url_for('achte'))
+
+    # Move the Gkach from buyer to seller in the same transaction
+    try:
+        transfer([(delivery.buyer_whatsapp, -total_price), (delivery.seller_whatsapp, total_price)],
+                 'buy_ad', reference=delivery_id)
+    except InsufficientGkach:
+        db.session.rollback()
         flash('Ou pa gen ase Gkach pou achte piblisite sa a. Ou bezwen achte Gkach.', 'error')
         return redirect(url_for('achte_gkach'))
-
-    # Deduct balance from buyer
-    user_gkach.gkach_balance -= total_price
-
-    # Credit balance to seller
-    seller_gkach = UserGkach.query.filter_by(user_whatsapp=delivery.seller_whatsapp).first()
-    if seller_gkach:
-        seller_gkach.gkach_balance += total_price
-
-    db.session.commit()
-
-    # Update delivery status to 'completed'
-    delivery.status = 'completed'
     db.session.commit()
 
     # Clear session
@@ -1176,6 +1374,7 @@ def manage_gkach():
             else:
                 gkach_rate.rate_per_gkach = rate
             db.session.commit()
+            invalidate_gkach_rate(currency)
             flash(f'Taux pou {currency} mete ajou a {rate}.', 'success')
             return redirect(url_for('manage_gkach'))
 
@@ -1187,48 +1386,63 @@ def manage_gkach():
             flash('Itilizatè pa jwenn.', 'error')
             return redirect(url_for('manage_gkach'))
 
-        if action == 'add_balance':
-            user_gkach.gkach_balance += amount
-            notify_admin_balance_change(user_whatsapp, f"Added {amount}", amount)
-            flash(f'{amount} Gkach ajoute nan balans {user_whatsapp}.', 'success')
-        elif action == 'edit_balance':
-            user_gkach.gkach_balance = amount
-            flash(f'Balans Gkach modifye a {amount} pou {user_whatsapp}.', 'success')
-        elif action == 'delete_user':
-            db.session.delete(user_gkach)
-            flash(f'Itilizatè {user_whatsapp} efase avèk siksè.', 'success')
-            db.session.commit()
-            return redirect(url_for('manage_gkach'))
-        elif action == 'approve_request':
-            request_id = request.form.get('request_id')
-            requests = json.loads(user_gkach.gkach_requests or '[]')
-            for req in requests:
-                if req.get('request_id') == request_id and req['status'] == 'pending' and req.get('document'):
-                    req['status'] = 'approved'
-                    user_gkach.gkach_balance += req['amount']
-                    notify_admin_request_approved(user_whatsapp, req['amount'], req['request_id'])
-                    notify_user_gkach_request_approved(user_whatsapp, req['amount'])
+        try:
+            if action == 'add_balance':
+                transfer([(MINT_ACCOUNT, -amount), (user_whatsapp, amount)], 'admin_add')
+                notify_admin_balance_change(user_whatsapp, f"Added {amount}", amount)
+                flash(f'{amount} Gkach ajoute nan balans {user_whatsapp}.', 'success')
+            elif action == 'edit_balance':
+                delta = amount - (user_gkach.gkach_balance or 0)
+                transfer([(MINT_ACCOUNT, -delta), (user_whatsapp, delta)], 'admin_edit')
+                flash(f'Balans Gkach modifye a {amount} pou {user_whatsapp}.', 'success')
+            elif action == 'delete_user':
+                # Return whatever is left to the mint so the ledger stays balanced
+                if user_gkach.gkach_balance:
+                    transfer([(user_whatsapp, -user_gkach.gkach_balance), (MINT_ACCOUNT, user_gkach.gkach_balance)],
+                             'account_deleted')
+                db.session.delete(user_gkach)
+                flash(f'Itilizatè {user_whatsapp} efase avèk siksè.', 'success')
+                db.session.commit()
+                return redirect(url_for('manage_gkach'))
+            elif action == 'approve_request':
+                request_id = request.form.get('request_id')
+                gkach_request = GkachRequest.query.filter_by(request_id=request_id, user_whatsapp=user_whatsapp).first()
+                # Conditional update so a double submit cannot credit the same request twice
+                approved = GkachRequest.query.filter(
+                    GkachRequest.request_id == request_id,
+                    GkachRequest.user_whatsapp == user_whatsapp,
+                    GkachRequest.status == 'pending',
+                    GkachRequest.document.isnot(None)
+                ).update({'status': 'approved', 'processed_at': datetime.utcnow()}, synchronize_session=False)
+                if approved:
+                    transfer([(MINT_ACCOUNT, -gkach_request.amount), (user_whatsapp, gkach_request.amount)],
+                             'gkach_request', reference=request_id)
+                    notify_admin_request_approved(user_whatsapp, gkach_request.amount, request_id)
+                    notify_user_gkach_request_approved(user_whatsapp, gkach_request.amount)
                     flash(f'Demann Gkach apwouve pou {user_whatsapp}.', 'success')
-                    break
-            user_gkach.gkach_requests = json.dumps(requests)
-        elif action == 'reject_request':
-            request_id = request.form.get('request_id')
-            requests = json.loads(user_gkach.gkach_requests or '[]')
-            for req in requests:
-                if req.get('request_id') == request_id and req['status'] == 'pending':
-                    req['status'] = 'rejected'
-                    notify_admin_request_rejected(user_whatsapp, req['amount'], req['request_id'])
-                    notify_user_gkach_request_rejected(user_whatsapp, req['amount'])
+            elif action == 'reject_request':
+                request_id = request.form.get('request_id')
+                gkach_request = GkachRequest.query.filter_by(request_id=request_id, user_whatsapp=user_whatsapp).first()
+                rejected = GkachRequest.query.filter_by(
+                    request_id=request_id, user_whatsapp=user_whatsapp, status='pending'
+                ).update({'status': 'rejected', 'processed_at': datetime.utcnow()}, synchronize_session=False)
+                if rejected:
+                    notify_admin_request_rejected(user_whatsapp, gkach_request.amount, request_id)
+                    notify_user_gkach_request_rejected(user_whatsapp, gkach_request.amount)
                     flash(f'Demann Gkach rejte pou {user_whatsapp}.', 'info')
-                    break
-            user_gkach.gkach_requests = json.dumps(requests)
+        except InsufficientGkach:
+            # The balance went down (e.g. a purchase) while the admin was editing it
+            db.session.rollback()
+            flash(f'Balans {user_whatsapp} chanje pandan modifikasyon an. Eseye ankò.', 'error')
+            return redirect(url_for('manage_gkach'))
 
         db.session.commit()
         return redirect(url_for('manage_gkach'))
 
-    # GET: show all users with gkach
+    # GET: show all users with gkach and the pending request queue
     users_gkach = UserGkach.query.all()
-    return render_template('admin_manage_gkach.html', users_gkach=users_gkach)
+    pending_requests = get_pending_requests(page=request.args.get('requests_page', 1, type=int))
+    return render_template('admin_manage_gkach.html', users_gkach=users_gkach, pending_requests=pending_requests)
 
 @app.route('/api/batch/<batch_id>/share', methods=['POST'])
 def share_batch(batch_id):
@@ -1254,9 +1468,7 @@ def share_batch(batch_id):
 def get_gkach_rate():
     try:
         # Get the current rate, default to HTG if available, else USD, else default 50
-        rate = GkachRate.query.filter_by(currency='HTG').first()
-        if not rate:
-            rate = GkachRate.query.filter_by(currency='USD').first()
+        rate = get_rate('HTG') or get_rate('USD')
         if rate:
             return jsonify({'rate': rate.rate_per_gkach, 'currency': rate.currency})
         else:
@@ -1275,34 +1487,32 @@ def delete_ad(ad_id):
             flash('Piblisite pa jwenn.', 'error')
             return redirect(url_for('admin'))
 
-        batch_id = ad.batch_id
+        batch_id = get_ad_batch_id(ad_id)
         if batch_id:
             # Remove from batch and replace with next approved ad
             batch = Batch.query.filter_by(batch_id=batch_id).first()
-            ad_ids = batch.ads.split(',')
-            ad_ids.remove(ad_id)
+            ad_ids = [member_id for member_id in batch.ad_ids if member_id != ad_id]
 
             # Find next approved ad not in any batch
-            next_ad = Ad.query.filter_by(admin_status='approved', batch_id=None).first()
+            next_ad = unbatched_ads().first()
 
             if next_ad:
                 ad_ids.append(next_ad.ad_id)
-                # Update batch ads
-                batch.ads = ','.join(ad_ids)
-                # Update new ad's batch_id
-                next_ad.batch_id = batch_id
-            else:
-                # No replacement, check if batch still has 5 ads
-                if len(ad_ids) < 5:
-                    # Delete the batch
-                    Ad.query.filter_by(batch_id=batch_id).update({'batch_id': None})
-                    db.session.delete(batch)
-                    flash('Gwoup la efase paske li pa gen ase piblisite apwouve.', 'info')
-                    batch_id = None  # Prevent further processing
+            # Update batch ads
+            set_batch_ads(batch, ad_ids)
+            if not next_ad and len(ad_ids) < 5:
+                # No replacement and fewer than 5 ads left: delete the batch
+                db.session.delete(batch)
+                flash('Gwoup la efase paske li pa gen ase piblisite apwouve.', 'info')
+                batch_id = None  # Prevent further processing
 
         # Delete the ad
+        remove_ad_text(ad_id, commit=False)
         db.session.delete(ad)
+        bump_content_version()
         db.session.commit()
+        invalidate_ad(ad_id)
+        remove_ad_from_index(ad_id)
         flash('Piblisite a efase avèk siksè!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -1315,10 +1525,10 @@ def delete_batch(batch_id):
     if 'admin' not in session:
         return redirect(url_for('admin_login'))
     try:
-        Ad.query.filter_by(batch_id=batch_id).update({'batch_id': None})
         batch = Batch.query.filter_by(batch_id=batch_id).first()
         if batch:
-            db.session.delete(batch)
+            db.session.delete(batch)  # Its batch_ads rows go with it
+        bump_content_version()
         db.session.commit()
 
         flash('Gwoup la efase avèk siksè!', 'success')
@@ -1338,11 +1548,10 @@ def edit_batch(batch_id):
         flash('Gwoup pa jwenn.', 'error')
         return redirect(url_for('admin'))
 
-    ad_ids = batch.ads.split(',')
-    batch_ads = Ad.query.filter(Ad.ad_id.in_(ad_ids)).all()
+    batch_ads = get_batch_ads(batch_id)
 
     # Get approved ads not in any batch
-    available_ads = Ad.query.filter_by(admin_status='approved', batch_id=None).all()
+    available_ads = load_ad_media(unbatched_ads().all())
 
     return render_template('admin_edit_batch.html', batch=batch, batch_ads=batch_ads, available_ads=available_ads)
 
@@ -1352,33 +1561,20 @@ def add_ad_to_batch(batch_id, ad_id):
         return redirect(url_for('admin_login'))
 
     batch = Batch.query.filter_by(batch_id=batch_id).first()
-    ad = Ad.query.filter_by(ad_id=ad_id, admin_status='approved', batch_id=None).first()
+    ad = unbatched_ads().filter(Ad.ad_id == ad_id).first()
 
     if not batch or not ad:
         flash('Gwoup oubyen piblisite pa jwenn.', 'error')
         return redirect(url_for('edit_batch', batch_id=batch_id))
 
     # Add ad to batch
-    ad_ids = batch.ads.split(',')
-    ad_ids.append(ad_id)
-    batch.ads = ','.join(ad_ids)
-    ad.batch_id = batch_id
+    set_batch_ads(batch, batch.ad_ids + [ad_id])
 
     # Update Open Graph data
-    og_data = {
-        'title': 'Glory2yahPub Ad Batch',
-        'description': 'Check out these amazing ads from Glory2yahPub!',
-        'url': url_for('view_batch', batch_id=batch_id, _external=True),
-        'images': []
-    }
-    for ad_id in ad_ids:
-        ad = Ad.query.filter_by(ad_id=ad_id).first()
-        if ad:
-            first_image = ad.images.split(',')[0]
-            image_url = url_for('static', filename='uploads/' + first_image, _external=True)
-            og_data['images'].append(image_url)
-    batch.open_graph_data = json.dumps(og_data)
+    db.session.flush()
+    batch.open_graph_data = batch_open_graph_data(batch_id, get_batch_ads(batch_id))
 
+    bump_content_version()
     db.session.commit()
 
     flash('Piblisite ajoute nan gwoup avèk siksè!', 'success')
@@ -1390,40 +1586,28 @@ def remove_ad_from_batch(batch_id, ad_id):
         return redirect(url_for('admin_login'))
 
     batch = Batch.query.filter_by(batch_id=batch_id).first()
-    ad = Ad.query.filter_by(ad_id=ad_id, batch_id=batch_id).first()
 
-    if not batch or not ad:
+    if not batch or ad_id not in batch.ad_ids:
         flash('Gwoup oubyen piblisite pa jwenn.', 'error')
         return redirect(url_for('edit_batch', batch_id=batch_id))
 
     # Remove ad from batch
-    ad_ids = batch.ads.split(',')
-    ad_ids.remove(ad_id)
-    batch.ads = ','.join(ad_ids)
-    ad.batch_id = None
+    ad_ids = [member_id for member_id in batch.ad_ids if member_id != ad_id]
+    set_batch_ads(batch, ad_ids)
 
     # Update Open Graph data
     if ad_ids:
-        og_data = {
-            'title': 'Glory2yahPub Ad Batch',
-            'description': 'Check out these amazing ads from Glory2yahPub!',
-            'url': url_for('view_batch', batch_id=batch_id, _external=True),
-            'images': []
-        }
-        for ad_id in ad_ids:
-            ad = Ad.query.filter_by(ad_id=ad_id).first()
-            if ad:
-                first_image = ad.images.split(',')[0]
-                image_url = url_for('static', filename='uploads/' + first_image, _external=True)
-                og_data['images'].append(image_url)
-        batch.open_graph_data = json.dumps(og_data)
+        db.session.flush()
+        batch.open_graph_data = batch_open_graph_data(batch_id, get_batch_ads(batch_id))
     else:
         # If no ads left, delete the batch
         db.session.delete(batch)
+        bump_content_version()
         db.session.commit()
         flash('Gwoup la efase paske li pa gen ase piblisite.', 'info')
         return redirect(url_for('admin'))
 
+    bump_content_version()
     db.session.commit()
 
     flash('Piblisite retire nan gwoup avèk siksè!', 'success')
@@ -1436,7 +1620,7 @@ def set_delivery(delivery_id):
         flash('Demann livrezon pa jwenn.', 'error')
         return redirect(url_for('index'))
 
-    ad = Ad.query.filter_by(ad_id=delivery.ad_id).first()
+    ad = get_ad(delivery.ad_id)
     if not ad:
         flash('Piblisite pa jwenn.', 'error')
         return redirect(url_for('index'))
@@ -1479,7 +1663,7 @@ def delivery_price_update(delivery_id):
         flash('Demann livrezon pa jwenn.', 'error')
         return redirect(url_for('index'))
 
-    ad = Ad.query.filter_by(ad_id=delivery.ad_id).first()
+    ad = get_ad(delivery.ad_id)
     if not ad:
         flash('Piblisite pa jwenn.', 'error')
         return redirect(url_for('index'))
@@ -1494,16 +1678,103 @@ def delivery_price_update(delivery_id):
 # Communication API routes
 @app.route('/api/delivery/<delivery_id>/messages', methods=['GET'])
 def get_delivery_messages(delivery_id):
+    """
+    Messages of a delivery, oldest first.
+
+    ?after_id=<id> only returns the messages after the last one the client has;
+    with ?wait=<seconds> as well, the request is held until one arrives (long poll,
+    for clients without EventSource). When this worker already holds
+    MESSAGE_MAX_WAITING requests, it answers at once with a Retry-After instead.
+    """
+    user_whatsapp = request.args.get('whatsapp')
+    if not user_whatsapp:
+        return jsonify({'error': 'WhatsApp number required'}), 400
+
+    after_id = request.args.get('after_id', type=int)
+    wait = min(max(request.args.get('wait', 0, type=float), 0), app.config['MESSAGE_LONG_POLL_MAX_SECONDS'])
+
+    try:
+        participants = get_participants_or_raise(delivery_id, user_whatsapp)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 403
+
+    held = bool(wait) and after_id is not None and message_bus.hold_waiter()
+    if not held:
+        messages = get_messages(delivery_id, user_whatsapp, after_id=after_id, participants=participants)
+    else:
+        try:
+            # Subscribed before reading, so a message sent in between still wakes us
+            with message_bus.subscribe(delivery_id) as subscription:
+                deadline = time.monotonic() + wait
+                while True:
+                    messages = get_messages(delivery_id, user_whatsapp, after_id=after_id, participants=participants)
+                    remaining = deadline - time.monotonic()
+                    if messages or remaining <= 0:
+                        break
+                    db.session.close()  # Give the connection back while waiting
+                    subscription.wait(remaining)
+        finally:
+            message_bus.release_waiter()
+
+    last_id = messages[-1]['id'] if messages else after_id
+    response = jsonify({'messages': messages, 'last_id': last_id})
+    if wait and not held and not messages:
+        response.headers['Retry-After'] = str(app.config['MESSAGE_RETRY_AFTER'])
+    return response
+
+@app.route('/api/delivery/<delivery_id>/messages/stream', methods=['GET'])
+def stream_delivery_messages(delivery_id):
+    """
+    Server-sent events stream of a delivery's new messages.
+
+    Sends the messages after ?after_id= (or the Last-Event-ID of a reconnecting
+    EventSource), then each new one as it is sent. The stream ends after
+    MESSAGE_STREAM_MAX_SECONDS so a worker thread is never held for good; the
+    browser reconnects by itself from the last event ID. When this worker
+    already holds MESSAGE_MAX_WAITING streams and long polls, it answers 503
+    with a Retry-After, and the client falls back to polling.
+    """
     user_whatsapp = request.args.get('whatsapp')
     if not user_whatsapp:
         return jsonify({'error': 'WhatsApp number required'}), 400
 
+    after_id = request.headers.get('Last-Event-ID', type=int) or request.args.get('after_id', type=int)
     try:
-        messages = get_messages(delivery_id, user_whatsapp)
-        return jsonify({'messages': messages})
+        participants = get_participants_or_raise(delivery_id, user_whatsapp)
     except ValueError as e:
         return jsonify({'error': str(e)}), 403
 
+    if not message_bus.hold_waiter():
+        response = jsonify({'error': 'Too many open message streams, poll instead'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(app.config['MESSAGE_RETRY_AFTER'])
+        return response
+
+    keepalive = app.config['MESSAGE_KEEPALIVE_SECONDS']
+    deadline = time.monotonic() + app.config['MESSAGE_STREAM_MAX_SECONDS']
+
+    def events(last_id):
+        yield 'retry: 3000\n\n'
+        # Subscribed before the first read, so a message sent in between still wakes us
+        with message_bus.subscribe(delivery_id) as subscription:
+            while True:
+                messages = get_messages(delivery_id, user_whatsapp, after_id=last_id, participants=participants)
+                db.session.close()  # No connection held between events
+                for message in messages:
+                    last_id = message['id']
+                    yield f"id: {last_id}\nevent: message\ndata: {json.dumps(message)}\n\n"
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not subscription.wait(min(keepalive, remaining)):
+                    yield ': keepalive\n\n'
+
+    response = Response(stream_with_context(events(after_id)), mimetype='text/event-stream')
+    response.call_on_close(message_bus.release_waiter)  # Also when the client goes away mid-stream
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Proxies must not buffer the stream
+    return response
+
 @app.route('/api/delivery/<delivery_id>/send_message', methods=['POST'])
 def send_delivery_message(delivery_id):
     data = request.get_json()
@@ -1548,7 +1819,7 @@ def shopping_card_update():
         flash('Itilizatè pa jwenn.', 'error')
         return redirect(url_for('achte'))
 
-    cart_items = CartItem.query.filter_by(user_id=user.id).all()
+    cart_items = get_cart_items(user.id)
     if not cart_items:
         flash('Pa gen atik nan panier ou.', 'error')
         return redirect(url_for('achte'))
@@ -1582,7 +1853,7 @@ def shopping_card_update():
             seller_whatsapp = None
             
             for item in cart_items:
-                ad = Ad.query.filter_by(ad_id=item.product_id).first()
+                ad = item.ad
                 if ad:
                     if not seller_whatsapp:
                         seller_whatsapp = ad.user_whatsapp
@@ -1652,7 +1923,7 @@ def shopping_card_update():
     delivery_address = cart_items[0].delivery_address if cart_items and cart_items[0].delivery_address else ''
 
     for item in cart_items:
-        ad = Ad.query.filter_by(ad_id=item.product_id).first()
+        ad = item.ad
         if ad:
             subtotal = ad.price_gkach * item.quantity
             total_price += subtotal
@@ -1689,20 +1960,16 @@ def publish_ad_to_facebook(ad_id):
             flash('Ou ka sèlman pibliye piblisite ki apwouve.', 'error')
             return redirect(url_for('admin'))
         
-        # Publish to Facebook
+        # Queue for the publishing worker; the result is recorded per ad
         app_url = request.url_root.rstrip('/')
-        success, message, post_id = facebook_publisher.publish_ad_to_facebook(ad, app_url)
-        
-        if success:
-            flash(f'✅ {message}', 'success')
-            # Store Facebook post ID in database (would need to add column to Ad model)
-            # ad.facebook_post_id = post_id
-            # db.session.commit()
+        if enqueue_publish([ad], app_url):
+            flash('✅ Piblisite a nan ke pou Facebook. Rezilta a ap parèt nan paj rezilta yo.', 'success')
         else:
-            flash(f'❌ {message}', 'error')
+            flash('Piblisite sa a deja nan ke pou Facebook.', 'info')
             
     except Exception as e:
-        logger.error(f"Error publishing ad to Facebook: {str(e)}")
+        db.session.rollback()
+        logger.error(f"Error queueing ad for Facebook: {str(e)}")
         flash('Erè sistèm nan pibliyasyon Facebook.', 'error')
     
     return redirect(url_for('admin'))
@@ -1719,35 +1986,28 @@ def publish_batch_to_facebook(batch_id):
             return redirect(url_for('admin'))
         
         # Get ads in batch
-        ad_ids = batch.ads.split(',')
-        ads = Ad.query.filter(
-            Ad.ad_id.in_(ad_ids),
-            Ad.admin_status == 'approved'
-        ).all()
+        ads = get_batch_ads(batch_id, approved_only=True)
         
         if not ads:
             flash('Pa gen piblisite apwouve nan gwoup sa a.', 'error')
             return redirect(url_for('admin'))
         
-        # Publish batch to Facebook
+        # Queue the batch; the worker publishes the ads and records each result
         app_url = request.url_root.rstrip('/')
-        results = facebook_publisher.publish_batch_to_facebook(ads, app_url)
+        posts = enqueue_publish(ads, app_url, batch_id=batch_id)
         
-        # Show results
-        success_count = len(results['successful'])
-        fail_count = len(results['failed'])
+        if posts:
+            flash(f'✅ {len(posts)} piblisite nan ke pou Facebook.', 'success')
         
-        if success_count > 0:
-            flash(f'✅ {success_count} piblisite pibliye avèk siksè!', 'success')
+        skipped = len(ads) - len(posts)
+        if skipped > 0:
+            flash(f'{skipped} piblisite te deja nan ke.', 'info')
         
-        if fail_count > 0:
-            flash(f'❌ {fail_count} piblisite pa t kapab pibliye.', 'error')
-            
-        # Store results in session for detailed view
-        session['facebook_batch_results'] = results
+        return redirect(url_for('show_facebook_batch_results', batch_id=batch_id))
         
     except Exception as e:
-        logger.error(f"Error publishing batch to Facebook: {str(e)}")
+        db.session.rollback()
+        logger.error(f"Error queueing batch for Facebook: {str(e)}")
         flash('Erè sistèm nan pibliyasyon batch Facebook.', 'error')
     
     return redirect(url_for('admin'))
@@ -1771,8 +2031,29 @@ def show_facebook_batch_results():
     if 'admin' not in session:
         return redirect(url_for('admin_login'))
     
-    results = session.get('facebook_batch_results', {})
-    return render_template('facebook_batch_results.html', results=results)
+    batch_id = request.args.get('batch_id')
+    results = get_publish_results(batch_id=batch_id)
+    return render_template('facebook_batch_results.html', results=results, batch_id=batch_id)
+
+@app.route('/admin/facebook/posts/<int:post_id>/resolve', methods=['POST'])
+def resolve_facebook_post(post_id):
+    """The admin checked the page for an unconfirmed post: mark it published, or publish it again."""
+    if 'admin' not in session:
+        return redirect(url_for('admin_login'))
+
+    found = request.form.get('found') == '1'
+    post = resolve_unconfirmed(post_id, found, request.url_root.rstrip('/'),
+                               facebook_post_id=request.form.get('facebook_post_id', '').strip() or None)
+    if post is None:
+        flash('Post sa a pa bezwen verifikasyon.', 'info')
+        return redirect(url_for('show_facebook_batch_results'))
+    if found:
+        flash('✅ Post la make kòm pibliye.', 'success')
+    elif post.status == 'queued':
+        flash('Piblisite a nan ke pou Facebook ankò.', 'success')
+    else:
+        flash(post.error, 'error')
+    return redirect(url_for('show_facebook_batch_results', batch_id=post.batch_id))
 
 # NEW DELIVERY-BASED ROUTES
 @app.route('/seller_update_delivery/<delivery_id>', methods=['GET', 'POST'])
@@ -1806,7 +2087,7 @@ def seller_update_delivery(delivery_id):
         total_price = delivery.total_price + delivery_cost
         buyer_confirm_url = url_for('buyer_confirm_delivery', delivery_id=delivery_id, _external=True)
         
-        cart_items_list = json.loads(delivery.cart_items) if delivery.cart_items else []
+        cart_items_list = parse_delivery_items(delivery)
         ad_titles = [item['title'] for item in cart_items_list]
         ad_titles_str = ", ".join(ad_titles[:3])
         if len(ad_titles) > 3:
@@ -1820,18 +2101,7 @@ def seller_update_delivery(delivery_id):
         return redirect(whatsapp_url)
 
     # GET: Display delivery for seller to set shipping price
-    cart_items_list = json.loads(delivery.cart_items) if delivery.cart_items else []
-    cart_data = []
-    
-    for item_data in cart_items_list:
-        ad = Ad.query.filter_by(ad_id=item_data['ad_id']).first()
-        if ad:
-            cart_data.append({
-                'ad': ad,
-                'quantity': item_data['quantity'],
-                'price': item_data['price'],
-                'subtotal': item_data['price'] * item_data['quantity']
-            })
+    cart_data = hydrate_delivery_items(delivery)
 
     # Get messages for this delivery
     try:
@@ -1860,23 +2130,26 @@ def buyer_confirm_delivery(delivery_id):
         action = request.form.get('action')
         
         if action == 'confirm':
-            # Check balance
             total_price = delivery.total_price + delivery.delivery_cost
-            user_gkach = UserGkach.query.filter_by(user_whatsapp=delivery.buyer_whatsapp).first()
-            
-            if not user_gkach or user_gkach.gkach_balance < total_price:
+
+            # Move to awaiting_delivery only once, even on a double submit
+            confirmed = Delivery.query.filter_by(delivery_id=delivery_id, status='price_set').update(
+                {'status': 'awaiting_delivery', 'confirmed_at': datetime.utcnow()}, synchronize_session=False)
+            if not confirmed:
+                flash('Livrezon sa a pa prè pou konfime.', 'info')
+                return redirect(url_for('achte'))
+
+            # Hold the buyer's Gkach in escrow until delivery is confirmed
+            try:
+                transfer([(delivery.buyer_whatsapp, -total_price), (ESCROW_ACCOUNT, total_price)],
+                         'delivery_escrow', reference=delivery_id)
+            except InsufficientGkach:
+                db.session.rollback()
                 # Store delivery_id in session to return after getting Gkach
                 session['pending_delivery_id'] = delivery_id
                 session['return_to'] = 'buyer_confirm_delivery'
                 flash('Ou pa gen ase Gkach. Achte Gkach epi retounen pou kontinye peye.', 'error')
                 return redirect(url_for('achte_gkach'))
-
-            # Deduct from buyer (but don't credit seller yet - wait for delivery confirmation)
-            user_gkach.gkach_balance -= total_price
-            
-            # Update delivery status to awaiting_delivery (not confirmed yet)
-            delivery.status = 'awaiting_delivery'
-            delivery.confirmed_at = datetime.utcnow()
             db.session.commit()
 
             # Notify seller that purchase is confirmed and they should deliver
@@ -1913,18 +2186,7 @@ def buyer_confirm_delivery(delivery_id):
             return redirect(url_for('achte'))
 
     # GET: Display delivery for buyer to confirm/decline
-    cart_items_list = json.loads(delivery.cart_items) if delivery.cart_items else []
-    cart_data = []
-    
-    for item_data in cart_items_list:
-        ad = Ad.query.filter_by(ad_id=item_data['ad_id']).first()
-        if ad:
-            cart_data.append({
-                'ad': ad,
-                'quantity': item_data['quantity'],
-                'price': item_data['price'],
-                'subtotal': item_data['price'] * item_data['quantity']
-            })
+    cart_data = hydrate_delivery_items(delivery)
 
     total_price = delivery.total_price + delivery.delivery_cost
 
@@ -1955,44 +2217,21 @@ def confirm_delivery_received(delivery_id):
         # Buyer confirms delivery was received
         total_price = delivery.total_price + delivery.delivery_cost
         
-        # Credit seller with Gkach
-        seller_gkach = UserGkach.query.filter_by(user_whatsapp=delivery.seller_whatsapp).first()
-        if seller_gkach:
-            seller_gkach.gkach_balance += total_price
-        else:
-            # Create seller gkach account if doesn't exist
-            seller_gkach = UserGkach(user_whatsapp=delivery.seller_whatsapp, gkach_balance=total_price)
-            db.session.add(seller_gkach)
-        
-        # Update delivery status to completed
-        delivery.status = 'completed'
-        delivery.delivered_at = datetime.utcnow()
+        # Complete the delivery only once, even on a double submit
+        completed = Delivery.query.filter_by(delivery_id=delivery_id, status='awaiting_delivery').update(
+            {'status': 'completed', 'delivered_at': datetime.utcnow()}, synchronize_session='fetch')
+        if not completed:
+            flash('Livrezon sa a pa nan estati ki pèmèt konfime resepsyon.', 'info')
+            return redirect(url_for('achte'))
+
+        # Release the escrowed Gkach to the seller (creates their account if needed)
+        transfer([(ESCROW_ACCOUNT, -total_price), (delivery.seller_whatsapp, total_price)],
+                 'delivery_release', reference=delivery_id)
         db.session.commit()
 
-        # Generate PDF receipt
-        from utils import generate_pdf_receipt
-        cart_items_list = json.loads(delivery.cart_items) if delivery.cart_items else []
-        
-        try:
-            pdf_path = generate_pdf_receipt(
-                delivery_id=delivery.delivery_id,
-                buyer_whatsapp=delivery.buyer_whatsapp,
-                seller_whatsapp=delivery.seller_whatsapp,
-                cart_items_data=cart_items_list,
-                total_product_price=delivery.total_price,
-                total_shipping=delivery.delivery_cost,
-                grand_total=total_price,
-                transaction_date=delivery.delivered_at
-            )
-            
-            # Get the PDF filename for WhatsApp sharing
-            pdf_filename = os.path.basename(pdf_path)
-            pdf_url = url_for('static', filename=f'uploads/{pdf_filename}', _external=True)
-            
-            logger.info(f"PDF receipt generated: {pdf_path}")
-        except Exception as e:
-            logger.error(f"Error generating PDF receipt: {str(e)}")
-            pdf_url = None
+        # The receipt is rendered by the media worker; the signed link works as soon as it is
+        queue_receipt(delivery_id)
+        pdf_url = receipt_url(delivery_id, _external=True)
 
         # Notify seller that delivery is confirmed and payment is released
         notify_seller_delivery_confirmed(delivery.seller_whatsapp, delivery.buyer_whatsapp, delivery_id, total_price)
@@ -2017,18 +2256,7 @@ def confirm_delivery_received(delivery_id):
         return redirect(url_for('achte'))
 
     # GET: Display delivery confirmation page
-    cart_items_list = json.loads(delivery.cart_items) if delivery.cart_items else []
-    cart_data = []
-    
-    for item_data in cart_items_list:
-        ad = Ad.query.filter_by(ad_id=item_data['ad_id']).first()
-        if ad:
-            cart_data.append({
-                'ad': ad,
-                'quantity': item_data['quantity'],
-                'price': item_data['price'],
-                'subtotal': item_data['price'] * item_data['quantity']
-            })
+    cart_data = hydrate_delivery_items(delivery)
 
     total_price = delivery.total_price + delivery.delivery_cost
 
@@ -2037,6 +2265,31 @@ def confirm_delivery_received(delivery_id):
                          cart_items=cart_data,
                          total_price=total_price)
 
+@app.route('/receipts/<delivery_id>')
+def get_receipt(delivery_id):
+    if 'admin' not in session and not check_receipt_token(delivery_id, request.args.get('token')):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 403
+    delivery = db.session.get(Delivery, delivery_id)
+    if not delivery or delivery.status != 'completed':
+        return jsonify({'success': False, 'error': 'Receipt not found'}), 404
+
+    path = get_receipt_path(delivery)
+    if not path:
+        # Not rendered yet (or lost with the disk): make sure it is queued and ask the browser to come back
+        queue_receipt(delivery_id)
+        response = make_response(
+            '<!doctype html><meta charset="utf-8"><meta http-equiv="refresh" content="3">'
+            '<title>Resi</title><p>Resi a ap prepare, tanpri tann kèk segonn...</p>', 202)
+        response.headers['Retry-After'] = '3'
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    response = send_file(os.path.abspath(path), mimetype='application/pdf', download_name=f'resi_{delivery_id}.pdf',
+                         etag=os.path.splitext(os.path.basename(path))[0], conditional=True, max_age=3600)
+    # Names and amounts: keep it out of shared caches
+    response.headers['Cache-Control'] = 'private, max-age=3600'
+    return response
+
 @app.route('/seller_update_cart/<buyer_whatsapp>', methods=['GET', 'POST'])
 def seller_update_cart(buyer_whatsapp):
     # Format WhatsApp number using utility function
@@ -2051,7 +2304,7 @@ def seller_update_cart(buyer_whatsapp):
         flash('Achte pa jwenn.', 'error')
         return redirect(url_for('achte'))
 
-    cart_items = CartItem.query.filter_by(user_id=user.id).all()
+    cart_items = get_cart_items(user.id)
     if not cart_items:
         flash('Pa gen atik nan panier achete a.', 'error')
         return redirect(url_for('achte'))
@@ -2072,20 +2325,20 @@ def seller_update_cart(buyer_whatsapp):
                 flash(f'Pri livrezon valab obligatwa pou atik {item.id}.', 'error')
                 return redirect(request.url)
 
-        db.session.commit()
-
-        # Calculate totals for notification
+        # Calculate totals for notification (before commit expires the loaded items)
         total_product_price = 0
         total_shipping = 0
         ad_titles = []
         
         for item in cart_items:
-            ad = Ad.query.filter_by(ad_id=item.product_id).first()
+            ad = item.ad
             if ad:
                 total_product_price += ad.price_gkach * item.quantity
                 total_shipping += item.shipping_fee
                 ad_titles.append(ad.title)
 
+        db.session.commit()
+
         # Send WhatsApp notification to buyer with updated prices (same format as seller notification)
         ad_titles_str = ", ".join(ad_titles[:3])
         if len(ad_titles) > 3:
@@ -2107,7 +2360,7 @@ def seller_update_cart(buyer_whatsapp):
     current_shipping_total = 0
 
     for item in cart_items:
-        ad = Ad.query.filter_by(ad_id=item.product_id).first()
+        ad = item.ad
         if ad:
             subtotal = ad.price_gkach * item.quantity
             total_product_price += subtotal
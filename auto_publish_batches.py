@@ -1,116 +1,148 @@
 #!/usr/bin/env python3
 """
 Auto-publish approved batches to Facebook
-This script automatically publishes all approved batches to the specified Facebook page.
+This script publishes the batches that are not on the Facebook page yet.
+
+Publishing state is kept in the database (facebook_posts per ad, facebook_*
+columns per batch), so every run only picks up new work:
+- batches already published are not looked at again
+- ads already published, with their batch or on their own, are skipped
+- an ad that failed is retried on its next run, without re-uploading the
+  album photos that did get through, until it failed --max-attempts times
+- an ad whose post Facebook may have created without confirming it (timeout,
+  5xx, crash while posting) is never retried; the admin checks the page
+  from the results page first
+
+The ads are queued as 'publish_facebook' media jobs and published by
+--concurrency threads of this process (a web worker's media thread may pick
+some of them up too). Every uploaded photo and published post is committed
+as it happens, so if a run crashes the next one resumes where it stopped.
+
+Usage:
+    python auto_publish_batches.py                     # publish new batches
+    python auto_publish_batches.py --concurrency 4     # four ads at a time
+    python auto_publish_batches.py --mark-existing     # once: record the batches
+                                                       # earlier runs already posted
 """
 
+import argparse
 import os
 import sys
-from datetime import datetime
+import threading
 
 # Add current directory to path to import app modules
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from flask import Flask
-from models import db, Batch, Ad
+from app import app
+from models import db, FacebookPost
 from src.facebook_publisher import facebook_publisher
+from src.facebook_queue import (ACTIVE_STATUSES, batches_to_publish, finish_published_batches, queue_unpublished_batches,
+                                mark_batches_published, refresh_batch_state)
+from src.media_jobs import requeue_stale_jobs, run_pending_jobs
 import logging
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def auto_publish_approved_batches():
-    """Automatically publish all approved batches to Facebook."""
+def _run_publish_jobs(concurrency):
+    """Run the queued publishing jobs with `concurrency` threads; returns the number of jobs run."""
+    counts = []
 
-    # Initialize Flask app context
-    app = Flask(__name__)
-    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL') or 'sqlite:///glory2yahpub.db'
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    def work():
+        with app.app_context():
+            counts.append(run_pending_jobs(kinds=['publish_facebook']))
 
-    with app.app_context():
-        db.init_app(app)
-
-        try:
-            # Get all approved batches that haven't been published yet
-            approved_batches = Batch.query.filter(
-                Batch.ads.isnot(None),
-                Batch.ads != ''
-            ).all()
-
-            if not approved_batches:
-                logger.info("No approved batches found to publish.")
-                return
-
-            logger.info(f"Found {len(approved_batches)} approved batches to publish.")
-
-            # Validate Facebook credentials
-            success, message = facebook_publisher.validate_credentials()
-            if not success:
-                logger.error(f"Facebook credentials validation failed: {message}")
-                return
-
-            logger.info("Facebook credentials validated successfully.")
-
-            # Get app URL for links
-            app_url = os.environ.get('APP_URL', 'https://glory2yahpub.onrender.com')
-
-            total_published = 0
-            total_failed = 0
-
-            for batch in approved_batches:
-                try:
-                    logger.info(f"Processing batch {batch.batch_id}...")
-
-                    # Get ads in this batch
-                    ad_ids = batch.ads.split(',')
-                    ads = Ad.query.filter(
-                        Ad.ad_id.in_(ad_ids),
-                        Ad.admin_status == 'approved'
-                    ).all()
-
-                    if not ads:
-                        logger.warning(f"No approved ads found in batch {batch.batch_id}")
-                        continue
+    threads = [threading.Thread(target=work, name=f'facebook-publish-{i}') for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts)
 
-                    logger.info(f"Publishing {len(ads)} ads from batch {batch.batch_id}")
+def auto_publish_approved_batches(concurrency=2, max_attempts=3, limit=None):
+    """
+    Publish the batches not published yet.
 
-                    # Publish batch to Facebook
-                    results = facebook_publisher.publish_batch_to_facebook(ads, app_url)
+    :param concurrency: Ads published at once
+    :param max_attempts: Give up on an ad after this many failed attempts
+    :param limit: At most this many batches per run, oldest first
+    :return: Dict with the 'published' and 'failed' FacebookPosts of this run, or None if it could not start
+    """
+    app_url = os.environ.get('APP_URL', 'https://glory2yahpub.onrender.com')
 
-                    successful = len(results['successful'])
-                    failed = len(results['failed'])
-
-                    total_published += successful
-                    total_failed += failed
-
-                    if successful > 0:
-                        logger.info(f"✅ Successfully published {successful} ads from batch {batch.batch_id}")
-                        for result in results['successful']:
-                            logger.info(f"  - {result['title']} (Post ID: {result['post_id']})")
-
-                    if failed > 0:
-                        logger.error(f"❌ Failed to publish {failed} ads from batch {batch.batch_id}")
-                        for result in results['failed']:
-                            logger.error(f"  - {result['title']}: {result['error']}")
-
-                except Exception as e:
-                    logger.error(f"Error processing batch {batch.batch_id}: {str(e)}")
-                    total_failed += 1
-
-            logger.info("Auto-publish completed!")
-            logger.info(f"Total ads published: {total_published}")
-            logger.info(f"Total ads failed: {total_failed}")
+    with app.app_context():
+        # Jobs of a run that crashed mid-publish go back in the queue
+        requeue_stale_jobs()
+        finish_published_batches()
+
+        if (not batches_to_publish(max_attempts).first()
+                and not FacebookPost.query.filter(FacebookPost.status.in_(ACTIVE_STATUSES)).first()):
+            logger.info("No unpublished batches to publish.")
+            return {'published': [], 'failed': []}
+
+        # Validate Facebook credentials
+        success, message = facebook_publisher.validate_credentials()
+        if not success:
+            logger.error(f"Facebook credentials validation failed: {message}")
+            return None
+        logger.info("Facebook credentials validated successfully.")
+
+        queued = queue_unpublished_batches(app_url, max_attempts=max_attempts, limit=limit)
+        logger.info(f"Queued {len(queued)} ad(s) from {len({post.batch_id for post in queued})} batch(es).")
+
+        # This run's work: the ads just queued and those left over by a run that crashed
+        active = FacebookPost.query.filter(FacebookPost.status.in_(ACTIVE_STATUSES)).all()
+        post_ids = [post.id for post in active]
+        batch_ids = {post.batch_id for post in active if post.batch_id}
+
+    if post_ids:
+        # One pooled connection per concurrent upload
+        facebook_publisher.pool_maxsize = concurrency * facebook_publisher.upload_concurrency
+        jobs = _run_publish_jobs(max(1, concurrency))
+        logger.info(f"Ran {jobs} publishing job(s).")
 
-            if total_published > 0:
-                logger.info("✅ Auto-publish completed successfully!")
+    with app.app_context():
+        # The job threads update their batch concurrently; settle the final state once here
+        for batch_id in batch_ids:
+            status = refresh_batch_state(batch_id)
+            logger.info(f"Batch {batch_id}: {status}")
+        db.session.commit()
+
+        posts = FacebookPost.query.filter(FacebookPost.id.in_(post_ids)).all() if post_ids else []
+        results = {'published': [post for post in posts if post.status == 'published'],
+                   'failed': [post for post in posts if post.status != 'published']}
+
+        logger.info(f"Total ads published: {len(results['published'])}")
+        logger.info(f"Total ads failed: {len(results['failed'])}")
+        for post in results['failed']:
+            if post.status == 'unconfirmed':
+                logger.warning(f"  - ad {post.ad_id}: check the Facebook page, {post.error}")
             else:
-                logger.warning("⚠️ No ads were published. Check Facebook credentials and batch status.")
-
-        except Exception as e:
-            logger.error(f"Critical error during auto-publish: {str(e)}")
+                logger.error(f"  - ad {post.ad_id} (attempt {post.attempts}/{max_attempts}): {post.error}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Publish new batches to Facebook')
+    parser.add_argument('--concurrency', type=int, default=int(os.environ.get('FACEBOOK_PUBLISH_CONCURRENCY', 2)),
+                        help='Ads published at once (default 2)')
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help='Stop retrying an ad after this many failures (default 3)')
+    parser.add_argument('--limit', type=int, help='At most this many batches, oldest first')
+    parser.add_argument('--mark-existing', action='store_true',
+                        help='Record every unpublished batch as published without posting, then exit')
+    args = parser.parse_args()
+
+    if args.mark_existing:
+        with app.app_context():
+            count = mark_batches_published()
+        logger.info(f"Marked {count} batch(es) as published.")
+        return 0
 
-if __name__ == "__main__":
     logger.info("Starting auto-publish of approved batches to Facebook...")
-    auto_publish_approved_batches()
+    results = auto_publish_approved_batches(args.concurrency, args.max_attempts, args.limit)
     logger.info("Auto-publish script finished.")
+    return 0 if results is not None else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""
+Benchmark: ORB brute-force image search vs. global-vector top-k search
+
+Compares recall and per-query latency of the original threshold=0.7 ORB
+path against the vector path (matrix multiply top-k, ORB re-rank of the
+candidates) for catalogs of 1k, 10k and 100k images.
+
+Features for a pool of synthetic images are computed for real; larger
+catalogs are filled with jittered copies of the pool's vectors and
+descriptors. The ORB path is timed on at most --orb-cap images and
+extrapolated linearly above that (it is O(N) by construction).
+
+Usage: python benchmark_image_search.py [--sizes 1000,10000,100000]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from image_search import extract_features, compute_global_vector, top_k_candidates, orb_similarity
+
+
+def make_image(rng, path):
+    """Draw a random scene of coloured shapes."""
+    img = np.full((256, 256, 3), rng.integers(0, 255, 3), dtype=np.uint8)
+    for _ in range(12):
+        colour = tuple(int(c) for c in rng.integers(0, 255, 3))
+        x, y = (int(v) for v in rng.integers(0, 256, 2))
+        if rng.random() < 0.5:
+            cv2.circle(img, (x, y), int(rng.integers(8, 60)), colour, -1)
+        else:
+            cv2.rectangle(img, (x, y), (x + int(rng.integers(10, 80)), y + int(rng.integers(10, 80))), colour, -1)
+    cv2.imwrite(path, img)
+    return img
+
+
+def perturb(rng, img, path):
+    """Simulate a buyer re-uploading a saved ad photo: brightness shift, light noise, JPEG re-encode."""
+    noisy = img.astype(np.int16) + rng.integers(-3, 3, img.shape) + 6
+    ok, jpeg = cv2.imencode('.jpg', np.clip(noisy, 0, 255).astype(np.uint8), [cv2.IMWRITE_JPEG_QUALITY, 85])
+    with open(path, 'wb') as f:
+        f.write(jpeg.tobytes())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--pool', type=int, default=1000, help='distinct images with real features')
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--orb-cap', type=int, default=1000)
+    parser.add_argument('--candidates', type=int, default=50)
+    parser.add_argument('--threshold', type=float, default=0.7)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    workdir = tempfile.mkdtemp(prefix='image_search_bench_')
+
+    print(f"Building pool of {args.pool} images in {workdir} ...")
+    pool_descriptors, pool_vectors, queries = [], [], []
+    for i in range(args.pool):
+        path = os.path.join(workdir, f"{i}.png")
+        img = make_image(rng, path)
+        descriptors = extract_features(path)
+        if descriptors is None:
+            descriptors = np.zeros((1, 32), dtype=np.uint8)
+        pool_descriptors.append(descriptors)
+        pool_vectors.append(compute_global_vector(path))
+        if i < args.queries:
+            query_path = os.path.join(workdir, f"query_{i}.jpg")
+            perturb(rng, img, query_path)
+            queries.append((i, extract_features(query_path), compute_global_vector(query_path)))
+    pool_vectors = np.stack(pool_vectors).astype(np.float32)
+
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+
+    print()
+    print(f"{'images':>8} | {'orb recall':>10} | {'orb ms/query':>14} | {'top-k recall':>12} | {'vec recall':>10} | {'vec ms/query':>12}")
+    print('-' * 83)
+    for size in [int(s) for s in args.sizes.split(',')]:
+        # Catalog rows beyond the pool are jittered copies acting as distractors
+        reps = int(np.ceil(size / args.pool))
+        matrix = np.tile(pool_vectors, (reps, 1))[:size]
+        matrix[args.pool:] += rng.normal(0, 0.05, matrix[args.pool:].shape).astype(np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = np.ascontiguousarray(matrix)
+        row_ids = list(range(size))
+
+        def descriptors_for(row):
+            return pool_descriptors[row % args.pool]
+
+        orb_hits, orb_time = 0, 0.0
+        vec_hits, vec_time, candidate_hits = 0, 0.0, 0
+        timed_rows = min(size, args.orb_cap)
+        for true_row, query_features, query_vector in queries:
+            if query_features is None:
+                continue
+
+            start = time.perf_counter()
+            found = [row for row in range(timed_rows)
+                     if orb_similarity(matcher, query_features, descriptors_for(row)) >= args.threshold]
+            orb_time += (time.perf_counter() - start) * size / timed_rows
+            orb_hits += true_row in found
+
+            start = time.perf_counter()
+            candidates = top_k_candidates(matrix, row_ids, query_vector, args.candidates)
+            found = [row for row in candidates
+                     if orb_similarity(matcher, query_features, descriptors_for(row)) >= args.threshold]
+            vec_time += time.perf_counter() - start
+            vec_hits += true_row in found
+            candidate_hits += true_row in candidates
+
+        n = len(queries)
+        orb_label = f"{orb_time / n * 1000:.1f}" + ('*' if timed_rows < size else '')
+        print(f"{size:>8} | {orb_hits / n:>10.2f} | {orb_label:>14} | {candidate_hits / n:>12.2f} | {vec_hits / n:>10.2f} | {vec_time / n * 1000:>12.2f}")
+
+    print()
+    print(f"* extrapolated from {args.orb_cap} images")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark: page weight of the index and catalog pages before/after srcset
+
+Seeds a throwaway database with ads using the real photos in static/uploads,
+renders / (latest batch) and /achte, and adds up the HTML plus the image bytes
+a browser would download:
+
+- before: the original upload behind every card (what the templates served)
+- after:  the variant a browser picks from the <picture> srcset/sizes for the
+          given viewport (WebP source first), fetched through /media so
+          legacy images are generated on demand exactly as in production
+
+Usage: python benchmark_page_weight.py [--ads 24] [--viewports 360x2,1280x1]
+"""
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+SAMPLE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+_work_dir = tempfile.mkdtemp(prefix='glory2yahpub_weight_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_work_dir, 'bench.db')
+os.environ['UPLOAD_FOLDER'] = os.path.join(_work_dir, 'uploads')
+os.environ['IMAGE_INDEX_FOLDER'] = os.path.join(_work_dir, 'image_index')
+os.environ['MEDIA_WORKER'] = 'off'
+os.makedirs(os.environ['UPLOAD_FOLDER'], exist_ok=True)
+
+PICTURE_RE = re.compile(r'<picture>(.*?)</picture>', re.S)
+SOURCE_RE = re.compile(r'<source type="image/webp" srcset="([^"]+)" sizes="([^"]+)"')
+SIZE_RE = re.compile(r'\(max-width:\s*(\d+)px\)\s*(\d+)(vw|px)')
+
+
+def slot_width(sizes, viewport):
+    """Evaluate a sizes attribute of the form '(max-width: Npx) Xvw, Ypx' for a viewport width."""
+    for condition in sizes.split(','):
+        condition = condition.strip()
+        match = SIZE_RE.match(condition)
+        if match:
+            if viewport <= int(match.group(1)):
+                value, unit = int(match.group(2)), match.group(3)
+                return viewport * value / 100 if unit == 'vw' else value
+            continue
+        value = condition.rstrip('pxvw')
+        return viewport * int(value) / 100 if condition.endswith('vw') else int(value)
+    return viewport
+
+
+def pick_candidate(srcset, sizes, viewport, dpr):
+    """The srcset candidate a browser picks: the smallest width covering slot * DPR."""
+    candidates = []
+    for entry in srcset.split(','):
+        url, width = entry.strip().rsplit(' ', 1)
+        candidates.append((int(width.rstrip('w')), url.replace('&amp;', '&')))
+    candidates.sort()
+    needed = slot_width(sizes, viewport) * dpr
+    for width, url in candidates:
+        if width >= needed:
+            return url
+    return candidates[-1][1]
+
+
+def seed(app, db, count):
+    import uuid
+    from models import Ad, Batch
+    from src.ad_media import set_ad_images
+    from src.batches import set_batch_ads
+
+    samples = sorted(name for name in os.listdir(SAMPLE_FOLDER) if name.lower().endswith(IMAGE_EXTENSIONS))
+    if not samples:
+        sys.exit(f"No sample images in {SAMPLE_FOLDER}")
+
+    with app.app_context():
+        ad_ids = []
+        for i in range(count):
+            name = samples[i % len(samples)]
+            copy_name = f"{i:03d}_{name}"
+            shutil.copy(os.path.join(SAMPLE_FOLDER, name), os.path.join(app.config['UPLOAD_FOLDER'], copy_name))
+            ad = Ad(ad_id=str(uuid.uuid4()), user_whatsapp='+50900000000',
+                    description='Benchmark', title=f'Atik {i}', admin_status='approved', price_gkach=100)
+            set_ad_images(ad, [copy_name])
+            db.session.add(ad)
+            ad_ids.append(ad.ad_id)
+        db.session.flush()  # batch_ads rows reference the ads
+        batch = Batch(batch_id=str(uuid.uuid4()))
+        set_batch_ads(batch, ad_ids)
+        db.session.add(batch)
+        db.session.commit()
+
+
+def measure(client, app, path, viewport, dpr):
+    html = client.get(path).get_data(as_text=True)
+    before = after = 0
+    for picture in PICTURE_RE.findall(html):
+        srcset, sizes = SOURCE_RE.search(picture).groups()
+        url = pick_candidate(srcset, sizes, viewport, dpr)
+        filename = url.rsplit('/', 1)[-1]
+        before += os.path.getsize(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        response = client.get(url)
+        after += len(response.get_data())
+    return len(html.encode()), before, after
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ads', type=int, default=24, help='Ads on each page')
+    parser.add_argument('--viewports', default='360x2,1280x1', help='Comma-separated WIDTHxDPR list')
+    args = parser.parse_args()
+
+    from app import app, db
+    seed(app, db, args.ads)
+    client = app.test_client()
+
+    print(f"{'page':<8} {'viewport':<10} {'html':>8} {'images before':>15} {'images after':>14} {'total saved':>12}")
+    for path in ('/', '/achte'):
+        for viewport in args.viewports.split(','):
+            width, dpr = viewport.split('x')
+            html, before, after = measure(client, app, path, int(width), float(dpr))
+            saved = 1 - (html + after) / (html + before)
+            print(f"{path:<8} {viewport:<10} {html / 1024:>7.0f}K {before / 1024:>14.0f}K {after / 1024:>13.0f}K {saved:>11.0%}")
+
+    shutil.rmtree(_work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
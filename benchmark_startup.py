@@ -0,0 +1,93 @@
+"""
+Benchmark: cost of `import app` (gunicorn --preload boot and worker RSS)
+
+Imports the app in a fresh interpreter under `python -X importtime` against a
+throwaway database and reports wall-clock time, peak RSS, the slowest imports
+and which heavy dependencies got loaded. --eager additionally imports the
+heavy modules up front, which is what the app used to do at module load.
+
+Usage: python benchmark_startup.py [--runs 5] [--top 15] [--eager]
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ('moviepy.editor', 'cv2', 'numpy', 'imageio', 'reportlab', 'PIL.Image', 'requests')
+
+CHILD = """
+import json, resource, sys, time
+eager = {eager!r}
+start = time.perf_counter()
+for name in eager:
+    __import__(name)
+import app
+elapsed = time.perf_counter() - start
+# ru_maxrss of a forked child starts at the parent's peak; VmHWM is reset by exec
+try:
+    with open('/proc/self/status') as f:
+        rss_kb = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+except (OSError, StopIteration):
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{
+    'seconds': elapsed,
+    'rss_mb': rss_kb / 1024,
+    'heavy': [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+IMPORTTIME_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def measure_import(eager=(), importtime=False):
+    """
+    Import the app in a fresh interpreter.
+
+    :return: (stats dict from the child, list of (cumulative_us, module) when importtime)
+    """
+    work_dir = tempfile.mkdtemp(prefix='glory2yahpub_startup_')
+    env = dict(os.environ,
+               DATABASE_URL='sqlite:///' + os.path.join(work_dir, 'startup.db'),
+               UPLOAD_FOLDER=os.path.join(work_dir, 'uploads'),
+               IMAGE_INDEX_FOLDER=os.path.join(work_dir, 'image_index'),
+               MEDIA_WORKER='off')
+    os.makedirs(env['UPLOAD_FOLDER'], exist_ok=True)
+    cmd = [sys.executable] + (['-X', 'importtime'] if importtime else []) + \
+          ['-c', CHILD.format(eager=tuple(eager), heavy=HEAVY_MODULES)]
+    result = subprocess.run(cmd, capture_output=True, text=True, env=env,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    stats = json.loads(result.stdout.strip().splitlines()[-1])
+    modules = [(int(m.group(2)), m.group(4)) for m in IMPORTTIME_RE.finditer(result.stderr)]
+    return stats, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--eager', action='store_true', help='Also measure with heavy modules imported up front')
+    args = parser.parse_args()
+
+    variants = [('lazy', ())]
+    if args.eager:
+        variants.append(('eager', ('moviepy.editor', 'cv2', 'numpy', 'imageio', 'PIL.Image', 'requests')))
+
+    for label, eager in variants:
+        runs = [measure_import(eager)[0] for _ in range(args.runs)]
+        seconds = statistics.median(run['seconds'] for run in runs)
+        rss = statistics.median(run['rss_mb'] for run in runs)
+        print(f"{label:<6} import app: {seconds * 1000:7.0f} ms (median of {args.runs}), peak RSS {rss:6.1f} MB, "
+              f"heavy modules loaded: {', '.join(runs[0]['heavy']) or 'none'}")
+
+    _, modules = measure_import(importtime=True)
+    print(f"\nSlowest imports (cumulative, lazy):")
+    for cumulative, module in sorted(modules, reverse=True)[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {module}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""
+Pytest configuration for Glory2yahPub
+
+Points the app at a throwaway SQLite database and upload folder before
+app.py is imported, so running the suite never touches the real
+glory2yahpub.db files committed in the repo.
+"""
+import os
+import tempfile
+
+_test_dir = tempfile.mkdtemp(prefix='glory2yahpub_test_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_test_dir, 'test.db')
+os.environ['UPLOAD_FOLDER'] = os.path.join(_test_dir, 'uploads')
+os.makedirs(os.environ['UPLOAD_FOLDER'], exist_ok=True)
+os.environ['IMAGE_INDEX_FOLDER'] = os.path.join(_test_dir, 'image_index')
+# An empty, already built index; a missing one is rebuilt by a media job
+os.makedirs(os.environ['IMAGE_INDEX_FOLDER'], exist_ok=True)
+# Media jobs are run explicitly by the tests, inline rather than in a process pool
+os.environ['MEDIA_WORKER'] = 'off'
+os.environ['MEDIA_PROCESS_WORKERS'] = '0'
+# Metrics go to a throwaway sink and are flushed explicitly, without the tick thread
+os.environ['METRICS_DB'] = os.path.join(_test_dir, 'metrics.db')
+os.environ['METRICS_FLUSH_INTERVAL'] = '0'
+# The shared cache backend, when a test turns it on, lives here too
+os.environ['CACHE_DB'] = os.path.join(_test_dir, 'cache.db')
+os.environ['RECEIPTS_FOLDER'] = os.path.join(_test_dir, 'receipts')
@@ -1,11 +1,34 @@
-import cv2
-import numpy as np
-from PIL import Image
 import os
+import shutil
+import threading
+import uuid
+from stat import S_ISDIR
 import logging
 
+# cv2 and numpy are only imported by the first search or indexing call
+from src.lazy_imports import cv2, np
+
 logger = logging.getLogger(__name__)
 
+# In-memory view of the on-disk descriptor index, shared by every request in the worker.
+# Maps ad_id -> list of ORB descriptor arrays (one per image, memory-mapped from disk).
+_index_cache = {}
+_index_mtime = None
+_index_lock = threading.Lock()
+
+# Version of each ad folder loaded into the caches, (inode, mtime): an ad is
+# reloaded when files are added to or removed from its folder, or the folder
+# is recreated (rebuild_index in another worker).
+_ad_versions = {}
+
+# Global image vectors of every indexed image stacked into one contiguous matrix,
+# with _vector_ad_ids[i] giving the ad that owns row i.
+_vector_cache = {}
+_vector_matrix = None
+_vector_ad_ids = []
+
+VECTOR_SUFFIX = '.vec.npy'
+
 def extract_features(image_path):
     """Extract features from an image using ORB."""
     try:
@@ -19,49 +42,359 @@ def extract_features(image_path):
         logger.error(f"Error extracting features from {image_path}: {e}")
         return None
 
-def find_similar_ads(query_image_path, threshold=0.7):
-    """Find ads similar to the query image."""
+def compute_global_vector(image_path):
+    """
+    Turn an image into a fixed-length, L2-normalised global vector.
+
+    The vector concatenates a 64-bit difference hash (as +/-1), an 8x4
+    hue/saturation colour histogram and a 16-bin edge orientation histogram,
+    so that a single dot product gives a cheap similarity between two images.
+    """
+    try:
+        img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        if img is None:
+            return None
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+        small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+        dhash = (small[:, 1:] > small[:, :-1]).flatten().astype(np.float32) * 2 - 1
+
+        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+        colour = cv2.calcHist([hsv], [0, 1], None, [8, 4], [0, 180, 0, 256]).flatten()
+
+        gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0)
+        gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1)
+        magnitude, angle = cv2.cartToPolar(gx, gy)
+        edges = np.histogram(angle, bins=16, range=(0, 2 * np.pi), weights=magnitude)[0]
+
+        parts = []
+        for part in (dhash, colour, edges):
+            part = np.asarray(part, dtype=np.float32)
+            norm = np.linalg.norm(part)
+            parts.append(part / norm if norm > 0 else part)
+        vector = np.concatenate(parts)
+        return vector / np.linalg.norm(vector)
+    except Exception as e:
+        logger.error(f"Error computing global vector for {image_path}: {e}")
+        return None
+
+def top_k_candidates(matrix, row_ad_ids, query_vector, k):
+    """
+    Vectorised top-k search over the stacked image vectors.
+
+    :return: Up to k distinct ad IDs, most similar first
+    """
+    if matrix is None or matrix.shape[0] == 0:
+        return []
+    scores = matrix @ query_vector
+    # Over-fetch rows since several rows can belong to the same ad
+    rows = min(len(scores), k * 3)
+    top = np.argpartition(-scores, rows - 1)[:rows]
+    top = top[np.argsort(-scores[top])]
+
+    ad_ids = []
+    for row in top:
+        ad_id = row_ad_ids[row]
+        if ad_id not in ad_ids:
+            ad_ids.append(ad_id)
+            if len(ad_ids) == k:
+                break
+    return ad_ids
+
+def get_index_folder():
+    """Get the folder holding the persistent ORB descriptor index."""
+    from flask import current_app
+    return current_app.config['IMAGE_INDEX_FOLDER']
+
+def _ad_image_paths(ad):
+    """
+    Images of an ad that can be indexed, as (name, full path) pairs: the
+    uploaded images, or the poster frame of a transcoded video.
+    """
+    from flask import current_app
+
+    if ad.media_type == 'video':
+        if not ad.video:
+            return []
+        from src.video_processing import rendition_name
+        poster = rendition_name(ad.video, 'poster')
+        full_path = os.path.join(current_app.config['MEDIA_VARIANTS_FOLDER'], poster)
+        return [(poster, full_path)] if os.path.exists(full_path) else []
+
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    paths = []
+    for img_path in ad.image_filenames:
+        full_path = os.path.join(upload_folder, img_path)
+        if os.path.exists(full_path):
+            paths.append((img_path, full_path))
+    return paths
+
+def _save_array(path, array):
+    """Write a .npy file atomically, so a worker loading the index never maps a partial file."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+def index_ad(ad, index_folder=None):
+    """
+    Extract and store ORB descriptors and the global vector for every image of
+    an approved ad (the poster frame for video ads).
+
+    Descriptors are written once per image as <index>/<ad_id>/<filename>.npy
+    (and the vector as <filename>.vec.npy) so that searches never have to
+    re-read or re-process the catalog images.
+
+    :param ad: The Ad object
+    :param index_folder: Index to write to; the live one by default
+    :return: Number of images indexed
+    """
+    image_paths = _ad_image_paths(ad)
+    if not image_paths:
+        return 0
+
+    if index_folder is None:
+        index_folder = get_index_folder()
+        if not os.path.isdir(index_folder):
+            # Not built yet on this disk: the rebuild job indexes this ad with all the others
+            queue_rebuild_index()
+            return 0
+    ad_folder = os.path.join(index_folder, ad.ad_id)
+    os.makedirs(ad_folder, exist_ok=True)
+
+    indexed = 0
+    for img_path, full_path in image_paths:
+        descriptors_path = os.path.join(ad_folder, f"{img_path}.npy")
+        vector_path = os.path.join(ad_folder, f"{img_path}{VECTOR_SUFFIX}")
+        if not os.path.exists(vector_path):
+            vector = compute_global_vector(full_path)
+            if vector is not None:
+                _save_array(vector_path, vector)
+        if os.path.exists(descriptors_path):
+            indexed += 1
+            continue
+        descriptors = extract_features(full_path)
+        if descriptors is None:
+            continue
+        _save_array(descriptors_path, descriptors)
+        indexed += 1
+
+    # Touch the index root, once the files are in place, so other workers notice the change
+    os.utime(index_folder, None)
+    with _index_lock:
+        _index_cache.pop(ad.ad_id, None)
+        _vector_cache.pop(ad.ad_id, None)
+        _ad_versions.pop(ad.ad_id, None)
+    logger.info(f"Indexed {indexed} image(s) for ad {ad.ad_id}")
+    return indexed
+
+def remove_ad_from_index(ad_id):
+    """
+    Drop an ad's descriptors from the index (on rejection or deletion).
+
+    :param ad_id: The ad ID
+    """
+    ad_folder = os.path.join(get_index_folder(), ad_id)
+    if os.path.isdir(ad_folder):
+        shutil.rmtree(ad_folder, ignore_errors=True)
+        os.utime(get_index_folder(), None)
+        logger.info(f"Removed ad {ad_id} from image index")
+    with _index_lock:
+        _index_cache.pop(ad_id, None)
+        _vector_cache.pop(ad_id, None)
+        _ad_versions.pop(ad_id, None)
+
+def rebuild_index():
+    """
+    Build the descriptor index from scratch for all approved ads.
+
+    Slow (every catalog image is read), so it runs as a 'rebuild_image_index'
+    media job, never in a request. The index is built in a folder of its own
+    and swapped in when complete: searches meanwhile use the old index, or an
+    empty one on a fresh deployment.
+
+    :return: Number of ads indexed
+    """
+    from models import Ad
+
+    index_folder = os.path.abspath(get_index_folder())
+    build_folder = f"{index_folder}.build-{uuid.uuid4().hex}"
+    os.makedirs(build_folder)
+    try:
+        ads = Ad.query.filter_by(admin_status='approved').all()
+        count = sum(1 for ad in ads if index_ad(ad, build_folder))
+
+        # Two renames: searches that look in between see no index for an instant, never a partial one
+        old_folder = f"{index_folder}.old-{uuid.uuid4().hex}"
+        if os.path.isdir(index_folder):
+            os.rename(index_folder, old_folder)
+        os.rename(build_folder, index_folder)
+        shutil.rmtree(old_folder, ignore_errors=True)
+    finally:
+        shutil.rmtree(build_folder, ignore_errors=True)
+
+    # Ads approved while the index was building were indexed into the old folder
+    for ad in Ad.query.filter_by(admin_status='approved').all():
+        if not os.path.isdir(os.path.join(index_folder, ad.ad_id)) and index_ad(ad):
+            count += 1
+    os.utime(index_folder, None)
+    logger.info(f"Rebuilt image index: {count} ad(s)")
+    return count
+
+def queue_rebuild_index():
+    """
+    Queue a 'rebuild_image_index' media job unless one is waiting or running.
+
+    :return: True if a job was queued
+    """
+    from models import MediaJob
+    from src.media_jobs import enqueue
+
+    pending = MediaJob.query.filter(MediaJob.kind == 'rebuild_image_index',
+                                    MediaJob.status.in_(('queued', 'running'))).first()
+    if pending:
+        return False
+    enqueue('rebuild_image_index')
+    return True
+
+def _load_index():
+    """
+    Load the descriptor index lazily, reloading only when another worker changed it.
+
+    Any change touches the index root. The ads are then checked one by one and
+    only those whose folder changed since they were loaded are read again, so
+    an ad loaded while another worker was still writing its files is completed
+    on the next search.
+
+    :return: Dict mapping ad_id to a list of descriptor arrays
+    """
+    global _index_mtime, _vector_matrix, _vector_ad_ids
+
+    index_folder = get_index_folder()
+    if not os.path.isdir(index_folder):
+        # Fresh deployment (ephemeral disk): the index is built in the background,
+        # searches find nothing until then. Also seen for an instant while a rebuild swaps folders.
+        queue_rebuild_index()
+        return _index_cache
+
+    mtime = os.stat(index_folder).st_mtime_ns
+    with _index_lock:
+        if mtime == _index_mtime:
+            return _index_cache
+
+        ad_ids = set(os.listdir(index_folder))
+        for ad_id in list(_ad_versions):
+            if ad_id not in ad_ids:
+                _index_cache.pop(ad_id, None)
+                _vector_cache.pop(ad_id, None)
+                del _ad_versions[ad_id]
+
+        for ad_id in ad_ids:
+            ad_folder = os.path.join(index_folder, ad_id)
+            try:
+                # Stat before listing: a file added in between changes the version again
+                info = os.stat(ad_folder)
+                if not S_ISDIR(info.st_mode):
+                    continue
+                version = (info.st_ino, info.st_mtime_ns)
+                if _ad_versions.get(ad_id) == version:
+                    continue
+                names = sorted(os.listdir(ad_folder))
+            except OSError:
+                continue  # Removed meanwhile
+            descriptors = []
+            vectors = []
+            for name in names:
+                try:
+                    if name.endswith(VECTOR_SUFFIX):
+                        vectors.append(np.load(os.path.join(ad_folder, name)))
+                    elif name.endswith('.npy'):
+                        descriptors.append(np.load(os.path.join(ad_folder, name), mmap_mode='r'))
+                except Exception as e:
+                    logger.error(f"Error loading index file {name} for ad {ad_id}: {e}")
+            _index_cache.pop(ad_id, None)
+            _vector_cache.pop(ad_id, None)
+            if descriptors:
+                _index_cache[ad_id] = descriptors
+            if vectors:
+                _vector_cache[ad_id] = vectors
+            _ad_versions[ad_id] = version
+
+        rows = [(ad_id, vector) for ad_id, vectors in _vector_cache.items() for vector in vectors]
+        if rows:
+            _vector_matrix = np.ascontiguousarray(np.stack([vector for _, vector in rows]), dtype=np.float32)
+        else:
+            _vector_matrix = np.zeros((0, 0), dtype=np.float32)
+        _vector_ad_ids = [ad_id for ad_id, _ in rows]
+
+        _index_mtime = mtime
+        return _index_cache
+
+def orb_similarity(matcher, query_features, ad_features):
+    """Fraction of cross-checked ORB matches between two descriptor sets."""
+    matches = matcher.match(query_features, np.asarray(ad_features))
+    if not matches:
+        return 0.0
+    return len(matches) / max(len(query_features), len(ad_features))
+
+def find_similar_ads(query_image_path, threshold=0.7, mode=None, candidates=None):
+    """
+    Find ads similar to the query image.
+
+    In 'vector' mode the global vector of the query is scored against every
+    indexed image with one matrix multiply, and ORB matching only re-ranks the
+    top candidates. 'orb' mode brute-force matches against every indexed ad.
+    """
     # Import inside function to avoid circular import
     from flask import current_app
     from models import Ad
-    
+
+    mode = mode or current_app.config.get('IMAGE_SEARCH_MODE', 'vector')
+    candidates = candidates or current_app.config.get('IMAGE_SEARCH_CANDIDATES', 50)
+
     query_features = extract_features(query_image_path)
     if query_features is None:
         return []
 
     similar_ads = []
     try:
-        ads = Ad.query.filter_by(admin_status='approved').all()
-        upload_folder = current_app.config['UPLOAD_FOLDER']
-        
-        for ad in ads:
-            if ad.media_type == 'video':
-                # For videos, we could extract a frame, but for simplicity, skip or use thumbnail
-                continue
-            elif ad.media_type == 'images':
-                image_paths = ad.images.split(',') if ad.images else []
-                for img_path in image_paths:
-                    full_path = os.path.join(upload_folder, img_path.strip())
-                    if os.path.exists(full_path):
-                        ad_features = extract_features(full_path)
-                        if ad_features is not None:
-                            # Compute similarity using BFMatcher
-                            bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-                            try:
-                                matches = bf.match(query_features, ad_features)
-                                if len(matches) > 0:
-                                    # Calculate similarity score
-                                    similarity = len(matches) / max(len(query_features), len(ad_features))
-                                    if similarity >= threshold:
-                                        similar_ads.append((ad, similarity))
-                                        break  # Found a match, no need to check other images
-                            except Exception as e:
-                                logger.error(f"Error matching features: {e}")
-                                continue
+        index = _load_index()
+        bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+
+        if mode == 'vector':
+            query_vector = compute_global_vector(query_image_path)
+            if query_vector is None:
+                return []
+            with _index_lock:
+                matrix, row_ad_ids = _vector_matrix, _vector_ad_ids
+            candidate_ids = top_k_candidates(matrix, row_ad_ids, query_vector, candidates)
+        else:
+            with _index_lock:
+                candidate_ids = list(index)
+
+        for ad_id in candidate_ids:
+            for ad_features in index.get(ad_id, []):
+                try:
+                    similarity = orb_similarity(bf, query_features, ad_features)
+                    if similarity >= threshold:
+                        similar_ads.append((ad_id, similarity))
+                        break  # Found a match, no need to check other images
+                except Exception as e:
+                    logger.error(f"Error matching features: {e}")
+                    continue
+
+        if not similar_ads:
+            return []
+
+        ads = Ad.query.filter(
+            Ad.ad_id.in_([ad_id for ad_id, _ in similar_ads]),
+            Ad.admin_status == 'approved'
+        ).all()
     except Exception as e:
         logger.error(f"Error in find_similar_ads: {e}")
         return []
 
     # Sort by similarity
+    ads_by_id = {ad.ad_id: ad for ad in ads}
     similar_ads.sort(key=lambda x: x[1], reverse=True)
-    return [ad for ad, _ in similar_ads]
+    return [ads_by_id[ad_id] for ad_id, _ in similar_ads if ad_id in ads_by_id]
@@ -0,0 +1,33 @@
+"""
+Standalone media job worker.
+
+Runs the media job queue outside the web processes, e.g. as a Render
+background worker. Set MEDIA_WORKER=off on the web service when using it.
+
+Usage:
+    python media_worker.py          # run forever
+    python media_worker.py --once   # drain the queue and exit
+"""
+import argparse
+import logging
+
+from app import app
+from src.media_jobs import run_pending_jobs, requeue_stale_jobs, worker_loop
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def main():
+    parser = argparse.ArgumentParser(description='Run queued media jobs')
+    parser.add_argument('--once', action='store_true', help='Drain the queue and exit')
+    args = parser.parse_args()
+
+    if args.once:
+        with app.app_context():
+            requeue_stale_jobs()
+            count = run_pending_jobs()
+        print(f"Ran {count} media job(s)")
+    else:
+        worker_loop(app)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+from app import app
+from src.ad_media import backfill_media_details
+
+print("=" * 50)
+print("AD MEDIA MIGRATION")
+print("=" * 50)
+
+with app.app_context():
+    try:
+        measured = backfill_media_details()
+        print(f"\n  ✓ Measured {measured} ad media file(s) (dimensions, size, hash)")
+        print("\n" + "=" * 50)
+        print("MIGRATION COMPLETE")
+        print("=" * 50)
+    except Exception as e:
+        print(f"\n✗ Migration failed: {str(e)}")
@@ -0,0 +1,16 @@
+from app import app
+from src.gkach_requests import backfill_gkach_requests
+
+print("=" * 50)
+print("GKACH REQUESTS MIGRATION")
+print("=" * 50)
+
+with app.app_context():
+    try:
+        copied = backfill_gkach_requests()
+        print(f"\n  ✓ Copied {copied} request(s) from user_gkach.gkach_requests JSON")
+        print("\n" + "=" * 50)
+        print("MIGRATION COMPLETE")
+        print("=" * 50)
+    except Exception as e:
+        print(f"\n✗ Migration failed: {str(e)}")
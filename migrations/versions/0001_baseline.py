@@ -0,0 +1,243 @@
+"""baseline
+
+Schema as it stood when migrations were introduced. Databases created before
+then by db.create_all() plus the ALTER TABLE block that used to run at boot
+already have most of it, so every table is only created when missing and the
+columns that block (and migrate_database.py) added later are added when
+missing.
+
+Revision ID: 0001_baseline
+Revises:
+Create Date: 2026-10-18 08:09:05.517783
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001_baseline'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# Columns added to existing tables after their creation: (name, type, server default)
+LEGACY_COLUMNS = {
+    'ads': [
+        ('media_type', sa.String(length=10), 'images'),
+        ('video', sa.String(length=255), None),
+    ],
+    'cart_items': [
+        ('negotiation_status', sa.String(length=20), 'cart'),
+        ('cart_id', sa.String(length=36), None),
+        ('delivery_address', sa.Text(), None),
+    ],
+    'deliveries': [
+        ('delivered_at', sa.DateTime(), None),
+        ('delivery_date', sa.DateTime(), None),
+        ('delivery_date_set_at', sa.DateTime(), None),
+        ('delivery_notes', sa.Text(), None),
+    ],
+}
+
+
+def _create_table(name, *columns, indexes=()):
+    """Create a table and its indexes unless it already exists; returns True if created."""
+    if sa.inspect(op.get_bind()).has_table(name):
+        return False
+    op.create_table(name, *columns)
+    for index_name, index_columns, unique in indexes:
+        op.create_index(index_name, name, index_columns, unique=unique)
+    return True
+
+
+def _add_legacy_columns():
+    inspector = sa.inspect(op.get_bind())
+    for table, columns in LEGACY_COLUMNS.items():
+        existing = {column['name'] for column in inspector.get_columns(table)}
+        for name, type_, default in columns:
+            if name not in existing:
+                op.add_column(table, sa.Column(name, type_, nullable=True, server_default=default))
+
+
+def upgrade():
+    _create_table('ads',
+        sa.Column('ad_id', sa.String(length=36), nullable=False),
+        sa.Column('user_whatsapp', sa.String(length=20), nullable=False),
+        sa.Column('media_type', sa.String(length=10), nullable=False),
+        sa.Column('images', sa.Text(), nullable=True),
+        sa.Column('video', sa.String(length=255), nullable=True),
+        sa.Column('description', sa.Text(), nullable=False),
+        sa.Column('title', sa.String(length=100), nullable=True),
+        sa.Column('ad_type', sa.String(length=10), nullable=False),
+        sa.Column('payment_status', sa.String(length=20), nullable=True),
+        sa.Column('payment_proof', sa.String(length=255), nullable=True),
+        sa.Column('admin_status', sa.String(length=20), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('batch_id', sa.String(length=36), nullable=True),
+        sa.Column('price_gkach', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('ad_id')
+    )
+    _create_table('batches',
+        sa.Column('batch_id', sa.String(length=36), nullable=False),
+        sa.Column('ads', sa.Text(), nullable=False),
+        sa.Column('open_graph_data', sa.Text(), nullable=True),
+        sa.Column('facebook_share_url', sa.Text(), nullable=True),
+        sa.Column('share_count', sa.Integer(), nullable=True),
+        sa.Column('click_rewards', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('batch_id')
+    )
+    _create_table('gkach_ledger',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('transfer_id', sa.String(length=36), nullable=False),
+        sa.Column('account', sa.String(length=40), nullable=False),
+        sa.Column('amount', sa.Integer(), nullable=False),
+        sa.Column('balance_after', sa.Integer(), nullable=True),
+        sa.Column('kind', sa.String(length=30), nullable=False),
+        sa.Column('reference', sa.String(length=36), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        indexes=[
+            ('ix_gkach_ledger_account', ['account'], False),
+            ('ix_gkach_ledger_reference', ['reference'], False),
+            ('ix_gkach_ledger_transfer_id', ['transfer_id'], False),
+        ]
+    )
+    _create_table('gkach_rates',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('currency', sa.String(length=10), nullable=False),
+        sa.Column('rate_per_gkach', sa.Float(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('currency')
+    )
+    _create_table('gkach_requests',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('request_id', sa.String(length=36), nullable=False),
+        sa.Column('user_whatsapp', sa.String(length=20), nullable=False),
+        sa.Column('amount', sa.Integer(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('document', sa.String(length=255), nullable=True),
+        sa.Column('requested_at', sa.DateTime(), nullable=True),
+        sa.Column('processed_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        indexes=[
+            ('ix_gkach_requests_request_id', ['request_id'], True),
+            ('ix_gkach_requests_status', ['status'], False),
+            ('ix_gkach_requests_user_whatsapp', ['user_whatsapp'], False),
+        ]
+    )
+    _create_table('media_jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('job_id', sa.String(length=36), nullable=False),
+        sa.Column('kind', sa.String(length=30), nullable=False),
+        sa.Column('ad_id', sa.String(length=36), nullable=True),
+        sa.Column('payload', sa.Text(), nullable=True),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=True),
+        sa.Column('worker', sa.String(length=64), nullable=True),
+        sa.Column('result', sa.Text(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        indexes=[
+            ('ix_media_jobs_ad_id', ['ad_id'], False),
+            ('ix_media_jobs_job_id', ['job_id'], True),
+            ('ix_media_jobs_status', ['status'], False),
+        ]
+    )
+    _create_table('user_gkach',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_whatsapp', sa.String(length=20), nullable=False),
+        sa.Column('gkach_balance', sa.Integer(), nullable=True),
+        sa.Column('gkach_requests', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_whatsapp')
+    )
+    _create_table('users',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=100), nullable=True),
+        sa.Column('whatsapp', sa.String(length=20), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    _create_table('ad_search_documents',
+        sa.Column('ad_id', sa.String(length=36), nullable=False),
+        sa.Column('title', sa.Text(), nullable=False),
+        sa.Column('body', sa.Text(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['ad_id'], ['ads.ad_id'], ),
+        sa.PrimaryKeyConstraint('ad_id')
+    )
+    _create_table('ads_owner',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('ad_id', sa.String(length=36), nullable=False),
+        sa.Column('buyers_whatsapp', sa.String(length=20), nullable=True),
+        sa.Column('publishers_whatsapp', sa.String(length=20), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['ad_id'], ['ads.ad_id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    _create_table('cart_items',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('product_id', sa.String(length=36), nullable=True),
+        sa.Column('quantity', sa.Integer(), nullable=True),
+        sa.Column('shipping_fee_set', sa.Boolean(), nullable=True),
+        sa.Column('shipping_fee', sa.Float(), nullable=True),
+        sa.Column('negotiation_status', sa.String(length=20), nullable=True),
+        sa.Column('cart_id', sa.String(length=36), nullable=True),
+        sa.Column('delivery_address', sa.Text(), nullable=True),
+        sa.ForeignKeyConstraint(['product_id'], ['ads.ad_id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    _create_table('deliveries',
+        sa.Column('delivery_id', sa.String(length=36), nullable=False),
+        sa.Column('ad_id', sa.String(length=36), nullable=True),
+        sa.Column('buyer_whatsapp', sa.String(length=20), nullable=False),
+        sa.Column('seller_whatsapp', sa.String(length=20), nullable=False),
+        sa.Column('delivery_cost', sa.Integer(), nullable=True),
+        sa.Column('total_price', sa.Integer(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=True),
+        sa.Column('otp', sa.String(length=4), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('confirmed_at', sa.DateTime(), nullable=True),
+        sa.Column('delivered_at', sa.DateTime(), nullable=True),
+        sa.Column('cart_items', sa.Text(), nullable=True),
+        sa.Column('delivery_address', sa.Text(), nullable=True),
+        sa.Column('delivery_date', sa.DateTime(), nullable=True),
+        sa.Column('delivery_date_set_at', sa.DateTime(), nullable=True),
+        sa.Column('delivery_notes', sa.Text(), nullable=True),
+        sa.ForeignKeyConstraint(['ad_id'], ['ads.ad_id'], ),
+        sa.PrimaryKeyConstraint('delivery_id')
+    )
+    _create_table('messages',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('delivery_id', sa.String(length=36), nullable=False),
+        sa.Column('sender_whatsapp', sa.String(length=20), nullable=False),
+        sa.Column('message', sa.Text(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['delivery_id'], ['deliveries.delivery_id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    _add_legacy_columns()
+
+
+def downgrade():
+    op.drop_table('messages')
+    op.drop_table('deliveries')
+    op.drop_table('cart_items')
+    op.drop_table('ads_owner')
+    op.drop_table('ad_search_documents')
+    op.drop_table('users')
+    op.drop_table('user_gkach')
+    op.drop_table('media_jobs')
+    op.drop_table('gkach_requests')
+    op.drop_table('gkach_rates')
+    op.drop_table('gkach_ledger')
+    op.drop_table('batches')
+    op.drop_table('ads')
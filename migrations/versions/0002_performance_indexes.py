@@ -0,0 +1,41 @@
+"""performance indexes
+
+The ads and deliveries indexes that migrate_database_enhancements.py used to
+create by hand. Databases where that script already ran keep their indexes.
+
+Revision ID: 0002_performance_indexes
+Revises: 0001_baseline
+Create Date: 2026-10-18 08:40:12.204118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002_performance_indexes'
+down_revision = '0001_baseline'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('idx_ad_status', 'ads', ['admin_status']),
+    ('idx_ad_batch', 'ads', ['batch_id']),
+    ('idx_ad_user', 'ads', ['user_whatsapp']),
+    ('idx_ad_created', 'ads', ['created_at']),
+    ('idx_delivery_buyer', 'deliveries', ['buyer_whatsapp']),
+    ('idx_delivery_seller', 'deliveries', ['seller_whatsapp']),
+    ('idx_delivery_status', 'deliveries', ['status']),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for name, table, columns in INDEXES:
+        if name not in {index['name'] for index in inspector.get_indexes(table)}:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
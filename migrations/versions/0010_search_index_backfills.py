@@ -0,0 +1,158 @@
+"""search index and legacy data backfills
+
+Work that every boot used to check for is done once here instead: the
+full-text index structures (GIN index on PostgreSQL, FTS5 table on SQLite),
+search documents for ads that have none, Gkach requests still in the legacy
+UserGkach.gkach_requests JSON, and opening ledger postings for balances that
+predate the ledger. Each step skips what is already there, so databases the
+boot code had backfilled are left as they are.
+
+The backfills mirror src/gkach_requests.backfill_gkach_requests and
+src/ledger.backfill_opening_balances on the migration's own connection.
+The downgrade drops the index structures; backfilled rows are kept.
+
+Revision ID: 0010_search_index_backfills
+Revises: 0009_batch_ads_unique_ad
+Create Date: 2026-10-18 14:02:37.518204
+
+"""
+import json
+import uuid
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+from src.search import tokenize
+
+BATCH_SIZE = 1000
+MINT_ACCOUNT = 'system:mint'
+ESCROW_ACCOUNT = 'system:escrow'
+
+
+# revision identifiers, used by Alembic.
+revision = '0010_search_index_backfills'
+down_revision = '0009_batch_ads_unique_ad'
+branch_labels = None
+depends_on = None
+
+ads = sa.table('ads', sa.column('ad_id'), sa.column('title'), sa.column('description'))
+ad_search_documents = sa.table('ad_search_documents', sa.column('ad_id'), sa.column('title'), sa.column('body'),
+                               sa.column('updated_at'))
+user_gkach = sa.table('user_gkach', sa.column('user_whatsapp'), sa.column('gkach_balance'),
+                      sa.column('gkach_requests'), sa.column('created_at'))
+gkach_requests = sa.table('gkach_requests', sa.column('request_id'), sa.column('user_whatsapp'),
+                          sa.column('amount'), sa.column('status'), sa.column('document'), sa.column('requested_at'))
+gkach_ledger = sa.table('gkach_ledger', sa.column('transfer_id'), sa.column('account'), sa.column('amount'),
+                        sa.column('balance_after'), sa.column('kind'), sa.column('created_at'))
+deliveries = sa.table('deliveries', sa.column('total_price'), sa.column('delivery_cost'), sa.column('status'))
+
+
+def upgrade():
+    _create_search_index()
+    _backfill_search_documents()
+    _backfill_gkach_requests()
+    _backfill_opening_balances()
+
+
+def _insert(conn, table, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        conn.execute(table.insert(), rows[start:start + BATCH_SIZE])
+
+
+def _create_search_index():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute(
+            "CREATE INDEX IF NOT EXISTS ix_ad_search_documents_tsv ON ad_search_documents USING GIN "
+            "((setweight(to_tsvector('simple', title), 'A') || setweight(to_tsvector('simple', body), 'B')))"
+        )
+    elif dialect == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS ad_search_fts USING fts5(ad_id UNINDEXED, title, body)")
+
+
+def _backfill_search_documents():
+    """Create the search documents of ads that have none, and fill the FTS5 table if it is empty."""
+    conn = op.get_bind()
+    missing = conn.execute(
+        sa.select(ads.c.ad_id, ads.c.title, ads.c.description)
+        .outerjoin(ad_search_documents, ad_search_documents.c.ad_id == ads.c.ad_id)
+        .where(ad_search_documents.c.ad_id.is_(None))
+    ).all()
+    now = datetime.utcnow()
+    _insert(conn, ad_search_documents, [
+        {'ad_id': ad_id, 'title': ' '.join(tokenize(title)), 'body': ' '.join(tokenize(description)),
+         'updated_at': now}
+        for ad_id, title, description in missing
+    ])
+
+    if conn.dialect.name == 'sqlite' and not conn.execute(sa.text('SELECT count(*) FROM ad_search_fts')).scalar():
+        conn.execute(sa.text('INSERT INTO ad_search_fts (ad_id, title, body) '
+                             'SELECT ad_id, title, body FROM ad_search_documents'))
+
+
+def _backfill_gkach_requests():
+    """Copy requests from the legacy UserGkach.gkach_requests JSON, skipping request IDs already copied."""
+    conn = op.get_bind()
+    existing = set(conn.execute(sa.select(gkach_requests.c.request_id)).scalars())
+    rows = []
+    for user_whatsapp, requests_json, created_at in conn.execute(
+            sa.select(user_gkach.c.user_whatsapp, user_gkach.c.gkach_requests, user_gkach.c.created_at)
+            .where(user_gkach.c.gkach_requests.isnot(None))).all():
+        try:
+            requests = json.loads(requests_json or '[]')
+        except (json.JSONDecodeError, TypeError):
+            continue
+
+        for req in requests:
+            request_id = req.get('request_id')
+            if not request_id or request_id in existing:
+                continue
+            try:
+                requested_at = datetime.fromisoformat(req['requested_at']) if req.get('requested_at') else None
+            except ValueError:
+                requested_at = None
+            rows.append({'request_id': request_id, 'user_whatsapp': user_whatsapp,
+                         'amount': int(req.get('amount') or 0), 'status': req.get('status', 'pending'),
+                         'document': req.get('document'),
+                         'requested_at': requested_at or created_at or datetime.utcnow()})
+            existing.add(request_id)
+    _insert(conn, gkach_requests, rows)
+
+
+def _backfill_opening_balances():
+    """Open every user account with no postings, and the escrow account, with the balance it holds."""
+    conn = op.get_bind()
+    with_postings = set(conn.execute(sa.select(gkach_ledger.c.account).distinct()).scalars())
+    openings = [(account, balance, balance) for account, balance in conn.execute(
+        sa.select(user_gkach.c.user_whatsapp, user_gkach.c.gkach_balance)
+        .where(user_gkach.c.gkach_balance != 0)).all()
+        if account not in with_postings]
+
+    if ESCROW_ACCOUNT not in with_postings:
+        held = conn.execute(
+            sa.select(sa.func.coalesce(sa.func.sum(
+                deliveries.c.total_price + sa.func.coalesce(deliveries.c.delivery_cost, 0)), 0))
+            .where(deliveries.c.status == 'awaiting_delivery')
+        ).scalar()
+        held = int(round(held or 0))
+        if held:
+            openings.append((ESCROW_ACCOUNT, held, None))
+
+    now = datetime.utcnow()
+    rows = []
+    for account, amount, balance_after in openings:
+        transfer_id = str(uuid.uuid4())
+        rows.append({'transfer_id': transfer_id, 'account': MINT_ACCOUNT, 'amount': -amount,
+                     'balance_after': None, 'kind': 'opening', 'created_at': now})
+        rows.append({'transfer_id': transfer_id, 'account': account, 'amount': amount,
+                     'balance_after': balance_after, 'kind': 'opening', 'created_at': now})
+    _insert(conn, gkach_ledger, rows)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute('DROP INDEX IF EXISTS ix_ad_search_documents_tsv')
+    elif dialect == 'sqlite':
+        op.execute('DROP TABLE IF EXISTS ad_search_fts')
@@ -16,13 +16,20 @@ class CartItem(db.Model):
     cart_id = db.Column(db.String(36), nullable=True)  # Unique ID for each cart submission
     delivery_address = db.Column(db.Text, nullable=True)  # Store delivery address
 
+    ad = db.relationship('Ad', lazy='select')
+
+    __table_args__ = (
+        # A user's cart, and the "already in cart?" check on (user_id, product_id)
+        db.Index('ix_cart_items_user_product', 'user_id', 'product_id'),
+    )
+
 class Ad(db.Model):
     __tablename__ = 'ads'
 
     ad_id = db.Column(db.String(36), primary_key=True)
     user_whatsapp = db.Column(db.String(20), nullable=False)
     media_type = db.Column(db.String(10), nullable=False, default='images')  # 'images' or 'video'
-    images = db.Column(db.Text)  # Comma-separated filenames for images
+    images = db.Column(db.Text)  # Legacy comma-separated filenames, kept in sync for rollbacks; read ad_media
     video = db.Column(db.String(255))  # Filename for video
     description = db.Column(db.Text, nullable=False)
     title = db.Column(db.String(100))  # New title field
@@ -31,19 +38,93 @@ class Ad(db.Model):
     payment_proof = db.Column(db.String(255))
     admin_status = db.Column(db.String(20), default='under_review')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    batch_id = db.Column(db.String(36))
     price_gkach = db.Column(db.Integer, default=100)  # Price in Gkach coins
+    thumbnail = db.Column(db.String(255))  # First image, precomputed at upload (src/ad_media.py)
+    thumbnail_width = db.Column(db.Integer)
+    thumbnail_height = db.Column(db.Integer)
+
+    media = db.relationship('AdMedia', order_by='AdMedia.position', lazy='select', cascade='all, delete-orphan')
+
+    @property
+    def image_filenames(self):
+        """Filenames of the ad's images, in order (loads ad.media unless already loaded)."""
+        return [item.filename for item in self.media if item.kind == 'image']
+
+    __table_args__ = (
+        # Approved ads newest first (index pages, keyset pagination of /achte)
+        db.Index('ix_ads_status_created', 'admin_status', created_at.desc(), ad_id.desc()),
+        db.Index('idx_ad_user', 'user_whatsapp'),
+        db.Index('idx_ad_created', 'created_at'),
+    )
+
+class AdMedia(db.Model):
+    __tablename__ = 'ad_media'
+
+    id = db.Column(db.Integer, primary_key=True)
+    ad_id = db.Column(db.String(36), db.ForeignKey('ads.ad_id', ondelete='CASCADE'), nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)  # Order of the images in the ad
+    filename = db.Column(db.String(255), nullable=False)  # In UPLOAD_FOLDER
+    kind = db.Column(db.String(10), nullable=False, default='image')  # 'image' or 'video'
+    width = db.Column(db.Integer)  # Pixels; None until known (videos, legacy rows)
+    height = db.Column(db.Integer)
+    bytes = db.Column(db.Integer)
+    sha256 = db.Column(db.String(64), index=True)  # Content hash, e.g. for duplicate uploads
+
+    __table_args__ = (
+        # An ad's media in order
+        db.Index('ix_ad_media_ad_position', 'ad_id', 'position', unique=True),
+    )
+
+class BatchAd(db.Model):
+    __tablename__ = 'batch_ads'
+
+    batch_id = db.Column(db.String(36), db.ForeignKey('batches.batch_id', ondelete='CASCADE'), primary_key=True)
+    ad_id = db.Column(db.String(36), db.ForeignKey('ads.ad_id', ondelete='CASCADE'), primary_key=True)
+    position = db.Column(db.Integer, nullable=False, default=0)  # Order of the ads in the batch
+
+    __table_args__ = (
+        # A batch's ads in order
+        db.Index('ix_batch_ads_batch_position', 'batch_id', 'position'),
+        # An ad is in one batch at most; also its batch, and "not in a batch" (NOT EXISTS)
+        db.Index('ix_batch_ads_ad', 'ad_id', unique=True),
+    )
+
+class AdSearchDocument(db.Model):
+    __tablename__ = 'ad_search_documents'
+
+    ad_id = db.Column(db.String(36), db.ForeignKey('ads.ad_id'), primary_key=True)
+    title = db.Column(db.Text, nullable=False, default='')  # Accent-folded, tokenised title
+    body = db.Column(db.Text, nullable=False, default='')  # Accent-folded, tokenised description
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 class Batch(db.Model):
     __tablename__ = 'batches'
 
     batch_id = db.Column(db.String(36), primary_key=True)
-    ads = db.Column(db.Text, nullable=False)
+    ads = db.Column(db.Text, nullable=False)  # Legacy comma-separated ad IDs, kept in sync for rollbacks; read batch_ads
     open_graph_data = db.Column(db.Text)
     facebook_share_url = db.Column(db.Text)
     share_count = db.Column(db.Integer, default=0)
     click_rewards = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    facebook_status = db.Column(db.String(20))  # None (never queued), publishing, published, partial, failed, unconfirmed
+    facebook_attempts = db.Column(db.Integer, default=0)  # Times the batch was queued for Facebook
+    facebook_error = db.Column(db.Text)  # Last error of one of its ads
+    facebook_published_at = db.Column(db.DateTime, nullable=True)  # Set once every approved ad is published
+
+    members = db.relationship('BatchAd', order_by='BatchAd.position', lazy='select', cascade='all, delete-orphan')
+
+    @property
+    def ad_ids(self):
+        """IDs of the batch's ads, in order (loads batch.members unless already loaded)."""
+        return [member.ad_id for member in self.members]
+
+    __table_args__ = (
+        # Batches still to publish (auto_publish_batches.py); shrinks as batches get published
+        db.Index('ix_batches_unpublished', 'created_at',
+                 sqlite_where=db.text('facebook_published_at IS NULL'),
+                 postgresql_where=db.text('facebook_published_at IS NULL')),
+    )
 
 class UserGkach(db.Model):
     __tablename__ = 'user_gkach'
@@ -51,9 +132,33 @@ class UserGkach(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_whatsapp = db.Column(db.String(20), nullable=False, unique=True)
     gkach_balance = db.Column(db.Integer, default=0)
-    gkach_requests = db.Column(db.Text)  # JSON string for pending requests
+    gkach_requests = db.Column(db.Text)  # Legacy JSON string, superseded by the gkach_requests table
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class GkachLedgerEntry(db.Model):
+    __tablename__ = 'gkach_ledger'
+
+    id = db.Column(db.Integer, primary_key=True)
+    transfer_id = db.Column(db.String(36), nullable=False, index=True)  # Postings of one transfer share this ID
+    account = db.Column(db.String(40), nullable=False, index=True)  # User WhatsApp or a 'system:' account
+    amount = db.Column(db.Integer, nullable=False)  # Positive credit, negative debit
+    balance_after = db.Column(db.Integer, nullable=True)  # Cached balance after this posting (user accounts only)
+    kind = db.Column(db.String(30), nullable=False)  # checkout, buy_ad, delivery_escrow, delivery_release, ...
+    reference = db.Column(db.String(36), nullable=True, index=True)  # Delivery or request ID
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class GkachRequest(db.Model):
+    __tablename__ = 'gkach_requests'
+
+    id = db.Column(db.Integer, primary_key=True)
+    request_id = db.Column(db.String(36), unique=True, nullable=False, index=True)
+    user_whatsapp = db.Column(db.String(20), nullable=False, index=True)
+    amount = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)  # pending, approved, rejected
+    document = db.Column(db.String(255), nullable=True)  # Uploaded payment proof filename
+    requested_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime, nullable=True)
+
 # GkachCashoutRequest model will be added in future update after migration
 # Commented out to prevent deployment issues
 # class GkachCashoutRequest(db.Model):
@@ -80,6 +185,11 @@ class GkachRate(db.Model):
 
 class Delivery(db.Model):
     __tablename__ = 'deliveries'
+    __table_args__ = (
+        db.Index('idx_delivery_buyer', 'buyer_whatsapp'),
+        db.Index('idx_delivery_seller', 'seller_whatsapp'),
+        db.Index('idx_delivery_status', 'status'),
+    )
 
     delivery_id = db.Column(db.String(36), primary_key=True)
     ad_id = db.Column(db.String(36), db.ForeignKey('ads.ad_id'), nullable=True)  # Nullable for multiple ads
@@ -105,7 +215,7 @@ class User(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100))
-    whatsapp = db.Column(db.String(20))
+    whatsapp = db.Column(db.String(20), index=True)
 
 class Ads_Owner(db.Model):
     __tablename__ = 'ads_owner'
@@ -124,3 +234,47 @@ class Message(db.Model):
     sender_whatsapp = db.Column(db.String(20), nullable=False)
     message = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # A delivery's conversation in order, and the messages after a client's cursor
+        db.Index('ix_messages_delivery_id', 'delivery_id', 'id'),
+    )
+
+class MediaJob(db.Model):
+    __tablename__ = 'media_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(36), unique=True, nullable=False, index=True)
+    kind = db.Column(db.String(30), nullable=False)  # process_images, ...
+    ad_id = db.Column(db.String(36), nullable=True, index=True)
+    payload = db.Column(db.Text)  # JSON arguments for the handler
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued, running, done, failed
+    attempts = db.Column(db.Integer, default=0)
+    worker = db.Column(db.String(64))  # host:pid of the worker that claimed the job
+    result = db.Column(db.Text)  # JSON returned by the handler
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class ContentVersion(db.Model):
+    __tablename__ = 'content_versions'
+
+    name = db.Column(db.String(40), primary_key=True)  # e.g., 'pages'
+    version = db.Column(db.Integer, nullable=False, default=0)  # Bumped whenever the content changes
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class FacebookPost(db.Model):
+    __tablename__ = 'facebook_posts'
+
+    id = db.Column(db.Integer, primary_key=True)
+    ad_id = db.Column(db.String(36), nullable=False, index=True)
+    batch_id = db.Column(db.String(36), nullable=True, index=True)  # Set when published as part of a batch
+    job_id = db.Column(db.String(36), nullable=True)  # MediaJob doing the publishing
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued, publishing, posting, published, failed, unconfirmed
+    post_id = db.Column(db.String(64))  # Facebook post ID once published
+    photo_ids = db.Column(db.Text)  # JSON {photo_url: media_fbid} of album photos uploaded so far
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    published_at = db.Column(db.DateTime, nullable=True)
@@ -0,0 +1,167 @@
+"""
+Ad media rows.
+
+An ad's images (or video) used to be only a comma-separated Ad.images string,
+split again by every page, job and template. They are now rows of the
+indexed ad_media table, one per file and in order, with the dimensions, size
+and content hash measured when the file is saved; the first image is also
+copied to Ad.thumbnail (with its dimensions), so list pages and carts show it
+without touching ad_media. Ad.images is still written, for rollbacks, but
+nothing reads it.
+
+Set an ad's media with set_ad_images() / set_ad_video(); load the media of a
+page of ads with load_ad_media() (one query), or joinedload(Ad.media).
+"""
+import hashlib
+import logging
+import os
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import db, Ad, AdMedia
+from src.lazy_imports import Image
+
+logger = logging.getLogger(__name__)
+
+def describe_file(path, kind='image'):
+    """
+    Size, content hash and, for images, dimensions of a saved upload.
+    Only the image header is decoded.
+
+    :param path: Full path of the file
+    :param kind: 'image' or 'video'
+    :return: Dict with 'bytes', 'sha256', 'width' and 'height' (None when unknown)
+    """
+    details = {'bytes': None, 'sha256': None, 'width': None, 'height': None}
+    try:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        details['bytes'] = os.path.getsize(path)
+        details['sha256'] = digest.hexdigest()
+    except OSError as e:
+        logger.warning(f"Could not read upload {path}: {e}")
+        return details
+    if kind == 'image':
+        try:
+            with Image.open(path) as img:
+                orientation = img.getexif().get(0x0112, 1)
+                width, height = img.size
+            # Displayed dimensions: EXIF orientations 5-8 swap them
+            details['width'], details['height'] = (height, width) if orientation in (5, 6, 7, 8) else (width, height)
+        except Exception as e:
+            logger.warning(f"Could not read the dimensions of {path}: {e}")
+    return details
+
+def _sync_thumbnail(ad, items):
+    first = next((item for item in items if item.kind == 'image'), None)
+    ad.thumbnail = first.filename if first else None
+    ad.thumbnail_width = first.width if first else None
+    ad.thumbnail_height = first.height if first else None
+
+def _clear_media(ad):
+    """Delete an ad's current rows first, so the new positions do not collide with them."""
+    if ad in db.session and ad.media:
+        ad.media = []
+        db.session.flush()
+
+def set_ad_images(ad, filenames, upload_folder=None):
+    """
+    Replace an ad's media with images, measuring the files found in the upload folder.
+    Not committed.
+
+    :param ad: The Ad
+    :param filenames: Image filenames in UPLOAD_FOLDER, in order
+    :param upload_folder: Defaults to UPLOAD_FOLDER
+    :return: The AdMedia rows
+    """
+    upload_folder = upload_folder or current_app.config['UPLOAD_FOLDER']
+    _clear_media(ad)
+    items = [AdMedia(position=position, filename=filename, kind='image',
+                     **describe_file(os.path.join(upload_folder, filename)))
+             for position, filename in enumerate(filenames)]
+    ad.media = items
+    ad.images = ','.join(filenames)
+    _sync_thumbnail(ad, items)
+    return items
+
+def set_ad_video(ad, filename, upload_folder=None):
+    """Replace an ad's media with a video. Not committed."""
+    upload_folder = upload_folder or current_app.config['UPLOAD_FOLDER']
+    _clear_media(ad)
+    ad.media = [AdMedia(position=0, filename=filename, kind='video',
+                        **describe_file(os.path.join(upload_folder, filename), kind='video'))]
+    ad.video = filename
+    ad.images = ''
+    _sync_thumbnail(ad, ad.media)
+    return ad.media
+
+def update_image_details(ad, results, upload_folder=None):
+    """
+    Record the final size and hash of images re-encoded by the media worker.
+    Not committed.
+
+    :param ad: The Ad
+    :param results: {filename: result of image_processing.process_upload}
+    """
+    upload_folder = upload_folder or current_app.config['UPLOAD_FOLDER']
+    for item in ad.media:
+        result = results.get(item.filename)
+        if not result:
+            continue
+        details = describe_file(os.path.join(upload_folder, item.filename), kind='image')
+        item.bytes, item.sha256 = details['bytes'], details['sha256']
+        item.width, item.height = result['width'], result['height']
+    _sync_thumbnail(ad, ad.media)
+
+def load_ad_media(ads):
+    """
+    Load the media of several ads with one query, so ad.media / ad.image_filenames
+    do not query once per ad.
+
+    :param ads: Ad objects
+    :return: The ads
+    """
+    ads = [ad for ad in ads if ad is not None]
+    if not ads:
+        return ads
+    by_ad = defaultdict(list)
+    for item in (AdMedia.query
+                 .filter(AdMedia.ad_id.in_({ad.ad_id for ad in ads}))
+                 .order_by(AdMedia.ad_id, AdMedia.position)):
+        by_ad[item.ad_id].append(item)
+    for ad in ads:
+        set_committed_value(ad, 'media', by_ad.get(ad.ad_id, []))
+    return ads
+
+def backfill_media_details(limit=None):
+    """
+    Measure the files of ad_media rows created by the migration (no hash yet)
+    and refresh the ads' thumbnail dimensions. Safe to run repeatedly.
+
+    :param limit: At most this many rows
+    :return: Number of rows measured
+    """
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    query = AdMedia.query.filter(AdMedia.sha256.is_(None)).order_by(AdMedia.id)
+    if limit:
+        query = query.limit(limit)
+    measured = 0
+    ad_ids = set()
+    for item in query.all():
+        path = os.path.join(upload_folder, item.filename)
+        if not os.path.exists(path):
+            continue
+        for key, value in describe_file(path, kind=item.kind).items():
+            setattr(item, key, value)
+        ad_ids.add(item.ad_id)
+        measured += 1
+    for ad in load_ad_media(Ad.query.filter(Ad.ad_id.in_(ad_ids)).all() if ad_ids else []):
+        _sync_thumbnail(ad, ad.media)
+    db.session.commit()
+    if measured:
+        logger.info(f"Measured {measured} ad media file(s)")
+    return measured
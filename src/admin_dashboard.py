@@ -0,0 +1,169 @@
+"""
+Admin dashboard data.
+
+The /admin page only renders the counts from get_dashboard_counts(), a few
+grouped aggregate queries whose cost does not grow with what they count in
+Python. The ad, batch and Gkach user tables are loaded by the page on demand,
+one page at a time, from the /admin/api/* JSON endpoints, filtered in SQL.
+"""
+import logging
+
+from flask import url_for
+
+from models import db, Ad, Batch, BatchAd, UserGkach, GkachRequest, MediaJob
+from src.ad_media import load_ad_media
+from src.media_jobs import get_ad_processing_state
+
+logger = logging.getLogger(__name__)
+
+AD_STATUSES = ('under_review', 'approved', 'rejected')
+PAYMENT_STATUSES = ('pending', 'verified', 'rejected')
+MAX_PER_PAGE = 100
+
+def get_dashboard_counts():
+    """
+    Headline counts of the admin dashboard.
+
+    :return: Dict with ads per admin status, pending payment proofs, pending Gkach
+             requests, batches (and those not published yet), Gkach users and failed media jobs
+    """
+    ads_by_status = dict(db.session.query(Ad.admin_status, db.func.count()).group_by(Ad.admin_status).all())
+    pending_proofs = (db.session.query(db.func.count(Ad.ad_id))
+                      .filter(Ad.payment_status == 'pending', Ad.payment_proof.isnot(None))
+                      .scalar())
+    pending_requests = (db.session.query(db.func.count(GkachRequest.id))
+                        .filter(GkachRequest.status == 'pending')
+                        .scalar())
+    batches, unpublished_batches = db.session.query(
+        db.func.count(Batch.batch_id),
+        db.func.count(Batch.batch_id).filter(Batch.facebook_published_at.is_(None))).one()
+    return {
+        'ads': {status: ads_by_status.get(status, 0) for status in AD_STATUSES},
+        'ads_total': sum(ads_by_status.values()),
+        'pending_proofs': pending_proofs,
+        'pending_requests': pending_requests,
+        'batches': batches,
+        'unpublished_batches': unpublished_batches,
+        'gkach_users': db.session.query(db.func.count(UserGkach.id)).scalar(),
+        'failed_media_jobs': db.session.query(db.func.count(MediaJob.id)).filter(MediaJob.status == 'failed').scalar(),
+    }
+
+def _paginate(query, page, per_page):
+    return query.paginate(page=page, per_page=max(1, min(per_page, MAX_PER_PAGE)), error_out=False)
+
+def admin_ads_query(status=None, payment_status=None, q=None):
+    """
+    Ads of the admin table, newest first; served by ix_ads_status_created when filtered by status.
+
+    :param status: Only ads with this admin_status
+    :param payment_status: Only ads with this payment_status
+    :param q: Only ads whose WhatsApp number, title or ad ID contains this
+    """
+    query = Ad.query
+    if status:
+        query = query.filter(Ad.admin_status == status)
+    if payment_status:
+        query = query.filter(Ad.payment_status == payment_status)
+    if q:
+        pattern = f"%{q}%"
+        query = query.filter(db.or_(Ad.user_whatsapp.like(pattern), Ad.title.ilike(pattern), Ad.ad_id.like(pattern)))
+    return query.order_by(Ad.created_at.desc(), Ad.ad_id.desc())
+
+def get_ads_page(status=None, payment_status=None, q=None, page=1, per_page=20):
+    """
+    Page of ads for the admin table (see admin_ads_query for the filters).
+
+    :return: Flask-SQLAlchemy Pagination of Ad
+    """
+    return _paginate(admin_ads_query(status, payment_status, q), page, per_page)
+
+def get_batches_page(unpublished=False, page=1, per_page=20):
+    """
+    Page of batches for the admin table, newest first.
+
+    :param unpublished: Only batches not published to Facebook yet
+    :return: Flask-SQLAlchemy Pagination of Batch
+    """
+    query = Batch.query
+    if unpublished:
+        query = query.filter(Batch.facebook_published_at.is_(None))
+    return _paginate(query.order_by(Batch.created_at.desc()), page, per_page)
+
+def get_gkach_users_page(q=None, page=1, per_page=20):
+    """
+    Page of Gkach accounts for the admin table, by WhatsApp number.
+
+    :param q: Only numbers containing this
+    :return: Flask-SQLAlchemy Pagination of UserGkach
+    """
+    query = UserGkach.query
+    if q:
+        query = query.filter(UserGkach.user_whatsapp.like(f"%{q}%"))
+    return _paginate(query.order_by(UserGkach.user_whatsapp), page, per_page)
+
+def page_to_dict(pagination, items):
+    """JSON envelope of one page of a table."""
+    return {
+        'success': True,
+        'items': items,
+        'page': pagination.page,
+        'pages': pagination.pages,
+        'per_page': pagination.per_page,
+        'total': pagination.total,
+    }
+
+def ads_to_dicts(ads):
+    """Rows of the admin ad table; the media and media states of the whole page come from one query each."""
+    load_ad_media(ads)
+    media_states = get_ad_processing_state(ad.ad_id for ad in ads)
+    rows = []
+    for ad in ads:
+        rows.append({
+            'ad_id': ad.ad_id,
+            'user_whatsapp': ad.user_whatsapp,
+            'title': ad.title,
+            'description': ad.description,
+            'admin_status': ad.admin_status,
+            'payment_status': ad.payment_status,
+            'media_type': ad.media_type,
+            'created_at': ad.created_at.isoformat() if ad.created_at else None,
+            'media_state': media_states.get(ad.ad_id),
+            'images': [url_for('static', filename='uploads/' + image) for image in ad.image_filenames],
+            'payment_proof_url': url_for('static', filename='uploads/' + ad.payment_proof) if ad.payment_proof else None,
+            'urls': {
+                'delete': url_for('delete_ad', ad_id=ad.ad_id),
+                'csv': url_for('download_csv', ad_id=ad.ad_id),
+                'publish_facebook': url_for('publish_ad_to_facebook', ad_id=ad.ad_id),
+                'media_jobs': url_for('admin_media_jobs', ad_id=ad.ad_id),
+            },
+        })
+    return rows
+
+def batches_to_dicts(batches):
+    """Rows of the admin batch table; the ad counts of the whole page come from one grouped query."""
+    batch_ids = [batch.batch_id for batch in batches]
+    ad_counts = dict(db.session.query(BatchAd.batch_id, db.func.count())
+                     .filter(BatchAd.batch_id.in_(batch_ids))
+                     .group_by(BatchAd.batch_id).all()) if batch_ids else {}
+    return [{
+        'batch_id': batch.batch_id,
+        'ad_count': ad_counts.get(batch.batch_id, 0),
+        'share_count': batch.share_count,
+        'click_rewards': batch.click_rewards,
+        'facebook_status': batch.facebook_status,
+        'created_at': batch.created_at.isoformat() if batch.created_at else None,
+        'urls': {
+            'view': url_for('view_batch', batch_id=batch.batch_id),
+            'edit': url_for('edit_batch', batch_id=batch.batch_id),
+            'delete': url_for('delete_batch', batch_id=batch.batch_id),
+            'publish_facebook': url_for('publish_batch_to_facebook', batch_id=batch.batch_id),
+        },
+    } for batch in batches]
+
+def gkach_users_to_dicts(users):
+    """Rows of the admin Gkach user table."""
+    return [{
+        'user_whatsapp': user.user_whatsapp,
+        'gkach_balance': user.gkach_balance,
+        'created_at': user.created_at.isoformat() if user.created_at else None,
+    } for user in users]
@@ -0,0 +1,76 @@
+"""
+Batch membership.
+
+A batch's ads used to be only the comma-separated Batch.ads string; they are
+now batch_ads rows (batch_id, ad_id, position), so a batch page loads its ads
+with one join and membership changes are row inserts and deletes. Batch.ads
+is still written, for rollbacks, but nothing reads it.
+
+batch_ads is the only record of which batch an ad is in: an ad is in one
+batch at most (unique ad_id), and ads not in a batch are the ones without a
+row (unbatched_ads).
+"""
+import json
+import logging
+
+from flask import url_for
+from sqlalchemy import exists
+from sqlalchemy.orm import joinedload
+
+from models import db, Ad, BatchAd
+
+logger = logging.getLogger(__name__)
+
+def set_batch_ads(batch, ad_ids):
+    """
+    Replace the ads of a batch, in order. Not committed.
+
+    :param batch: The Batch
+    :param ad_ids: Ad IDs in order
+    """
+    members = {member.ad_id: member for member in batch.members}
+    batch.members = [members.get(ad_id) or BatchAd(ad_id=ad_id) for ad_id in ad_ids]
+    for position, member in enumerate(batch.members):
+        member.position = position
+    batch.ads = ','.join(ad_ids)
+
+def get_batch_ads(batch_id, approved_only=False):
+    """
+    Ads of a batch in order, with their media, in a single joined query.
+
+    :param batch_id: Batch ID
+    :param approved_only: Only approved ads
+    :return: List of Ad
+    """
+    query = (Ad.query
+             .join(BatchAd, BatchAd.ad_id == Ad.ad_id)
+             .filter(BatchAd.batch_id == batch_id)
+             .options(joinedload(Ad.media)))
+    if approved_only:
+        query = query.filter(Ad.admin_status == 'approved')
+    return query.order_by(BatchAd.position).all()
+
+def get_batch_ad_ids(batch_id, approved_only=False):
+    """IDs of a batch's ads in order (index only, no ad rows unless approved_only)."""
+    query = db.session.query(BatchAd.ad_id).filter(BatchAd.batch_id == batch_id)
+    if approved_only:
+        query = query.join(Ad, Ad.ad_id == BatchAd.ad_id).filter(Ad.admin_status == 'approved')
+    return [ad_id for ad_id, in query.order_by(BatchAd.position)]
+
+def get_ad_batch_id(ad_id):
+    """ID of the batch an ad is in, or None."""
+    return db.session.query(BatchAd.batch_id).filter(BatchAd.ad_id == ad_id).scalar()
+
+def unbatched_ads():
+    """Query of the approved ads not in any batch."""
+    return Ad.query.filter(Ad.admin_status == 'approved', ~exists().where(BatchAd.ad_id == Ad.ad_id))
+
+def batch_open_graph_data(batch_id, ads):
+    """Open Graph data (JSON) of a batch: its link and the first image of each ad."""
+    return json.dumps({
+        'title': 'Glory2yahPub Ad Batch',
+        'description': 'Check out these amazing ads from Glory2yahPub!',
+        'url': url_for('view_batch', batch_id=batch_id, _external=True),
+        'images': [url_for('static', filename='uploads/' + ad.thumbnail, _external=True)
+                   for ad in ads if ad.thumbnail]
+    })
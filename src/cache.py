@@ -0,0 +1,348 @@
+"""
+Read-through cache for hot single-row lookups (ads by ID, Gkach rates by currency).
+
+Lookups go through two layers:
+- an in-process LRU with a TTL (LRUCache), always on
+- optionally a backend shared by the workers of a host (CACHE_BACKEND=sqlite,
+  a small SQLite file like the metrics sink), so a row loaded by one worker
+  is not loaded again by the others
+
+Cached values are Snapshots: plain dicts of the row's column values, detached
+from the session and JSON-serialisable, that read like the model (ad.title).
+Code that changes a row still loads the ORM instance and, after committing,
+calls the invalidation hook for it (invalidate_ad, invalidate_gkach_rate).
+An invalidation removes the key from the shared backend and is logged there;
+every worker replays that log into its own LRU at most every
+CACHE_SYNC_INTERVAL seconds. Without a shared backend, other workers' copies
+expire with the TTL.
+
+A snapshot can therefore be stale for up to the TTL. Paths that take an order
+or move Gkach do not decide on one: they check the ad with load_approved_ad,
+which reads the row itself.
+
+Hits and misses are counted per cache and reported with the request metrics
+(/admin/metrics).
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+from models import db, Ad, GkachRate
+from src.metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+# Cached "no such row", for caches whose rows are only created through an invalidating code path
+_NONE = {'__none__': True}
+
+
+class Snapshot(dict):
+    """Column values of one row, detached from the session; read-only, attribute access like the model."""
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError('snapshots are read-only')
+
+    def to_json(self):
+        return json.dumps({key: value.isoformat() if isinstance(value, datetime) else value
+                           for key, value in self.items()})
+
+def snapshot(instance):
+    """Copy a model instance's column values into a Snapshot."""
+    return Snapshot({column.key: getattr(instance, column.key) for column in instance.__table__.columns})
+
+def snapshot_from_json(model, text):
+    """Rebuild a Snapshot serialised with Snapshot.to_json, restoring DateTime columns."""
+    data = json.loads(text)
+    for column in model.__table__.columns:
+        if isinstance(column.type, db.DateTime) and data.get(column.key):
+            data[column.key] = datetime.fromisoformat(data[column.key])
+    return Snapshot(data)
+
+
+class LRUCache:
+    """In-process LRU whose entries also expire after ttl seconds."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """:return: The cached value, or MISSING"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return MISSING
+            if item[0] < time.monotonic():
+                del self._items[key]
+                return MISSING
+            self._items.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SqliteCacheBackend:
+    """Cache entries shared by the workers of one host, in a SQLite file."""
+
+    # Invalidations older than this are forgotten; workers that slept longer drop their whole LRU
+    INVALIDATION_RETENTION = 3600
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_entries '
+                         '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_invalidations '
+                         '(seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, at REAL NOT NULL)')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:  # Commits, or rolls back on error
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        """:return: The stored text, or None if missing or expired"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT value FROM cache_entries WHERE key = ? AND expires > ?',
+                               (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO cache_entries (key, value, expires) VALUES (?, ?, ?)',
+                         (key, value, time.time() + ttl))
+
+    def delete(self, keys):
+        """Remove keys and log their invalidation for the other workers."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany('DELETE FROM cache_entries WHERE key = ?', [(key,) for key in keys])
+            conn.executemany('INSERT INTO cache_invalidations (key, at) VALUES (?, ?)', [(key, now) for key in keys])
+            conn.execute('DELETE FROM cache_invalidations WHERE at < ?', (now - self.INVALIDATION_RETENTION,))
+            conn.execute('DELETE FROM cache_entries WHERE expires < ?', (now,))
+
+    def invalidations_since(self, seq):
+        """
+        :param seq: Last sequence number seen, or None on first use
+        :return: (latest seq, keys invalidated after seq, or None if the log no longer reaches back to seq)
+        """
+        with self._connect() as conn:
+            latest, oldest = conn.execute('SELECT MAX(seq), MIN(seq) FROM cache_invalidations').fetchone()
+            if seq is None:
+                return latest or 0, None
+            if oldest is not None and oldest > seq + 1:
+                return latest, None
+            keys = [row[0] for row in conn.execute('SELECT key FROM cache_invalidations WHERE seq > ?', (seq,))]
+        return latest or seq, keys
+
+
+class ReadThroughCache:
+    """Snapshots of one model, loaded on a miss and kept in the LRU (and the shared backend if any)."""
+
+    def __init__(self, name, model, local=None, shared=None, ttl=300, sync_interval=1.0, cache_missing=False):
+        """
+        :param name: Cache name, used as key prefix in the shared backend and as metric label
+        :param model: Model whose rows are cached
+        :param local: LRUCache; a default one is created if omitted
+        :param shared: Optional shared backend (SqliteCacheBackend)
+        :param ttl: Seconds an entry stays in the shared backend
+        :param sync_interval: Seconds between replays of the shared invalidation log
+        :param cache_missing: Also cache "no such row"; only safe when rows are created through an invalidating path
+        """
+        self.name = name
+        self.model = model
+        self.local = local or LRUCache(ttl=ttl)
+        self.shared = shared
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+        self.cache_missing = cache_missing
+        self.stats = defaultdict(int)  # hit, shared_hit, miss
+        self._reported = defaultdict(int)
+        self._synced_at = 0
+        self._seq = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _sync(self):
+        """Drop local entries other workers invalidated since the last sync."""
+        if self.shared is None:
+            return
+        now = time.monotonic()
+        if self._pid == os.getpid() and now - self._synced_at < self.sync_interval:
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked worker: whatever the parent cached may be stale by now
+                self._pid, self._seq = os.getpid(), None
+                self.local.clear()
+            self._synced_at = now
+            try:
+                self._seq, keys = self.shared.invalidations_since(self._seq)
+            except sqlite3.Error as e:
+                logger.error(f"Could not read cache invalidations: {e}")
+                return
+            if keys is None:
+                self.local.clear()
+                return
+            prefix = f"{self.name}:"
+            for key in keys:
+                if key.startswith(prefix):
+                    self.local.delete(key[len(prefix):])
+
+    def get(self, key, load):
+        """
+        :param key: Lookup key, e.g. the ad ID
+        :param load: Callable returning the ORM instance (or None) on a miss
+        :return: A Snapshot, or None if there is no such row
+        """
+        self._sync()
+        value = self.local.get(key)
+        if value is not MISSING:
+            self.stats['hit'] += 1
+            return None if value is _NONE else value
+
+        if self.shared is not None:
+            try:
+                text = self.shared.get(f"{self.name}:{key}")
+            except sqlite3.Error as e:
+                logger.error(f"Shared cache read failed: {e}")
+                text = None
+            if text is not None:
+                value = _NONE if text == 'null' else snapshot_from_json(self.model, text)
+                self.local.set(key, value)
+                self.stats['shared_hit'] += 1
+                return None if value is _NONE else value
+
+        self.stats['miss'] += 1
+        instance = load()
+        if instance is None and not self.cache_missing:
+            return None
+        value = snapshot(instance) if instance is not None else _NONE
+        self.local.set(key, value)
+        if self.shared is not None:
+            try:
+                self.shared.set(f"{self.name}:{key}", 'null' if value is _NONE else value.to_json(), self.ttl)
+            except sqlite3.Error as e:
+                logger.error(f"Shared cache write failed: {e}")
+        return None if value is _NONE else value
+
+    def invalidate(self, *keys):
+        """Forget keys here and, through the shared backend, in every worker. Call after committing."""
+        for key in keys:
+            self.local.delete(key)
+        if self.shared is not None and keys:
+            try:
+                self.shared.delete([f"{self.name}:{key}" for key in keys])
+            except sqlite3.Error as e:
+                logger.error(f"Shared cache invalidation failed: {e}")
+
+    def collect(self):
+        """Hit/miss counts since the last call, as (name, labels, delta) metric counter deltas."""
+        deltas = []
+        for result, count in list(self.stats.items()):
+            if count > self._reported[result]:
+                deltas.append(('cache_requests_total', {'cache': self.name, 'result': result}, count - self._reported[result]))
+                self._reported[result] = count
+        return deltas
+
+
+ads = ReadThroughCache('ad', Ad)
+gkach_rates = ReadThroughCache('gkach_rate', GkachRate, cache_missing=True)
+
+def init_cache(app):
+    """Size the caches from the config and attach the shared backend if CACHE_BACKEND is set."""
+    global ads, gkach_rates
+    backend = app.config.get('CACHE_BACKEND')
+    shared = None
+    if backend == 'sqlite':
+        shared = SqliteCacheBackend(app.config['CACHE_DB'])
+    elif backend:
+        logger.error(f"Unknown CACHE_BACKEND {backend!r}; using the in-process cache only")
+
+    options = {'ttl': app.config.get('CACHE_TTL', 300), 'sync_interval': app.config.get('CACHE_SYNC_INTERVAL', 1.0)}
+    size = app.config.get('CACHE_SIZE', 1024)
+    ads = ReadThroughCache('ad', Ad, LRUCache(size, options['ttl']), shared, **options)
+    gkach_rates = ReadThroughCache('gkach_rate', GkachRate, LRUCache(size, options['ttl']), shared,
+                                   cache_missing=True, **options)
+
+def get_ad(ad_id, approved=False):
+    """
+    :param ad_id: Ad ID
+    :param approved: Only return the ad if it is approved
+    :return: Snapshot of the ad, or None
+    """
+    ad = ads.get(ad_id, lambda: db.session.get(Ad, ad_id)) if ad_id else None
+    if ad is not None and approved and ad.admin_status != 'approved':
+        return None
+    return ad
+
+def load_approved_ad(ad_id, lock=False):
+    """
+    The ad if it is approved, read from the database rather than the cache.
+
+    :param ad_id: Ad ID
+    :param lock: Lock the row until the end of the transaction (SELECT ... FOR UPDATE),
+        so the ad cannot be rejected while a purchase of it is committed
+    :return: Ad, or None
+    """
+    if not ad_id:
+        return None
+    query = Ad.query.filter_by(ad_id=ad_id, admin_status='approved')
+    if lock:
+        query = query.with_for_update()
+    return query.first()
+
+def get_rate(currency):
+    """:return: Snapshot of the rate for currency, or None"""
+    return gkach_rates.get(currency, lambda: GkachRate.query.filter_by(currency=currency).first())
+
+def invalidate_ad(*ad_ids):
+    ads.invalidate(*ad_ids)
+
+def invalidate_gkach_rate(*currencies):
+    gkach_rates.invalidate(*currencies)
+
+def _collect():
+    return ads.collect() + gkach_rates.collect()
+
+register_collector(_collect)
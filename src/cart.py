@@ -0,0 +1,72 @@
+"""
+Cart and delivery hydration helpers.
+
+Cart and delivery pages all need the Ad behind each line item. These helpers
+load them in a fixed number of queries (a joined load for CartItem.ad, a
+single IN (...) for the ad IDs stored in Delivery.cart_items) instead of one
+query per line.
+"""
+import json
+
+from sqlalchemy.orm import joinedload
+
+from models import Ad, CartItem
+
+def get_cart_items(user_id):
+    """
+    Get a user's cart items with their ads loaded in the same query.
+
+    :param user_id: The User.id owning the cart
+    :return: List of CartItem objects with .ad populated
+    """
+    return (CartItem.query
+            .options(joinedload(CartItem.ad))
+            .filter_by(user_id=user_id)
+            .all())
+
+def load_ads(ad_ids):
+    """
+    Load several ads with a single IN (...) query.
+
+    :param ad_ids: Iterable of ad IDs (duplicates and None are ignored)
+    :return: Dict mapping ad_id to Ad
+    """
+    ad_ids = {ad_id for ad_id in ad_ids if ad_id}
+    if not ad_ids:
+        return {}
+    return {ad.ad_id: ad for ad in Ad.query.filter(Ad.ad_id.in_(ad_ids)).all()}
+
+def parse_delivery_items(delivery):
+    """Decode the JSON list stored in Delivery.cart_items."""
+    if not delivery.cart_items:
+        return []
+    try:
+        return json.loads(delivery.cart_items)
+    except (json.JSONDecodeError, TypeError):
+        return []
+
+def hydrate_delivery_items(deliveries):
+    """
+    Attach the Ad to every item stored in the given deliveries' cart_items JSON.
+
+    :param deliveries: A Delivery or a list of Delivery objects
+    :return: List of dicts with 'ad', 'quantity', 'price' and 'subtotal', in
+             delivery then item order; items whose ad no longer exists are skipped
+    """
+    if not isinstance(deliveries, (list, tuple)):
+        deliveries = [deliveries]
+
+    items = [item for delivery in deliveries for item in parse_delivery_items(delivery)]
+    ads = load_ads(item.get('ad_id') for item in items)
+
+    hydrated = []
+    for item in items:
+        ad = ads.get(item.get('ad_id'))
+        if ad:
+            hydrated.append({
+                'ad': ad,
+                'quantity': item['quantity'],
+                'price': item['price'],
+                'subtotal': item['price'] * item['quantity']
+            })
+    return hydrated
@@ -1,6 +1,7 @@
 from models import db, Message, Delivery
 from datetime import datetime
 import json
+from src.message_bus import message_bus
 
 def send_message(delivery_id, sender_whatsapp, message):
     """
@@ -26,20 +27,48 @@ def send_message(delivery_id, sender_whatsapp, message):
     db.session.add(new_message)
     db.session.commit()
 
+    # Wake the buyer and seller listening on this worker; other workers' pollers find the row
+    message_bus.publish(delivery_id)
+
     return new_message
 
-def get_messages(delivery_id, user_whatsapp):
+def get_participants_or_raise(delivery_id, user_whatsapp):
     """
-    Get all messages for a delivery, but only if user is buyer or seller.
+    Check that a user is the buyer or seller of a delivery.
+
+    :param delivery_id: Delivery ID
+    :param user_whatsapp: WhatsApp number of the user
+    :return: (buyer_whatsapp, seller_whatsapp), to pass to get_messages as participants
+    :raises ValueError: Unknown delivery, or the user is not part of it
     """
-    delivery = Delivery.query.filter_by(delivery_id=delivery_id).first()
-    if not delivery:
+    participants = (db.session.query(Delivery.buyer_whatsapp, Delivery.seller_whatsapp)
+                    .filter(Delivery.delivery_id == delivery_id)
+                    .first())
+    if not participants:
         raise ValueError("Delivery not found")
 
-    if user_whatsapp not in [delivery.buyer_whatsapp, delivery.seller_whatsapp]:
+    if user_whatsapp not in participants:
         raise ValueError("Unauthorized access")
+    return tuple(participants)
+
+def get_messages(delivery_id, user_whatsapp, after_id=None, limit=None, participants=None):
+    """
+    Get the messages for a delivery, but only if user is buyer or seller.
+
+    :param after_id: Only messages newer than this message ID (the last one the client has)
+    :param limit: At most this many messages, oldest first
+    :param participants: Result of get_participants_or_raise when already checked, skipping the delivery query
+    """
+    if participants is None:
+        get_participants_or_raise(delivery_id, user_whatsapp)
 
-    messages = Message.query.filter_by(delivery_id=delivery_id).order_by(Message.created_at).all()
+    query = Message.query.filter(Message.delivery_id == delivery_id)
+    if after_id:
+        query = query.filter(Message.id > after_id)
+    query = query.order_by(Message.id)
+    if limit:
+        query = query.limit(limit)
+    messages = query.all()
 
     return [{
         'id': msg.id,
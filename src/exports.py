@@ -0,0 +1,122 @@
+"""
+Streaming data exports for the admin.
+
+/admin/export/<name> streams a table as CSV or JSONL straight from the
+database. Rows are read through a server-side cursor (yield_per), turned into
+text in ~64 KB chunks and, when the client accepts it, gzipped on the fly, so
+memory stays flat whatever the number of rows.
+"""
+import csv
+import io
+import json
+import logging
+import zlib
+from datetime import datetime
+
+from models import db, Ad, BatchAd, Delivery, Message, UserGkach
+
+logger = logging.getLogger(__name__)
+
+_AD_BATCH_ID = db.select(BatchAd.batch_id).where(BatchAd.ad_id == Ad.ad_id).scalar_subquery().label('batch_id')
+
+YIELD_PER = 1000  # Rows fetched from the cursor at a time
+CHUNK_SIZE = 65536  # Bytes of output gathered before a chunk is sent
+
+# name -> (columns, date column filtered by start/end, status column or None)
+EXPORTS = {
+    'ads': ((Ad.ad_id, Ad.user_whatsapp, Ad.title, Ad.description, Ad.media_type, Ad.ad_type, Ad.admin_status,
+             Ad.payment_status, Ad.price_gkach, _AD_BATCH_ID, Ad.created_at),
+            Ad.created_at, Ad.admin_status),
+    'deliveries': ((Delivery.delivery_id, Delivery.ad_id, Delivery.buyer_whatsapp, Delivery.seller_whatsapp,
+                    Delivery.delivery_cost, Delivery.total_price, Delivery.status, Delivery.created_at,
+                    Delivery.confirmed_at, Delivery.delivered_at),
+                   Delivery.created_at, Delivery.status),
+    'messages': ((Message.id, Message.delivery_id, Message.sender_whatsapp, Message.message, Message.created_at),
+                 Message.created_at, None),
+    'gkach_balances': ((UserGkach.user_whatsapp, UserGkach.gkach_balance, UserGkach.created_at),
+                       UserGkach.created_at, None),
+}
+
+FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+def export_columns(name):
+    return [column.key for column in EXPORTS[name][0]]
+
+def export_rows(name, start=None, end=None, status=None, ad_id=None):
+    """
+    Stream the rows of an export from a server-side cursor.
+
+    :param name: Key of EXPORTS
+    :param start: Only rows dated on or after this datetime
+    :param end: Only rows dated before this datetime
+    :param status: Only rows with this status (exports that have one)
+    :param ad_id: Only this ad (the 'ads' export)
+    :return: Iterator of row tuples, in the order of export_columns(name)
+    """
+    columns, date_column, status_column = EXPORTS[name]
+    query = db.select(*columns)
+    if start:
+        query = query.where(date_column >= start)
+    if end:
+        query = query.where(date_column < end)
+    if status:
+        if status_column is None:
+            raise ValueError(f"The {name} export has no status")
+        query = query.where(status_column == status)
+    if ad_id:
+        query = query.where(Ad.ad_id == ad_id)
+    query = query.order_by(date_column).execution_options(yield_per=YIELD_PER)
+    # yield_per streams the result (stream_results) and fetches YIELD_PER rows at a time
+    for partition in db.session.execute(query).partitions():
+        yield from partition
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def iter_csv(columns, rows):
+    """Header then rows as CSV text, in chunks of about CHUNK_SIZE."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_value(value) for value in row])
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def iter_jsonl(columns, rows):
+    """One JSON object per row, in chunks of about CHUNK_SIZE."""
+    lines, size = [], 0
+    for row in rows:
+        line = json.dumps(dict(zip(columns, (_value(value) for value in row))), ensure_ascii=False) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(lines).encode('utf-8')
+            lines, size = [], 0
+    yield ''.join(lines).encode('utf-8')
+
+def gzip_chunks(chunks, level=6):
+    """Gzip a stream of byte chunks as it goes."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip header and trailer
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def stream_export(name, fmt='csv', **filters):
+    """
+    Encoded chunks of an export.
+
+    :param name: Key of EXPORTS
+    :param fmt: 'csv' or 'jsonl'
+    :param filters: Passed to export_rows
+    """
+    if filters.get('status') and EXPORTS[name][2] is None:
+        raise ValueError(f"The {name} export has no status")  # Checked here, before the response starts
+    columns = export_columns(name)
+    rows = export_rows(name, **filters)
+    return iter_csv(columns, rows) if fmt == 'csv' else iter_jsonl(columns, rows)
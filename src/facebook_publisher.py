@@ -1,19 +1,159 @@
 import os
-import requests
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from src.lazy_imports import requests
 import logging
-from typing import Tuple, List, Dict
-from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+# Graph API error codes meaning "slow down" (application, user and page level throttling)
+RATE_LIMIT_CODES = {4, 17, 32, 613}
+
+class GraphAPIError(Exception):
+    """A Graph API call that failed, after retries when the failure was transient."""
+
+    def __init__(self, message: str, status: Optional[int] = None, code: Optional[int] = None,
+                 retryable: bool = False, retry_after: Optional[float] = None, ambiguous: bool = False):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.ambiguous = ambiguous  # A non-idempotent call that may have taken effect (the post may exist)
+
+def _request_sent(error) -> bool:
+    """Whether a request that raised may have reached Facebook: anything but a failed connection attempt."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return False
+    if isinstance(error, requests.exceptions.ConnectionError):
+        # Refused connections and DNS failures: MaxRetryError(reason=NewConnectionError)
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return not isinstance(reason, requests.packages.urllib3.exceptions.NewConnectionError)
+    return True
+
+class RateLimiter:
+    """Token bucket shared by the threads of one process: at most `rate` calls per second on average."""
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
 class FacebookPublisher:
-    def __init__(self):
+    def __init__(self, graph_url: Optional[str] = None, page_id: Optional[str] = None,
+                 page_access_token: Optional[str] = None):
         """Initialize Facebook Publisher with credentials from environment variables."""
-        self.page_access_token = os.getenv('FACEBOOK_PAGE_ACCESS_TOKEN', '')
-        self.page_id = os.getenv('FACEBOOK_PAGE_ID', '')
+        self.page_access_token = page_access_token if page_access_token is not None else os.getenv('FACEBOOK_PAGE_ACCESS_TOKEN', '')
+        self.page_id = page_id if page_id is not None else os.getenv('FACEBOOK_PAGE_ID', '')
         self.api_version = 'v18.0'
-        self.base_url = f'https://graph.facebook.com/{self.api_version}'
-        
+        self.base_url = f"{(graph_url or os.getenv('FACEBOOK_GRAPH_URL', 'https://graph.facebook.com')).rstrip('/')}/{self.api_version}"
+        self.upload_concurrency = int(os.getenv('FACEBOOK_UPLOAD_CONCURRENCY', 4))  # Photos of one album uploaded at once
+        self.max_retries = int(os.getenv('FACEBOOK_MAX_RETRIES', 4))
+        self.retry_backoff = float(os.getenv('FACEBOOK_RETRY_BACKOFF', 2))  # Seconds, doubled on every retry
+        self.rate_limiter = RateLimiter(float(os.getenv('FACEBOOK_RATE_LIMIT', 5)))  # Calls per second per process
+        self.pool_maxsize = None  # Pooled connections; defaults to upload_concurrency
+        self._session = None
+        self._session_key = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """Pooled HTTP session, one per process (connections must not be shared across a fork) and pool size."""
+        pool_maxsize = max(self.pool_maxsize or self.upload_concurrency, 1)
+        with self._session_lock:
+            if self._session is None or self._session_key != (os.getpid(), pool_maxsize):
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+                self._session_key = (os.getpid(), pool_maxsize)
+            return self._session
+
+    def _call(self, method: str, path: str, timeout: float = 30, idempotent: bool = True, **kwargs) -> Dict:
+        """
+        Make a Graph API call, retrying transient failures with exponential backoff.
+
+        Calls that publish a post are not idempotent: sending one again after a
+        timeout or a 5xx could post twice. They are only retried when Facebook
+        refused them (rate limits) or when the connection failed before anything
+        was sent; other failures raise a GraphAPIError marked ambiguous.
+
+        Args:
+            method: 'GET' or 'POST'
+            path: Path under the versioned base URL, e.g. '<page_id>/photos'
+            timeout: Seconds to wait for the response
+            idempotent: Whether sending the call twice is harmless
+            **kwargs: Passed to requests (params, data, json)
+
+        Returns:
+            The decoded JSON response
+
+        Raises:
+            GraphAPIError: The call failed for good
+        """
+        attempt = 0
+        while True:
+            try:
+                return self._call_once(method, path, timeout, idempotent, **kwargs)
+            except GraphAPIError as e:
+                if not e.retryable or attempt >= self.max_retries:
+                    raise
+                delay = e.retry_after or self.retry_backoff * (2 ** attempt) * random.uniform(0.5, 1)
+                logger.warning(f"Facebook API {method} {path} failed ({e}); retry {attempt + 1} in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+
+    def _call_once(self, method: str, path: str, timeout: float, idempotent: bool, **kwargs) -> Dict:
+        self.rate_limiter.acquire()
+        kwargs.setdefault('params', {})['access_token'] = self.page_access_token
+        try:
+            response = self.session.request(method, f"{self.base_url}/{path}", timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            sent = _request_sent(e)
+            raise GraphAPIError(f"Erè koneksyon: {e}", retryable=idempotent or not sent,
+                                ambiguous=sent and not idempotent)
+
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        if response.status_code == 200 and 'error' not in data:
+            return data
+
+        error = data.get('error', {}) if isinstance(data, dict) else {}
+        code = error.get('code')
+        retry_after = response.headers.get('Retry-After')
+        throttled = response.status_code == 429 or code in RATE_LIMIT_CODES  # Refused: nothing was done
+        transient = response.status_code >= 500 or bool(error.get('is_transient'))
+        raise GraphAPIError(
+            error.get('message') or f"HTTP {response.status_code}",
+            status=response.status_code,
+            code=code,
+            retryable=throttled or (transient and idempotent),
+            retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+            ambiguous=transient and not throttled and not idempotent
+        )
+
     def validate_credentials(self) -> Tuple[bool, str]:
         """
         Validate Facebook credentials.
@@ -21,228 +161,141 @@ class FacebookPublisher:
         """
         if not self.page_access_token:
             return False, "FACEBOOK_PAGE_ACCESS_TOKEN pa konfigire nan anviwònman an."
-        
+
         if not self.page_id:
             return False, "FACEBOOK_PAGE_ID pa konfigire nan anviwònman an."
-        
+
         try:
             # Test API connection
-            url = f"{self.base_url}/me"
-            params = {'access_token': self.page_access_token}
-            response = requests.get(url, params=params, timeout=10)
-            
-            if response.status_code == 200:
-                data = response.json()
-                return True, f"Koneksyon Facebook OK! Paj: {data.get('name', 'Unknown')}"
-            else:
-                error_data = response.json()
-                error_msg = error_data.get('error', {}).get('message', 'Unknown error')
-                return False, f"Erè koneksyon Facebook: {error_msg}"
-                
-        except requests.exceptions.RequestException as e:
+            data = self._call('GET', 'me', timeout=10)
+            return True, f"Koneksyon Facebook OK! Paj: {data.get('name', 'Unknown')}"
+        except GraphAPIError as e:
             logger.error(f"Facebook API connection error: {str(e)}")
-            return False, f"Erè koneksyon: {str(e)}"
-    
-    def publish_ad_to_facebook(self, ad, app_url: str) -> Tuple[bool, str, str]:
+            return False, f"Erè koneksyon Facebook: {e}"
+
+    def build_post(self, ad, app_url: str) -> Tuple[str, List[str]]:
+        """
+        Message and media URLs of an ad's post.
+
+        Returns:
+            (message: str, media_urls: list)
+        """
+        # Prepare ad URL
+        ad_url = f"{app_url}/achte"
+
+        # Prepare message
+        message = f"🎯 {ad.title}\n\n"
+        message += f"📝 {ad.description}\n\n"
+
+        if ad.ad_type == 'sell':
+            message += f"💰 Pri: {ad.price_gkach} Gkach\n\n"
+
+        message += f"🔗 Wè plis detay: {ad_url}\n"
+        message += f"📱 Kontakte nou sou WhatsApp: {ad.user_whatsapp}"
+
+        # Prepare media
+        media_urls = []
+        if ad.media_type == 'images':
+            for img in ad.image_filenames[:10]:  # Facebook allows max 10 images
+                media_urls.append(f"{app_url}/static/uploads/{img}")
+        elif ad.media_type == 'video' and ad.video:
+            media_urls.append(f"{app_url}/static/uploads/{ad.video}")
+        return message, media_urls
+
+    def publish_ad(self, ad, app_url: str, uploaded: Optional[Dict[str, str]] = None,
+                   on_upload: Optional[Callable[[str, str], None]] = None,
+                   on_post: Optional[Callable[[], None]] = None) -> str:
         """
         Publish a single ad to Facebook.
-        
+
         Args:
             ad: Ad object from database
             app_url: Base URL of the application
-            
+            uploaded: Photos of an album already uploaded by an earlier attempt, {photo_url: media_fbid}
+            on_upload: Called as on_upload(photo_url, media_fbid) in this thread after each album photo upload
+            on_post: Called in this thread right before the call that creates the post
+
         Returns:
-            (success: bool, message: str, post_id: str)
+            The Facebook post ID
+
+        Raises:
+            GraphAPIError: Publishing failed; if ambiguous, the post may exist anyway
         """
         if not self.page_access_token or not self.page_id:
-            return False, "Konfigirasyon Facebook pa konplè.", ""
-        
-        try:
-            # Prepare ad URL
-            ad_url = f"{app_url}/achte"
-            
-            # Prepare message
-            message = f"🎯 {ad.title}\n\n"
-            message += f"📝 {ad.description}\n\n"
-            
-            if ad.ad_type == 'sell':
-                message += f"💰 Pri: {ad.price_gkach} Gkach\n\n"
-            
-            message += f"🔗 Wè plis detay: {ad_url}\n"
-            message += f"📱 Kontakte nou sou WhatsApp: {ad.user_whatsapp}"
-            
-            # Prepare media
-            media_urls = []
-            if ad.media_type == 'images' and ad.images:
-                image_list = ad.images.split(',')
-                for img in image_list[:10]:  # Facebook allows max 10 images
-                    media_urls.append(f"{app_url}/static/uploads/{img.strip()}")
-            elif ad.media_type == 'video' and ad.video:
-                media_urls.append(f"{app_url}/static/uploads/{ad.video}")
-            
-            # Publish based on media type
-            if ad.media_type == 'video' and media_urls:
-                # Publish video
-                post_id = self._publish_video(message, media_urls[0])
-            elif media_urls:
-                # Publish photos
-                if len(media_urls) == 1:
-                    post_id = self._publish_single_photo(message, media_urls[0])
-                else:
-                    post_id = self._publish_multiple_photos(message, media_urls)
-            else:
-                # Publish text only
-                post_id = self._publish_text(message)
-            
-            if post_id:
-                return True, "Piblisite pibliye sou Facebook avèk siksè!", post_id
-            else:
-                return False, "Erè nan pibliyasyon Facebook.", ""
-                
-        except Exception as e:
-            logger.error(f"Error publishing ad to Facebook: {str(e)}")
-            return False, f"Erè: {str(e)}", ""
-    
+            raise GraphAPIError("Konfigirasyon Facebook pa konplè.")
+
+        message, media_urls = self.build_post(ad, app_url)
+        on_post = on_post or (lambda: None)
+
+        # Publish based on media type
+        if ad.media_type == 'video' and media_urls:
+            on_post()
+            post_id = self._publish_video(message, media_urls[0])
+        elif len(media_urls) == 1:
+            on_post()
+            post_id = self._publish_single_photo(message, media_urls[0])
+        elif media_urls:
+            post_id = self._publish_multiple_photos(message, media_urls, uploaded, on_upload, on_post)
+        else:
+            on_post()
+            post_id = self._publish_text(message)
+
+        if not post_id:
+            raise GraphAPIError("Facebook pa t bay ID pou post la.")
+        return post_id
+
     def _publish_text(self, message: str) -> str:
         """Publish text-only post."""
-        try:
-            url = f"{self.base_url}/{self.page_id}/feed"
-            data = {
-                'message': message,
-                'access_token': self.page_access_token
-            }
-            
-            response = requests.post(url, data=data, timeout=30)
-            
-            if response.status_code == 200:
-                return response.json().get('id', '')
-            else:
-                logger.error(f"Facebook API error: {response.text}")
-                return ""
-                
-        except Exception as e:
-            logger.error(f"Error publishing text: {str(e)}")
-            return ""
-    
+        return self._call('POST', f"{self.page_id}/feed", idempotent=False, data={'message': message}).get('id', '')
+
     def _publish_single_photo(self, message: str, photo_url: str) -> str:
         """Publish single photo post."""
-        try:
-            url = f"{self.base_url}/{self.page_id}/photos"
-            data = {
-                'message': message,
-                'url': photo_url,
-                'access_token': self.page_access_token
-            }
-            
-            response = requests.post(url, data=data, timeout=30)
-            
-            if response.status_code == 200:
-                return response.json().get('id', '')
-            else:
-                logger.error(f"Facebook API error: {response.text}")
-                return ""
-                
-        except Exception as e:
-            logger.error(f"Error publishing photo: {str(e)}")
-            return ""
-    
-    def _publish_multiple_photos(self, message: str, photo_urls: List[str]) -> str:
+        return self._call('POST', f"{self.page_id}/photos", idempotent=False,
+                          data={'message': message, 'url': photo_url}).get('id', '')
+
+    def _upload_unpublished_photo(self, photo_url: str) -> str:
+        # Unpublished: uploading a photo twice leaves an unused copy, never a duplicate post
+        return self._call('POST', f"{self.page_id}/photos", data={'url': photo_url, 'published': 'false'})['id']
+
+    def _publish_multiple_photos(self, message: str, photo_urls: List[str], uploaded: Optional[Dict[str, str]] = None,
+                                 on_upload: Optional[Callable[[str, str], None]] = None,
+                                 on_post: Callable[[], None] = lambda: None) -> str:
         """Publish multiple photos as album."""
-        try:
-            # Step 1: Upload photos without publishing
-            photo_ids = []
-            for photo_url in photo_urls:
-                url = f"{self.base_url}/{self.page_id}/photos"
-                data = {
-                    'url': photo_url,
-                    'published': 'false',
-                    'access_token': self.page_access_token
-                }
-                
-                response = requests.post(url, data=data, timeout=30)
-                if response.status_code == 200:
-                    photo_ids.append({'media_fbid': response.json().get('id')})
-            
-            if not photo_ids:
-                return ""
-            
-            # Step 2: Publish all photos together
-            url = f"{self.base_url}/{self.page_id}/feed"
-            data = {
-                'message': message,
-                'attached_media': photo_ids,
-                'access_token': self.page_access_token
-            }
-            
-            response = requests.post(url, json=data, timeout=30)
-            
-            if response.status_code == 200:
-                return response.json().get('id', '')
-            else:
-                logger.error(f"Facebook API error: {response.text}")
-                return ""
-                
-        except Exception as e:
-            logger.error(f"Error publishing multiple photos: {str(e)}")
-            return ""
-    
+        uploaded = dict(uploaded or {})
+
+        # Step 1: Upload the photos not uploaded yet, unpublished, several at a time
+        pending = [url for url in photo_urls if url not in uploaded]
+        if pending:
+            errors = []
+            with ThreadPoolExecutor(max_workers=max(1, min(self.upload_concurrency, len(pending))),
+                                    thread_name_prefix='facebook-upload') as pool:
+                futures = {pool.submit(self._upload_unpublished_photo, url): url for url in pending}
+                for future in as_completed(futures):
+                    url = futures[future]
+                    try:
+                        uploaded[url] = future.result()
+                    except GraphAPIError as e:
+                        logger.error(f"Facebook photo upload failed for {url}: {e}")
+                        errors.append(e)
+                        continue
+                    if on_upload:
+                        on_upload(url, uploaded[url])
+            if errors:
+                # The uploaded ones are kept (on_upload), so a retry only uploads the rest
+                raise errors[0]
+
+        # Step 2: Publish all photos together, in the ad's order
+        data = {
+            'message': message,
+            'attached_media': [{'media_fbid': uploaded[url]} for url in photo_urls]
+        }
+        on_post()
+        return self._call('POST', f"{self.page_id}/feed", idempotent=False, json=data).get('id', '')
+
     def _publish_video(self, message: str, video_url: str) -> str:
         """Publish video post."""
-        try:
-            url = f"{self.base_url}/{self.page_id}/videos"
-            data = {
-                'description': message,
-                'file_url': video_url,
-                'access_token': self.page_access_token
-            }
-            
-            response = requests.post(url, data=data, timeout=60)
-            
-            if response.status_code == 200:
-                return response.json().get('id', '')
-            else:
-                logger.error(f"Facebook API error: {response.text}")
-                return ""
-                
-        except Exception as e:
-            logger.error(f"Error publishing video: {str(e)}")
-            return ""
-    
-    def publish_batch_to_facebook(self, ads: List, app_url: str) -> Dict:
-        """
-        Publish multiple ads to Facebook as a batch.
-        
-        Args:
-            ads: List of Ad objects
-            app_url: Base URL of the application
-            
-        Returns:
-            Dictionary with 'successful' and 'failed' lists
-        """
-        results = {
-            'successful': [],
-            'failed': [],
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        for ad in ads:
-            success, message, post_id = self.publish_ad_to_facebook(ad, app_url)
-            
-            if success:
-                results['successful'].append({
-                    'ad_id': ad.ad_id,
-                    'title': ad.title,
-                    'post_id': post_id,
-                    'message': message
-                })
-            else:
-                results['failed'].append({
-                    'ad_id': ad.ad_id,
-                    'title': ad.title,
-                    'error': message
-                })
-        
-        return results
+        return self._call('POST', f"{self.page_id}/videos", timeout=60, idempotent=False,
+                          data={'description': message, 'file_url': video_url}).get('id', '')
 
 # Create singleton instance
 facebook_publisher = FacebookPublisher()
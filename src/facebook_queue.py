@@ -0,0 +1,383 @@
+"""
+Facebook publishing queue.
+
+Publishing an ad means several Graph API calls (one per album photo plus the
+post), each of which can take tens of seconds, so it no longer runs inside
+the admin's request. The admin routes create one FacebookPost row per ad and
+queue a 'publish_facebook' job for it on the media job queue
+(src/media_jobs.py); whichever worker claims the job publishes the ad with
+the pooled, rate-limited client in src/facebook_publisher.py.
+
+Progress and results are stored on the FacebookPost row: its status, the
+Facebook post ID or the error, and the album photos already uploaded, so a
+retried job only uploads the photos that are still missing.
+
+The call that creates the post is never repeated blindly. The post is marked
+'posting' right before it; if that call times out, fails with a 5xx, or its
+job dies, Facebook may have created the post anyway, so the post becomes
+'unconfirmed' and nothing retries it until the admin has checked the page
+(resolve_unconfirmed).
+
+Batches keep a summary of their ads' posts (facebook_status, attempts, last
+error, facebook_published_at). auto_publish_batches.py only looks at batches
+with no facebook_published_at that still hold an ad it can queue, picked in
+SQL: batches whose ads are all rejected, given up on or unconfirmed are never
+loaded again, so a run costs time in proportion to the new work, and a run
+that crashed is simply picked up by the next one.
+"""
+import json
+import logging
+from datetime import datetime
+
+from sqlalchemy import and_, exists, func, or_, select
+
+from models import db, Ad, Batch, BatchAd, FacebookPost, MediaJob
+from src.batches import get_batch_ads, get_batch_ad_ids
+from src.facebook_publisher import GraphAPIError, facebook_publisher
+from src.media_jobs import enqueue, job_handler, wake_worker
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ('queued', 'publishing', 'posting')
+UNCONFIRMED_ERROR = 'Facebook pa t konfime post la; verifye paj la anvan ou pibliye ankò.'
+
+def _latest_posts(ad_ids):
+    """
+    Latest FacebookPost of each ad, and the ads published at least once.
+
+    Posts still marked active whose job is over (e.g. failed by
+    requeue_stale_jobs after its worker died) are marked failed on the way,
+    or unconfirmed if the job died while creating the post.
+
+    :param ad_ids: Ad IDs
+    :return: ({ad_id: latest FacebookPost}, set of published ad IDs)
+    """
+    ad_ids = list(ad_ids)
+    if not ad_ids:
+        return {}, set()
+    rows = (db.session.query(FacebookPost, MediaJob.status, MediaJob.error)
+            .outerjoin(MediaJob, MediaJob.job_id == FacebookPost.job_id)
+            .filter(FacebookPost.ad_id.in_(ad_ids))
+            .order_by(FacebookPost.id)
+            .all())
+    latest, published = {}, set()
+    for post, job_status, job_error in rows:
+        if post.status == 'posting' and job_status not in ('queued', 'running'):
+            post.status = 'unconfirmed'
+            post.error = UNCONFIRMED_ERROR
+        elif post.status in ACTIVE_STATUSES and job_status not in ('queued', 'running'):
+            post.status = 'failed'
+            post.error = job_error or 'Travay pibliyasyon an pa t fini.'
+        if post.status == 'published':
+            published.add(post.ad_id)
+        latest[post.ad_id] = post
+    return latest, published
+
+def enqueue_publish(ads, app_url, batch_id=None, skip_published=False):
+    """
+    Queue ads for publishing. Ads already queued or being published are skipped,
+    and so are ads whose last post is unconfirmed (see resolve_unconfirmed).
+    An ad whose last attempt failed is queued again on the same FacebookPost,
+    so the album photos uploaded by that attempt are not uploaded twice.
+
+    :param ads: Ad objects (approved)
+    :param app_url: Base URL of the application, for the links and media URLs in the posts
+    :param batch_id: Batch the ads are published with, if any
+    :param skip_published: Also skip ads published before
+    :return: The FacebookPost rows queued
+    """
+    latest, published = _latest_posts(ad.ad_id for ad in ads)
+
+    posts = []
+    for ad in ads:
+        post = latest.get(ad.ad_id)
+        if post is not None and post.status in ACTIVE_STATUSES + ('unconfirmed',):
+            continue
+        if skip_published and ad.ad_id in published:
+            continue
+        if post is not None and post.status == 'failed':
+            post.status = 'queued'
+            post.error = None
+            post.batch_id = batch_id or post.batch_id
+        else:
+            post = FacebookPost(ad_id=ad.ad_id, batch_id=batch_id, status='queued')
+            db.session.add(post)
+            db.session.flush()
+        job = enqueue('publish_facebook', ad_id=ad.ad_id, payload={'post': post.id, 'app_url': app_url}, commit=False)
+        post.job_id = job.job_id
+        posts.append(post)
+
+    if batch_id and posts:
+        batch = db.session.get(Batch, batch_id)
+        if batch is not None:
+            batch.facebook_status = 'publishing'
+            batch.facebook_attempts = (batch.facebook_attempts or 0) + 1
+    db.session.commit()
+    if posts:
+        wake_worker()
+    return posts
+
+def refresh_batch_state(batch_id):
+    """
+    Recompute a batch's Facebook state from the posts of its approved ads.
+    Not committed. Batches never queued are left alone.
+
+    :param batch_id: Batch ID
+    :return: The new facebook_status, or None
+    """
+    batch = db.session.get(Batch, batch_id)
+    if batch is None:
+        return None
+    ad_ids = get_batch_ad_ids(batch_id, approved_only=True)
+    latest, published = _latest_posts(ad_ids)
+    if not latest:
+        return batch.facebook_status
+
+    if ad_ids and published.issuperset(ad_ids):
+        batch.facebook_status = 'published'
+        batch.facebook_error = None
+        batch.facebook_published_at = batch.facebook_published_at or datetime.utcnow()
+    else:
+        pending = [post for ad_id, post in latest.items() if ad_id not in published]
+        if any(post.status in ACTIVE_STATUSES for post in pending):
+            batch.facebook_status = 'publishing'
+        elif any(post.status == 'unconfirmed' for post in pending):
+            batch.facebook_status = 'unconfirmed'
+        else:
+            batch.facebook_status = 'partial' if published else 'failed'
+        errors = [post.error for post in pending if post.error]
+        batch.facebook_error = errors[-1] if errors else None
+        batch.facebook_published_at = None
+    return batch.facebook_status
+
+def _approved_members():
+    """Approved ads of the batch of the enclosing query."""
+    return (select(BatchAd.ad_id)
+            .join(Ad, Ad.ad_id == BatchAd.ad_id)
+            .where(BatchAd.batch_id == Batch.batch_id, Ad.admin_status == 'approved'))
+
+def _not_queueable(max_attempts):
+    """
+    The ad of the enclosing query has a post that keeps it from being queued:
+    published, unconfirmed, failed max_attempts times, or still in the job queue.
+    Active posts whose job is over are queueable: _latest_posts marks them failed.
+    """
+    in_queue = exists().where(MediaJob.job_id == FacebookPost.job_id, MediaJob.status.in_(('queued', 'running')))
+    return exists().where(FacebookPost.ad_id == Ad.ad_id, or_(
+        FacebookPost.status.in_(('published', 'unconfirmed')),
+        and_(FacebookPost.status == 'failed', func.coalesce(FacebookPost.attempts, 0) >= max_attempts),
+        and_(FacebookPost.status.in_(ACTIVE_STATUSES), in_queue),
+    ))
+
+def batches_to_publish(max_attempts=3):
+    """
+    Query of the unpublished batches holding at least one ad that can be queued, oldest first.
+
+    :param max_attempts: Ads that failed this many times are not queued again
+    """
+    return (Batch.query
+            .filter(Batch.facebook_published_at.is_(None),
+                    _approved_members().where(~_not_queueable(max_attempts)).exists())
+            .order_by(Batch.created_at))
+
+def finish_published_batches():
+    """
+    Mark published the unpublished batches whose approved ads are all published,
+    e.g. when two ads of a batch finished together or a run crashed right after
+    the last post. Committed.
+
+    :return: Number of batches marked
+    """
+    published = exists().where(FacebookPost.ad_id == Ad.ad_id, FacebookPost.status == 'published')
+    batches = Batch.query.filter(Batch.facebook_published_at.is_(None),
+                                 _approved_members().exists(),
+                                 ~_approved_members().where(~published).exists()).all()
+    for batch in batches:
+        refresh_batch_state(batch.batch_id)
+    db.session.commit()
+    return len(batches)
+
+def queue_unpublished_batches(app_url, max_attempts=3, limit=None):
+    """
+    Queue the ads of batches not published yet that still need publishing.
+
+    Ads already published (with the batch or on their own) are skipped, and so
+    are ads that failed max_attempts times; those need a retry from the admin.
+    Only batches with such an ad are loaded (batches_to_publish), so batches
+    that cannot make progress neither cost anything nor use up the limit.
+
+    :param app_url: Base URL of the application
+    :param max_attempts: Give up on an ad after this many failed attempts
+    :param limit: At most this many batches, oldest first
+    :return: The FacebookPost rows queued
+    """
+    query = batches_to_publish(max_attempts)
+    if limit:
+        query = query.limit(limit)
+
+    queued = []
+    for batch in query.all():
+        ads = get_batch_ads(batch.batch_id, approved_only=True)
+        latest, _ = _latest_posts(ad.ad_id for ad in ads)
+        ads = [ad for ad in ads if not (ad.ad_id in latest and latest[ad.ad_id].status == 'failed'
+                                        and (latest[ad.ad_id].attempts or 0) >= max_attempts)]
+        posts = enqueue_publish(ads, app_url, batch_id=batch.batch_id, skip_published=True)
+        if posts:
+            queued.extend(posts)
+            logger.info(f"Queued {len(posts)} ad(s) of batch {batch.batch_id} for Facebook")
+        else:
+            refresh_batch_state(batch.batch_id)
+            db.session.commit()
+    return queued
+
+def mark_batches_published(before=None):
+    """
+    Record every unpublished batch as published without posting anything, e.g.
+    once on the first deployment with publishing state, when earlier runs of
+    auto_publish_batches.py already posted them.
+
+    :param before: Only batches created before this datetime
+    :return: Number of batches marked
+    """
+    query = Batch.query.filter(Batch.facebook_published_at.is_(None))
+    if before:
+        query = query.filter(Batch.created_at < before)
+    count = query.update({'facebook_status': 'published', 'facebook_published_at': datetime.utcnow()},
+                         synchronize_session=False)
+    db.session.commit()
+    return count
+
+@job_handler('publish_facebook')
+def publish_facebook_job(job, payload):
+    """Publish one ad and record the outcome on its FacebookPost."""
+    post = db.session.get(FacebookPost, payload['post'])
+    if post is None:
+        return {}
+    if post.status == 'published':
+        # The job ran twice (e.g. requeued after a crash right after publishing)
+        return {'post_id': post.post_id}
+    if post.status in ('posting', 'unconfirmed'):
+        # Requeued after its worker died while creating the post: it may be on the page
+        return _mark_unconfirmed(post, UNCONFIRMED_ERROR)
+
+    ad = db.session.get(Ad, post.ad_id)
+    if ad is None or ad.admin_status != 'approved':
+        post.status = 'failed'
+        post.error = 'Piblisite pa jwenn oubyen li pa apwouve.'
+        if post.batch_id:
+            refresh_batch_state(post.batch_id)
+        return {'error': post.error}
+
+    post.status = 'publishing'
+    post.attempts = (post.attempts or 0) + 1
+    post.job_id = job.job_id
+    db.session.commit()
+
+    uploaded = json.loads(post.photo_ids or '{}')
+
+    def on_upload(photo_url, media_fbid):
+        uploaded[photo_url] = media_fbid
+        post.photo_ids = json.dumps(uploaded)
+        db.session.commit()
+
+    def on_post():
+        post.status = 'posting'
+        db.session.commit()
+
+    try:
+        post_id = facebook_publisher.publish_ad(ad, payload['app_url'], uploaded, on_upload, on_post)
+    except Exception as e:
+        ambiguous = e.ambiguous if isinstance(e, GraphAPIError) else post.status == 'posting'
+        if ambiguous:
+            # Not retried: the job ends here and the admin checks the page
+            logger.error(f"Facebook post of ad {ad.ad_id} unconfirmed: {e}")
+            return _mark_unconfirmed(post, f"{UNCONFIRMED_ERROR} ({e})")
+        # Recorded before run_job rolls back and marks the job itself failed
+        post.status = 'failed'
+        post.error = str(e)
+        if post.batch_id:
+            refresh_batch_state(post.batch_id)
+        db.session.commit()
+        raise
+
+    post.status = 'published'
+    post.post_id = post_id
+    post.error = None
+    post.published_at = datetime.utcnow()
+    if post.batch_id:
+        # Two ads of a batch finishing together can race here; the next
+        # auto_publish_batches.py run recomputes the state of unpublished batches
+        refresh_batch_state(post.batch_id)
+    logger.info(f"Published ad {ad.ad_id} to Facebook as {post_id}")
+    return {'post_id': post_id}
+
+def _mark_unconfirmed(post, error):
+    post.status = 'unconfirmed'
+    post.error = error
+    if post.batch_id:
+        refresh_batch_state(post.batch_id)
+    db.session.commit()
+    return {'error': error}
+
+def resolve_unconfirmed(post_id, found, app_url, facebook_post_id=None):
+    """
+    Settle an unconfirmed post once the admin has checked the Facebook page.
+
+    :param post_id: FacebookPost ID
+    :param found: Whether the post is on the page; if not, the ad is queued again
+    :param app_url: Base URL of the application, for the new attempt
+    :param facebook_post_id: ID of the post found on the page, if known
+    :return: The FacebookPost, or None if it is not unconfirmed
+    """
+    post = db.session.get(FacebookPost, post_id)
+    if post is None or post.status != 'unconfirmed':
+        return None
+    if found:
+        post.status = 'published'
+        post.post_id = facebook_post_id or post.post_id
+        post.error = None
+        post.published_at = datetime.utcnow()
+        if post.batch_id:
+            refresh_batch_state(post.batch_id)
+        db.session.commit()
+        return post
+
+    # Queued again on the same row, keeping the album photos already uploaded
+    post.status = 'failed'
+    ad = db.session.get(Ad, post.ad_id)
+    if ad is None or ad.admin_status != 'approved':
+        post.error = 'Piblisite pa jwenn oubyen li pa apwouve.'
+        db.session.commit()
+        return post
+    enqueue_publish([ad], app_url, batch_id=post.batch_id)
+    return post
+
+def get_publish_results(batch_id=None, limit=50):
+    """
+    Latest publishing results for the admin, newest first.
+
+    :param batch_id: Only the posts of this batch
+    :param limit: Maximum number of posts
+    :return: Dict with 'successful', 'failed', 'unconfirmed' and 'pending' lists and the latest 'timestamp'
+    """
+    query = db.session.query(FacebookPost, Ad.title).outerjoin(Ad, Ad.ad_id == FacebookPost.ad_id)
+    if batch_id:
+        query = query.filter(FacebookPost.batch_id == batch_id)
+    rows = query.order_by(FacebookPost.created_at.desc(), FacebookPost.id.desc()).limit(limit).all()
+
+    results = {'successful': [], 'failed': [], 'unconfirmed': [], 'pending': [], 'timestamp': None}
+    for post, title in rows:
+        item = {'id': post.id, 'ad_id': post.ad_id, 'title': title, 'status': post.status, 'attempts': post.attempts,
+                'post_id': post.post_id, 'error': post.error}
+        if post.status == 'published':
+            item['message'] = f"Pibliye {post.published_at:%Y-%m-%d %H:%M}" if post.published_at else ''
+            results['successful'].append(item)
+        elif post.status == 'failed':
+            results['failed'].append(item)
+        elif post.status == 'unconfirmed':
+            results['unconfirmed'].append(item)
+        else:
+            results['pending'].append(item)
+    if rows:
+        results['timestamp'] = rows[0][0].created_at.isoformat()
+    return results
@@ -1,73 +1,236 @@
+"""
+Animated previews of multi-image ads.
+
+An approved ad with several images gets a looping slideshow of them,
+rendered by the 'render_animation' media job (src/media_jobs.py), never in a
+request:
+
+- <key>.webp  animated WebP, the small primary format
+- <key>.gif   GIF fallback, quantised to one optimised palette for all frames
+- <key>.mp4   optional short H.264 loop (ANIMATION_FORMATS=webp,gif,mp4), for
+              <video autoplay loop muted playsinline>
+
+Frames keep the images' aspect ratio: every image is fitted into a canvas
+shaped like the first one and letterboxed. Sources are decoded one at a
+time (JPEGs in draft mode, straight at about the frame size), so only the
+small frames are held, and the MP4 encoder is fed frame by frame over a pipe.
+
+Outputs live in MEDIA_VARIANTS_FOLDER/animations and are named by a hash of
+the source images' bytes and the render settings, so re-approving an ad or
+re-processing its images only re-renders when the pixels actually changed.
+A small <ad_id>.json pointer records each ad's current animation.
+
+The render functions only touch files, so they run in the media process pool.
+"""
+import hashlib
+import json
+import logging
 import os
-import imageio
-from PIL import Image
+import subprocess
+import threading
+
 from flask import current_app
 
-def create_gif_from_images(image_paths, output_path, duration=1.0):
+from src.lazy_imports import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+ANIMATION_EXTENSIONS = {'webp': 'webp', 'gif': 'gif', 'mp4': 'mp4'}
+
+WEBP_QUALITY = 70
+MP4_FRAME_RATE = 10  # Output frame rate; each image is repeated for its duration
+BACKGROUND = (255, 255, 255)
+
+def _animations_folder(variants_folder):
+    return os.path.join(variants_folder, 'animations')
+
+def animation_key(image_paths, size, duration):
+    """
+    Content hash of the source images and the render settings.
+
+    :param image_paths: Full paths of the images, in slideshow order
+    :param size: Longest side of the frames in pixels
+    :param duration: Seconds per image
+    :return: Hex digest naming the outputs
+    """
+    digest = hashlib.sha256(f"v1|{size}|{duration}|{len(image_paths)}".encode())
+    for path in image_paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        digest.update(b'\0')
+    return digest.hexdigest()[:32]
+
+def _canvas_size(first_path, size):
+    """Frame size: the first image's aspect ratio, longest side `size`, even dimensions (for H.264)."""
+    with Image.open(first_path) as img:
+        img = ImageOps.exif_transpose(img)
+        width, height = img.size
+    scale = size / max(width, height)
+    return max(2, round(width * scale) // 2 * 2), max(2, round(height * scale) // 2 * 2)
+
+def iter_frames(image_paths, canvas):
+    """
+    Yield the letterboxed frames one at a time.
+
+    :param image_paths: Full paths of the images
+    :param canvas: (width, height) of the frames
+    """
+    for path in image_paths:
+        with Image.open(path) as img:
+            img.draft('RGB', canvas)  # JPEG: decode at reduced scale
+            img = ImageOps.exif_transpose(img)
+            if img.mode != 'RGB':
+                rgba = img.convert('RGBA')
+                img = Image.new('RGB', rgba.size, BACKGROUND)
+                img.paste(rgba, mask=rgba.split()[-1])
+            yield ImageOps.pad(img, canvas, Image.LANCZOS, color=BACKGROUND)
+
+def _tmp_path(path):
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp{os.path.splitext(path)[1]}"
+
+def _save_webp(frames, path, duration_ms):
+    tmp_path = _tmp_path(path)
+    frames[0].save(tmp_path, 'WEBP', save_all=True, append_images=frames[1:], duration=duration_ms,
+                   loop=0, quality=WEBP_QUALITY, method=4)
+    os.replace(tmp_path, path)
+
+def _save_gif(frames, path, duration_ms):
+    """One adaptive palette built from all frames, so colours do not flicker between them."""
+    thumb_height = 64
+    thumbs = [frame.resize((max(1, frame.width * thumb_height // frame.height), thumb_height)) for frame in frames]
+    strip = Image.new('RGB', (sum(thumb.width for thumb in thumbs), thumb_height))
+    x = 0
+    for thumb in thumbs:
+        strip.paste(thumb, (x, 0))
+        x += thumb.width
+    palette = strip.quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+
+    quantised = [frame.quantize(palette=palette, dither=Image.Dither.FLOYDSTEINBERG) for frame in frames]
+    tmp_path = _tmp_path(path)
+    quantised[0].save(tmp_path, 'GIF', save_all=True, append_images=quantised[1:], duration=duration_ms,
+                      loop=0, optimize=True)
+    os.replace(tmp_path, path)
+
+def _save_mp4(image_paths, canvas, path, duration, timeout=120):
+    """Pipe raw frames to ffmpeg one at a time; each image lasts `duration` seconds."""
+    from src.video_processing import get_ffmpeg
+
+    tmp_path = _tmp_path(path)
+    width, height = canvas
+    cmd = [get_ffmpeg(), '-y', '-loglevel', 'error',
+           '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-framerate', f'1/{duration}', '-i', '-',
+           '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-r', str(MP4_FRAME_RATE), '-an', '-movflags', '+faststart',
+           tmp_path]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        try:
+            for frame in iter_frames(image_paths, canvas):
+                process.stdin.write(frame.tobytes())
+        finally:
+            process.stdin.close()
+        stderr = process.stderr.read()
+        if process.wait(timeout) != 0 or not os.path.exists(tmp_path):
+            raise RuntimeError(stderr.decode(errors='replace').strip()[-500:] or 'ffmpeg produced no output')
+        os.replace(tmp_path, path)
+    finally:
+        if process.poll() is None:
+            process.kill()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def render_animation(image_paths, variants_folder, size=480, duration=1.0, formats=('webp', 'gif')):
     """
-    Create a GIF from a list of image paths.
+    Render the animation of a set of images, unless it already exists.
 
-    :param image_paths: List of paths to images
-    :param output_path: Path to save the GIF
-    :param duration: Duration between frames in seconds
-    :return: Path to the created GIF or None if failed
+    :param image_paths: Full paths of the images, in slideshow order
+    :param variants_folder: MEDIA_VARIANTS_FOLDER; outputs go to its 'animations' subfolder
+    :param size: Longest side of the frames in pixels
+    :param duration: Seconds per image
+    :param formats: Any of 'webp', 'gif' and 'mp4'
+    :return: Dict with the 'key', the 'files' per format, and whether anything was 'rendered'
     """
+    folder = _animations_folder(variants_folder)
+    os.makedirs(folder, exist_ok=True)
+    key = animation_key(image_paths, size, duration)
+    files = {fmt: f"{key}.{ANIMATION_EXTENSIONS[fmt]}" for fmt in formats}
+    missing = [fmt for fmt in formats if not os.path.exists(os.path.join(folder, files[fmt]))]
+    if not missing:
+        return {'key': key, 'files': files, 'rendered': False}
+
+    canvas = _canvas_size(image_paths[0], size)
+    duration_ms = int(duration * 1000)
+    if 'webp' in missing or 'gif' in missing:
+        frames = list(iter_frames(image_paths, canvas))
+        if 'webp' in missing:
+            _save_webp(frames, os.path.join(folder, files['webp']), duration_ms)
+        if 'gif' in missing:
+            _save_gif(frames, os.path.join(folder, files['gif']), duration_ms)
+        del frames
+    if 'mp4' in missing:
+        _save_mp4(image_paths, canvas, os.path.join(folder, files['mp4']), duration)
+
+    logger.info(f"Rendered animation {key} ({canvas[0]}x{canvas[1]}, {len(image_paths)} frames): {', '.join(missing)}")
+    return {'key': key, 'files': files, 'rendered': True}
+
+def write_ad_animation(ad_id, variants_folder, animation):
+    """Point an ad at its current animation (the result of render_animation)."""
+    folder = _animations_folder(variants_folder)
+    path = os.path.join(folder, f"{ad_id}.json")
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'w') as f:
+        json.dump({'key': animation['key'], 'files': animation['files']}, f)
+    os.replace(tmp_path, path)
+
+def remove_ad_animation(ad_id, variants_folder):
+    """Forget an ad's animation, e.g. when it no longer has several images. The shared outputs stay."""
+    path = os.path.join(_animations_folder(variants_folder), f"{ad_id}.json")
+    if os.path.exists(path):
+        os.remove(path)
+
+def get_ad_animation(ad_id):
+    """
+    Files of an ad's current animation.
+
+    :param ad_id: The ad ID
+    :return: Dict mapping format to the file path, for the formats rendered; empty if none
+    """
+    folder = _animations_folder(current_app.config['MEDIA_VARIANTS_FOLDER'])
     try:
-        images = []
-        for img_path in image_paths:
-            if os.path.exists(img_path):
-                img = Image.open(img_path)
-                # Resize to a consistent size (e.g., 300x300) to avoid issues
-                img = img.resize((300, 300), Image.Resampling.LANCZOS)
-                images.append(img)
-            else:
-                print(f"Image not found: {img_path}")
-                return None
-
-        if not images:
-            print("No images to create GIF")
-            return None
-
-        # Save as GIF
-        images[0].save(output_path, save_all=True, append_images=images[1:], duration=int(duration * 1000), loop=0)
-        print(f"GIF created successfully: {output_path}")
-        return output_path
-    except Exception as e:
-        print(f"Error creating GIF: {str(e)}")
-        return None
+        with open(os.path.join(folder, f"{ad_id}.json")) as f:
+            files = json.load(f)['files']
+    except (OSError, ValueError, KeyError):
+        return {}
+    paths = {fmt: os.path.join(folder, name) for fmt, name in files.items()}
+    return {fmt: path for fmt, path in paths.items() if os.path.exists(path)}
 
 def get_ad_gif_path(ad_id):
     """
-    Get the path for the GIF file for a given ad_id.
+    Get the path of the GIF for a given ad_id.
 
     :param ad_id: The ad ID
-    :return: Path to the GIF file
+    :return: Path to the GIF file, or None if it has not been rendered
     """
-    upload_folder = current_app.config['UPLOAD_FOLDER']
-    return os.path.join(upload_folder, f"{ad_id}_gif.gif")
+    return get_ad_animation(ad_id).get('gif')
 
-def generate_ad_gif(ad):
+def ad_animation_sources(ad):
     """
-    Generate a GIF for an ad if it has multiple images.
+    Image paths of an ad's animation.
 
     :param ad: The Ad object
-    :return: Path to the GIF or None
+    :return: Full paths of its images, or None if the ad gets no animation (not images, fewer than 2, missing files)
     """
     if ad.media_type != 'images':
         return None
 
-    image_list = ad.images.split(',') if ad.images else []
+    image_list = ad.image_filenames
     if len(image_list) < 2:
-        return None  # Need at least 2 images for a GIF
+        return None  # Need at least 2 images for an animation
 
     upload_folder = current_app.config['UPLOAD_FOLDER']
-    image_paths = [os.path.join(upload_folder, img.strip()) for img in image_list]
-
-    gif_path = get_ad_gif_path(ad.ad_id)
-
-    # Check if GIF already exists
-    if os.path.exists(gif_path):
-        return gif_path
-
-    # Create GIF
-    return create_gif_from_images(image_paths, gif_path)
+    image_paths = [os.path.join(upload_folder, img) for img in image_list]
+    missing = [path for path in image_paths if not os.path.exists(path)]
+    if missing:
+        logger.warning(f"Images not found for the animation of ad {ad.ad_id}: {missing}")
+        return None
+    return image_paths
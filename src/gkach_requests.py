@@ -0,0 +1,66 @@
+"""
+Gkach purchase requests.
+
+Requests used to live as a JSON list in UserGkach.gkach_requests; they are now
+rows in the indexed gkach_requests table. This module holds the backfill from
+the legacy JSON and the paginated admin queue.
+"""
+import json
+import logging
+from datetime import datetime
+
+from models import db, UserGkach, GkachRequest
+
+logger = logging.getLogger(__name__)
+
+def backfill_gkach_requests():
+    """
+    Copy requests from the legacy UserGkach.gkach_requests JSON into the
+    gkach_requests table. Safe to run repeatedly: existing request IDs are skipped.
+
+    :return: Number of requests copied
+    """
+    existing = {row.request_id for row in db.session.query(GkachRequest.request_id).all()}
+    copied = 0
+
+    for user_gkach in UserGkach.query.filter(UserGkach.gkach_requests.isnot(None)).all():
+        try:
+            requests = json.loads(user_gkach.gkach_requests or '[]')
+        except (json.JSONDecodeError, TypeError):
+            logger.error(f"Error parsing gkach_requests for user {user_gkach.user_whatsapp}")
+            continue
+
+        for req in requests:
+            request_id = req.get('request_id')
+            if not request_id or request_id in existing:
+                continue
+            try:
+                requested_at = datetime.fromisoformat(req['requested_at']) if req.get('requested_at') else None
+            except ValueError:
+                requested_at = None
+            db.session.add(GkachRequest(
+                request_id=request_id,
+                user_whatsapp=user_gkach.user_whatsapp,
+                amount=int(req.get('amount') or 0),
+                status=req.get('status', 'pending'),
+                document=req.get('document'),
+                requested_at=requested_at or user_gkach.created_at or datetime.utcnow()
+            ))
+            existing.add(request_id)
+            copied += 1
+
+    db.session.commit()
+    if copied:
+        logger.info(f"Backfilled {copied} Gkach request(s) into gkach_requests")
+    return copied
+
+def get_pending_requests(page=1, per_page=20):
+    """
+    Paginated queue of pending Gkach requests, oldest first.
+
+    :return: Flask-SQLAlchemy Pagination of GkachRequest
+    """
+    return (GkachRequest.query
+            .filter_by(status='pending')
+            .order_by(GkachRequest.requested_at.asc())
+            .paginate(page=page, per_page=per_page, error_out=False))
@@ -0,0 +1,133 @@
+"""
+CPU-bound image processing for uploaded ad images.
+
+These functions only touch files (no Flask app, no database) so the media
+job worker can run them in a separate process.
+"""
+import functools
+import logging
+import os
+import threading
+
+from src.lazy_imports import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# File extension used for each variant format
+VARIANT_EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg', 'avif': 'avif'}
+
+JPEG_QUALITY = 80
+WEBP_QUALITY = 75
+AVIF_QUALITY = 60
+
+@functools.lru_cache(maxsize=None)
+def _can_save(fmt):
+    Image.init()
+    return fmt.upper() in Image.SAVE
+
+def supported_formats(formats):
+    """Drop formats this Pillow build cannot write (AVIF needs a plugin)."""
+    return [fmt for fmt in formats if _can_save(fmt)]
+
+def variant_name(filename, width, fmt):
+    """
+    Name of a resized variant, e.g. 'abc_photo.jpg' -> 'abc_photo-640w.webp'.
+
+    :param filename: Original upload filename
+    :param width: Variant width in pixels
+    :param fmt: 'webp', 'jpeg' or 'avif'
+    """
+    stem = os.path.splitext(filename)[0]
+    return f"{stem}-{width}w.{VARIANT_EXTENSIONS[fmt]}"
+
+def _save_atomic(img, path, fmt, **options):
+    """Write to a temporary file and rename so readers never see a half-written image."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    img.save(tmp_path, fmt, **options)
+    os.replace(tmp_path, path)
+
+def _flatten(img):
+    """RGB copy of an image, with transparency composited onto white (for JPEG)."""
+    if img.mode == 'RGB':
+        return img
+    if img.mode in ('RGBA', 'LA', 'P'):
+        rgba = img.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.split()[-1])
+        return background
+    return img.convert('RGB')
+
+def save_variant(img, path, fmt):
+    """Encode one variant in the given format."""
+    if fmt == 'jpeg':
+        _save_atomic(_flatten(img), path, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    elif fmt == 'webp':
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() or img.mode == 'P' else 'RGB')
+        _save_atomic(img, path, 'WEBP', quality=WEBP_QUALITY, method=4)
+    elif fmt == 'avif':
+        _save_atomic(_flatten(img), path, 'AVIF', quality=AVIF_QUALITY)
+    else:
+        raise ValueError(f"Unknown variant format: {fmt}")
+
+def process_upload(image_path, variants_folder, widths, formats):
+    """
+    Normalise an uploaded image in place and write its responsive variants.
+
+    The original is rotated according to its EXIF orientation and re-encoded
+    (JPEG at quality 80, PNG optimised). A variant is written for every width
+    smaller than the image, in every requested format.
+
+    :param image_path: Full path of the uploaded image
+    :param variants_folder: Folder receiving the resized variants
+    :param widths: Iterable of target widths in pixels
+    :param formats: Iterable of 'webp', 'jpeg' and/or 'avif'
+    :return: Dict with the final 'width', 'height' and the list of 'variants' filenames
+    """
+    filename = os.path.basename(image_path)
+    os.makedirs(variants_folder, exist_ok=True)
+
+    with Image.open(image_path) as original:
+        fmt = original.format
+        rotated = original.getexif().get(0x0112, 1) not in (None, 1)
+        img = ImageOps.exif_transpose(original)
+        img.load()
+
+    if fmt in ('JPEG', 'MPO'):
+        _save_atomic(_flatten(img), image_path, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    elif fmt == 'PNG':
+        _save_atomic(img, image_path, 'PNG', optimize=True)
+    elif rotated:
+        _save_atomic(img, image_path, fmt)
+    # GIF and others are otherwise left as uploaded
+
+    variants = []
+    width, height = img.size
+    for target in sorted(set(int(w) for w in widths)):
+        if target >= width:
+            continue
+        resized = img.resize((target, max(1, round(height * target / width))), Image.LANCZOS)
+        for variant_fmt in formats:
+            name = variant_name(filename, target, variant_fmt)
+            save_variant(resized, os.path.join(variants_folder, name), variant_fmt)
+            variants.append(name)
+
+    logger.info(f"Processed {filename}: {width}x{height}, {len(variants)} variant(s)")
+    return {'width': width, 'height': height, 'variants': variants}
+
+def make_variant(image_path, variants_folder, width, fmt):
+    """
+    Write a single variant of an image (used for legacy uploads that were
+    never processed). Images narrower than width are encoded at their own size.
+
+    :return: Filename of the variant inside variants_folder
+    """
+    name = variant_name(os.path.basename(image_path), width, fmt)
+    os.makedirs(variants_folder, exist_ok=True)
+    with Image.open(image_path) as original:
+        img = ImageOps.exif_transpose(original)
+        img.load()
+    if width < img.size[0]:
+        img = img.resize((width, max(1, round(img.size[1] * width / img.size[0]))), Image.LANCZOS)
+    save_variant(img, os.path.join(variants_folder, name), fmt)
+    return name
@@ -0,0 +1,182 @@
+"""
+Opt-in per-request instrumentation.
+
+Enabled with INSTRUMENTATION=on. When off, init_instrumentation() returns
+before registering anything, so requests and queries run exactly as before.
+
+When on, every request gets:
+- its SQL statements counted and timed through SQLAlchemy's
+  before_cursor_execute/after_cursor_execute events
+- a Server-Timing header (db and app time) visible in the browser devtools
+- a stack sample every PROFILE_SAMPLE_INTERVAL_MS from one shared sampler
+  thread, kept only when the request turns out to be slow
+
+Requests slower than SLOW_REQUEST_THRESHOLD_MS are written as one JSON line
+to SLOW_REQUEST_LOG with their top queries and hottest stacks (folded,
+root first, ready for flamegraph.pl).
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from logging.handlers import RotatingFileHandler
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+slow_log = logging.getLogger('glory2yahpub.slow_requests')
+
+TOP_QUERIES = 10
+TOP_STACKS = 20
+MAX_STACK_DEPTH = 40
+
+
+class StackSampler:
+    """Samples the stacks of the threads currently serving requests."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = {}  # thread ident -> Counter of folded stacks
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Start the sampling thread, once per process (forked workers need their own)."""
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def begin(self, ident):
+        self._active[ident] = Counter()
+
+    def end(self, ident):
+        """Stop sampling a thread and return its Counter of folded stacks."""
+        return self._active.pop(ident, None) or Counter()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self._active:
+                continue
+            frames = sys._current_frames()
+            for ident, samples in list(self._active.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    samples[fold_stack(frame)] += 1
+
+
+def fold_stack(frame):
+    """'file:function' frames from the outermost call to frame, joined by ';'."""
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_start_time'].pop()
+    if has_request_context():
+        state = g.get('instrumentation')
+        if state is not None:
+            state['queries'].append((statement, time.perf_counter() - started))
+
+
+def _top_queries(queries):
+    totals = {}
+    for statement, seconds in queries:
+        count, total = totals.get(statement, (0, 0.0))
+        totals[statement] = (count + 1, total + seconds)
+    ranked = sorted(totals.items(), key=lambda item: item[1][1], reverse=True)[:TOP_QUERIES]
+    return [{'sql': ' '.join(statement.split())[:500], 'count': count, 'total_ms': round(total * 1000, 2)}
+            for statement, (count, total) in ranked]
+
+
+def init_instrumentation(app):
+    """
+    Install the hooks when INSTRUMENTATION is on; do nothing otherwise.
+
+    :return: True if instrumentation was installed
+    """
+    if not app.config.get('INSTRUMENTATION'):
+        return False
+
+    threshold = app.config.get('SLOW_REQUEST_THRESHOLD_MS', 500) / 1000
+    interval = app.config.get('PROFILE_SAMPLE_INTERVAL_MS', 5) / 1000
+    sampler = StackSampler(interval) if interval else None
+
+    log_path = app.config.get('SLOW_REQUEST_LOG')
+    if log_path and not any(getattr(handler, 'baseFilename', None) == os.path.abspath(log_path)
+                            for handler in slow_log.handlers):
+        os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+        slow_log.addHandler(RotatingFileHandler(log_path, maxBytes=10 * 1024 * 1024, backupCount=3))
+        slow_log.setLevel(logging.INFO)
+        slow_log.propagate = False
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_instrumentation():
+        g.instrumentation = {'started': time.perf_counter(), 'queries': []}
+        if sampler:
+            sampler.start()
+            sampler.begin(threading.get_ident())
+
+    @app.after_request
+    def finish_instrumentation(response):
+        state = g.pop('instrumentation', None)
+        if state is None:
+            return response
+        elapsed = time.perf_counter() - state['started']
+        stacks = sampler.end(threading.get_ident()) if sampler else Counter()
+        queries = state['queries']
+        db_seconds = sum(seconds for _, seconds in queries)
+
+        response.headers['Server-Timing'] = (
+            f'db;dur={db_seconds * 1000:.1f};desc="{len(queries)} queries", '
+            f'app;dur={(elapsed - db_seconds) * 1000:.1f}, total;dur={elapsed * 1000:.1f}'
+        )
+
+        if elapsed >= threshold:
+            entry = {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'method': request.method,
+                'path': request.full_path.rstrip('?'),
+                'endpoint': request.endpoint,
+                'status': response.status_code,
+                'duration_ms': round(elapsed * 1000, 1),
+                'query_count': len(queries),
+                'query_ms': round(db_seconds * 1000, 1),
+                'top_queries': _top_queries(queries),
+                'profile_interval_ms': app.config.get('PROFILE_SAMPLE_INTERVAL_MS', 5),
+                'profile': [{'stack': stack, 'samples': count} for stack, count in stacks.most_common(TOP_STACKS)],
+            }
+            slow_log.info(json.dumps(entry))
+            logger.warning(f"Slow request {request.method} {request.path}: {elapsed * 1000:.0f}ms, "
+                           f"{len(queries)} queries ({db_seconds * 1000:.0f}ms)")
+        return response
+
+    @app.teardown_request
+    def stop_sampling(exc):
+        # after_request is skipped when a response could not be produced at all
+        if sampler:
+            sampler.end(threading.get_ident())
+
+    logger.info(f"Request instrumentation on (slow threshold {threshold * 1000:.0f}ms)")
+    return True
@@ -0,0 +1,55 @@
+"""
+Lazy stand-ins for heavy optional dependencies.
+
+cv2, numpy, PIL, requests and friends add hundreds of milliseconds and tens
+of MB to every gunicorn worker when imported at module load, although most
+requests never touch them. Modules that need them import the facade instead:
+
+    from src.lazy_imports import cv2, np
+
+and the real module is imported on first attribute access.
+"""
+import importlib
+import sys
+import threading
+import types
+
+_lock = threading.Lock()
+
+class LazyModule(types.ModuleType):
+    """Module proxy that imports the real module on first attribute access."""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_lazy_target'] = name
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            with _lock:
+                module = self.__dict__['_lazy_module']
+                if module is None:
+                    module = importlib.import_module(self.__dict__['_lazy_target'])
+                    self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_lazy_module'] is not None else 'not loaded'
+        return f"<lazy module '{self.__dict__['_lazy_target']}' ({state})>"
+
+def lazy_module(name):
+    """Return the module if already imported, else a proxy that imports it on first use."""
+    return sys.modules.get(name) or LazyModule(name)
+
+cv2 = lazy_module('cv2')
+np = lazy_module('numpy')
+Image = lazy_module('PIL.Image')
+ImageOps = lazy_module('PIL.ImageOps')
+requests = lazy_module('requests')
@@ -0,0 +1,171 @@
+"""
+Gkach ledger.
+
+Every balance movement is an append-only row in gkach_ledger. A transfer is a
+set of postings that sum to zero, applied inside the caller's transaction so
+the money moves in the same commit as the delivery or request it pays for.
+
+UserGkach.gkach_balance is kept as the cached balance of each user account.
+Debits are a single conditional UPDATE ... WHERE gkach_balance >= :amount, so
+two workers can never spend the same Gkach: on PostgreSQL the UPDATE takes the
+row lock, on SQLite it takes the database write lock (the driver only opens
+the transaction at the first write, which makes it behave like BEGIN IMMEDIATE).
+
+Money entering or leaving the system goes through 'system:' accounts, which
+have no cached balance:
+
+- system:mint    Gkach bought with real money, admin adjustments, opening balances
+- system:escrow  Gkach paid by a buyer and held until delivery is confirmed
+"""
+import logging
+import uuid
+from collections import defaultdict
+
+from sqlalchemy import func, update
+
+from models import db, UserGkach, GkachLedgerEntry, Delivery
+
+logger = logging.getLogger(__name__)
+
+MINT_ACCOUNT = 'system:mint'
+ESCROW_ACCOUNT = 'system:escrow'
+
+class InsufficientGkach(Exception):
+    """Raised when a debit would take an account below zero."""
+
+    def __init__(self, account, amount):
+        super().__init__(f"Insufficient Gkach in {account} for {amount}")
+        self.account = account
+        self.amount = amount
+
+def is_system_account(account):
+    return account.startswith('system:')
+
+def transfer(postings, kind, reference=None):
+    """
+    Apply a balanced transfer within the current transaction (the caller commits).
+
+    :param postings: List of (account, amount) pairs; negative amounts debit,
+                     positive amounts credit, and they must sum to zero
+    :param kind: Short label stored on every posting (e.g. 'checkout')
+    :param reference: Optional delivery/request ID stored on every posting
+    :return: The transfer ID
+    :raises InsufficientGkach: If a user account cannot cover its debit; the
+                               caller must roll back
+    """
+    totals = defaultdict(int)
+    for account, amount in postings:
+        totals[account] += int(round(amount))
+    if sum(totals.values()) != 0:
+        raise ValueError(f"Unbalanced {kind} transfer: {dict(totals)}")
+
+    transfer_id = str(uuid.uuid4())
+    # Fixed lock order so two transfers touching the same accounts cannot deadlock
+    for account in sorted(totals):
+        amount = totals[account]
+        if amount == 0:
+            continue
+        balance_after = None if is_system_account(account) else _apply(account, amount)
+        db.session.add(GkachLedgerEntry(
+            transfer_id=transfer_id,
+            account=account,
+            amount=amount,
+            balance_after=balance_after,
+            kind=kind,
+            reference=reference
+        ))
+    db.session.flush()
+    return transfer_id
+
+def _apply(account, amount):
+    """Move a user's cached balance by amount and return the new balance."""
+    stmt = (update(UserGkach)
+            .where(UserGkach.user_whatsapp == account)
+            .values(gkach_balance=UserGkach.gkach_balance + amount)
+            .returning(UserGkach.gkach_balance)
+            .execution_options(synchronize_session='fetch'))
+    if amount < 0:
+        stmt = stmt.where(UserGkach.gkach_balance >= -amount)
+
+    balance = db.session.execute(stmt).scalar_one_or_none()
+    if balance is not None:
+        return balance
+    if amount < 0:
+        raise InsufficientGkach(account, -amount)
+
+    # First credit for a seller without a Gkach account. Two transfers can get
+    # here at once: the row is created empty by whichever comes first, then credited
+    _create_account(account)
+    return db.session.execute(stmt).scalar_one()
+
+def _create_account(account):
+    """Create an empty UserGkach row unless it exists; a concurrent insert is not an error."""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    db.session.execute(insert(UserGkach).values(user_whatsapp=account, gkach_balance=0)
+                       .on_conflict_do_nothing(index_elements=['user_whatsapp']))
+
+def get_balance(account):
+    """Current balance of an account: cached for users, summed from the ledger for system accounts."""
+    if is_system_account(account):
+        return ledger_balance(account)
+    balance = db.session.query(UserGkach.gkach_balance).filter_by(user_whatsapp=account).scalar()
+    return balance or 0
+
+def ledger_balance(account):
+    """Balance of an account derived from its postings."""
+    return db.session.query(func.coalesce(func.sum(GkachLedgerEntry.amount), 0)).filter_by(account=account).scalar()
+
+def find_drift():
+    """
+    Compare cached user balances with the ledger.
+
+    :return: Dict mapping account to (cached balance, ledger balance) for every mismatch
+    """
+    sums = dict(db.session.query(GkachLedgerEntry.account, func.sum(GkachLedgerEntry.amount))
+                .group_by(GkachLedgerEntry.account).all())
+    drift = {}
+    for account, balance in db.session.query(UserGkach.user_whatsapp, UserGkach.gkach_balance).all():
+        expected = sums.get(account, 0)
+        if (balance or 0) != expected:
+            drift[account] = (balance or 0, expected)
+    return drift
+
+def backfill_opening_balances():
+    """
+    Record opening postings for balances that predate the ledger: every user
+    account with no postings yet, and the Gkach already held in escrow for
+    deliveries awaiting confirmation. Safe to run repeatedly.
+
+    :return: Number of accounts opened
+    """
+    with_postings = {row.account for row in db.session.query(GkachLedgerEntry.account).distinct().all()}
+    opened = 0
+
+    for user_gkach in UserGkach.query.filter(UserGkach.gkach_balance != 0).all():
+        if user_gkach.user_whatsapp in with_postings:
+            continue
+        _record_opening(user_gkach.user_whatsapp, user_gkach.gkach_balance, user_gkach.gkach_balance)
+        opened += 1
+
+    if ESCROW_ACCOUNT not in with_postings:
+        held = (db.session.query(func.coalesce(func.sum(Delivery.total_price + func.coalesce(Delivery.delivery_cost, 0)), 0))
+                .filter(Delivery.status == 'awaiting_delivery')
+                .scalar())
+        held = int(round(held or 0))
+        if held:
+            _record_opening(ESCROW_ACCOUNT, held, None)
+            opened += 1
+
+    db.session.commit()
+    if opened:
+        logger.info(f"Recorded opening ledger balances for {opened} account(s)")
+    return opened
+
+def _record_opening(account, amount, balance_after):
+    transfer_id = str(uuid.uuid4())
+    db.session.add(GkachLedgerEntry(transfer_id=transfer_id, account=MINT_ACCOUNT, amount=-amount, kind='opening'))
+    db.session.add(GkachLedgerEntry(transfer_id=transfer_id, account=account, amount=amount,
+                                    balance_after=balance_after, kind='opening'))
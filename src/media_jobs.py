@@ -0,0 +1,343 @@
+"""
+Background media job queue.
+
+Slow media work (image re-encoding, responsive variants, ...) runs after the
+request that triggered it has committed. Jobs are rows in the media_jobs
+table, so no external broker is needed and every gunicorn worker (or a
+standalone `python media_worker.py`) can pick them up:
+
+- enqueue() inserts a job and wakes the worker thread of this process
+- a worker claims the oldest queued job with a conditional UPDATE, so two
+  workers never run the same job
+- CPU-bound PIL work is handed to a process pool, keeping the GIL free for
+  the web threads
+
+Handlers are registered per job kind with @job_handler('kind') and return a
+JSON-serialisable result stored on the job.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from models import db, Ad, MediaJob
+from src.batches import get_ad_batch_id
+from src.page_cache import bump_content_version
+
+logger = logging.getLogger(__name__)
+
+JOB_STATUSES = ('queued', 'running', 'done', 'failed')
+
+HANDLERS = {}
+
+_wakeup = threading.Event()
+_worker_thread = None
+_worker_pid = None
+_pool = None
+_pool_lock = threading.Lock()
+
+def job_handler(kind):
+    """Register the function that runs jobs of the given kind."""
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+def _worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def enqueue(kind, ad_id=None, payload=None, commit=True):
+    """
+    Queue a media job.
+
+    :param kind: Registered job kind, e.g. 'process_images'
+    :param ad_id: Ad the job belongs to, shown as its processing state in the admin
+    :param payload: JSON-serialisable arguments for the handler
+    :param commit: Commit the session when done
+    :return: The MediaJob
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f"No media job handler for {kind}")
+    job = MediaJob(job_id=str(uuid.uuid4()), kind=kind, ad_id=ad_id,
+                   payload=json.dumps(payload or {}), status='queued')
+    db.session.add(job)
+    if commit:
+        db.session.commit()
+        _wakeup.set()
+    return job
+
+def wake_worker():
+    """Wake this process's worker, e.g. after committing jobs queued with commit=False."""
+    _wakeup.set()
+
+def claim_next_job(kinds=None):
+    """
+    Atomically take the oldest queued job.
+
+    :param kinds: Only take jobs of these kinds
+    :return: The claimed MediaJob, or None when the queue is empty
+    """
+    while True:
+        query = db.session.query(MediaJob.id).filter(MediaJob.status == 'queued')
+        if kinds:
+            query = query.filter(MediaJob.kind.in_(kinds))
+        candidate = (query
+                     .order_by(MediaJob.created_at, MediaJob.id)
+                     .first())
+        if candidate is None:
+            return None
+        claimed = MediaJob.query.filter_by(id=candidate.id, status='queued').update({
+            'status': 'running',
+            'worker': _worker_name(),
+            'started_at': datetime.utcnow(),
+            'attempts': MediaJob.attempts + 1
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return db.session.get(MediaJob, candidate.id)
+        # Another worker got it first; try the next one
+
+def run_job(job):
+    """Run a claimed job and record its result or error."""
+    try:
+        result = HANDLERS[job.kind](job, json.loads(job.payload or '{}'))
+        job.status = 'done'
+        job.result = json.dumps(result) if result is not None else None
+        job.error = None
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Media job {job.job_id} ({job.kind}) failed: {e}")
+        job.status = 'failed'
+        job.error = str(e)
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+def run_pending_jobs(limit=None, kinds=None):
+    """
+    Run queued jobs in this thread until the queue is empty.
+
+    :param limit: Stop after this many jobs
+    :param kinds: Only run jobs of these kinds
+    :return: Number of jobs run
+    """
+    count = 0
+    while limit is None or count < limit:
+        job = claim_next_job(kinds)
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+def requeue_stale_jobs():
+    """
+    Put back jobs whose worker died mid-run (still 'running' after
+    MEDIA_JOB_TIMEOUT seconds), or fail them after MEDIA_JOB_MAX_ATTEMPTS.
+
+    :return: Number of jobs requeued or failed
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config.get('MEDIA_JOB_TIMEOUT', 600))
+    max_attempts = current_app.config.get('MEDIA_JOB_MAX_ATTEMPTS', 3)
+    stale = MediaJob.query.filter(MediaJob.status == 'running', MediaJob.started_at < cutoff)
+    failed = stale.filter(MediaJob.attempts >= max_attempts).update(
+        {'status': 'failed', 'error': 'Timed out', 'finished_at': datetime.utcnow()}, synchronize_session=False)
+    requeued = stale.filter(MediaJob.attempts < max_attempts).update(
+        {'status': 'queued', 'worker': None}, synchronize_session=False)
+    db.session.commit()
+    return failed + requeued
+
+def retry_job(job_id):
+    """Queue a failed job again. Returns True if it was requeued."""
+    retried = MediaJob.query.filter_by(job_id=job_id, status='failed').update(
+        {'status': 'queued', 'error': None, 'worker': None}, synchronize_session=False)
+    db.session.commit()
+    if retried:
+        _wakeup.set()
+    return bool(retried)
+
+def job_to_dict(job):
+    return {
+        'job_id': job.job_id,
+        'kind': job.kind,
+        'ad_id': job.ad_id,
+        'status': job.status,
+        'attempts': job.attempts,
+        'error': job.error,
+        'result': json.loads(job.result) if job.result else None,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+
+def get_job_status(job_id):
+    """Status of a single job as a dict, or None if it does not exist."""
+    job = MediaJob.query.filter_by(job_id=job_id).first()
+    return job_to_dict(job) if job else None
+
+def get_ad_processing_state(ad_ids):
+    """
+    Summarise the media jobs of several ads with a single grouped query.
+
+    :param ad_ids: Iterable of ad IDs
+    :return: Dict mapping ad_id to 'failed', 'running', 'queued' or 'done'
+             (the most urgent status among its jobs); ads without jobs are omitted
+    """
+    ad_ids = list(ad_ids)
+    if not ad_ids:
+        return {}
+    rows = (db.session.query(MediaJob.ad_id, MediaJob.status)
+            .filter(MediaJob.ad_id.in_(ad_ids))
+            .group_by(MediaJob.ad_id, MediaJob.status)
+            .all())
+    urgency = {'failed': 0, 'running': 1, 'queued': 2, 'done': 3}
+    states = {}
+    for ad_id, status in rows:
+        if ad_id not in states or urgency[status] < urgency[states[ad_id]]:
+            states[ad_id] = status
+    return states
+
+def get_process_pool():
+    """
+    Process pool for CPU-bound work, created lazily in each worker process.
+    Returns None when MEDIA_PROCESS_WORKERS is 0 (run inline instead).
+    """
+    global _pool
+    workers = current_app.config.get('MEDIA_PROCESS_WORKERS', 1)
+    if not workers:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # spawn: children must not inherit the web worker's DB connections and locks
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+def run_cpu_bound(func, *args):
+    """Run func(*args) in the process pool (or inline) and return its result."""
+    pool = get_process_pool()
+    if pool is None:
+        return func(*args)
+    return pool.submit(func, *args).result()
+
+def map_cpu_bound(func, arg_lists):
+    """Run func over several argument tuples in parallel; results keep input order."""
+    pool = get_process_pool()
+    if pool is None:
+        return [func(*args) for args in arg_lists]
+    futures = [pool.submit(func, *args) for args in arg_lists]
+    return [future.result() for future in futures]
+
+def worker_loop(app, poll_interval=None, stop_event=None):
+    """Run jobs forever, waking on enqueue() or every poll_interval seconds."""
+    poll_interval = poll_interval or app.config.get('MEDIA_WORKER_POLL_INTERVAL', 5)
+    logger.info(f"Media worker started ({_worker_name()})")
+    while stop_event is None or not stop_event.is_set():
+        _wakeup.clear()
+        try:
+            with app.app_context():
+                requeue_stale_jobs()
+                run_pending_jobs()
+        except Exception as e:
+            logger.error(f"Media worker error: {e}")
+        _wakeup.wait(poll_interval)
+
+def start_worker(app):
+    """
+    Start this process's background worker thread, once per process.
+
+    With gunicorn --preload the app is imported before forking, so this is
+    called from the first request of each worker rather than at import time.
+    """
+    global _worker_thread, _worker_pid
+    if app.config.get('MEDIA_WORKER', 'thread') != 'thread':
+        return
+    if _worker_pid == os.getpid() and _worker_thread and _worker_thread.is_alive():
+        return
+    _worker_pid = os.getpid()
+    _worker_thread = threading.Thread(target=worker_loop, args=(app,), name='media-worker', daemon=True)
+    _worker_thread.start()
+
+@job_handler('process_images')
+def process_images_job(job, payload):
+    """Fix orientation, recompress and build responsive variants for an ad's images."""
+    from src.image_processing import process_upload, supported_formats
+    from src.ad_media import update_image_details
+
+    ad = db.session.get(Ad, job.ad_id)
+    if not ad or not ad.image_filenames:
+        return {'images': {}}
+
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    variants_folder = current_app.config['MEDIA_VARIANTS_FOLDER']
+    widths = current_app.config['IMAGE_VARIANT_WIDTHS']
+    formats = supported_formats(current_app.config['IMAGE_VARIANT_FORMATS'])
+
+    filenames = [name for name in ad.image_filenames if os.path.exists(os.path.join(upload_folder, name))]
+    results = map_cpu_bound(process_upload, [
+        (os.path.join(upload_folder, name), variants_folder, widths, formats) for name in filenames
+    ])
+    # The re-encoded files have new sizes and hashes, and the orientation fix may swap the dimensions
+    update_image_details(ad, dict(zip(filenames, results)))
+    if get_ad_batch_id(ad.ad_id):
+        # The batch pages were cached without these variants; committed with the job
+        bump_content_version()
+    if ad.admin_status == 'approved' and len(filenames) > 1:
+        # The originals were just re-encoded; the animation re-renders only if their pixels changed
+        enqueue('render_animation', ad_id=ad.ad_id, commit=False)
+    return {'images': dict(zip(filenames, results))}
+
+@job_handler('render_animation')
+def render_animation_job(job, payload):
+    """Render the animated WebP/GIF (and optionally MP4) slideshow of an approved multi-image ad."""
+    from src.gif_utils import ad_animation_sources, render_animation, write_ad_animation, remove_ad_animation
+
+    config = current_app.config
+    ad = db.session.get(Ad, job.ad_id)
+    sources = ad_animation_sources(ad) if ad and ad.admin_status == 'approved' else None
+    if not sources:
+        remove_ad_animation(job.ad_id, config['MEDIA_VARIANTS_FOLDER'])
+        return {}
+
+    animation = run_cpu_bound(render_animation, sources, config['MEDIA_VARIANTS_FOLDER'],
+                              config['ANIMATION_SIZE'], config['ANIMATION_FRAME_SECONDS'], config['ANIMATION_FORMATS'])
+    write_ad_animation(ad.ad_id, config['MEDIA_VARIANTS_FOLDER'], animation)
+    return animation
+
+@job_handler('rebuild_image_index')
+def rebuild_image_index_job(job, payload):
+    """Build the image search index from scratch for every approved ad and swap it in."""
+    from image_search import rebuild_index
+    return {'ads': rebuild_index()}
+
+@job_handler('transcode_video')
+def transcode_video_job(job, payload):
+    """Transcode an approved video ad and index its poster frame for image search."""
+    from image_search import index_ad
+    from src.video_processing import transcode_video
+
+    ad = db.session.get(Ad, job.ad_id)
+    if not ad or not ad.video:
+        return {}
+
+    config = current_app.config
+    outputs = transcode_video(
+        os.path.join(config['UPLOAD_FOLDER'], ad.video),
+        config['MEDIA_VARIANTS_FOLDER'],
+        max_size=config['VIDEO_MAX_SIZE'],
+        max_bitrate=config['VIDEO_MAX_BITRATE'],
+        preview_size=config['VIDEO_PREVIEW_SIZE'],
+        preview_bitrate=config['VIDEO_PREVIEW_BITRATE'],
+        timeout=config['VIDEO_TRANSCODE_TIMEOUT']
+    )
+    if ad.admin_status == 'approved':
+        index_ad(ad)
+    if get_ad_batch_id(ad.ad_id):
+        # Cached batch pages have no poster or preview rendition for this video yet
+        bump_content_version()
+    return outputs
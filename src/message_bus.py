@@ -0,0 +1,187 @@
+"""
+In-process pub/sub for delivery messages.
+
+Buyer and seller pages listen for new messages on a delivery with a
+server-sent events stream or a long poll (see app.py). Each of those requests
+subscribes here and sleeps until it is notified, then reads the new Message
+rows from the database itself (after the last ID it sent), so the bus only
+carries "something new on delivery X" and a lost notification costs at most
+one wait.
+
+Notifications come from two places:
+- send_message() in this worker publishes right after committing
+- messages sent through another worker (or process) are found by one poller
+  thread per worker, which runs a single grouped query every
+  MESSAGE_POLL_INTERVAL seconds, and only while someone is subscribed
+
+Waiting uses threading primitives, which gevent monkey-patches, so the same
+code serves gthread and gevent gunicorn workers. Under gthread every waiting
+request holds one of the worker's threads, so at most MESSAGE_MAX_WAITING of
+them wait at once per worker (hold_waiter); that limit must stay well below
+gunicorn's --threads, or open chats would leave no thread for the site.
+"""
+import logging
+import os
+import threading
+from collections import defaultdict
+
+from models import db, Message
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """One listener on a delivery; wait() returns as soon as a message is published on it."""
+
+    def __init__(self, bus, delivery_id):
+        self.bus = bus
+        self.delivery_id = delivery_id
+        self._event = threading.Event()
+
+    def notify(self):
+        self._event.set()
+
+    def wait(self, timeout):
+        """
+        :param timeout: Seconds to wait at most
+        :return: True if notified (since the last wait), False on timeout
+        """
+        notified = self._event.wait(timeout)
+        self._event.clear()
+        return notified
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MessageBus:
+    """Subscriptions of this worker, per delivery, and the poller that watches the messages table."""
+
+    def __init__(self, poll_interval=1.0, max_waiting=4):
+        self.poll_interval = poll_interval
+        self.max_waiting = max_waiting
+        self._waiting = 0
+        self._app = None
+        self._subscriptions = defaultdict(set)  # delivery_id -> Subscriptions
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._last_id = None
+        self._poller = None
+        self._poller_pid = None
+
+    def init_app(self, app):
+        self._app = app
+        self.poll_interval = app.config.get('MESSAGE_POLL_INTERVAL', self.poll_interval)
+        self.max_waiting = app.config.get('MESSAGE_MAX_WAITING', self.max_waiting)
+
+    def hold_waiter(self):
+        """
+        Reserve one of this worker's waiting slots for a stream or long poll.
+
+        :return: True if reserved (call release_waiter when the request ends), False if all are taken
+        """
+        with self._lock:
+            if self._waiting >= self.max_waiting:
+                return False
+            self._waiting += 1
+            return True
+
+    def release_waiter(self):
+        with self._lock:
+            self._waiting -= 1
+
+    def waiter_count(self):
+        with self._lock:
+            return self._waiting
+
+    def subscribe(self, delivery_id):
+        """Listen for messages on a delivery; use as a context manager, or close() when done."""
+        subscription = Subscription(self, delivery_id)
+        with self._lock:
+            if self._last_id is None:
+                # Start watching from here, before the caller reads its backlog, so nothing falls in between
+                self._last_id = db.session.query(db.func.max(Message.id)).scalar() or 0
+            self._subscriptions[delivery_id].add(subscription)
+        self._start_poller()
+        self._wakeup.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            listeners = self._subscriptions.get(subscription.delivery_id)
+            if listeners is not None:
+                listeners.discard(subscription)
+                if not listeners:
+                    del self._subscriptions[subscription.delivery_id]
+
+    def publish(self, delivery_id):
+        """Wake this worker's subscribers of a delivery."""
+        with self._lock:
+            listeners = list(self._subscriptions.get(delivery_id, ()))
+        for subscription in listeners:
+            subscription.notify()
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(listeners) for listeners in self._subscriptions.values())
+
+    def poll(self):
+        """
+        Publish the deliveries that got messages since the last poll (from any worker).
+        Needs an app context.
+
+        :return: Number of deliveries notified
+        """
+        last_id = self._last_id
+        if last_id is None:
+            return 0
+        rows = (db.session.query(Message.delivery_id, db.func.max(Message.id))
+                .filter(Message.id > last_id)
+                .group_by(Message.delivery_id)
+                .all())
+        for delivery_id, message_id in rows:
+            last_id = max(last_id, message_id)
+            self.publish(delivery_id)
+        with self._lock:
+            if self._last_id is not None:
+                self._last_id = max(self._last_id, last_id)
+        return len(rows)
+
+    def _poll_loop(self):
+        while True:
+            with self._lock:
+                idle = not self._subscriptions
+                if idle:
+                    # Forget the position; the next subscriber starts watching from the last message then
+                    self._last_id = None
+            if idle:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                with self._app.app_context():
+                    self.poll()
+            except Exception as e:
+                logger.error(f"Message poller error: {e}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _start_poller(self):
+        """Start this process's poller thread, once per process (see media_jobs.start_worker)."""
+        if self._app is None:
+            return
+        with self._lock:
+            if self._poller_pid == os.getpid() and self._poller and self._poller.is_alive():
+                return
+            self._poller_pid = os.getpid()
+            self._poller = threading.Thread(target=self._poll_loop, name='message-poller', daemon=True)
+            self._poller.start()
+
+
+message_bus = MessageBus()
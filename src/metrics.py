@@ -0,0 +1,293 @@
+"""
+Request metrics and traffic alerts.
+
+The request path only appends one tuple to a bounded ring buffer
+(collections.deque(maxlen=...) appends are atomic, so no lock is taken).
+A background tick in each gunicorn worker drains the buffer, folds it into
+per-endpoint counters, latency histogram buckets and per-minute rate windows,
+and adds those deltas to a small SQLite file shared by all workers on the
+host. Totals therefore cover every worker and survive restarts.
+
+/admin/metrics renders the shared totals in the Prometheus text format.
+Traffic alerts are evaluated on the tick against the shared per-minute
+counts, and at most one alert fires per cooldown across all workers.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque, defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'glory2yahpub_'
+
+# Upper bounds in seconds, Prometheus' defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+HELP = {
+    'http_requests_total': ('counter', 'HTTP requests by endpoint, method and status'),
+    'http_request_duration_seconds': ('histogram', 'HTTP request latency by endpoint'),
+    'http_requests_per_minute': ('gauge', 'Requests over the trailing window, per minute'),
+    'traffic_alerts_total': ('counter', 'Traffic alerts sent to the admin'),
+    'cache_requests_total': ('counter', 'Read-through cache lookups by cache and result (hit, shared_hit, miss)'),
+}
+
+_events = None
+_collectors = []
+_tick_thread = None
+_tick_pid = None
+_stop = threading.Event()
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else f"{bound:g}"
+
+def _labels_key(labels):
+    return json.dumps(sorted(labels.items()))
+
+def init_metrics(app):
+    """Create this process's ring buffer (sized by METRICS_BUFFER_SIZE)."""
+    global _events
+    _events = deque(maxlen=app.config.get('METRICS_BUFFER_SIZE', 10000))
+
+def record_request(endpoint, method, status, seconds):
+    """
+    Note one finished request. Called on every request, so it only appends.
+
+    :param endpoint: Flask endpoint name (bounded, unlike the path)
+    :param method: HTTP method
+    :param status: Response status code
+    :param seconds: Time spent handling the request
+    """
+    if _events is not None:
+        _events.append((time.time(), endpoint or 'unknown', method, status, seconds))
+
+def register_collector(collect):
+    """
+    Add counters kept elsewhere (e.g. the cache hit/miss counts) to every flush.
+
+    :param collect: Callable returning (name, labels dict, delta) tuples for what changed since its last call
+    """
+    _collectors.append(collect)
+
+def drain():
+    """
+    Empty the ring buffer and aggregate what it held.
+
+    :return: (counters, rates): counters maps (name, labels_key) to a delta,
+             rates maps (minute, endpoint) to a request count
+    """
+    counters = defaultdict(float)
+    rates = defaultdict(int)
+    if _events is None:
+        return counters, rates
+    while True:
+        try:
+            timestamp, endpoint, method, status, seconds = _events.popleft()
+        except IndexError:
+            break
+        counters[('http_requests_total', _labels_key({'endpoint': endpoint, 'method': method, 'status': str(status)}))] += 1
+        bound = next(b for b in LATENCY_BUCKETS if seconds <= b)
+        counters[('http_request_duration_seconds_bucket', _labels_key({'endpoint': endpoint, 'le': _format_bound(bound)}))] += 1
+        counters[('http_request_duration_seconds_sum', _labels_key({'endpoint': endpoint}))] += seconds
+        counters[('http_request_duration_seconds_count', _labels_key({'endpoint': endpoint}))] += 1
+        rates[(int(timestamp // 60), endpoint)] += 1
+    return counters, rates
+
+
+class SqliteMetricsSink:
+    """Metric totals shared by the workers of one host, in a SQLite file."""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS metric_counters '
+                         '(name TEXT NOT NULL, labels TEXT NOT NULL, value REAL NOT NULL, PRIMARY KEY (name, labels))')
+            conn.execute('CREATE TABLE IF NOT EXISTS metric_rates '
+                         '(minute INTEGER NOT NULL, endpoint TEXT NOT NULL, requests INTEGER NOT NULL, '
+                         'PRIMARY KEY (minute, endpoint))')
+            conn.execute('CREATE TABLE IF NOT EXISTS metric_alerts (name TEXT PRIMARY KEY, last_fired REAL NOT NULL)')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:  # Commits, or rolls back on error
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, counters, rates):
+        """Add counter deltas and per-minute request counts."""
+        if not counters and not rates:
+            return
+        with self._connect() as conn:
+            conn.executemany(
+                'INSERT INTO metric_counters (name, labels, value) VALUES (?, ?, ?) '
+                'ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value',
+                [(name, labels, value) for (name, labels), value in counters.items()])
+            conn.executemany(
+                'INSERT INTO metric_rates (minute, endpoint, requests) VALUES (?, ?, ?) '
+                'ON CONFLICT (minute, endpoint) DO UPDATE SET requests = requests + excluded.requests',
+                [(minute, endpoint, count) for (minute, endpoint), count in rates.items()])
+
+    def counters(self):
+        """All counters as a list of (name, labels dict, value)."""
+        with self._connect() as conn:
+            rows = conn.execute('SELECT name, labels, value FROM metric_counters ORDER BY name, labels').fetchall()
+        return [(name, dict(json.loads(labels)), value) for name, labels, value in rows]
+
+    def requests_between(self, start_minute, end_minute):
+        """Requests counted in minutes (epoch // 60) start_minute <= minute < end_minute."""
+        with self._connect() as conn:
+            return conn.execute('SELECT COALESCE(SUM(requests), 0) FROM metric_rates WHERE minute >= ? AND minute < ?',
+                                (start_minute, end_minute)).fetchone()[0]
+
+    def prune(self, before_minute):
+        """Forget rate windows older than before_minute."""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM metric_rates WHERE minute < ?', (before_minute,))
+
+    def claim_alert(self, name, cooldown):
+        """
+        Take the right to send an alert; only one worker wins per cooldown.
+
+        :return: True if this caller should send the alert
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO metric_alerts (name, last_fired) VALUES (?, 0)', (name,))
+            claimed = conn.execute('UPDATE metric_alerts SET last_fired = ? WHERE name = ? AND last_fired <= ?',
+                                   (now, name, now - cooldown)).rowcount
+        return bool(claimed)
+
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+def get_sink(app):
+    """The shared sink for METRICS_DB, created on first use in each process."""
+    path = app.config['METRICS_DB']
+    with _sinks_lock:
+        if (os.getpid(), path) not in _sinks:
+            _sinks[(os.getpid(), path)] = SqliteMetricsSink(path)
+        return _sinks[(os.getpid(), path)]
+
+def flush(app):
+    """Move this process's buffered requests into the shared sink."""
+    counters, rates = drain()
+    for collect in _collectors:
+        for name, labels, delta in collect():
+            counters[(name, _labels_key(labels))] += delta
+    get_sink(app).add(counters, rates)
+
+def evaluate_alerts(app):
+    """
+    Send the traffic alert when the last minute's requests across all
+    workers exceed TRAFFIC_ALERT_THRESHOLD, at most once per cooldown.
+
+    :return: The request count that triggered an alert, or None
+    """
+    from src.notifications import notify_admin_traffic_alert
+
+    threshold = app.config.get('TRAFFIC_ALERT_THRESHOLD', 600)
+    if not threshold:
+        return None
+    sink = get_sink(app)
+    # The current minute is still filling up, so the last complete one counts too
+    current = int(time.time() // 60)
+    count = max(sink.requests_between(current - 1, current), sink.requests_between(current, current + 1))
+    if count <= threshold or not sink.claim_alert('traffic', app.config.get('TRAFFIC_ALERT_COOLDOWN', 900)):
+        return None
+    link = notify_admin_traffic_alert(count)
+    sink.add({('traffic_alerts_total', _labels_key({})): 1}, {})
+    logger.warning(f"Traffic alert: {count} requests in a minute (threshold {threshold}): {link}")
+    return count
+
+def tick(app):
+    """One background tick: flush, evaluate alerts, prune old rate windows."""
+    flush(app)
+    evaluate_alerts(app)
+    retention = app.config.get('METRICS_RATE_RETENTION', 60)
+    get_sink(app).prune(int(time.time() // 60) - retention)
+
+def _tick_loop(app):
+    interval = app.config.get('METRICS_FLUSH_INTERVAL', 5)
+    while not _stop.wait(interval):
+        try:
+            tick(app)
+        except Exception as e:
+            logger.error(f"Metrics tick failed: {e}")
+
+def start_ticker(app):
+    """Start this process's metrics tick thread, once per process (see media_jobs.start_worker)."""
+    global _tick_thread, _tick_pid
+    if not app.config.get('METRICS_FLUSH_INTERVAL'):
+        return
+    if _tick_pid == os.getpid() and _tick_thread and _tick_thread.is_alive():
+        return
+    _tick_pid = os.getpid()
+    _tick_thread = threading.Thread(target=_tick_loop, args=(app,), name='metrics-tick', daemon=True)
+    _tick_thread.start()
+
+def render_prometheus(app):
+    """All shared metrics in the Prometheus text exposition format (0.0.4)."""
+    sink = get_sink(app)
+    by_name = defaultdict(list)
+    for name, labels, value in sink.counters():
+        by_name[name].append((labels, value))
+
+    lines = []
+
+    def header(metric):
+        kind, text = HELP[metric]
+        lines.append(f"# HELP {PREFIX}{metric} {text}")
+        lines.append(f"# TYPE {PREFIX}{metric} {kind}")
+
+    def sample(name, labels, value):
+        label_text = ','.join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+        value = str(int(value)) if float(value).is_integer() else repr(float(value))
+        lines.append(f"{PREFIX}{name}{{{label_text}}} {value}" if label_text else f"{PREFIX}{name} {value}")
+
+    header('http_requests_total')
+    for labels, value in by_name['http_requests_total']:
+        sample('http_requests_total', labels, value)
+
+    header('http_request_duration_seconds')
+    buckets = defaultdict(dict)
+    for labels, value in by_name['http_request_duration_seconds_bucket']:
+        buckets[labels['endpoint']][labels['le']] = value
+    sums = {labels['endpoint']: value for labels, value in by_name['http_request_duration_seconds_sum']}
+    counts = {labels['endpoint']: value for labels, value in by_name['http_request_duration_seconds_count']}
+    for endpoint in sorted(counts):
+        cumulative = 0
+        for bound in LATENCY_BUCKETS:
+            cumulative += buckets[endpoint].get(_format_bound(bound), 0)
+            sample('http_request_duration_seconds_bucket', {'endpoint': endpoint, 'le': _format_bound(bound)}, cumulative)
+        sample('http_request_duration_seconds_sum', {'endpoint': endpoint}, sums.get(endpoint, 0))
+        sample('http_request_duration_seconds_count', {'endpoint': endpoint}, counts[endpoint])
+
+    header('http_requests_per_minute')
+    current = int(time.time() // 60)
+    for window in (1, 5, 15):
+        # Completed minutes only, so the value does not dip at the start of each minute
+        requests = sink.requests_between(current - window, current)
+        sample('http_requests_per_minute', {'window': f"{window}m"}, requests / window)
+
+    header('traffic_alerts_total')
+    sample('traffic_alerts_total', {}, sum(value for _, value in by_name['traffic_alerts_total']))
+
+    header('cache_requests_total')
+    for labels, value in by_name['cache_requests_total']:
+        sample('cache_requests_total', labels, value)
+
+    return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
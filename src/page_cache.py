@@ -0,0 +1,153 @@
+"""
+Cached homepage and batch pages.
+
+The homepage and /batch/<batch_id> only change when an admin creates,
+edits or deletes a batch, deletes an ad, or when the media worker finishes
+the images or video of an ad shown in a batch. Those code paths call
+bump_content_version() inside their own transaction, which increments one
+row of content_versions. The counter lives in the database, so every
+gunicorn worker (and every host) sees the bump on its next request.
+
+A page request reads that one row and:
+- answers a client revalidating with a matching If-None-Match (or
+  If-Modified-Since) with a 304 before querying or rendering anything
+- otherwise takes the page's fragments (everything except the base layout
+  and its flashed messages) from a small per-process LRU keyed by page,
+  batch ID and version, so the batch and its ads are queried and rendered
+  once per version per worker
+
+The ETag is strong: the same version of the same page renders the same
+bytes. Responses carrying flashed messages are sent with no-store and no
+validators, since those messages are shown only once.
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import Response, current_app, make_response, render_template, request, session
+from markupsafe import Markup
+from sqlalchemy import select
+
+from models import db, ContentVersion
+
+logger = logging.getLogger(__name__)
+
+PAGES = 'pages'
+
+def bump_content_version(name=PAGES):
+    """
+    Invalidate the cached pages everywhere. Call it before the commit of the
+    change it covers, so the bump is committed (or rolled back) with it.
+
+    :param name: Counter to bump
+    """
+    now = datetime.utcnow()
+    updated = ContentVersion.query.filter_by(name=name).update(
+        {'version': ContentVersion.version + 1, 'updated_at': now}, synchronize_session=False)
+    if not updated:
+        db.session.add(ContentVersion(name=name, version=1, updated_at=now))
+
+def get_content_version(name=PAGES):
+    """
+    :param name: Counter to read
+    :return: (version, updated_at); (0, None) when the counter was never bumped
+    """
+    row = db.session.execute(
+        select(ContentVersion.version, ContentVersion.updated_at).filter_by(name=name)).first()
+    return (row.version, row.updated_at) if row else (0, None)
+
+
+class FragmentCache:
+    """Small thread-safe LRU of rendered fragments, one per process."""
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        """
+        :param key: Hashable key; it must change whenever the fragments would
+        :param render: Callable producing the fragments on a miss
+        :return: The cached or freshly rendered fragments
+        """
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+        # Rendered outside the lock; two threads missing together both render, which is harmless
+        value = render()
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+fragment_cache = FragmentCache()
+
+def render_fragment(template, **context):
+    """Render a partial template into markup the page template can output as is."""
+    return Markup(render_template(template, **context))
+
+_template_digests = {}
+
+def _template_digest(templates):
+    """Hash of the templates' source, so a deploy that changes them changes the ETags."""
+    if templates not in _template_digests or current_app.debug:
+        env = current_app.jinja_env
+        digest = hashlib.sha1()
+        for name in templates:
+            digest.update(env.loader.get_source(env, name)[0].encode('utf-8'))
+        _template_digests[templates] = digest.hexdigest()
+    return _template_digests[templates]
+
+def cached_page(template, fragment_templates, render_fragments, key=None):
+    """
+    Serve a page whose content is cached per content version.
+
+    :param template: Page template; it receives the fragments as variables
+    :param fragment_templates: Templates render_fragments uses (part of the ETag)
+    :param render_fragments: Callable returning a dict of rendered fragments,
+                             or None when the page does not exist
+    :param key: What else the page depends on, e.g. the batch ID
+    :return: The response, a 304, or None if render_fragments returned None
+    """
+    version, updated_at = get_content_version()
+    seed = f"{template}:{key}:{version}:{_template_digest((template, 'base.html') + tuple(fragment_templates))}"
+    etag = hashlib.sha1(seed.encode('utf-8')).hexdigest()
+    has_flashes = bool(session.get('_flashes'))
+
+    if not has_flashes:
+        probe = _with_validators(Response(), etag, updated_at)
+        probe.make_conditional(request)
+        if probe.status_code == 304:
+            return probe
+
+    fragments = fragment_cache.get_or_render((template, key, version), render_fragments)
+    if fragments is None:
+        return None
+    response = make_response(render_template(template, **fragments))
+    if has_flashes:
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    return _with_validators(response, etag, updated_at)
+
+def _with_validators(response, etag, updated_at):
+    response.set_etag(etag)
+    if updated_at:
+        response.last_modified = updated_at
+    # Always revalidate: the version can be bumped at any moment by another worker
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
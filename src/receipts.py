@@ -0,0 +1,313 @@
+"""
+PDF receipts for completed deliveries.
+
+Confirming a delivery only queues a 'render_receipt' media job; the worker
+renders the PDF with ReportLab, whose styles are built once per process.
+
+Receipts are content-addressed: the file name is a hash of everything
+printed on it (receipt_data), stored in RECEIPTS_FOLDER, outside the public
+static folder. /receipts/<delivery_id> serves it to the admin or to holders
+of the signed link sent over WhatsApp (receipt_url), with an ETag, and
+answers 202 while the receipt is still being rendered.
+
+Statements bundle the receipts of one seller over a date range, as a ZIP
+streamed while it is written, or as a single multi-page PDF; receipts not
+rendered yet are rendered in parallel in the media process pool first.
+"""
+import functools
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import zipfile
+from datetime import datetime
+
+from flask import current_app, url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+
+from models import db, Delivery, MediaJob
+from src.cart import parse_delivery_items
+from src.media_jobs import enqueue, job_handler, run_cpu_bound, map_cpu_bound
+
+logger = logging.getLogger(__name__)
+
+RECEIPT_VERSION = 1  # Bump when the layout changes, so receipts are rendered again
+
+def receipt_data(delivery):
+    """
+    Everything printed on a delivery's receipt, as plain JSON-serialisable values.
+
+    :param delivery: A completed Delivery
+    :return: Dict passed to render_receipt
+    """
+    items = [{'title': item.get('title', 'N/A'), 'quantity': item.get('quantity', 1), 'price': item.get('price', 0)}
+             for item in parse_delivery_items(delivery)]
+    shipping = delivery.delivery_cost or 0
+    return {
+        'version': RECEIPT_VERSION,
+        'delivery_id': delivery.delivery_id,
+        'buyer_whatsapp': delivery.buyer_whatsapp,
+        'seller_whatsapp': delivery.seller_whatsapp,
+        'items': items,
+        'total_product_price': delivery.total_price,
+        'total_shipping': shipping,
+        'grand_total': delivery.total_price + shipping,
+        'date': (delivery.delivered_at or delivery.created_at).isoformat(),
+    }
+
+def receipt_key(data):
+    """Content hash naming a receipt file."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()[:32]
+
+def receipt_path(folder, data):
+    return os.path.join(folder, f"{receipt_key(data)}.pdf")
+
+@functools.lru_cache(maxsize=None)
+def _styles():
+    """Paragraph and table styles, built once per process."""
+    from reportlab.lib import colors
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.platypus import TableStyle
+
+    sheet = getSampleStyleSheet()
+    return {
+        'title': ParagraphStyle('CustomTitle', parent=sheet['Heading1'], fontSize=24,
+                                textColor=colors.HexColor('#2c3e50'), spaceAfter=30, alignment=1),
+        'heading': sheet['Heading2'],
+        'normal': sheet['Normal'],
+        'footer': ParagraphStyle('Footer', parent=sheet['Normal'], fontSize=10,
+                                 textColor=colors.HexColor('#27ae60'), alignment=1),
+        'info': TableStyle([
+            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('TEXTCOLOR', (0, 0), (0, -1), colors.HexColor('#7f8c8d')),
+            ('TEXTCOLOR', (1, 0), (1, -1), colors.HexColor('#2c3e50')),
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+        ]),
+        'items': TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#3498db')),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, 0), 11),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black),
+            ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+            ('FONTSIZE', (0, 1), (-1, -1), 9),
+        ]),
+        'summary': TableStyle([
+            ('FONTNAME', (0, 0), (-1, -2), 'Helvetica'),
+            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 11),
+            ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
+            ('LINEABOVE', (0, -1), (-1, -1), 2, colors.black),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+        ]),
+    }
+
+def _receipt_elements(data):
+    """ReportLab flowables of one receipt."""
+    from reportlab.lib.units import inch
+    from reportlab.platypus import Table, Paragraph, Spacer
+
+    styles = _styles()
+    elements = [
+        Paragraph("RESI TRANZAKSYON", styles['title']),
+        Paragraph("Glory2yahPub", styles['heading']),
+        Spacer(1, 0.3*inch),
+    ]
+
+    # Transaction info
+    date_str = datetime.fromisoformat(data['date']).strftime("%d/%m/%Y %H:%M")
+    info_table = Table([
+        ['Dat:', date_str],
+        ['ID Tranzaksyon:', data['delivery_id']],
+        ['Vandè:', data['seller_whatsapp']],
+        ['Achte:', data['buyer_whatsapp']]
+    ], colWidths=[2*inch, 4*inch])
+    info_table.setStyle(styles['info'])
+    elements += [info_table, Spacer(1, 0.3*inch)]
+
+    # Items table
+    items_data = [['#', 'Atik', 'Kantite', 'Pri Inite', 'Sou-total']]
+    for idx, item in enumerate(data['items'], 1):
+        title = item['title']
+        items_data.append([
+            str(idx),
+            title[:30] + '...' if len(title) > 30 else title,
+            str(item['quantity']),
+            f"{item['price']} Gkach",
+            f"{item['price'] * item['quantity']} Gkach"
+        ])
+    items_table = Table(items_data, colWidths=[0.5*inch, 2.5*inch, 1*inch, 1.2*inch, 1.2*inch])
+    items_table.setStyle(styles['items'])
+    elements += [items_table, Spacer(1, 0.3*inch)]
+
+    # Summary table
+    summary_table = Table([
+        ['Pri Pwodwi:', f"{data['total_product_price']} Gkach"],
+        ['Pri Livrezon:', f"{data['total_shipping']} Gkach"],
+        ['TOTAL:', f"{data['grand_total']} Gkach"]
+    ], colWidths=[3*inch, 2*inch])
+    summary_table.setStyle(styles['summary'])
+    elements += [summary_table, Spacer(1, 0.5*inch)]
+
+    # Footer
+    elements += [
+        Paragraph("✅ TRANZAKSYON KONPLETE", styles['footer']),
+        Spacer(1, 0.2*inch),
+        Paragraph("Mèsi pou biznis ou! 🙏", styles['normal']),
+        Paragraph("Glory2yahPub - Platfòm Piblisite #1", styles['normal']),
+    ]
+    return elements
+
+def _build_pdf(path, elements):
+    """Write the PDF to a temporary file and rename it, so readers never see half a receipt."""
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate
+
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        SimpleDocTemplate(tmp_path, pagesize=letter).build(elements)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def render_receipt(data, folder):
+    """
+    Render a receipt unless it exists already. Only touches files (runs in the process pool).
+
+    :param data: Result of receipt_data
+    :param folder: RECEIPTS_FOLDER
+    :return: Path of the PDF
+    """
+    path = receipt_path(folder, data)
+    if not os.path.exists(path):
+        os.makedirs(folder, exist_ok=True)
+        _build_pdf(path, _receipt_elements(data))
+        logger.info(f"Rendered receipt for delivery {data['delivery_id']}")
+    return path
+
+def render_statement(datas, folder):
+    """
+    Render several receipts as one PDF, a receipt per page, unless it exists already.
+
+    :param datas: Results of receipt_data, in order
+    :param folder: RECEIPTS_FOLDER; statements go to its 'statements' subfolder
+    :return: Path of the PDF
+    """
+    from reportlab.platypus import PageBreak
+
+    key = hashlib.sha256('|'.join(receipt_key(data) for data in datas).encode()).hexdigest()[:32]
+    path = os.path.join(folder, 'statements', f"{key}.pdf")
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        elements = []
+        for data in datas:
+            if elements:
+                elements.append(PageBreak())
+            elements += _receipt_elements(data)
+        _build_pdf(path, elements)
+    return path
+
+def _serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='receipt')
+
+def receipt_url(delivery_id, **kwargs):
+    """URL of a delivery's receipt, signed so whoever gets the link (buyer, seller) can open it."""
+    return url_for('get_receipt', delivery_id=delivery_id, token=_serializer().dumps(delivery_id), **kwargs)
+
+def check_receipt_token(delivery_id, token):
+    try:
+        return _serializer().loads(token or '') == delivery_id
+    except BadSignature:
+        return False
+
+def _job_payload(delivery_id):
+    return json.dumps({'delivery_id': delivery_id})
+
+def queue_receipt(delivery_id, commit=True):
+    """Queue the rendering of a delivery's receipt, unless it is already queued."""
+    pending = MediaJob.query.filter(MediaJob.kind == 'render_receipt', MediaJob.status.in_(('queued', 'running')),
+                                    MediaJob.payload == _job_payload(delivery_id)).first()
+    if pending is None:
+        enqueue('render_receipt', payload={'delivery_id': delivery_id}, commit=commit)
+
+@job_handler('render_receipt')
+def render_receipt_job(job, payload):
+    """Render the receipt of a completed delivery."""
+    delivery = db.session.get(Delivery, payload['delivery_id'])
+    if delivery is None or delivery.status != 'completed':
+        return {}
+    path = run_cpu_bound(render_receipt, receipt_data(delivery), current_app.config['RECEIPTS_FOLDER'])
+    return {'receipt': os.path.basename(path)}
+
+def get_receipt_path(delivery):
+    """Path of a completed delivery's receipt if it has been rendered, else None."""
+    path = receipt_path(current_app.config['RECEIPTS_FOLDER'], receipt_data(delivery))
+    return path if os.path.exists(path) else None
+
+def statement_deliveries(seller_whatsapp, start, end):
+    """
+    Completed deliveries of a seller delivered in [start, end), oldest first.
+    """
+    return (Delivery.query
+            .filter(Delivery.seller_whatsapp == seller_whatsapp, Delivery.status == 'completed',
+                    Delivery.delivered_at >= start, Delivery.delivered_at < end)
+            .order_by(Delivery.delivered_at, Delivery.delivery_id)
+            .all())
+
+def render_missing_receipts(datas):
+    """
+    Render the receipts not rendered yet, in parallel in the media process pool.
+
+    :param datas: Results of receipt_data
+    :return: Paths of all the receipts, in order
+    """
+    folder = current_app.config['RECEIPTS_FOLDER']
+    missing = [data for data in datas if not os.path.exists(receipt_path(folder, data))]
+    if missing:
+        map_cpu_bound(render_receipt, [(data, folder) for data in missing])
+    return [receipt_path(folder, data) for data in datas]
+
+class _ZipSink(io.RawIOBase):
+    """Unseekable file collecting what zipfile writes, drained by the response generator."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def stream_zip(files, chunk_size=65536):
+    """
+    Yield a ZIP archive while it is written, a chunk at a time.
+
+    :param files: (name in the archive, path) pairs
+    """
+    sink = _ZipSink()
+    # PDFs are compressed already; stored entries keep the worker's CPU free
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+        for name, path in files:
+            with open(path, 'rb') as source, archive.open(name, 'w', force_zip64=True) as entry:
+                for chunk in iter(lambda: source.read(chunk_size), b''):
+                    entry.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            yield sink.drain()
+    yield sink.drain()
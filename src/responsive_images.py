@@ -0,0 +1,130 @@
+"""
+Responsive image serving for ad media.
+
+Uploads get 320/640/1280-wide WebP and JPEG variants from the media job
+queue. Templates call responsive_image() to emit a <picture> whose srcset
+points at /media/<width>/<fmt>/<filename>. That route serves the variant from
+the disk cache, generating it on first request for legacy uploads that were
+never processed.
+
+Video cards get the poster frame and the small preview rendition produced by
+the transcode job, served from /media/video/<kind>/<filename>, which falls
+back to the original upload until the video has been transcoded.
+"""
+import logging
+import os
+import threading
+
+from flask import current_app, url_for
+from markupsafe import Markup, escape
+
+from src.image_processing import make_variant, variant_name, supported_formats
+from src.video_processing import rendition_name
+
+logger = logging.getLogger(__name__)
+
+# Card images are full width on phones and at most ~400px wide otherwise
+DEFAULT_SIZES = '(max-width: 768px) 100vw, 400px'
+
+MIME_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg', 'avif': 'image/avif'}
+
+_generation_locks = {}
+_generation_locks_guard = threading.Lock()
+
+def variant_widths():
+    return sorted(current_app.config['IMAGE_VARIANT_WIDTHS'])
+
+def variant_formats():
+    """Configured formats this Pillow can write, JPEG always last as the fallback."""
+    formats = [fmt for fmt in supported_formats(current_app.config['IMAGE_VARIANT_FORMATS']) if fmt != 'jpeg']
+    return formats + ['jpeg']
+
+def image_variant_url(filename, width, fmt='jpeg'):
+    """URL of one variant of an uploaded image."""
+    return url_for('media_variant', width=width, fmt=fmt, filename=filename)
+
+def image_srcset(filename, fmt='jpeg'):
+    """srcset value listing every configured width of an uploaded image."""
+    return ', '.join(f"{image_variant_url(filename, width, fmt)} {width}w" for width in variant_widths())
+
+def responsive_image(filename, alt='', sizes=DEFAULT_SIZES, loading='lazy', width=None, height=None, **attrs):
+    """
+    <picture> for an uploaded image: modern formats first, JPEG srcset on the <img>.
+
+    :param filename: Upload filename (e.g. Ad.thumbnail)
+    :param alt: Alt text
+    :param sizes: The sizes attribute describing the rendered slot width
+    :param loading: 'lazy' or 'eager'
+    :param width: Intrinsic width, when known, so the browser reserves the space before loading
+    :param height: Intrinsic height, with width
+    :param attrs: Extra attributes for the <img> (use class_ for class)
+    """
+    filename = filename.strip()
+    if width and height:
+        attrs.update(width=width, height=height)
+    widths = variant_widths()
+    fallback_width = widths[len(widths) // 2]
+
+    sources = ''.join(
+        f'<source type="{MIME_TYPES[fmt]}" srcset="{escape(image_srcset(filename, fmt))}" sizes="{escape(sizes)}">'
+        for fmt in variant_formats() if fmt != 'jpeg'
+    )
+    extra = ''.join(f' {escape(key.rstrip("_").replace("_", "-"))}="{escape(value)}"' for key, value in attrs.items())
+    img = (f'<img src="{escape(image_variant_url(filename, fallback_width))}" '
+           f'srcset="{escape(image_srcset(filename))}" sizes="{escape(sizes)}" '
+           f'alt="{escape(alt)}" loading="{escape(loading)}" decoding="async"{extra}>')
+    return Markup(f'<picture>{sources}{img}</picture>')
+
+def get_variant_path(filename, width, fmt):
+    """
+    Path of a cached variant, generating it from the original if needed.
+
+    :return: Full path of the variant, or None if the width/format is not
+             allowed or the original does not exist
+    """
+    if width not in variant_widths() or fmt not in variant_formats():
+        return None
+    filename = os.path.basename(filename)
+    variants_folder = current_app.config['MEDIA_VARIANTS_FOLDER']
+    path = os.path.join(variants_folder, variant_name(filename, width, fmt))
+    if os.path.exists(path):
+        return path
+
+    original = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    if not os.path.isfile(original):
+        return None
+
+    # One generation per variant in this process; other workers' duplicates are harmless (atomic rename)
+    with _generation_locks_guard:
+        lock = _generation_locks.setdefault(path, threading.Lock())
+    with lock:
+        if not os.path.exists(path):
+            try:
+                make_variant(original, variants_folder, width, fmt)
+                logger.info(f"Generated missing variant {os.path.basename(path)}")
+            except Exception as e:
+                logger.error(f"Error generating variant of {filename}: {e}")
+                return None
+    with _generation_locks_guard:
+        _generation_locks.pop(path, None)
+    return path
+
+def video_url(filename, kind='full'):
+    """URL of a video rendition ('full' or 'preview')."""
+    return url_for('media_video', kind=kind, filename=filename)
+
+def video_poster_url(filename):
+    """URL of a video's poster frame, or None until the video has been transcoded."""
+    if not filename:
+        return None
+    poster = rendition_name(filename, 'poster')
+    if not os.path.exists(os.path.join(current_app.config['MEDIA_VARIANTS_FOLDER'], poster)):
+        return None
+    return video_url(filename, 'poster')
+
+def get_rendition_path(filename, kind):
+    """Path of a video rendition if it has been produced, else None."""
+    if kind not in ('full', 'preview', 'poster'):
+        return None
+    path = os.path.join(current_app.config['MEDIA_VARIANTS_FOLDER'], rendition_name(os.path.basename(filename), kind))
+    return path if os.path.exists(path) else None
@@ -0,0 +1,110 @@
+"""
+Database schema versioning.
+
+The schema is managed by Alembic migrations in migrations/ (Flask-Migrate).
+Boot only runs one query, reading alembic_version, and compares it with
+SCHEMA_VERSION. Alembic itself, which costs ~300ms to import, is loaded only
+when the database is behind and has to be upgraded, or by the `flask db` CLI.
+"""
+import logging
+import os
+
+import click
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# Head revision of migrations/versions; bump it with every new migration
+SCHEMA_VERSION = '0010_search_index_backfills'
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+# Arbitrary key for the Postgres advisory lock serialising concurrent upgrades
+_ADVISORY_LOCK_KEY = 0x6c6f7279
+
+def _include_name(name, type_, parent_names):
+    """Keep autogenerate away from the full-text structures the 0010 migration creates by hand."""
+    return not ((type_ == 'table' and name.startswith('ad_search_fts')) or
+                (type_ == 'index' and name == 'ix_ad_search_documents_tsv'))
+
+def init_migrate(app):
+    """Register Flask-Migrate on the app (needed by migrations/env.py and `flask db`)."""
+    if 'migrate' not in app.extensions:
+        from flask_migrate import Migrate
+        Migrate(app, db, directory=MIGRATIONS_DIR, include_name=_include_name)
+    return app.extensions['migrate']
+
+class LazyMigrateGroup(click.Group):
+    """`flask db` command group that loads Flask-Migrate only when a subcommand is used."""
+
+    def __init__(self, app, **kwargs):
+        super().__init__(**kwargs)
+        self.app = app
+
+    def _commands(self):
+        init_migrate(self.app)
+        from flask_migrate.cli import db as migrate_group
+        return migrate_group
+
+    def list_commands(self, ctx):
+        return self._commands().list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        return self._commands().get_command(ctx, name)
+
+def register_migrate_cli(app):
+    """Add the `flask db` commands without importing Flask-Migrate at boot."""
+    app.cli.add_command(LazyMigrateGroup(app, name='db', help='Perform database migrations.'))
+
+def get_schema_version():
+    """
+    Current revision of the database.
+
+    :return: The revision ID, or None if the database has never been migrated
+    """
+    try:
+        version = db.session.execute(text('SELECT version_num FROM alembic_version')).scalar()
+        db.session.commit()
+        return version
+    except (OperationalError, ProgrammingError):
+        db.session.rollback()
+        return None
+
+def upgrade_schema(app, revision='head'):
+    """Run the migrations up to revision, holding an advisory lock on Postgres."""
+    from alembic import command
+
+    config = init_migrate(app).migrate.get_config(MIGRATIONS_DIR)
+    config.attributes['configure_logger'] = False
+
+    if db.engine.dialect.name != 'postgresql':
+        command.upgrade(config, revision)
+        return
+    with db.engine.connect() as lock_connection:
+        lock_connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': _ADVISORY_LOCK_KEY})
+        try:
+            # Another instance may have upgraded while we waited for the lock
+            if revision != 'head' or get_schema_version() != SCHEMA_VERSION:
+                command.upgrade(config, revision)
+        finally:
+            lock_connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': _ADVISORY_LOCK_KEY})
+            lock_connection.commit()
+
+def ensure_schema(app):
+    """
+    Bring the database up to SCHEMA_VERSION at boot.
+
+    :return: True if migrations were run
+    """
+    version = get_schema_version()
+    if version == SCHEMA_VERSION:
+        return False
+    if not app.config.get('AUTO_MIGRATE', True):
+        logger.warning(f"Database schema is at {version}, expected {SCHEMA_VERSION}; run `flask db upgrade`")
+        return False
+    logger.info(f"Upgrading database schema from {version or 'unversioned'} to {SCHEMA_VERSION}")
+    upgrade_schema(app)
+    return True
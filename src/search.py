@@ -0,0 +1,231 @@
+"""
+Full-text search over ad titles and descriptions.
+
+Every ad gets an AdSearchDocument row holding its accent-folded title and
+description, kept current on submit, approve and delete. Queries go to the
+best index the database offers:
+
+- PostgreSQL: GIN index over a weighted tsvector, ranked with ts_rank_cd
+- SQLite: FTS5 virtual table, ranked with bm25()
+- anything else: an in-process inverted index with BM25 scoring
+"""
+import bisect
+import logging
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from sqlalchemy import text, func
+
+from models import db, Ad, AdSearchDocument
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# BM25 parameters and title weight for the pure-Python fallback
+BM25_K1 = 1.2
+BM25_B = 0.75
+TITLE_WEIGHT = 2
+
+_backend = None
+_python_index = None
+_python_index_lock = threading.Lock()
+
+def fold_text(value):
+    """
+    Lowercase and strip accents so Creole/French spellings match
+    (e.g. 'Machin à laver' and 'machin a lave' share 'machin').
+    """
+    if not value:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', value.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+def tokenize(value):
+    """Split folded text into search tokens."""
+    return TOKEN_RE.findall(fold_text(value))
+
+def get_backend():
+    """Return the active search backend: 'postgres', 'fts5' or 'python'."""
+    return _backend or 'python'
+
+def init_search_index(app):
+    """
+    Pick the search backend for the configured database. Its index structures
+    and the documents of older ads come from the 0010 migration, so this runs
+    no query.
+    """
+    global _backend
+
+    configured = app.config.get('SEARCH_BACKEND', 'auto')
+    if configured == 'auto':
+        configured = {'postgresql': 'postgres', 'sqlite': 'fts5'}.get(db.engine.dialect.name, 'python')
+
+    _backend = configured
+    logger.info(f"Search backend: {_backend}")
+
+def _write_fts(ad_id, title, body):
+    db.session.execute(text("DELETE FROM ad_search_fts WHERE ad_id = :ad_id"), {'ad_id': ad_id})
+    db.session.execute(
+        text("INSERT INTO ad_search_fts (ad_id, title, body) VALUES (:ad_id, :title, :body)"),
+        {'ad_id': ad_id, 'title': title, 'body': body}
+    )
+
+def index_ad_text(ad, commit=True):
+    """
+    Create or refresh the search document for an ad.
+
+    :param ad: The Ad object
+    :param commit: Commit the session when done
+    """
+    title = ' '.join(tokenize(ad.title))
+    body = ' '.join(tokenize(ad.description))
+
+    doc = db.session.get(AdSearchDocument, ad.ad_id)
+    if doc:
+        doc.title = title
+        doc.body = body
+        # Always bump so the fallback index also notices status changes
+        doc.updated_at = datetime.utcnow()
+    else:
+        db.session.add(AdSearchDocument(ad_id=ad.ad_id, title=title, body=body))
+
+    if get_backend() == 'fts5':
+        _write_fts(ad.ad_id, title, body)
+    if commit:
+        db.session.commit()
+
+def remove_ad_text(ad_id, commit=True):
+    """
+    Remove an ad's search document.
+
+    :param ad_id: The ad ID
+    :param commit: Commit the session when done
+    """
+    AdSearchDocument.query.filter_by(ad_id=ad_id).delete()
+    if get_backend() == 'fts5':
+        db.session.execute(text("DELETE FROM ad_search_fts WHERE ad_id = :ad_id"), {'ad_id': ad_id})
+    if commit:
+        db.session.commit()
+
+def search_ads(query, page=1, per_page=24):
+    """
+    Ranked full-text search over approved ads.
+
+    :param query: Raw search string from the user
+    :param page: 1-based page number
+    :param per_page: Results per page
+    :return: (ads on this page in rank order, total number of matches)
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return [], 0
+
+    offset = (max(page, 1) - 1) * per_page
+    backend = get_backend()
+    if backend == 'postgres':
+        ranked, total = _search_postgres(tokens, per_page, offset)
+    elif backend == 'fts5':
+        ranked, total = _search_fts5(tokens, per_page, offset)
+    else:
+        ranked, total = _search_python(tokens, per_page, offset)
+
+    if not ranked:
+        return [], total
+
+    ads = Ad.query.filter(Ad.ad_id.in_(ranked)).all()
+    ads_by_id = {ad.ad_id: ad for ad in ads}
+    return [ads_by_id[ad_id] for ad_id in ranked if ad_id in ads_by_id], total
+
+def _search_postgres(tokens, limit, offset):
+    tsquery = ' & '.join(f"{token}:*" for token in tokens)
+    rows = db.session.execute(text(
+        "SELECT d.ad_id, count(*) OVER () AS total "
+        "FROM ad_search_documents d JOIN ads a ON a.ad_id = d.ad_id, "
+        "to_tsquery('simple', :q) q "
+        "WHERE (setweight(to_tsvector('simple', d.title), 'A') || setweight(to_tsvector('simple', d.body), 'B')) @@ q "
+        "AND a.admin_status = 'approved' "
+        "ORDER BY ts_rank_cd(setweight(to_tsvector('simple', d.title), 'A') || setweight(to_tsvector('simple', d.body), 'B'), q) DESC, "
+        "a.created_at DESC "
+        "LIMIT :limit OFFSET :offset"
+    ), {'q': tsquery, 'limit': limit, 'offset': offset}).all()
+    return [row.ad_id for row in rows], (rows[0].total if rows else 0)
+
+def _search_fts5(tokens, limit, offset):
+    match = ' '.join(f'"{token}"*' for token in tokens)
+    rows = db.session.execute(text(
+        "WITH hits AS ("
+        "  SELECT ad_id, bm25(ad_search_fts, 0.0, :title_weight, 1.0) AS rank "
+        "  FROM ad_search_fts WHERE ad_search_fts MATCH :q"
+        ") "
+        "SELECT hits.ad_id, count(*) OVER () AS total "
+        "FROM hits JOIN ads a ON a.ad_id = hits.ad_id "
+        "WHERE a.admin_status = 'approved' "
+        "ORDER BY hits.rank, a.created_at DESC "
+        "LIMIT :limit OFFSET :offset"
+    ), {'q': match, 'title_weight': float(TITLE_WEIGHT), 'limit': limit, 'offset': offset}).all()
+    return [row.ad_id for row in rows], (rows[0].total if rows else 0)
+
+class InvertedIndex:
+    """In-process inverted index with BM25 ranking, used when the database has no full-text support."""
+
+    def __init__(self, documents):
+        self.postings = defaultdict(dict)
+        self.lengths = {}
+        for ad_id, title, body in documents:
+            counts = Counter(body.split())
+            for token in title.split():
+                counts[token] += TITLE_WEIGHT
+            self.lengths[ad_id] = sum(counts.values())
+            for token, count in counts.items():
+                self.postings[token][ad_id] = count
+        self.vocabulary = sorted(self.postings)
+        self.avg_length = (sum(self.lengths.values()) / len(self.lengths)) if self.lengths else 0
+
+    def _expand(self, prefix):
+        """All indexed tokens starting with prefix."""
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        end = bisect.bisect_left(self.vocabulary, prefix + '\uffff')
+        return self.vocabulary[start:end]
+
+    def search(self, tokens):
+        """Return ad IDs matching every token (by prefix), best BM25 score first."""
+        n = len(self.lengths)
+        scores = None
+        for token in tokens:
+            token_scores = defaultdict(float)
+            for term in self._expand(token):
+                postings = self.postings[term]
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for ad_id, tf in postings.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[ad_id] / self.avg_length)
+                    token_scores[ad_id] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {ad_id: score + token_scores[ad_id] for ad_id, score in scores.items() if ad_id in token_scores}
+            if not scores:
+                return []
+        return sorted(scores, key=scores.get, reverse=True)
+
+def _get_python_index():
+    """Build the fallback index lazily and rebuild it when the documents change."""
+    global _python_index
+
+    version = db.session.query(func.count(AdSearchDocument.ad_id), func.max(AdSearchDocument.updated_at)).one()
+    with _python_index_lock:
+        if _python_index is None or _python_index[0] != tuple(version):
+            documents = (db.session.query(AdSearchDocument.ad_id, AdSearchDocument.title, AdSearchDocument.body)
+                         .join(Ad, Ad.ad_id == AdSearchDocument.ad_id)
+                         .filter(Ad.admin_status == 'approved')
+                         .all())
+            _python_index = (tuple(version), InvertedIndex(documents))
+        return _python_index[1]
+
+def _search_python(tokens, limit, offset):
+    ranked = _get_python_index().search(tokens)
+    return ranked[offset:offset + limit], len(ranked)
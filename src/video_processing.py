@@ -0,0 +1,97 @@
+"""
+Offline video transcoding for approved video ads.
+
+Uploads arrive as arbitrary MP4/MOV/MKV/AVI. For each approved video this
+module produces, next to the image variants:
+
+- <stem>.h264.mp4     H.264/AAC at a capped bitrate, moov atom first (faststart)
+- <stem>.preview.mp4  small low-bitrate rendition for autoplaying cards
+- <stem>.poster.jpg   poster frame shown before the video loads
+
+ffmpeg is run as a subprocess (the binary bundled with imageio-ffmpeg unless
+FFMPEG_BINARY is set), so nothing here imports moviepy.
+"""
+import logging
+import os
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+RENDITION_SUFFIXES = {
+    'full': '.h264.mp4',
+    'preview': '.preview.mp4',
+    'poster': '.poster.jpg',
+}
+
+def rendition_name(filename, kind):
+    """Name of a rendition, e.g. 'abc_clip.mov' -> 'abc_clip.preview.mp4'."""
+    return os.path.splitext(filename)[0] + RENDITION_SUFFIXES[kind]
+
+def get_ffmpeg():
+    """Path of the ffmpeg binary."""
+    binary = os.environ.get('FFMPEG_BINARY')
+    if binary:
+        return binary
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+def _fit(max_size):
+    """Scale filter fitting the video inside max_size x max_size, never upscaling, even dimensions."""
+    return (f"scale=w='min({max_size},iw)':h='min({max_size},ih)':force_original_aspect_ratio=decrease,"
+            f"scale=trunc(iw/2)*2:trunc(ih/2)*2")
+
+def _run(args, output, timeout):
+    """Run ffmpeg into a temporary file and rename it into place on success."""
+    tmp_output = f"{output}.{os.getpid()}.tmp{os.path.splitext(output)[1]}"
+    cmd = [get_ffmpeg(), '-y', '-loglevel', 'error'] + args + [tmp_output]
+    try:
+        result = subprocess.run(cmd, capture_output=True, timeout=timeout)
+        if result.returncode != 0 or not os.path.exists(tmp_output) or os.path.getsize(tmp_output) == 0:
+            raise RuntimeError(result.stderr.decode(errors='replace').strip()[-500:] or 'ffmpeg produced no output')
+        os.replace(tmp_output, output)
+    finally:
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+
+def transcode_video(video_path, output_folder, max_size=1280, max_bitrate='2M',
+                    preview_size=480, preview_bitrate='400k', timeout=600):
+    """
+    Produce the full, preview and poster renditions of a video.
+
+    :param video_path: Full path of the uploaded video
+    :param output_folder: Folder receiving the renditions
+    :param max_size: Longest side of the full rendition in pixels
+    :param max_bitrate: Video bitrate cap of the full rendition (ffmpeg syntax)
+    :param preview_size: Longest side of the preview rendition
+    :param preview_bitrate: Video bitrate cap of the preview rendition
+    :param timeout: Seconds allowed per ffmpeg run
+    :return: Dict mapping 'full', 'preview' and 'poster' to rendition filenames
+    """
+    filename = os.path.basename(video_path)
+    os.makedirs(output_folder, exist_ok=True)
+    outputs = {kind: rendition_name(filename, kind) for kind in RENDITION_SUFFIXES}
+
+    common = ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-movflags', '+faststart']
+    _run(['-i', video_path, '-map', '0:v:0', '-map', '0:a:0?', '-vf', _fit(max_size),
+          '-crf', '23', '-maxrate', max_bitrate, '-bufsize', _double(max_bitrate),
+          '-c:a', 'aac', '-b:a', '128k'] + common,
+         os.path.join(output_folder, outputs['full']), timeout)
+    _run(['-i', video_path, '-map', '0:v:0', '-map', '0:a:0?', '-vf', _fit(preview_size),
+          '-crf', '30', '-maxrate', preview_bitrate, '-bufsize', _double(preview_bitrate),
+          '-c:a', 'aac', '-b:a', '64k', '-ac', '1'] + common,
+         os.path.join(output_folder, outputs['preview']), timeout)
+
+    poster = os.path.join(output_folder, outputs['poster'])
+    try:
+        # A frame one second in is rarely the black fade-in of the first frame
+        _run(['-ss', '1', '-i', video_path, '-frames:v', '1', '-vf', _fit(max_size), '-q:v', '3'], poster, timeout)
+    except RuntimeError:
+        _run(['-i', video_path, '-frames:v', '1', '-vf', _fit(max_size), '-q:v', '3'], poster, timeout)
+
+    logger.info(f"Transcoded {filename}")
+    return outputs
+
+def _double(bitrate):
+    """'2M' -> '4M', used as the rate-control buffer size."""
+    number, unit = (bitrate[:-1], bitrate[-1]) if bitrate[-1].isalpha() else (bitrate, '')
+    return f"{float(number) * 2:g}{unit}"
@@ -0,0 +1,202 @@
+// Admin dashboard tables: each one loads a page at a time from its JSON endpoint (/admin/api/*)
+document.addEventListener('DOMContentLoaded', function() {
+    const AD_STATUSES = {under_review: 'An Revizyon', approved: 'Apwouve', rejected: 'Rejte'};
+    const PAYMENT_STATUSES = {pending: 'Pèman an Atann', verified: 'Pèman Verifye', rejected: 'Pèman Rejte'};
+    const MEDIA_STATES = {queued: 'An atant', running: 'Ap trete', done: 'Fini', failed: 'Echwe'};
+
+    function escapeHtml(value) {
+        const div = document.createElement('div');
+        div.textContent = value == null ? '' : String(value);
+        return div.innerHTML;
+    }
+
+    function options(labels, selected) {
+        return Object.entries(labels).map(([value, label]) =>
+            `<option value="${value}" ${value === selected ? 'selected' : ''}>${label}</option>`).join('');
+    }
+
+    function renderAd(ad, container) {
+        const images = ad.images.map(src => `<img src="${escapeHtml(src)}" alt="Piblisite Imaj" loading="lazy">`).join('');
+        const mediaState = ad.media_state ? `
+            <p><strong>Medya:</strong>
+                <a href="${escapeHtml(ad.urls.media_jobs)}" target="_blank" class="media-state media-state-${ad.media_state}">
+                    ${MEDIA_STATES[ad.media_state]}
+                </a>
+            </p>` : '';
+        const proof = ad.payment_proof_url ? `
+            <p><strong>Prèv Pèman:</strong> <a href="${escapeHtml(ad.payment_proof_url)}" target="_blank">Wè Prèv</a></p>` : '';
+        const approvedActions = ad.admin_status === 'approved' ? `
+            <a href="${escapeHtml(ad.urls.csv)}" class="btn btn-gold" target="_blank">📄 Telechaje CSV</a>
+            <form method="POST" action="${escapeHtml(ad.urls.publish_facebook)}" style="display: inline;">
+                <button type="submit" class="btn btn-blue" title="Pibliye sou Facebook">
+                    <i class="fab fa-facebook"></i> Pibliye Facebook
+                </button>
+            </form>` : '';
+
+        return `
+        <div class="ad-card">
+            <div class="ad-images">${images}</div>
+            <div class="ad-info">
+                <p><strong>WhatsApp:</strong> ${escapeHtml(ad.user_whatsapp)}</p>
+                <p><strong>Deskripsyon:</strong> ${escapeHtml(ad.description)}</p>
+                <p><strong>Estati:</strong> ${escapeHtml(ad.admin_status)}</p>
+                <p><strong>Pèman:</strong> ${escapeHtml(ad.payment_status)}</p>
+                ${mediaState}
+                ${proof}
+            </div>
+            <div class="ad-actions">
+                <form method="POST" action="${escapeHtml(container.dataset.updateUrl)}">
+                    <input type="hidden" name="ad_id" value="${escapeHtml(ad.ad_id)}">
+                    <select name="status" required>${options(AD_STATUSES, ad.admin_status)}</select>
+                    <select name="payment_status" required>${options(PAYMENT_STATUSES, ad.payment_status)}</select>
+                    <button type="submit" class="btn btn-blue">Mete Ajou</button>
+                </form>
+                <form method="POST" action="${escapeHtml(ad.urls.delete)}"
+                      onsubmit="return confirm('Èske w sèten w vle efase piblisite sa?')">
+                    <button type="submit" class="btn btn-danger">Efase</button>
+                </form>
+                ${approvedActions}
+                <a href="https://wa.me/${escapeHtml(ad.user_whatsapp)}?text=Ey%20Admin..." class="btn btn-whatsapp" target="_blank">
+                    📱 Ey Admin...
+                </a>
+            </div>
+        </div>`;
+    }
+
+    function renderBatch(batch) {
+        return `
+        <div class="batch-card">
+            <h4>${escapeHtml(batch.batch_id)}</h4>
+            <p>Piblisite: ${batch.ad_count}/5</p>
+            <p>Pataj: ${batch.share_count || 0}</p>
+            <p>Rekonpans: ${batch.click_rewards || 0} klike</p>
+            <div class="batch-actions">
+                <a href="${escapeHtml(batch.urls.view)}" class="btn btn-blue">Wè Gwoup</a>
+                <a href="${escapeHtml(batch.urls.edit)}" class="btn btn-green">Modifye Gwoup</a>
+                <button type="button" data-copy-batch="${escapeHtml(batch.batch_id)}" class="btn btn-gold">Kopi Lyen</button>
+                <form method="POST" action="${escapeHtml(batch.urls.publish_facebook)}" style="display: inline;">
+                    <button type="submit" class="btn btn-blue" title="Pibliye gwoup sou Facebook">
+                        <i class="fab fa-facebook"></i> Pibliye Facebook
+                    </button>
+                </form>
+                <form method="POST" action="${escapeHtml(batch.urls.delete)}"
+                      onsubmit="return confirm('Èske w sèten w vle efase gwoup sa?')">
+                    <button type="submit" class="btn btn-danger">Efase</button>
+                </form>
+            </div>
+        </div>`;
+    }
+
+    function renderGkachUser(user, container) {
+        const action = escapeHtml(container.dataset.manageUrl);
+        const whatsapp = escapeHtml(user.user_whatsapp);
+        return `
+        <div class="user-gkach-card">
+            <div class="user-header">
+                <h5>${whatsapp}</h5>
+                <form method="POST" action="${action}" style="display: inline;" onsubmit="return confirm('Èske ou sèten ou vle efase itilizatè sa a?')">
+                    <input type="hidden" name="whatsapp" value="${whatsapp}">
+                    <input type="hidden" name="action" value="delete_user">
+                    <button type="submit" class="btn btn-delete">Efase Itilizatè</button>
+                </form>
+            </div>
+            <p><strong>Balans Gkach:</strong> ${user.gkach_balance || 0}</p>
+            <div class="balance-actions">
+                <div class="edit-balance">
+                    <form method="POST" action="${action}">
+                        <input type="hidden" name="whatsapp" value="${whatsapp}">
+                        <input type="hidden" name="action" value="edit_balance">
+                        <input type="number" name="amount" placeholder="Nouvo balans" min="0" required>
+                        <button type="submit" class="btn btn-edit">Modifye Balans</button>
+                    </form>
+                </div>
+                <div class="add-balance">
+                    <form method="POST" action="${action}">
+                        <input type="hidden" name="whatsapp" value="${whatsapp}">
+                        <input type="hidden" name="action" value="add_balance">
+                        <input type="number" name="amount" placeholder="Kantite Gkach" min="1" required>
+                        <button type="submit" class="btn btn-blue">Ajoute Balans</button>
+                    </form>
+                </div>
+            </div>
+        </div>`;
+    }
+
+    const TABLES = {
+        ads: {render: renderAd, empty: 'Pa gen piblisite pou montre.'},
+        batches: {render: renderBatch, empty: 'Pa gen gwoup pou montre.'},
+        gkach_users: {render: renderGkachUser, empty: 'Pa gen itilizatè Gkach pou montre.'},
+    };
+
+    function loadTable(name, page) {
+        const container = document.querySelector(`[data-rows="${name}"]`);
+        const pagination = document.querySelector(`[data-pagination="${name}"]`);
+        const filters = document.querySelector(`.admin-filters[data-table="${name}"]`);
+        const params = new URLSearchParams(filters ? new FormData(filters) : undefined);
+        params.set('page', page || 1);
+
+        container.innerHTML = '<p>Chajman...</p>';
+        fetch(`${container.dataset.url}?${params}`, {credentials: 'same-origin'})
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.error);
+                }
+                container.innerHTML = data.items.length
+                    ? data.items.map(item => TABLES[name].render(item, container)).join('')
+                    : `<p>${TABLES[name].empty}</p>`;
+                pagination.innerHTML = data.pages > 1 ? `
+                    ${data.page > 1 ? `<button type="button" class="btn btn-blue" data-page="${data.page - 1}"><i class="fas fa-chevron-left"></i></button>` : ''}
+                    <span>Paj ${data.page} / ${data.pages} (${data.total})</span>
+                    ${data.page < data.pages ? `<button type="button" class="btn btn-blue" data-page="${data.page + 1}"><i class="fas fa-chevron-right"></i></button>` : ''}` : '';
+            })
+            .catch(err => {
+                console.error('Erè nan chajman tablo:', err);
+                container.innerHTML = '<p>Erè nan chajman. Eseye ankò.</p>';
+            });
+    }
+
+    Object.keys(TABLES).forEach(name => {
+        if (!document.querySelector(`[data-rows="${name}"]`)) {
+            return;
+        }
+        const filters = document.querySelector(`.admin-filters[data-table="${name}"]`);
+        if (filters) {
+            filters.addEventListener('submit', function(event) {
+                event.preventDefault();
+                loadTable(name, 1);
+            });
+        }
+        document.querySelector(`[data-pagination="${name}"]`).addEventListener('click', function(event) {
+            const button = event.target.closest('[data-page]');
+            if (button) {
+                loadTable(name, button.dataset.page);
+            }
+        });
+        loadTable(name, 1);
+    });
+
+    // Count cards filter the ad table
+    document.querySelectorAll('[data-ads-status], [data-ads-payment-status]').forEach(card => {
+        card.addEventListener('click', function() {
+            const filters = document.querySelector('.admin-filters[data-table="ads"]');
+            filters.elements.status.value = card.dataset.adsStatus || '';
+            filters.elements.payment_status.value = card.dataset.adsPaymentStatus || '';
+            loadTable('ads', 1);
+        });
+    });
+
+    document.addEventListener('click', function(event) {
+        const button = event.target.closest('[data-copy-batch]');
+        if (!button) {
+            return;
+        }
+        const batchUrl = `${window.location.origin}/batch/${button.dataset.copyBatch}`;
+        navigator.clipboard.writeText(batchUrl).then(() => {
+            alert('Lyen gwoup kopye nan clipboard!');
+        }).catch(err => {
+            console.error('Erè nan kopye lyen:', err);
+            alert('Erè nan kopye lyen.');
+        });
+    });
+});
@@ -262,3 +262,52 @@ document.addEventListener('DOMContentLoaded', function() {
         setInterval(nextSlide, 5000); // Change slide every 5 seconds
     }
 });
+
+// Infinite scroll for the /achte catalog
+document.addEventListener('DOMContentLoaded', function() {
+    const grid = document.querySelector('.ads-grid[data-next-cursor]');
+    const sentinel = document.querySelector('.ads-grid-sentinel');
+
+    if (!grid || !sentinel || !('IntersectionObserver' in window)) {
+        return;
+    }
+
+    let nextCursor = grid.dataset.nextCursor;
+    let loading = false;
+
+    const observer = new IntersectionObserver((entries) => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadNextPage();
+        }
+    }, { rootMargin: '400px 0px' });
+
+    function loadNextPage() {
+        if (loading || !nextCursor) return;
+        loading = true;
+
+        fetch(`${grid.dataset.pageUrl}?cursor=${encodeURIComponent(nextCursor)}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.message);
+                }
+                grid.insertAdjacentHTML('beforeend', data.html);
+                nextCursor = data.next_cursor;
+                if (window.videoManager) {
+                    window.videoManager.refresh();
+                }
+                if (!nextCursor) {
+                    observer.disconnect();
+                    sentinel.remove();
+                }
+            })
+            .catch(error => {
+                console.error('Erè nan chajman piblisite yo:', error);
+            })
+            .finally(() => {
+                loading = false;
+            });
+    }
+
+    observer.observe(sentinel);
+});
@@ -1,6 +1,7 @@
 /**
  * Enhanced Video Autoplay System for Glory2YahPub
- * Handles intelligent video autoplay with viewport detection
+ * Handles intelligent video autoplay with viewport detection.
+ * Videos rendered with <source data-src> only download once they scroll into view.
  */
 
 class VideoAutoplayManager {
@@ -104,8 +105,22 @@ class VideoAutoplayManager {
         });
     }
 
+    loadDeferredSources(video) {
+        // Cards ship only a poster and <source data-src>; fetch the video once it is in view
+        const sources = video.querySelectorAll('source[data-src]');
+        if (!sources.length) return;
+        sources.forEach(source => {
+            source.src = source.dataset.src;
+            source.removeAttribute('data-src');
+        });
+        video.preload = video.dataset.preload || 'metadata';
+        video.load();
+    }
+
     async playVideo(video) {
         try {
+            this.loadDeferredSources(video);
+
             // Ensure video is muted for autoplay (browser requirement)
             video.muted = true;
             
@@ -200,12 +215,14 @@ class VideoAutoplayManager {
 
     // Public method to refresh video list (useful for dynamically added videos)
     refresh() {
-        this.videos = Array.from(document.querySelectorAll('video[data-autoplay]'));
-        this.videos.forEach(video => {
-            if (!this.observer) return;
+        if (!this.observer) return;
+        const newVideos = Array.from(document.querySelectorAll('video[data-autoplay]'))
+            .filter(video => !this.videos.includes(video));
+        newVideos.forEach(video => {
             this.observer.observe(video);
             this.setupVideoListeners(video);
         });
+        this.videos = this.videos.concat(newVideos);
     }
 
     // Cleanup method
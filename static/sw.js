@@ -1,4 +1,4 @@
-const CACHE_NAME = 'glory2yahpub-v1';
+const CACHE_NAME = 'glory2yahpub-v2';
 const urlsToCache = [
   '/',
   '/static/css/style.css',
@@ -21,6 +21,22 @@ self.addEventListener('install', event => {
 
 // Fetch event
 self.addEventListener('fetch', event => {
+  if (event.request.mode === 'navigate') {
+    // Pages go to the network first: they revalidate with their ETag (a cheap
+    // 304 when unchanged) and the cached copy is only used offline
+    event.respondWith(
+      fetch(event.request)
+        .then(response => {
+          if (response.ok) {
+            const copy = response.clone();
+            caches.open(CACHE_NAME).then(cache => cache.put(event.request, copy));
+          }
+          return response;
+        })
+        .catch(() => caches.match(event.request))
+    );
+    return;
+  }
   event.respondWith(
     caches.match(event.request)
       .then(response => {
@@ -0,0 +1,46 @@
+"""
+Tests for keyset pagination of the /achte catalog
+"""
+import uuid
+from datetime import datetime, timedelta
+
+from app import app, db, Ad, get_approved_ads_page
+
+
+def test_keyset_pages_cover_catalog_once(monkeypatch):
+    monkeypatch.setitem(app.config, 'ACHTE_PAGE_SIZE', 4)
+    with app.app_context():
+        Ad.query.delete()
+        base = datetime(2025, 1, 1)
+        created = []
+        for i in range(10):
+            # Pairs of ads share a timestamp to exercise the ad_id tie-breaker
+            ad = Ad(ad_id=str(uuid.uuid4()), user_whatsapp='+50912345678', images='x.jpg',
+                    description='d', title=f'Ad {i}', admin_status='approved',
+                    created_at=base + timedelta(minutes=i // 2))
+            db.session.add(ad)
+            created.append(ad)
+        db.session.add(Ad(ad_id=str(uuid.uuid4()), user_whatsapp='+50912345678', images='x.jpg',
+                          description='d', title='Pending', admin_status='under_review'))
+        db.session.commit()
+        expected = [ad.ad_id for ad in sorted(created, key=lambda a: (a.created_at, a.ad_id), reverse=True)]
+
+    client = app.test_client()
+    first = client.get('/achte').get_data(as_text=True)
+    assert first.count('onclick="showAdModal(') == 4
+    assert 'data-next-cursor' in first
+
+    with app.app_context():
+        ads, cursor = get_approved_ads_page(limit=4)
+    seen = [ad.ad_id for ad in ads]
+    while cursor:
+        data = client.get('/api/achte/ads', query_string={'cursor': cursor}).get_json()
+        assert data['success']
+        seen.extend(data['ad_ids'])
+        cursor = data['next_cursor']
+    assert seen == expected
+
+
+def test_invalid_cursor_is_rejected():
+    response = app.test_client().get('/api/achte/ads?cursor=garbage')
+    assert response.status_code == 400
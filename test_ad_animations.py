@@ -0,0 +1,108 @@
+"""
+Tests for the animated previews of multi-image ads
+"""
+import json
+import os
+import tempfile
+import uuid
+
+import pytest
+from PIL import Image
+
+from app import app, db, Ad, MediaJob
+from src.ad_media import set_ad_images
+from src.gif_utils import get_ad_animation, render_animation
+from src.media_jobs import run_pending_jobs
+
+
+def _image(path, size, color):
+    Image.new('RGB', size, color).save(path, 'JPEG', quality=90)
+    return path
+
+
+def _sources(folder, sizes=((800, 400), (400, 800), (600, 600))):
+    colors = [(200, 30, 30), (30, 200, 30), (30, 30, 200)]
+    return [_image(os.path.join(folder, f'{n}.jpg'), size, colors[n % 3]) for n, size in enumerate(sizes)]
+
+
+def _admin_client():
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['admin'] = True
+    return client
+
+
+def test_frames_keep_their_aspect_ratio_with_letterboxing():
+    folder = tempfile.mkdtemp()
+    result = render_animation(_sources(folder), folder, size=480, duration=0.5)
+    assert result['rendered'] and set(result['files']) == {'webp', 'gif'}
+    animations = os.path.join(folder, 'animations')
+
+    with Image.open(os.path.join(animations, result['files']['webp'])) as webp:
+        assert webp.size == (480, 240)  # Shaped like the first image, not forced square
+        assert webp.n_frames == 3 and webp.info['loop'] == 0
+        webp.seek(1)
+        portrait = webp.convert('RGB')
+    # The portrait image is pillarboxed: white bars left and right, the photo in the middle
+    assert portrait.getpixel((5, 120)) == pytest.approx((255, 255, 255), abs=8)
+    assert portrait.getpixel((240, 120)) == pytest.approx((30, 200, 30), abs=25)
+
+    with Image.open(os.path.join(animations, result['files']['gif'])) as gif:
+        assert gif.size == (480, 240) and gif.n_frames == 3
+        assert gif.info['duration'] == 500
+
+
+def test_outputs_are_cached_by_image_content():
+    folder = tempfile.mkdtemp()
+    sources = _sources(folder)
+    first = render_animation(sources, folder)
+    again = render_animation(sources, folder)
+    assert again == dict(first, rendered=False)
+
+    os.utime(sources[0])  # Touched but unchanged: still cached
+    assert render_animation(sources, folder)['rendered'] is False
+
+    _image(sources[1], (400, 800), (250, 250, 0))  # Edited image: new animation
+    edited = render_animation(sources, folder)
+    assert edited['rendered'] and edited['key'] != first['key']
+
+
+def test_mp4_loop_is_streamed_to_ffmpeg():
+    pytest.importorskip('imageio_ffmpeg')
+    folder = tempfile.mkdtemp()
+    result = render_animation(_sources(folder), folder, size=320, duration=0.5, formats=('mp4',))
+    path = os.path.join(folder, 'animations', result['files']['mp4'])
+    with open(path, 'rb') as f:
+        assert f.read(12)[4:8] == b'ftyp'
+
+
+def test_approval_queues_the_animation_instead_of_rendering_it():
+    upload_folder = app.config['UPLOAD_FOLDER']
+    names = [f'{uuid.uuid4()}.jpg' for _ in range(2)]
+    for name, color in zip(names, [(10, 10, 10), (240, 240, 240)]):
+        _image(os.path.join(upload_folder, name), (640, 480), color)
+    with app.app_context():
+        ad = Ad(ad_id=str(uuid.uuid4()), user_whatsapp='+50912345678', description='Bel pwodwi', title='Atik',
+                admin_status='under_review')
+        set_ad_images(ad, names)
+        db.session.add(ad)
+        db.session.commit()
+        ad_id = ad.ad_id
+
+    admin = _admin_client()
+    admin.post('/admin/update_ad_status', data={'ad_id': ad_id, 'status': 'approved'})
+    with app.app_context():
+        assert get_ad_animation(ad_id) == {}  # Nothing rendered in the request
+        assert MediaJob.query.filter_by(ad_id=ad_id, kind='render_animation', status='queued').count() == 1
+        run_pending_jobs()
+        animation = get_ad_animation(ad_id)
+        assert set(animation) == {'webp', 'gif'}
+        mtime = os.path.getmtime(animation['webp'])
+
+    # Approved again with the same images: the job only hashes them
+    admin.post('/admin/update_ad_status', data={'ad_id': ad_id, 'status': 'approved'})
+    with app.app_context():
+        run_pending_jobs()
+        job = MediaJob.query.filter_by(ad_id=ad_id, kind='render_animation').order_by(MediaJob.id.desc()).first()
+        assert job.status == 'done' and json.loads(job.result)['rendered'] is False
+        assert os.path.getmtime(get_ad_animation(ad_id)['webp']) == mtime
@@ -0,0 +1,182 @@
+"""
+Tests for the ad_media and batch_ads tables
+
+Uploads record one ad_media row per file with its dimensions, size and hash,
+plus the ad's thumbnail; batch pages load their ads and media with one
+joined query, and membership changes keep the positions in order.
+"""
+import hashlib
+import io
+import os
+import uuid
+from contextlib import contextmanager
+
+from PIL import Image
+from sqlalchemy import event
+
+from app import app, db, Ad, Batch
+from models import AdMedia, BatchAd
+from src.ad_media import set_ad_images, backfill_media_details
+from src.batches import set_batch_ads, get_batch_ads
+from src.media_jobs import run_pending_jobs
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def _photo(width=1500, height=1000, orientation=None):
+    """JPEG bytes, optionally tagged with an EXIF orientation like a phone photo."""
+    img = Image.new('RGB', (width, height), (30, 120, 200))
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=90, exif=exif.tobytes())
+    return buf.getvalue()
+
+
+def _sha256(name):
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], name), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _upload(width=640, height=480):
+    name = f'{uuid.uuid4()}.jpg'
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], name), 'wb') as f:
+        f.write(_photo(width, height))
+    return name
+
+
+def _batch(n_ads):
+    """A batch of n approved ads with two images each; returns (batch_id, ad_ids)."""
+    with app.app_context():
+        batch = Batch(batch_id=str(uuid.uuid4()))
+        ad_ids = []
+        for i in range(n_ads):
+            ad = Ad(ad_id=str(uuid.uuid4()), user_whatsapp='+50912345678', description='Bel pwodwi',
+                    title=f'Atik {i}', admin_status='approved')
+            set_ad_images(ad, [_upload(), _upload()])
+            db.session.add(ad)
+            ad_ids.append(ad.ad_id)
+        db.session.flush()
+        set_batch_ads(batch, ad_ids)
+        db.session.add(batch)
+        db.session.commit()
+        return batch.batch_id, ad_ids
+
+
+def _admin_client():
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['admin'] = True
+    return client
+
+
+def test_upload_records_media_and_thumbnail():
+    photo = _photo(orientation=6)
+    response = app.test_client().post('/submit_ad', data={
+        'whatsapp': '+50912345678',
+        'title': 'Telefòn',
+        'description': 'Tou nèf',
+        'ad_type': 'publish',
+        'media_type': 'images',
+        'accept_terms': 'on',
+        'image_1': (io.BytesIO(photo), 'a.jpg'),
+        'image_2': (io.BytesIO(_photo(800, 600)), 'b.jpg'),
+        'image_3': (io.BytesIO(_photo(800, 600)), 'c.jpg'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 302
+    ad_id = response.headers['Location'].rstrip('/').rsplit('/', 1)[-1]
+
+    with app.app_context():
+        ad = db.session.get(Ad, ad_id)
+        first, second, third = ad.media
+        assert [item.position for item in ad.media] == [0, 1, 2]
+        # Displayed dimensions: the EXIF rotation is accounted for before the worker fixes it
+        assert (first.width, first.height) == (1000, 1500) and (second.width, second.height) == (800, 600)
+        assert first.sha256 == _sha256(first.filename) and first.bytes == len(photo)
+        assert (ad.thumbnail, ad.thumbnail_width, ad.thumbnail_height) == (first.filename, 1000, 1500)
+        assert ad.images == f'{first.filename},{second.filename},{third.filename}'  # Legacy column kept in sync
+
+        run_pending_jobs(kinds=['process_images'])
+        db.session.expire_all()
+        ad = db.session.get(Ad, ad_id)
+        first = ad.media[0]
+        # Re-encoded upright by the worker: new hash and size, same displayed dimensions
+        assert first.sha256 == _sha256(first.filename) and first.bytes != len(photo)
+        assert (first.width, first.height) == (1000, 1500)
+        assert (ad.thumbnail_width, ad.thumbnail_height) == (1000, 1500)
+
+
+def test_batch_ads_and_media_load_with_one_query():
+    batch_id, ad_ids = _batch(5)
+    with app.app_context():
+        with count_queries() as statements:
+            ads = get_batch_ads(batch_id)
+            filenames = [ad.image_filenames for ad in ads]
+        assert len(statements) == 1
+        assert [ad.ad_id for ad in ads] == ad_ids
+        assert all(len(names) == 2 for names in filenames)
+        thumbnail = ads[0].thumbnail
+
+    html = app.test_client().get(f'/batch/{batch_id}').get_data(as_text=True)
+    assert f'/media/320/webp/{thumbnail} 320w' in html
+    assert 'width="640" height="480"' in html
+
+
+def test_adding_and_removing_ads_keeps_positions():
+    batch_id, ad_ids = _batch(3)
+    with app.app_context():
+        extra = Ad(ad_id=str(uuid.uuid4()), user_whatsapp='+50912345678', description='d', title='Lòt',
+                   admin_status='approved')
+        set_ad_images(extra, [_upload()])
+        db.session.add(extra)
+        db.session.commit()
+        extra_id = extra.ad_id
+
+    admin = _admin_client()
+    admin.post(f'/admin/remove_ad_from_batch/{batch_id}/{ad_ids[1]}')
+    admin.post(f'/admin/add_ad_to_batch/{batch_id}/{extra_id}')
+
+    expected = [ad_ids[0], ad_ids[2], extra_id]
+    with app.app_context():
+        batch = db.session.get(Batch, batch_id)
+        assert [(member.ad_id, member.position) for member in batch.members] == list(zip(expected, range(3)))
+        assert batch.ads == ','.join(expected)
+        assert BatchAd.query.filter_by(ad_id=ad_ids[1]).count() == 0
+
+    # Back among the ads available for a batch, and in one batch at most
+    admin.post(f'/admin/add_ad_to_batch/{batch_id}/{extra_id}')
+    with app.app_context():
+        assert BatchAd.query.filter_by(ad_id=extra_id).count() == 1
+
+
+def test_backfill_measures_migrated_rows():
+    name = _upload(320, 240)
+    with app.app_context():
+        # As left by the migration: the filenames only
+        ad = Ad(ad_id=str(uuid.uuid4()), user_whatsapp='+50912345678', description='d', images=name,
+                thumbnail=name, admin_status='approved')
+        ad.media = [AdMedia(position=0, filename=name, kind='image')]
+        db.session.add(ad)
+        db.session.commit()
+        ad_id = ad.ad_id
+
+        assert backfill_media_details() >= 1
+        ad = db.session.get(Ad, ad_id)
+        assert (ad.media[0].width, ad.media[0].height, ad.media[0].sha256) == (320, 240, _sha256(name))
+        assert (ad.thumbnail_width, ad.thumbnail_height) == (320, 240)
+        assert backfill_media_details() == 0
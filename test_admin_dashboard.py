@@ -0,0 +1,127 @@
+"""
+Tests for the admin dashboard: aggregate counts on the page, tables served
+a page at a time by the /admin/api/* endpoints.
+"""
+import uuid
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from app import app, db, Ad, Batch, UserGkach, GkachRequest
+from src.ad_media import set_ad_images
+from src.admin_dashboard import get_dashboard_counts
+from src.batches import set_batch_ads
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def _admin_client():
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['admin'] = True
+    return client
+
+
+def _seed(n_ads, seller):
+    with app.app_context():
+        ad_ids = []
+        for n in range(n_ads):
+            ad = Ad(ad_id=str(uuid.uuid4()), user_whatsapp=seller, description='d', title=f'Atik {n}',
+                    admin_status=['under_review', 'approved'][n % 2],
+                    payment_status='pending', payment_proof='proof.jpg' if n % 3 == 0 else None)
+            set_ad_images(ad, ['a.jpg', 'b.jpg'])
+            db.session.add(ad)
+            ad_ids.append(ad.ad_id)
+        db.session.flush()
+        batch = Batch(batch_id=str(uuid.uuid4()))
+        set_batch_ads(batch, ad_ids[:2])
+        db.session.add(batch)
+        db.session.add(UserGkach(user_whatsapp=seller, gkach_balance=12))
+        db.session.add(GkachRequest(request_id=str(uuid.uuid4()), user_whatsapp=seller, amount=5))
+        db.session.commit()
+
+
+def test_dashboard_page_cost_does_not_grow_with_the_tables():
+    admin = _admin_client()
+    _seed(3, f'+509{uuid.uuid4().int % 10**8:08d}')
+    with count_queries() as few:
+        response = admin.get('/admin')
+    assert response.status_code == 200
+
+    _seed(40, f'+509{uuid.uuid4().int % 10**8:08d}')
+    with count_queries() as many:
+        html = admin.get('/admin').get_data(as_text=True)
+    assert len(many) == len(few)
+    # Rows are not rendered in the page, only the counts
+    assert 'Atik 1' not in html
+    with app.app_context():
+        counts = get_dashboard_counts()
+    assert f"<strong>{counts['ads']['under_review']}</strong>" in html
+    assert f"<strong>{counts['pending_proofs']}</strong>" in html
+
+
+def test_dashboard_counts_match_the_rows():
+    with app.app_context():
+        before = get_dashboard_counts()
+    _seed(6, f'+509{uuid.uuid4().int % 10**8:08d}')
+    with app.app_context():
+        after = get_dashboard_counts()
+    assert after['ads']['under_review'] - before['ads']['under_review'] == 3
+    assert after['ads']['approved'] - before['ads']['approved'] == 3
+    assert after['ads_total'] - before['ads_total'] == 6
+    assert after['pending_proofs'] - before['pending_proofs'] == 2
+    assert after['pending_requests'] - before['pending_requests'] == 1
+    assert after['batches'] - before['batches'] == 1
+    assert after['unpublished_batches'] - before['unpublished_batches'] == 1
+    assert after['gkach_users'] - before['gkach_users'] == 1
+
+
+def test_ad_table_is_paginated_and_filtered_in_sql():
+    seller = f'+509{uuid.uuid4().int % 10**8:08d}'
+    _seed(25, seller)
+    admin = _admin_client()
+
+    first = admin.get('/admin/api/ads', query_string={'q': seller, 'per_page': 10}).get_json()
+    assert first['total'] == 25 and first['pages'] == 3 and len(first['items']) == 10
+    second = admin.get('/admin/api/ads', query_string={'q': seller, 'per_page': 10, 'page': 2}).get_json()
+    assert not {ad['ad_id'] for ad in first['items']} & {ad['ad_id'] for ad in second['items']}
+
+    approved = admin.get('/admin/api/ads', query_string={'q': seller, 'status': 'approved', 'per_page': 100}).get_json()
+    assert approved['total'] == 12 and {ad['admin_status'] for ad in approved['items']} == {'approved'}
+    ad = approved['items'][0]
+    assert len(ad['images']) == 2 and ad['urls']['delete'].endswith(ad['ad_id'])
+
+    with count_queries() as statements:
+        admin.get('/admin/api/ads', query_string={'q': seller, 'per_page': 20})
+    assert len(statements) == 4  # Count, page, media and media states of the page
+
+
+def test_batch_and_user_tables():
+    seller = f'+509{uuid.uuid4().int % 10**8:08d}'
+    _seed(2, seller)
+    admin = _admin_client()
+
+    users = admin.get('/admin/api/gkach_users', query_string={'q': seller}).get_json()
+    assert users['items'] == [{'user_whatsapp': seller, 'gkach_balance': 12, 'created_at': users['items'][0]['created_at']}]
+
+    batches = admin.get('/admin/api/batches', query_string={'unpublished': '1', 'per_page': 1}).get_json()
+    assert batches['total'] >= 1 and len(batches['items']) == 1
+    assert batches['items'][0]['ad_count'] == 2
+
+    client = app.test_client()
+    for endpoint in ('/admin/api/ads', '/admin/api/batches', '/admin/api/gkach_users'):
+        assert client.get(endpoint).status_code == 401
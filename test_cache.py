@@ -0,0 +1,175 @@
+"""
+Tests for the read-through cache of ads and Gkach rates
+"""
+import json
+import os
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from app import app, db, Ad, CartItem, Delivery, User, UserGkach
+from src import cache, metrics
+from src.cache import LRUCache, ReadThroughCache, Snapshot, SqliteCacheBackend, snapshot_from_json
+from src.ledger import MINT_ACCOUNT, get_balance, transfer
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def _create_ad(**fields):
+    values = {'ad_id': str(uuid.uuid4()), 'user_whatsapp': '+50912345678', 'images': 'a.jpg',
+              'description': 'Bel pwodwi', 'title': 'Atik', 'admin_status': 'approved', 'price_gkach': 25}
+    values.update(fields)
+    with app.app_context():
+        db.session.add(Ad(**values))
+        db.session.commit()
+    return values['ad_id']
+
+
+def _admin_client():
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['admin'] = True
+    return client
+
+
+def test_ads_are_cached_as_detached_snapshots():
+    ad_id = _create_ad(title='Soulye')
+    with app.app_context():
+        first = cache.get_ad(ad_id)
+    with app.app_context():
+        with count_queries() as statements:
+            again = cache.get_ad(ad_id, approved=True)
+    assert statements == []
+    assert again is first
+    assert isinstance(again, Snapshot)
+    assert again.title == 'Soulye' and again['price_gkach'] == 25
+    with pytest.raises(AttributeError):
+        again.title = 'Chanje'
+
+    restored = snapshot_from_json(Ad, again.to_json())
+    assert restored == again
+    assert restored.created_at == again.created_at
+    json.loads(again.to_json())
+
+
+def test_ad_status_change_and_delete_invalidate():
+    ad_id = _create_ad()
+    admin = _admin_client()
+    with app.app_context():
+        assert cache.get_ad(ad_id, approved=True) is not None
+
+    admin.post('/admin/update_ad_status', data={'ad_id': ad_id, 'status': 'rejected'})
+    with app.app_context():
+        assert cache.get_ad(ad_id).admin_status == 'rejected'
+        assert cache.get_ad(ad_id, approved=True) is None
+
+    admin.post(f'/admin/delete_ad/{ad_id}')
+    with app.app_context():
+        assert cache.get_ad(ad_id) is None
+
+
+def test_orders_and_payments_do_not_trust_a_stale_snapshot():
+    seller, buyer = '+50911111111', f'+509{uuid.uuid4().int % 10**8:08d}'
+    ad_id = _create_ad(user_whatsapp=seller)
+    with app.app_context():
+        assert cache.get_ad(ad_id, approved=True) is not None
+        # Rejected by another worker: this worker's snapshot still says approved
+        Ad.query.filter_by(ad_id=ad_id).update({'admin_status': 'rejected'})
+        db.session.add(UserGkach(user_whatsapp=buyer, gkach_balance=0))
+        transfer([(MINT_ACCOUNT, -100), (buyer, 100)], 'test_fund')
+        delivery = Delivery(delivery_id=str(uuid.uuid4()), ad_id=ad_id, buyer_whatsapp=buyer, seller_whatsapp=seller,
+                            delivery_cost=5, total_price=25, status='confirmed')
+        db.session.add(delivery)
+        db.session.commit()
+        delivery_id = delivery.delivery_id
+        assert cache.get_ad(ad_id, approved=True) is not None
+
+    client = app.test_client()
+    client.post('/add_to_cart', data={'whatsapp': buyer, 'name': 'Achte', 'product_id': ad_id, 'quantity': '1'})
+    with client.session_transaction() as sess:
+        sess['delivery_id'] = delivery_id
+    client.post(f'/achte/buy/{ad_id}')
+
+    with app.app_context():
+        user = User.query.filter_by(whatsapp=buyer).one()
+        assert CartItem.query.filter_by(user_id=user.id).count() == 0
+        assert db.session.get(Delivery, delivery_id).status == 'confirmed'
+        assert get_balance(buyer) == 100
+
+
+def test_gkach_rate_endpoint_uses_the_cache():
+    admin = _admin_client()
+    client = app.test_client()
+    admin.post('/admin/manage_gkach', data={'action': 'set_rate', 'currency': 'HTG', 'rate': '60'})
+    assert client.get('/api/gkach_rate').get_json() == {'rate': 60.0, 'currency': 'HTG'}
+
+    with count_queries() as statements:
+        client.get('/api/gkach_rate')
+    assert not any('gkach_rates' in statement for statement in statements)
+
+    admin.post('/admin/manage_gkach', data={'action': 'set_rate', 'currency': 'HTG', 'rate': '65'})
+    assert client.get('/api/gkach_rate').get_json() == {'rate': 65.0, 'currency': 'HTG'}
+
+
+def test_shared_backend_between_workers():
+    backend_path = os.path.join(tempfile.mkdtemp(), 'cache.db')
+    # Two workers of one host: each has its own LRU, both use the same file
+    worker_a = ReadThroughCache('ad', Ad, shared=SqliteCacheBackend(backend_path), sync_interval=0)
+    worker_b = ReadThroughCache('ad', Ad, shared=SqliteCacheBackend(backend_path), sync_interval=0)
+    ad_id = _create_ad(title='Chemiz')
+
+    with app.app_context():
+        load = lambda: db.session.get(Ad, ad_id)
+        assert worker_a.get(ad_id, load).title == 'Chemiz'
+        with count_queries() as statements:
+            assert worker_b.get(ad_id, load).title == 'Chemiz'
+        assert statements == []
+        assert worker_a.stats['miss'] == 1 and worker_b.stats['shared_hit'] == 1
+
+        db.session.get(Ad, ad_id).title = 'Chemiz ble'
+        db.session.commit()
+        worker_a.invalidate(ad_id)
+        assert worker_b.get(ad_id, load).title == 'Chemiz ble'
+        assert worker_b.stats['miss'] == 1
+
+
+def test_lru_evicts_and_expires():
+    lru = LRUCache(maxsize=2, ttl=0.05)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    lru.get('a')
+    lru.set('c', 3)
+    assert lru.get('b') is cache.MISSING
+    assert lru.get('a') == 1
+    time.sleep(0.06)
+    assert lru.get('a') is cache.MISSING
+
+
+def test_hits_and_misses_reach_the_metrics():
+    ad_id = _create_ad()
+    with app.app_context():
+        cache.get_ad(ad_id)
+        cache.get_ad(ad_id)
+    metrics.flush(app)
+    text = metrics.render_prometheus(app)
+    assert '# TYPE glory2yahpub_cache_requests_total counter' in text
+    assert 'glory2yahpub_cache_requests_total{cache="ad",result="hit"}' in text
+    assert 'glory2yahpub_cache_requests_total{cache="ad",result="miss"}' in text
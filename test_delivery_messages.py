@@ -0,0 +1,185 @@
+"""
+Tests for the delivery message API: ?after_id= cursor, long poll and
+server-sent events, woken by the in-process bus or, for messages sent
+through another worker, by its database poller.
+"""
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import quote
+
+import pytest
+from sqlalchemy import event
+
+from app import app, db, Delivery, Message
+from src.communication import send_message
+from src.message_bus import message_bus
+
+BUYER = '+50911111111'
+SELLER = '+50922222222'
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@pytest.fixture
+def delivery_id(monkeypatch):
+    monkeypatch.setitem(app.config, 'MESSAGE_KEEPALIVE_SECONDS', 0.2)
+    monkeypatch.setattr(message_bus, 'poll_interval', 0.05)
+    with app.app_context():
+        delivery = Delivery(delivery_id=str(uuid.uuid4()), buyer_whatsapp=BUYER, seller_whatsapp=SELLER,
+                            total_price=100, status='negotiating')
+        db.session.add(delivery)
+        db.session.commit()
+        return delivery.delivery_id
+
+
+def _send(delivery_id, text, sender=SELLER):
+    with app.app_context():
+        return send_message(delivery_id, sender, text).id
+
+
+def _send_later(delivery_id, text, delay=0.2, through_other_worker=False):
+    """Send a message from another thread; through_other_worker skips this worker's bus, like a message sent elsewhere."""
+    def send():
+        time.sleep(delay)
+        with app.app_context():
+            if through_other_worker:
+                db.session.add(Message(delivery_id=delivery_id, sender_whatsapp=SELLER, message=text,
+                                       created_at=datetime.utcnow()))
+                db.session.commit()
+            else:
+                send_message(delivery_id, SELLER, text)
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    return thread
+
+
+def test_after_id_returns_only_new_messages(delivery_id):
+    ids = [_send(delivery_id, f'Mesaj {n}') for n in range(3)]
+    client = app.test_client()
+
+    data = client.get(f'/api/delivery/{delivery_id}/messages?whatsapp={quote(BUYER)}').get_json()
+    assert [message['id'] for message in data['messages']] == ids
+    assert data['last_id'] == ids[-1]
+
+    with count_queries() as statements:
+        data = client.get(f'/api/delivery/{delivery_id}/messages?whatsapp={quote(BUYER)}&after_id={ids[0]}').get_json()
+    assert [message['message'] for message in data['messages']] == ['Mesaj 1', 'Mesaj 2']
+    assert len(statements) == 2  # Participants, then the new messages
+
+    data = client.get(f'/api/delivery/{delivery_id}/messages?whatsapp={quote(BUYER)}&after_id={ids[-1]}').get_json()
+    assert data == {'messages': [], 'last_id': ids[-1]}
+
+    response = client.get(f'/api/delivery/{delivery_id}/messages?whatsapp=%2B50933333333')
+    assert response.status_code == 403
+
+
+@pytest.mark.parametrize('through_other_worker', [False, True], ids=['same_worker', 'other_worker'])
+def test_long_poll_returns_when_a_message_arrives(delivery_id, through_other_worker):
+    last_id = _send(delivery_id, 'Bonjou')
+    sender = _send_later(delivery_id, 'Livrezon an pare', through_other_worker=through_other_worker)
+
+    started = time.monotonic()
+    data = app.test_client().get(
+        f'/api/delivery/{delivery_id}/messages?whatsapp={quote(BUYER)}&after_id={last_id}&wait=5').get_json()
+    elapsed = time.monotonic() - started
+    sender.join()
+
+    assert [message['message'] for message in data['messages']] == ['Livrezon an pare']
+    assert 0.15 < elapsed < 2
+    assert message_bus.subscriber_count() == 0
+
+
+def _read_events(chunks, count):
+    """Read SSE chunks until `count` message events arrived; returns them and the comment lines seen."""
+    events, comments = [], []
+    for chunk in chunks:
+        text = chunk.decode() if isinstance(chunk, bytes) else chunk
+        if text.startswith(':'):
+            comments.append(text)
+        elif 'event: message' in text:
+            fields = dict(line.split(': ', 1) for line in text.strip().split('\n'))
+            events.append((int(fields['id']), json.loads(fields['data'])))
+            if len(events) == count:
+                break
+    return events, comments
+
+
+def test_event_stream_sends_backlog_then_new_messages(delivery_id):
+    first = _send(delivery_id, 'Mesaj 1')
+    second = _send(delivery_id, 'Mesaj 2', sender=BUYER)
+
+    response = app.test_client().get(
+        f'/api/delivery/{delivery_id}/messages/stream?whatsapp={quote(BUYER)}&after_id={first}', buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    chunks = response.iter_encoded()
+    assert next(chunks).startswith(b'retry:')
+
+    events, _ = _read_events(chunks, 1)
+    assert events[0][0] == second and events[0][1]['is_mine'] is True
+
+    sender = _send_later(delivery_id, 'Mesaj 3', delay=0.5)
+    other_worker = _send_later(delivery_id, 'Mesaj 4', delay=0.8, through_other_worker=True)
+    events, comments = _read_events(chunks, 2)
+    sender.join()
+    other_worker.join()
+    assert [data['message'] for _, data in events] == ['Mesaj 3', 'Mesaj 4']
+    assert comments  # Keepalives while waiting
+    response.close()
+    assert message_bus.subscriber_count() == 0
+
+
+def test_event_stream_resumes_from_last_event_id(delivery_id):
+    ids = [_send(delivery_id, f'Mesaj {n}') for n in range(3)]
+    response = app.test_client().get(f'/api/delivery/{delivery_id}/messages/stream?whatsapp={quote(SELLER)}',
+                                     headers={'Last-Event-ID': str(ids[1])}, buffered=False)
+    events, _ = _read_events(response.iter_encoded(), 1)
+    response.close()
+    assert events[0][0] == ids[2] and events[0][1]['is_mine'] is True
+
+    response = app.test_client().get(f'/api/delivery/{delivery_id}/messages/stream?whatsapp=%2B50933333333')
+    assert response.status_code == 403
+
+
+def test_waiting_requests_are_capped_per_worker(delivery_id, monkeypatch):
+    monkeypatch.setattr(message_bus, 'max_waiting', 1)
+    last_id = _send(delivery_id, 'Bonjou')
+    client = app.test_client()
+
+    stream = client.get(f'/api/delivery/{delivery_id}/messages/stream?whatsapp={quote(BUYER)}&after_id={last_id}',
+                        buffered=False)
+    assert stream.status_code == 200 and message_bus.waiter_count() == 1
+
+    # Every slot taken: another stream is refused, a long poll answers at once
+    refused = client.get(f'/api/delivery/{delivery_id}/messages/stream?whatsapp={quote(SELLER)}')
+    assert refused.status_code == 503 and refused.headers['Retry-After']
+    started = time.monotonic()
+    response = client.get(f'/api/delivery/{delivery_id}/messages?whatsapp={quote(BUYER)}&after_id={last_id}&wait=5')
+    assert time.monotonic() - started < 1
+    assert response.get_json() == {'messages': [], 'last_id': last_id} and response.headers['Retry-After']
+
+    stream.close()
+    assert message_bus.waiter_count() == 0
+    response = client.get(f'/api/delivery/{delivery_id}/messages/stream?whatsapp={quote(SELLER)}', buffered=False)
+    assert response.status_code == 200
+    response.close()
+    assert message_bus.waiter_count() == 0
@@ -0,0 +1,102 @@
+"""
+Tests for the streaming admin exports (CSV / JSONL, optionally gzipped).
+"""
+import csv
+import gzip
+import io
+import json
+import tracemalloc
+import uuid
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from app import app, db, Ad, Delivery
+from src import exports
+from src.exports import stream_export
+
+SELLER = '+50966666666'
+
+
+def _admin_client():
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['admin'] = True
+    return client
+
+
+def _deliveries(n, created_at, status='completed'):
+    with app.app_context():
+        ids = [str(uuid.uuid4()) for _ in range(n)]
+        db.session.execute(insert(Delivery), [
+            {'delivery_id': delivery_id, 'buyer_whatsapp': '+50977777777', 'seller_whatsapp': SELLER,
+             'total_price': 10, 'delivery_cost': 2, 'status': status, 'created_at': created_at}
+            for delivery_id in ids])
+        db.session.commit()
+    return ids
+
+
+def test_csv_export_filters_by_date_and_status():
+    kept = _deliveries(3, datetime(2025, 2, 10))
+    _deliveries(2, datetime(2025, 2, 11), status='cancelled')
+    _deliveries(2, datetime(2025, 3, 1))
+    response = _admin_client().get('/admin/export/deliveries?start=2025-02-01&end=2025-02-28&status=completed')
+    assert response.status_code == 200 and response.mimetype == 'text/csv'
+    assert 'attachment' in response.headers['Content-Disposition']
+
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert sorted(row['delivery_id'] for row in rows) == sorted(kept)
+    assert rows[0]['seller_whatsapp'] == SELLER and rows[0]['created_at'] == '2025-02-10T00:00:00'
+
+
+def test_jsonl_export_is_gzipped_on_the_fly():
+    _deliveries(5, datetime(2025, 4, 2))
+    response = _admin_client().get('/admin/export/deliveries?format=jsonl&start=2025-04-01&end=2025-04-30',
+                                   headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    lines = gzip.decompress(response.data).decode().splitlines()
+    assert len(lines) == 5 and json.loads(lines[0])['total_price'] == 10
+
+
+def test_bad_requests_and_auth():
+    admin = _admin_client()
+    assert admin.get('/admin/export/users').status_code == 404
+    assert admin.get('/admin/export/ads?format=xml').status_code == 404
+    assert admin.get('/admin/export/messages?status=sent').status_code == 400
+    assert admin.get('/admin/export/ads?start=yesterday').status_code == 400
+    assert app.test_client().get('/admin/export/ads').status_code == 401
+
+
+def test_ad_csv_is_streamed_from_the_database():
+    ad_id = str(uuid.uuid4())
+    with app.app_context():
+        db.session.add(Ad(ad_id=ad_id, user_whatsapp=SELLER, description='Bel, "pwodwi"', title='Atik',
+                          admin_status='approved'))
+        db.session.commit()
+    response = _admin_client().get(f'/admin/csv/{ad_id}')
+    assert response.status_code == 200
+    assert f'filename="{ad_id}.csv"' in response.headers['Content-Disposition']
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [(row['ad_id'], row['description']) for row in rows] == [(ad_id, 'Bel, "pwodwi"')]
+
+    assert _admin_client().get(f'/admin/csv/{uuid.uuid4()}').status_code == 302
+
+
+def test_memory_stays_flat_with_the_row_count(monkeypatch):
+    monkeypatch.setattr(exports, 'YIELD_PER', 200)
+
+    def peak_memory(n, day):
+        _deliveries(n, datetime(2024, 6, day))
+        with app.app_context():
+            tracemalloc.start()
+            size = sum(len(chunk) for chunk in stream_export('deliveries', start=datetime(2024, 6, day),
+                                                             end=datetime(2024, 6, day + 1)))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return size, peak
+
+    small_size, small_peak = peak_memory(1000, 1)
+    large_size, large_peak = peak_memory(20000, 2)
+    assert large_size > 15 * small_size
+    assert large_peak < 2 * small_peak + 512 * 1024
@@ -0,0 +1,451 @@
+"""
+Tests for the Facebook publishing queue
+
+Runs the publisher against a local fake Graph API server (real HTTP on
+127.0.0.1), so connection pooling, concurrent album uploads, retries and
+rate-limit handling are exercised end to end.
+"""
+import json
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from app import app, db, Ad, Batch
+from models import FacebookPost, MediaJob
+from src.ad_media import set_ad_images
+from src.batches import set_batch_ads
+from src.facebook_publisher import FacebookPublisher, GraphAPIError, RateLimiter, facebook_publisher
+from src.media_jobs import retry_job, run_pending_jobs
+
+PAGE_ID = 'page123'
+TOKEN = 'test-token'
+
+
+class FakeGraphAPI(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so pooled connections are reused
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, form):
+        server = self.server
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        endpoint = url.path.rsplit('/', 1)[-1]
+        with server.lock:
+            server.calls.append((self.command, endpoint, form))
+            server.client_ports.add(self.client_address[1])
+            failure = None
+            for key in (form.get('url'), endpoint):  # A photo URL, or any call to an endpoint
+                if server.fail_next.get(key):
+                    failure = server.fail_next[key].pop(0)
+                    break
+
+        if query.get('access_token') != [TOKEN]:
+            return self._reply(400, {'error': {'message': 'Invalid OAuth access token', 'code': 190}})
+        if failure:
+            return self._reply(*failure)
+        if endpoint == 'me':
+            return self._reply(200, {'name': 'Glory2yahPub', 'id': PAGE_ID})
+
+        with server.lock:
+            server.counter += 1
+            number = server.counter
+        if endpoint == 'photos' and form.get('published') == 'false':
+            with server.lock:
+                server.in_flight += 1
+                server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            time.sleep(server.upload_delay)
+            with server.lock:
+                server.in_flight -= 1
+            return self._reply(200, {'id': f'photo-{number}'})
+        if endpoint == 'feed':
+            server.posts.append(form)
+        return self._reply(200, {'id': f'{PAGE_ID}_{endpoint}-{number}'})
+
+    def do_GET(self):
+        self._handle({})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            form = json.loads(body)
+        else:
+            form = {key: values[0] for key, values in parse_qs(body).items()}
+        self._handle(form)
+
+
+@pytest.fixture
+def graph_api():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeGraphAPI)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.calls, server.posts, server.client_ports = [], [], set()
+    server.fail_next = {}
+    server.counter = server.in_flight = server.max_in_flight = 0
+    server.upload_delay = 0.1
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _publisher(graph_api, concurrency=4):
+    publisher = FacebookPublisher(graph_url=graph_api.url, page_id=PAGE_ID, page_access_token=TOKEN)
+    publisher.upload_concurrency = concurrency
+    publisher.retry_backoff = 0.01
+    publisher.rate_limiter = RateLimiter(0)
+    return publisher
+
+
+def _ad(n_images=1, **fields):
+    values = dict(ad_id=str(uuid.uuid4()), title='Atik', description='Bel pwodwi', ad_type='sell',
+                  price_gkach=50, user_whatsapp='+50912345678', media_type='images',
+                  image_filenames=[f'img{i}.jpg' for i in range(n_images)], video=None)
+    values.update(fields)
+    return SimpleNamespace(**values)
+
+
+def test_album_photos_upload_concurrently_on_pooled_connections(graph_api):
+    publisher = _publisher(graph_api, concurrency=3)
+    ad = _ad(n_images=6)
+
+    started = time.monotonic()
+    post_id = publisher.publish_ad(ad, 'https://example.test')
+    elapsed = time.monotonic() - started
+
+    assert post_id.startswith(f'{PAGE_ID}_feed-')
+    assert 1 < graph_api.max_in_flight <= 3
+    assert elapsed < 6 * graph_api.upload_delay  # Not one after the other
+    assert len(graph_api.client_ports) <= 3  # 7 calls over at most 3 pooled connections
+
+    uploads = sorted(form['url'] for _, endpoint, form in graph_api.calls if endpoint == 'photos')
+    assert uploads == [f'https://example.test/static/uploads/img{i}.jpg' for i in range(6)]
+    album = graph_api.posts[0]
+    assert len({media['media_fbid'] for media in album['attached_media']}) == 6
+
+
+def test_transient_errors_are_retried_and_permanent_ones_are_not(graph_api):
+    publisher = _publisher(graph_api)
+    ad = _ad(n_images=2)
+    graph_api.fail_next['https://example.test/static/uploads/img0.jpg'] = [
+        (500, {'error': {'message': 'Service temporarily unavailable', 'code': 2, 'is_transient': True}}),
+        (400, {'error': {'message': 'Application request limit reached', 'code': 4}}, {'Retry-After': '0'}),
+    ]
+    assert publisher.publish_ad(ad, 'https://example.test')
+    assert [endpoint for _, endpoint, _ in graph_api.calls] == ['photos'] * 4 + ['feed']
+
+    graph_api.fail_next['photos'] = [(400, {'error': {'message': 'Invalid parameter', 'code': 100}})]
+    with pytest.raises(GraphAPIError) as error:
+        publisher.publish_ad(_ad(), 'https://example.test')
+    assert error.value.code == 100 and not error.value.retryable and not error.value.ambiguous
+    assert len(graph_api.calls) == 6
+
+    publisher.max_retries = 1
+    graph_api.fail_next['https://example.test/static/uploads/img0.jpg'] = [(503, {})] * 3
+    with pytest.raises(GraphAPIError) as error:
+        publisher.publish_ad(ad, 'https://example.test')
+    assert len(graph_api.calls) == 9 and not error.value.ambiguous
+
+
+def test_calls_creating_the_post_are_not_resent(graph_api):
+    publisher = _publisher(graph_api)
+
+    # Rate limited: Facebook refused the call, so sending it again is safe
+    graph_api.fail_next['feed'] = [(429, {'error': {'message': 'Too many calls', 'code': 32}}, {'Retry-After': '0'})]
+    assert publisher.publish_ad(_ad(n_images=0), 'https://example.test')
+    assert len(_feed_posts(graph_api)) == 2
+
+    # A 5xx on the post itself may still have created it
+    for n_images, endpoint in ((0, 'feed'), (1, 'photos'), (2, 'feed')):
+        graph_api.fail_next[endpoint] = [(500, {'error': {'message': 'Unknown error', 'is_transient': True}})]
+        calls_before = len(graph_api.calls)
+        with pytest.raises(GraphAPIError) as error:
+            publisher.publish_ad(_ad(n_images=n_images), 'https://example.test')
+        assert error.value.ambiguous and not error.value.retryable
+        assert [call[1] for call in graph_api.calls[calls_before:]].count(endpoint) == 1
+        graph_api.fail_next.pop(endpoint, None)
+
+    # Nothing was sent: refused connections are retried, then fail unambiguously
+    offline = FacebookPublisher(graph_url='http://127.0.0.1:9', page_id=PAGE_ID, page_access_token=TOKEN)
+    offline.retry_backoff, offline.max_retries, offline.rate_limiter = 0.01, 1, RateLimiter(0)
+    with pytest.raises(GraphAPIError) as error:
+        offline.publish_ad(_ad(n_images=0), 'https://example.test')
+    assert error.value.retryable and not error.value.ambiguous
+
+
+def test_rate_limiter_spaces_calls():
+    limiter = RateLimiter(50, burst=1)
+    started = time.monotonic()
+    for _ in range(6):
+        limiter.acquire()
+    assert time.monotonic() - started >= 0.09
+
+
+def _create_ads(n_ads=3, n_images=3):
+    with app.app_context():
+        ad_ids = []
+        for i in range(n_ads):
+            ad = Ad(ad_id=str(uuid.uuid4()), user_whatsapp='+50912345678', description='Bel pwodwi',
+                    title=f'Atik {i}', ad_type='sell', admin_status='approved', price_gkach=50)
+            set_ad_images(ad, [f'{uuid.uuid4()}.jpg' for _ in range(n_images)])
+            db.session.add(ad)
+            ad_ids.append(ad.ad_id)
+        db.session.commit()
+        return ad_ids
+
+
+def _create_batch(n_ads=3, n_images=3):
+    ad_ids = _create_ads(n_ads, n_images)
+    with app.app_context():
+        batch = Batch(batch_id=str(uuid.uuid4()))
+        set_batch_ads(batch, ad_ids)
+        db.session.add(batch)
+        db.session.commit()
+        return batch.batch_id, ad_ids
+
+
+@pytest.fixture
+def queue_publisher(graph_api, monkeypatch):
+    """Point the app's publisher at the fake Graph API."""
+    monkeypatch.setattr(facebook_publisher, 'base_url', f'{graph_api.url}/v18.0')
+    monkeypatch.setattr(facebook_publisher, 'page_id', PAGE_ID)
+    monkeypatch.setattr(facebook_publisher, 'page_access_token', TOKEN)
+    monkeypatch.setattr(facebook_publisher, 'retry_backoff', 0.01)
+    monkeypatch.setattr(facebook_publisher, 'rate_limiter', RateLimiter(0))
+    return graph_api
+
+
+def _admin_client():
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['admin'] = True
+    return client
+
+
+def test_batch_is_queued_and_results_stored_per_ad(queue_publisher):
+    batch_id, ad_ids = _create_batch()
+    client = _admin_client()
+
+    response = client.post(f'/admin/facebook/publish_batch/{batch_id}')
+    assert response.status_code == 302 and 'batch_results' in response.headers['Location']
+    assert queue_publisher.calls == []  # Nothing published inside the request
+    client.post(f'/admin/facebook/publish_batch/{batch_id}')  # Double click: already queued
+
+    with app.app_context():
+        posts = FacebookPost.query.filter_by(batch_id=batch_id).all()
+        assert sorted(post.ad_id for post in posts) == sorted(ad_ids)
+        assert {post.status for post in posts} == {'queued'}
+        run_pending_jobs()
+        posts = FacebookPost.query.filter_by(batch_id=batch_id).all()
+        assert {post.status for post in posts} == {'published'}
+        assert all(post.post_id.startswith(f'{PAGE_ID}_feed-') for post in posts)
+        assert all(len(json.loads(post.photo_ids)) == 3 for post in posts)
+
+    page = client.get(f'/admin/facebook/batch_results?batch_id={batch_id}').get_data(as_text=True)
+    assert 'Total Siksè:</strong> 3' in page
+    for post in posts:
+        assert post.post_id in page
+    with client.session_transaction() as sess:
+        assert 'facebook_batch_results' not in sess
+
+
+def test_failed_album_resumes_with_missing_photos_only(queue_publisher):
+    batch_id, (ad_id,) = _create_batch(n_ads=1, n_images=4)
+    with app.app_context():
+        images = db.session.get(Ad, ad_id).image_filenames
+    broken_url = f'http://localhost/static/uploads/{images[2]}'
+    queue_publisher.fail_next[broken_url] = [(400, {'error': {'message': 'Missing or invalid image file', 'code': 324}})]
+
+    _admin_client().post(f'/admin/facebook/publish_ad/{ad_id}')
+    with app.app_context():
+        run_pending_jobs()
+        post = FacebookPost.query.filter_by(ad_id=ad_id).one()
+        assert post.status == 'failed'
+        assert 'invalid image' in post.error
+        assert broken_url not in json.loads(post.photo_ids)
+        assert len(json.loads(post.photo_ids)) == 3
+
+        calls_before = len(queue_publisher.calls)
+        assert retry_job(post.job_id)
+        run_pending_jobs()
+        post = FacebookPost.query.filter_by(ad_id=ad_id).one()
+        assert post.status == 'published' and post.attempts == 2
+        retried = [form['url'] for _, endpoint, form in queue_publisher.calls[calls_before:] if endpoint == 'photos']
+        assert retried == [broken_url]
+
+
+@pytest.fixture
+def auto_publish(queue_publisher, monkeypatch):
+    """auto_publish_batches.py against the fake Graph API, with the batches of other tests out of the way."""
+    import auto_publish_batches
+    from src.facebook_queue import mark_batches_published
+
+    monkeypatch.setenv('APP_URL', 'https://example.test')
+    with app.app_context():
+        mark_batches_published()
+    return auto_publish_batches.auto_publish_approved_batches
+
+
+def _feed_posts(graph_api):
+    return [call for call in graph_api.calls if call[1] == 'feed']
+
+
+def test_auto_publish_only_publishes_new_batches(auto_publish, queue_publisher):
+    first_batch, first_ads = _create_batch(n_ads=3, n_images=2)
+    results = auto_publish(concurrency=3)
+    assert len(results['published']) == 3 and results['failed'] == []
+    assert len(_feed_posts(queue_publisher)) == 3
+    with app.app_context():
+        batch = db.session.get(Batch, first_batch)
+        assert batch.facebook_status == 'published' and batch.facebook_published_at is not None
+        assert batch.facebook_attempts == 1
+
+    # Nothing new: no Graph API call at all
+    calls_before = len(queue_publisher.calls)
+    assert auto_publish() == {'published': [], 'failed': []}
+    assert len(queue_publisher.calls) == calls_before
+
+    # A new batch holding an ad already published on its own: only the new ad is posted
+    (published_id,) = _create_ads(n_ads=1, n_images=2)
+    _admin_client().post(f'/admin/facebook/publish_ad/{published_id}')
+    with app.app_context():
+        run_pending_jobs()
+        ad = Ad(ad_id=str(uuid.uuid4()), user_whatsapp='+50912345678', description='Bel pwodwi',
+                title='Nouvo', ad_type='sell', admin_status='approved', price_gkach=50)
+        set_ad_images(ad, ['nouvo.jpg'])
+        db.session.add(ad)
+        db.session.flush()
+        batch = Batch(batch_id=str(uuid.uuid4()))
+        set_batch_ads(batch, [published_id, ad.ad_id])
+        db.session.add(batch)
+        db.session.commit()
+        new_ad_id = ad.ad_id
+    results = auto_publish()
+    assert [post.ad_id for post in results['published']] == [new_ad_id]
+    assert len(_feed_posts(queue_publisher)) == 4  # The album published on its own; the single photo goes to /photos
+
+
+def test_auto_publish_resumes_failed_and_interrupted_work(auto_publish, queue_publisher):
+    batch_id, (broken_ad, crashed_ad) = _create_batch(n_ads=2, n_images=3)
+    with app.app_context():
+        images = db.session.get(Ad, broken_ad).image_filenames
+    broken_url = f'https://example.test/static/uploads/{images[1]}'
+    queue_publisher.fail_next[broken_url] = [(400, {'error': {'message': 'Missing or invalid image file', 'code': 324}})]
+
+    results = auto_publish()
+    assert [post.ad_id for post in results['published']] == [crashed_ad]
+    with app.app_context():
+        batch = db.session.get(Batch, batch_id)
+        assert batch.facebook_status == 'partial' and 'invalid image' in batch.facebook_error
+        assert batch.facebook_published_at is None
+
+        # Simulate a run that died while publishing the other ad: its job is left 'running'
+        post = FacebookPost.query.filter_by(ad_id=crashed_ad).one()
+        post.status, post.post_id, post.published_at = 'publishing', None, None
+        job = MediaJob.query.filter_by(job_id=post.job_id).one()
+        job.status, job.started_at = 'running', datetime.utcnow() - timedelta(hours=2)
+        db.session.commit()
+
+    calls_before = len(queue_publisher.calls)
+    results = auto_publish()
+    assert sorted(post.ad_id for post in results['published']) == sorted([broken_ad, crashed_ad])
+    retried = [form.get('url') for _, endpoint, form in queue_publisher.calls[calls_before:] if endpoint == 'photos']
+    assert retried == [broken_url]  # The other photos of both albums were uploaded before
+    with app.app_context():
+        batch = db.session.get(Batch, batch_id)
+        assert batch.facebook_status == 'published' and batch.facebook_error is None
+        assert FacebookPost.query.filter_by(ad_id=broken_ad).one().attempts == 2
+
+
+def test_unconfirmed_post_is_not_published_again_until_checked(auto_publish, queue_publisher):
+    batch_id, (ad_id,) = _create_batch(n_ads=1, n_images=2)
+    queue_publisher.fail_next['feed'] = [(500, {'error': {'message': 'Unknown error', 'is_transient': True}})]
+
+    results = auto_publish()
+    assert results['published'] == [] and [post.status for post in results['failed']] == ['unconfirmed']
+    assert len(_feed_posts(queue_publisher)) == 1
+    with app.app_context():
+        post = FacebookPost.query.filter_by(ad_id=ad_id).one()
+        assert db.session.get(Batch, batch_id).facebook_status == 'unconfirmed'
+        assert MediaJob.query.filter_by(job_id=post.job_id).one().status == 'done'  # Nothing left for the job queue to retry
+        post_id = post.id
+
+    # Later runs leave it alone
+    auto_publish()
+    assert len(_feed_posts(queue_publisher)) == 1
+
+    client = _admin_client()
+    page = client.get(f'/admin/facebook/batch_results?batch_id={batch_id}').get_data(as_text=True)
+    assert 'Total Pou Verifye:</strong> 1' in page and f'/admin/facebook/posts/{post_id}/resolve' in page
+
+    # Not on the page: published again
+    calls_before = len(queue_publisher.calls)
+    response = client.post(f'/admin/facebook/posts/{post_id}/resolve', data={'found': '0'})
+    assert response.status_code == 302
+    with app.app_context():
+        run_pending_jobs()
+        post = db.session.get(FacebookPost, post_id)
+        assert post.status == 'published' and post.attempts == 2
+    assert [call[1] for call in queue_publisher.calls[calls_before:]].count('feed') == 1
+
+
+def test_job_requeued_while_posting_is_unconfirmed(queue_publisher):
+    batch_id, (ad_id,) = _create_batch(n_ads=1, n_images=2)
+    _admin_client().post(f'/admin/facebook/publish_ad/{ad_id}')
+    with app.app_context():
+        # The worker died right after sending the post: requeue_stale_jobs runs the job again
+        post = FacebookPost.query.filter_by(ad_id=ad_id).one()
+        post.status = 'posting'
+        db.session.commit()
+        run_pending_jobs()
+        post = FacebookPost.query.filter_by(ad_id=ad_id).one()
+        assert post.status == 'unconfirmed'
+        post_id = post.id
+    assert _feed_posts(queue_publisher) == []
+
+    _admin_client().post(f'/admin/facebook/posts/{post_id}/resolve',
+                         data={'found': '1', 'facebook_post_id': f'{PAGE_ID}_42'})
+    with app.app_context():
+        post = db.session.get(FacebookPost, post_id)
+        assert (post.status, post.post_id, post.error) == ('published', f'{PAGE_ID}_42', None)
+
+
+def test_stuck_batches_do_not_starve_new_ones(auto_publish, queue_publisher):
+    from src.facebook_queue import batches_to_publish
+
+    rejected_batch, rejected_ads = _create_batch(n_ads=2, n_images=1)
+    exhausted_batch, (exhausted_ad,) = _create_batch(n_ads=1, n_images=2)
+    with app.app_context():
+        Ad.query.filter(Ad.ad_id.in_(rejected_ads)).update({'admin_status': 'rejected'}, synchronize_session=False)
+        db.session.add(FacebookPost(ad_id=exhausted_ad, batch_id=exhausted_batch, status='failed', attempts=3))
+        db.session.commit()
+    new_batch, new_ads = _create_batch(n_ads=2, n_images=1)
+
+    # The two older batches can never make progress: they neither run first nor use up the limit
+    with app.app_context():
+        assert [batch.batch_id for batch in batches_to_publish(max_attempts=3)] == [new_batch]
+    results = auto_publish(limit=1)
+    assert sorted(post.ad_id for post in results['published']) == sorted(new_ads)
+
+    calls_before = len(queue_publisher.calls)
+    assert auto_publish(limit=1) == {'published': [], 'failed': []}
+    assert len(queue_publisher.calls) == calls_before
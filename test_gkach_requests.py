@@ -0,0 +1,66 @@
+"""
+Tests for the normalised gkach_requests table
+"""
+import io
+import json
+import uuid
+
+from app import app, db, UserGkach, GkachRequest
+from src.gkach_requests import backfill_gkach_requests
+
+
+def _whatsapp():
+    return f'+509{uuid.uuid4().int % 10**8:08d}'
+
+
+def _admin_client():
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['admin'] = True
+    return client
+
+
+def test_backfill_copies_legacy_json_once():
+    whatsapp = _whatsapp()
+    legacy = [
+        {'request_id': str(uuid.uuid4()), 'amount': 50, 'status': 'pending', 'document': 'proof.jpg',
+         'requested_at': '2025-09-18T10:00:00'},
+        {'request_id': str(uuid.uuid4()), 'amount': 20, 'status': 'approved', 'document': None,
+         'requested_at': '2025-09-17T10:00:00'},
+    ]
+    with app.app_context():
+        db.session.add(UserGkach(user_whatsapp=whatsapp, gkach_requests=json.dumps(legacy)))
+        db.session.commit()
+
+        assert backfill_gkach_requests() == 2
+        assert backfill_gkach_requests() == 0
+        rows = GkachRequest.query.filter_by(user_whatsapp=whatsapp).order_by(GkachRequest.amount).all()
+        assert [(r.amount, r.status, r.document) for r in rows] == [(20, 'approved', None), (50, 'pending', 'proof.jpg')]
+
+
+def test_request_upload_and_single_approval():
+    whatsapp = _whatsapp()
+    client = app.test_client()
+    response = client.post('/achte_gkach', data={'whatsapp': whatsapp, 'amount': '75', 'accept_terms': 'on'})
+    assert response.status_code == 302
+    with app.app_context():
+        request_id = GkachRequest.query.filter_by(user_whatsapp=whatsapp).one().request_id
+
+    client.post(f'/upload_gkach_approval/{request_id}', data={
+        'accept_terms': 'on',
+        'approval_document': (io.BytesIO(b'proof'), 'proof.png'),
+    }, content_type='multipart/form-data')
+
+    admin = _admin_client()
+    form = {'whatsapp': whatsapp, 'request_id': request_id, 'action': 'approve_request'}
+    admin.post('/admin/manage_gkach', data=form)
+    admin.post('/admin/manage_gkach', data=form)
+
+    with app.app_context():
+        gkach_request = GkachRequest.query.filter_by(request_id=request_id).one()
+        assert gkach_request.status == 'approved'
+        assert gkach_request.document.startswith('gkach_approval_')
+        assert UserGkach.query.filter_by(user_whatsapp=whatsapp).one().gkach_balance == 75
+
+    page = admin.get('/admin/manage_gkach').get_data(as_text=True)
+    assert request_id not in page
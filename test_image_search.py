@@ -0,0 +1,114 @@
+"""
+Tests for the persistent ORB descriptor index used by /search_by_image
+"""
+import os
+import shutil
+import uuid
+
+import cv2
+import numpy as np
+
+from app import app, db, Ad
+import image_search
+from src.ad_media import set_ad_images
+
+
+def _make_image(name, seed):
+    rng = np.random.default_rng(seed)
+    img = (rng.random((200, 200)) * 255).astype(np.uint8)
+    img = cv2.GaussianBlur(img, (3, 3), 0)
+    cv2.imwrite(os.path.join(app.config['UPLOAD_FOLDER'], name), img)
+    return name
+
+
+def _make_ad(images):
+    ad = Ad(ad_id=str(uuid.uuid4()), user_whatsapp='+50912345678', media_type='images',
+            description='test', title='test', admin_status='approved')
+    set_ad_images(ad, images)
+    db.session.add(ad)
+    db.session.commit()
+    return ad
+
+
+def test_index_and_search_uses_cached_descriptors():
+    with app.app_context():
+        ad = _make_ad([_make_image(f'{uuid.uuid4()}.png', 1)])
+        other = _make_ad([_make_image(f'{uuid.uuid4()}.png', 2)])
+        assert image_search.index_ad(ad) == 1
+        assert image_search.index_ad(other) == 1
+
+        query = os.path.join(app.config['UPLOAD_FOLDER'], ad.thumbnail)
+        assert [a.ad_id for a in image_search.find_similar_ads(query, mode='orb')] == [ad.ad_id]
+        assert [a.ad_id for a in image_search.find_similar_ads(query, mode='vector')] == [ad.ad_id]
+
+        # Source images are no longer needed once indexed
+        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], other.thumbnail))
+        extracted = []
+        original = image_search.extract_features
+        image_search.extract_features = lambda path: extracted.append(path) or original(path)
+        try:
+            image_search.find_similar_ads(query)
+        finally:
+            image_search.extract_features = original
+        assert extracted == [query]
+
+
+def test_removed_ad_is_not_returned():
+    with app.app_context():
+        ad = _make_ad([_make_image(f'{uuid.uuid4()}.png', 3)])
+        image_search.index_ad(ad)
+        query = os.path.join(app.config['UPLOAD_FOLDER'], ad.thumbnail)
+        assert ad.ad_id in [a.ad_id for a in image_search.find_similar_ads(query)]
+
+        image_search.remove_ad_from_index(ad.ad_id)
+        assert ad.ad_id not in [a.ad_id for a in image_search.find_similar_ads(query)]
+
+
+def test_changes_made_by_another_worker_are_loaded():
+    with app.app_context():
+        ad = _make_ad([_make_image(f'{uuid.uuid4()}.png', 4), _make_image(f'{uuid.uuid4()}.png', 5)])
+        image_search.index_ad(ad)
+        index_folder = image_search.get_index_folder()
+        ad_folder = os.path.join(index_folder, ad.ad_id)
+        names = sorted(name for name in os.listdir(ad_folder) if not name.endswith(image_search.VECTOR_SUFFIX))
+
+        # This worker loads the ad while another one has only written its first image
+        held_back = os.path.join(index_folder, f'{names[1]}.held')
+        shutil.move(os.path.join(ad_folder, names[1]), held_back)
+        os.utime(index_folder, None)
+        assert len(image_search._load_index()[ad.ad_id]) == 1
+
+        # The other worker finishes the ad, then touches the index root
+        shutil.move(held_back, os.path.join(ad_folder, names[1]))
+        os.utime(index_folder, None)
+        assert len(image_search._load_index()[ad.ad_id]) == 2
+
+        # rebuild_index in another worker: every ad folder is recreated
+        stale = image_search._load_index()[ad.ad_id]
+        shutil.rmtree(index_folder)
+        os.makedirs(ad_folder)
+        np.save(os.path.join(ad_folder, names[0]), np.zeros((1, 32), dtype=np.uint8))
+        reloaded = image_search._load_index()[ad.ad_id]
+        assert len(reloaded) == 1 and reloaded[0] is not stale[0]
+
+
+def test_missing_index_is_rebuilt_by_a_media_job():
+    from models import MediaJob
+    from src.media_jobs import run_pending_jobs
+
+    with app.app_context():
+        ad = _make_ad([_make_image(f'{uuid.uuid4()}.png', 6)])
+        query = os.path.join(app.config['UPLOAD_FOLDER'], ad.thumbnail)
+
+        # Fresh deployment: the search answers at once, without indexing in the request
+        shutil.rmtree(image_search.get_index_folder())
+        assert image_search.find_similar_ads(query) == []
+        assert image_search.index_ad(ad) == 0
+        assert not os.path.isdir(image_search.get_index_folder())
+        assert MediaJob.query.filter_by(kind='rebuild_image_index', status='queued').count() == 1
+
+        run_pending_jobs(kinds=['rebuild_image_index'])
+        assert MediaJob.query.filter_by(kind='rebuild_image_index', status='done').count() == 1
+        assert ad.ad_id in [a.ad_id for a in image_search.find_similar_ads(query)]
+        assert not [name for name in os.listdir(os.path.dirname(os.path.abspath(image_search.get_index_folder())))
+                    if name.startswith('image_index.')]
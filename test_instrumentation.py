@@ -0,0 +1,79 @@
+"""
+Tests for the opt-in request instrumentation
+"""
+import json
+import os
+import tempfile
+import time
+
+from flask import Flask
+from sqlalchemy import event, text
+
+from app import app, db
+from src.instrumentation import init_instrumentation, _before_cursor_execute
+
+
+def _instrumented_app(**config):
+    scratch = Flask(__name__)
+    scratch.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'instr.db')
+    scratch.config.update(INSTRUMENTATION=True, SLOW_REQUEST_THRESHOLD_MS=100, PROFILE_SAMPLE_INTERVAL_MS=2,
+                          SLOW_REQUEST_LOG=os.path.join(tempfile.mkdtemp(), 'slow.log'), **config)
+    db.init_app(scratch)
+
+    def busy_wait(seconds):
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            pass
+
+    @scratch.route('/fast')
+    def fast():
+        db.session.execute(text('SELECT 1'))
+        return 'ok'
+
+    @scratch.route('/slow')
+    def slow():
+        for _ in range(3):
+            db.session.execute(text('SELECT 2'))
+        busy_wait(0.2)
+        return 'ok'
+
+    assert init_instrumentation(scratch) is True
+    return scratch
+
+
+def test_disabled_by_default_installs_nothing():
+    assert app.config['INSTRUMENTATION'] is False
+    with app.app_context():
+        assert not event.contains(db.engine, 'before_cursor_execute', _before_cursor_execute)
+    hooks = [func.__name__ for func in app.before_request_funcs.get(None, [])]
+    assert 'start_instrumentation' not in hooks
+    assert 'Server-Timing' not in app.test_client().get('/').headers
+
+
+def test_server_timing_counts_queries():
+    scratch = _instrumented_app()
+    response = scratch.test_client().get('/fast')
+    timing = response.headers['Server-Timing']
+    assert timing.startswith('db;dur=')
+    assert 'desc="1 queries"' in timing
+    assert 'total;dur=' in timing
+    assert not os.path.exists(scratch.config['SLOW_REQUEST_LOG']) or \
+        os.path.getsize(scratch.config['SLOW_REQUEST_LOG']) == 0
+
+
+def test_slow_request_is_logged_with_queries_and_profile():
+    scratch = _instrumented_app()
+    assert scratch.test_client().get('/slow?page=2').status_code == 200
+
+    with open(scratch.config['SLOW_REQUEST_LOG']) as f:
+        entries = [json.loads(line) for line in f]
+    assert len(entries) == 1
+    entry = entries[0]
+    assert entry['path'] == '/slow?page=2'
+    assert entry['duration_ms'] >= 200
+    assert entry['query_count'] == 3
+    assert entry['top_queries'][0]['sql'] == 'SELECT 2'
+    assert entry['top_queries'][0]['count'] == 3
+    # The sampler caught the busy loop inside the view
+    assert entry['profile']
+    assert entry['profile'][0]['stack'].endswith('test_instrumentation.py:slow;test_instrumentation.py:busy_wait')
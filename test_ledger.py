@@ -0,0 +1,169 @@
+"""
+Tests for the Gkach ledger
+
+The stress test fires many concurrent checkouts (including the same cart
+from several threads at once) and checks that no Gkach is created or lost:
+cached balances match the ledger and every transfer sums to zero.
+"""
+import threading
+import uuid
+
+from sqlalchemy import func
+
+from app import app, db, Ad, User, CartItem, Delivery, UserGkach, GkachLedgerEntry
+from src.ledger import transfer, InsufficientGkach, find_drift, get_balance, MINT_ACCOUNT, ESCROW_ACCOUNT
+from src.media_jobs import run_pending_jobs
+
+PRICE = 10
+SHIPPING = 5
+
+
+def _whatsapp():
+    return f'+509{uuid.uuid4().int % 10**8:08d}'
+
+
+def _fund(whatsapp, amount):
+    transfer([(MINT_ACCOUNT, -amount), (whatsapp, amount)], 'test_fund')
+
+
+def _buyer_with_cart(seller, balance):
+    """Create a buyer holding `balance` Gkach and a one-item cart ready for checkout."""
+    whatsapp = _whatsapp()
+    user = User(name='Achte', whatsapp=whatsapp)
+    db.session.add(user)
+    db.session.add(UserGkach(user_whatsapp=whatsapp, gkach_balance=0))
+    db.session.flush()
+    _fund(whatsapp, balance)
+    ad = Ad(ad_id=str(uuid.uuid4()), user_whatsapp=seller, images='x.jpg', description='d',
+            title='Atik', admin_status='approved', price_gkach=PRICE)
+    db.session.add(ad)
+    db.session.add(CartItem(user_id=user.id, product_id=ad.ad_id, quantity=1, shipping_fee=SHIPPING,
+                            shipping_fee_set=True, negotiation_status='seller_updated'))
+    return whatsapp
+
+
+def test_transfer_rejects_overdraft_and_unbalanced_postings():
+    whatsapp = _whatsapp()
+    with app.app_context():
+        db.session.add(UserGkach(user_whatsapp=whatsapp, gkach_balance=0))
+        _fund(whatsapp, 30)
+        db.session.commit()
+
+        try:
+            transfer([(whatsapp, -31), (MINT_ACCOUNT, 31)], 'test')
+            assert False, 'overdraft accepted'
+        except InsufficientGkach:
+            db.session.rollback()
+
+        try:
+            transfer([(whatsapp, -10)], 'test')
+            assert False, 'unbalanced transfer accepted'
+        except ValueError:
+            db.session.rollback()
+
+        assert get_balance(whatsapp) == 30
+        assert whatsapp not in find_drift()
+
+
+def test_concurrent_checkouts_conserve_gkach():
+    seller = _whatsapp()
+    with app.app_context():
+        db.session.add(UserGkach(user_whatsapp=seller, gkach_balance=0))
+        # Buyers who can pay exactly once, plus one who could pay for several carts
+        buyers = [_buyer_with_cart(seller, PRICE + SHIPPING) for _ in range(6)]
+        buyers.append(_buyer_with_cart(seller, 10 * (PRICE + SHIPPING)))
+        db.session.commit()
+        accounts = buyers + [seller]
+        total_before = db.session.query(func.sum(UserGkach.gkach_balance)).filter(
+            UserGkach.user_whatsapp.in_(accounts)).scalar()
+
+    errors = []
+    barrier = threading.Barrier(len(buyers) * 4)
+
+    def hammer(whatsapp):
+        try:
+            client = app.test_client()
+            barrier.wait()
+            response = client.post('/checkout', data={'whatsapp': whatsapp})
+            assert response.status_code == 302
+        except Exception as e:  # pragma: no cover - surfaced by the assertion below
+            errors.append(e)
+
+    threads = [threading.Thread(target=hammer, args=(whatsapp,)) for whatsapp in buyers for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+    with app.app_context():
+        balances = dict(db.session.query(UserGkach.user_whatsapp, UserGkach.gkach_balance)
+                        .filter(UserGkach.user_whatsapp.in_(accounts)).all())
+        # Each cart was paid exactly once, however many threads raced for it
+        assert balances[seller] == len(buyers) * (PRICE + SHIPPING)
+        assert all(balances[whatsapp] >= 0 for whatsapp in buyers)
+        assert sum(balances.values()) == total_before
+        assert Delivery.query.filter_by(seller_whatsapp=seller).count() == len(buyers)
+
+        assert not {account: drift for account, drift in find_drift().items() if account in accounts}
+        unbalanced = (db.session.query(GkachLedgerEntry.transfer_id)
+                      .group_by(GkachLedgerEntry.transfer_id)
+                      .having(func.sum(GkachLedgerEntry.amount) != 0)
+                      .all())
+        assert unbalanced == []
+
+
+def test_escrow_is_released_once():
+    buyer, seller = _whatsapp(), _whatsapp()
+    with app.app_context():
+        db.session.add(UserGkach(user_whatsapp=buyer, gkach_balance=0))
+        _fund(buyer, 100)
+        delivery = Delivery(delivery_id=str(uuid.uuid4()), buyer_whatsapp=buyer, seller_whatsapp=seller,
+                            total_price=40, delivery_cost=5, status='price_set', cart_items='[]')
+        db.session.add(delivery)
+        db.session.commit()
+        delivery_id = delivery.delivery_id
+        escrow_before = get_balance(ESCROW_ACCOUNT)
+
+    client = app.test_client()
+    client.post(f'/buyer_confirm_delivery/{delivery_id}', data={'action': 'confirm'})
+    client.post(f'/buyer_confirm_delivery/{delivery_id}', data={'action': 'confirm'})
+    with app.app_context():
+        assert get_balance(buyer) == 55
+        assert get_balance(ESCROW_ACCOUNT) == escrow_before + 45
+
+    client.post(f'/confirm_delivery_received/{delivery_id}')
+    client.post(f'/confirm_delivery_received/{delivery_id}')
+    with app.app_context():
+        # The seller had no Gkach account yet; the release opens one
+        assert get_balance(seller) == 45
+        assert get_balance(ESCROW_ACCOUNT) == escrow_before
+        assert db.session.get(Delivery, delivery_id).status == 'completed'
+
+        # confirm_delivery_received queued the receipt; render it so it does not linger in the queue
+        assert run_pending_jobs(kinds=['render_receipt']) == 1
+
+
+def test_first_credits_to_a_new_account_do_not_collide(monkeypatch):
+    from src import ledger
+
+    seller = _whatsapp()
+    create_account = ledger._create_account
+
+    def created_concurrently(account):
+        # Another transfer crediting the same seller inserted the row first
+        db.session.add(UserGkach(user_whatsapp=account, gkach_balance=7))
+        db.session.flush()
+        create_account(account)
+
+    with app.app_context():
+        monkeypatch.setattr(ledger, '_create_account', created_concurrently)
+        transfer([(MINT_ACCOUNT, -10), (seller, 10)], 'test')
+        db.session.commit()
+        assert get_balance(seller) == 17
+
+        monkeypatch.setattr(ledger, '_create_account', create_account)
+        other = _whatsapp()
+        transfer([(MINT_ACCOUNT, -5), (other, 5)], 'test')
+        db.session.commit()
+        assert get_balance(other) == 5
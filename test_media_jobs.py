@@ -0,0 +1,120 @@
+"""
+Tests for the background media job queue
+"""
+import io
+import os
+import uuid
+
+from PIL import Image
+
+from app import app, db, Ad, MediaJob
+from src.media_jobs import enqueue, claim_next_job, run_pending_jobs, run_job, retry_job, get_ad_processing_state, map_cpu_bound
+from src.image_processing import process_upload, variant_name
+
+
+def _photo(width=1500, height=1000, orientation=None):
+    """JPEG bytes, optionally tagged with an EXIF orientation like a phone photo."""
+    img = Image.new('RGB', (width, height), (200, 30, 30))
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=95, exif=exif.tobytes())
+    return buf.getvalue()
+
+
+def _admin_client():
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['admin'] = True
+    return client
+
+
+def test_submit_ad_defers_image_processing_to_the_queue():
+    client = app.test_client()
+    photo = _photo(orientation=6)
+    response = client.post('/submit_ad', data={
+        'whatsapp': '+50912345678',
+        'title': 'Machin a lave',
+        'description': 'Bon kondisyon',
+        'ad_type': 'publish',
+        'media_type': 'images',
+        'accept_terms': 'on',
+        'image_1': (io.BytesIO(photo), 'a.jpg'),
+        'image_2': (io.BytesIO(photo), 'b.jpg'),
+        'image_3': (io.BytesIO(photo), 'c.jpg'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 302
+
+    with app.app_context():
+        upload_folder = app.config['UPLOAD_FOLDER']
+        variants_folder = app.config['MEDIA_VARIANTS_FOLDER']
+        ad_id = response.headers['Location'].rstrip('/').rsplit('/', 1)[-1]
+        ad = db.session.get(Ad, ad_id)
+        filenames = ad.image_filenames
+
+        # The request only stored the uploads as-is
+        for name in filenames:
+            with open(os.path.join(upload_folder, name), 'rb') as f:
+                assert f.read() == photo
+        job = MediaJob.query.filter_by(ad_id=ad_id).one()
+        assert job.status == 'queued'
+        assert get_ad_processing_state([ad_id]) == {ad_id: 'queued'}
+
+        assert run_pending_jobs() == 1
+        assert get_ad_processing_state([ad_id]) == {ad_id: 'done'}
+
+        for name in filenames:
+            with Image.open(os.path.join(upload_folder, name)) as img:
+                assert img.size == (1000, 1500)  # EXIF rotation applied
+            for width in (320, 640):
+                for fmt in ('webp', 'jpeg'):
+                    with Image.open(os.path.join(variants_folder, variant_name(name, width, fmt))) as variant:
+                        assert variant.size[0] == width
+            # No upscaled variant wider than the image
+            assert not os.path.exists(os.path.join(variants_folder, variant_name(name, 1280, 'webp')))
+        job_id = job.job_id
+
+    admin = _admin_client()
+    status = admin.get(f'/admin/media_jobs/{job_id}').get_json()
+    assert status['job']['status'] == 'done'
+    assert sorted(status['job']['result']['images']) == sorted(filenames)
+    ads = admin.get('/admin/api/ads', query_string={'q': ad_id}).get_json()['items']
+    assert [ad['media_state'] for ad in ads] == ['done']
+
+
+def test_jobs_are_claimed_once_and_failures_can_be_retried():
+    with app.app_context():
+        ad_id = str(uuid.uuid4())
+        db.session.add(Ad(ad_id=ad_id, user_whatsapp='+50912345678', description='d',
+                          images='missing.jpg', admin_status='under_review'))
+        job = enqueue('process_images', ad_id=ad_id)
+        # Clear out anything queued by other tests first
+        while True:
+            claimed = claim_next_job()
+            assert claimed is not None
+            if claimed.job_id == job.job_id:
+                break
+            run_job(claimed)
+        assert claim_next_job() is None
+
+        MediaJob.query.filter_by(job_id=job.job_id).update({'status': 'failed', 'error': 'boom'})
+        db.session.commit()
+        assert get_ad_processing_state([ad_id]) == {ad_id: 'failed'}
+        assert retry_job(job.job_id)
+        assert not retry_job(job.job_id)
+        assert run_pending_jobs() == 1
+        assert MediaJob.query.filter_by(job_id=job.job_id).one().status == 'done'
+
+
+def test_process_pool_runs_image_work(tmp_path):
+    path = tmp_path / 'photo.jpg'
+    path.write_bytes(_photo(800, 600))
+    with app.app_context():
+        app.config['MEDIA_PROCESS_WORKERS'] = 1
+        try:
+            [result] = map_cpu_bound(process_upload, [(str(path), str(tmp_path / 'variants'), [320, 640, 1280], ['webp'])])
+        finally:
+            app.config['MEDIA_PROCESS_WORKERS'] = 0
+    assert result['width'] == 800
+    assert result['variants'] == ['photo-320w.webp', 'photo-640w.webp']
@@ -0,0 +1,118 @@
+"""
+Tests for request metrics, the shared sink and traffic alerts
+"""
+import multiprocessing
+import os
+import re
+import tempfile
+import time
+from types import SimpleNamespace
+
+from app import app
+from src import metrics
+
+
+def _scratch_app(**config):
+    """Just enough of an app for the metrics functions, on its own sink."""
+    defaults = {'METRICS_DB': os.path.join(tempfile.mkdtemp(), 'metrics.db'),
+                'TRAFFIC_ALERT_THRESHOLD': 5, 'TRAFFIC_ALERT_COOLDOWN': 900}
+    defaults.update(config)
+    return SimpleNamespace(config=defaults)
+
+
+def _samples(text, name):
+    """{labels: value} of one metric in Prometheus text output."""
+    pattern = re.compile(rf'^glory2yahpub_{name}(?:{{(.*)}})? (\S+)$', re.MULTILINE)
+    return {labels or '': float(value) for labels, value in pattern.findall(text)}
+
+
+def test_requests_are_exported_in_prometheus_format():
+    client = app.test_client()
+    for _ in range(3):
+        client.get('/')
+    assert client.get('/admin/metrics').status_code == 401
+
+    with client.session_transaction() as sess:
+        sess['admin'] = True
+    response = client.get('/admin/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    text = response.get_data(as_text=True)
+
+    requests = _samples(text, 'http_requests_total')
+    assert requests['endpoint="index",method="GET",status="200"'] >= 3
+
+    buckets = _samples(text, 'http_request_duration_seconds_bucket')
+    index_buckets = [value for labels, value in buckets.items() if labels.startswith('endpoint="index"')]
+    assert index_buckets == sorted(index_buckets)  # Cumulative
+    count = _samples(text, 'http_request_duration_seconds_count')['endpoint="index"']
+    assert buckets['endpoint="index",le="+Inf"'] == count >= 3
+    assert '# TYPE glory2yahpub_http_request_duration_seconds histogram' in text
+
+
+def test_metrics_token_allows_scrapes():
+    app.config['METRICS_TOKEN'] = 'scrape-secret'
+    try:
+        client = app.test_client()
+        assert client.get('/admin/metrics').status_code == 401
+        assert client.get('/admin/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+        assert client.get('/admin/metrics', headers={'Authorization': 'Bearer scrapé'}).status_code == 401
+        assert client.get('/admin/metrics', headers={'Authorization': 'Bearer scrape-secret'}).status_code == 200
+    finally:
+        app.config['METRICS_TOKEN'] = None
+
+
+def test_ring_buffer_is_bounded():
+    metrics.init_metrics(_scratch_app(METRICS_BUFFER_SIZE=100))
+    try:
+        for _ in range(250):
+            metrics.record_request('index', 'GET', 200, 0.01)
+        counters, rates = metrics.drain()
+        assert sum(rates.values()) == 100
+        assert metrics.drain() == ({}, {})
+    finally:
+        metrics.init_metrics(app)
+
+
+def _worker(path, n):
+    """Stand-in for a gunicorn worker: count n requests and flush them."""
+    scratch = _scratch_app(METRICS_DB=path)
+    metrics.init_metrics(scratch)
+    for i in range(n):
+        metrics.record_request('achte', 'GET', 200 if i % 10 else 500, 0.02)
+    metrics.flush(scratch)
+
+
+def test_workers_aggregate_through_shared_sink():
+    scratch = _scratch_app()
+    path = scratch.config['METRICS_DB']
+    metrics.get_sink(scratch)  # Create the schema before the workers race
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=_worker, args=(path, 200)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    text = metrics.render_prometheus(scratch)
+    requests = _samples(text, 'http_requests_total')
+    assert requests['endpoint="achte",method="GET",status="200"'] == 540
+    assert requests['endpoint="achte",method="GET",status="500"'] == 60
+    assert _samples(text, 'http_request_duration_seconds_count')['endpoint="achte"'] == 600
+    assert metrics.get_sink(scratch).requests_between(int(time.time() // 60) - 1, int(time.time() // 60) + 1) == 600
+
+
+def test_traffic_alert_fires_once_per_cooldown():
+    scratch = _scratch_app()
+    sink = metrics.get_sink(scratch)
+    minute = int(time.time() // 60)
+
+    sink.add({}, {(minute, 'index'): 3})
+    assert metrics.evaluate_alerts(scratch) is None  # Below threshold
+
+    sink.add({}, {(minute, 'index'): 7})
+    assert metrics.evaluate_alerts(scratch) == 10
+    sink.add({}, {(minute, 'index'): 50})
+    assert metrics.evaluate_alerts(scratch) is None  # Cooling down
+    assert _samples(metrics.render_prometheus(scratch), 'traffic_alerts_total') == {'': 1}
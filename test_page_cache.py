@@ -0,0 +1,141 @@
+"""
+Tests for the cached homepage and batch pages
+
+Pages carry strong ETags derived from the shared content version, answer
+revalidation with 304 before querying anything else, render their fragments
+once per version, and change as soon as any worker bumps the version.
+"""
+import sqlite3
+import uuid
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from app import app, db, Ad, Batch
+from src.ad_media import set_ad_images
+from src.page_cache import fragment_cache, get_content_version
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def _admin_client():
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['admin'] = True
+    return client
+
+
+def _create_batch(client):
+    """Approve five fresh ads and batch them through the admin route; returns the batch ID."""
+    with app.app_context():
+        for i in range(5):
+            ad = Ad(ad_id=str(uuid.uuid4()), user_whatsapp='+50912345678',
+                    description='Bel pwodwi', title=f'Atik {i}', ad_type='publish', admin_status='approved')
+            set_ad_images(ad, [f'{i}.jpg'])
+            db.session.add(ad)
+        db.session.commit()
+    client.post('/admin/create_batch')
+    client.get('/')  # Consume the flashed message
+    with app.app_context():
+        return Batch.query.order_by(Batch.created_at.desc()).first().batch_id
+
+
+def test_homepage_revalidates_with_304():
+    client = app.test_client()
+    first = client.get('/')
+    assert first.status_code == 200
+    assert first.headers['Cache-Control'] == 'no-cache'
+    etag = first.headers['ETag']
+    assert not etag.startswith('W/')
+
+    with count_queries() as statements:
+        again = client.get('/', headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.data == b''
+    assert len(statements) == 1  # The content version, nothing else
+
+
+def test_fragments_rendered_once_per_version():
+    client = app.test_client()
+    batch_id = _create_batch(_admin_client())
+    client.get(f'/batch/{batch_id}')
+
+    hits = fragment_cache.hits
+    with count_queries() as statements:
+        response = client.get(f'/batch/{batch_id}')
+    assert response.status_code == 200
+    assert fragment_cache.hits == hits + 1
+    assert len(statements) == 1
+    assert f'Gwoup Piblisite {batch_id}'.encode() in response.data
+
+
+def test_batch_changes_invalidate_pages():
+    admin = _admin_client()
+    client = app.test_client()
+    etag = client.get('/').headers['ETag']
+
+    batch_id = _create_batch(admin)
+    created = client.get('/', headers={'If-None-Match': etag})
+    assert created.status_code == 200
+    assert created.headers['ETag'] != etag
+    with app.app_context():
+        ad_ids = db.session.get(Batch, batch_id).ads.split(',')
+    assert all(ad_id.encode() in created.data for ad_id in ad_ids)
+
+    batch_etag = client.get(f'/batch/{batch_id}').headers['ETag']
+    admin.post(f'/admin/remove_ad_from_batch/{batch_id}/{ad_ids[0]}')
+    edited = client.get(f'/batch/{batch_id}', headers={'If-None-Match': batch_etag})
+    assert edited.status_code == 200
+    assert ad_ids[0].encode() not in edited.data
+
+    admin.post(f'/admin/delete_batch/{batch_id}')
+    admin.get('/')
+    gone = client.get(f'/batch/{batch_id}')
+    assert gone.status_code == 302
+
+
+def test_version_bump_from_another_worker():
+    client = app.test_client()
+    first = client.get('/')
+
+    # Another process bumps the shared counter; this process is never told
+    with app.app_context():
+        path = db.engine.url.database
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("UPDATE content_versions SET version = version + 1, updated_at = '2030-01-01 00:00:00' "
+                     "WHERE name = 'pages'")
+    conn.close()
+
+    response = client.get('/', headers={'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != first.headers['ETag']
+    with app.app_context():
+        version, updated_at = get_content_version()
+    assert response.last_modified.replace(tzinfo=None) == updated_at
+
+    not_modified = client.get('/', headers={'If-Modified-Since': response.headers['Last-Modified']})
+    assert not_modified.status_code == 304
+
+
+def test_flashed_messages_are_not_cached():
+    client = app.test_client()
+    client.get('/batch/does-not-exist')  # Flashes an error and redirects home
+    response = client.get('/')
+    assert 'Gwoup sa pa egziste.' in response.get_data(as_text=True)
+    assert response.headers['Cache-Control'] == 'no-store'
+    assert 'ETag' not in response.headers
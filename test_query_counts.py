@@ -0,0 +1,97 @@
+"""
+Query-count regression tests for cart and delivery pages
+
+Each page must issue the same, bounded number of SQL statements whether the
+cart holds one item or many; a per-item Ad lookup would make the count grow.
+"""
+import json
+import uuid
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from app import app, db, Ad, User, CartItem, Delivery, UserGkach
+
+MAX_STATEMENTS = 12
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def _seed(n_items):
+    """Create a buyer with n cart items (one seller) and a delivery for each delivery page."""
+    buyer = f'+509{uuid.uuid4().int % 10**8:08d}'
+    seller = f'+509{uuid.uuid4().int % 10**8:08d}'
+    with app.app_context():
+        user = User(name='Achte', whatsapp=buyer)
+        db.session.add(user)
+        db.session.add(UserGkach(user_whatsapp=buyer, gkach_balance=10**6))
+        db.session.add(UserGkach(user_whatsapp=seller, gkach_balance=0))
+        db.session.flush()
+
+        items = []
+        for i in range(n_items):
+            ad = Ad(ad_id=str(uuid.uuid4()), user_whatsapp=seller, images='x.jpg', description='d',
+                    title=f'Atik {i}', admin_status='approved', price_gkach=10)
+            db.session.add(ad)
+            db.session.add(CartItem(user_id=user.id, product_id=ad.ad_id, quantity=1, shipping_fee=5,
+                                    shipping_fee_set=True, negotiation_status='seller_updated'))
+            items.append({'ad_id': ad.ad_id, 'quantity': 1, 'price': 10, 'title': ad.title})
+
+        deliveries = {}
+        for status in ('pending', 'price_set', 'awaiting_delivery'):
+            delivery = Delivery(delivery_id=str(uuid.uuid4()), buyer_whatsapp=buyer, seller_whatsapp=seller,
+                                total_price=10 * n_items, status=status, cart_items=json.dumps(items))
+            db.session.add(delivery)
+            deliveries[status] = delivery.delivery_id
+        db.session.commit()
+    return buyer, deliveries
+
+
+def _page_requests(buyer, deliveries, n_items):
+    return {
+        'view_cart': ('GET', f'/view_cart?whatsapp={buyer}', None),
+        'shopping_card_update': ('GET', f'/shopping_card_update?whatsapp={buyer}', None),
+        'seller_update_cart': ('GET', f'/seller_update_cart/{buyer}', None),
+        'cart_success': ('GET', '/cart_success', None),
+        'seller_update_delivery': ('GET', f"/seller_update_delivery/{deliveries['pending']}", None),
+        'buyer_confirm_delivery': ('GET', f"/buyer_confirm_delivery/{deliveries['price_set']}", None),
+        'confirm_delivery_received': ('GET', f"/confirm_delivery_received/{deliveries['awaiting_delivery']}", None),
+        'checkout': ('POST', '/checkout', {'whatsapp': buyer}),
+    }
+
+
+def _statements_per_page(n_items):
+    buyer, deliveries = _seed(n_items)
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['delivery_ids'] = list(deliveries.values())
+
+    counts = {}
+    for name, (method, url, data) in _page_requests(buyer, deliveries, n_items).items():
+        with count_queries() as statements:
+            response = client.open(url, method=method, data=data)
+        assert response.status_code in (200, 302), (name, response.status_code)
+        counts[name] = len(statements)
+    return counts
+
+
+def test_cart_pages_issue_constant_queries():
+    small = _statements_per_page(1)
+    large = _statements_per_page(10)
+    for page, count in large.items():
+        assert count <= MAX_STATEMENTS, f'{page} issued {count} statements'
+        assert count == small[page], f'{page}: {small[page]} statements for 1 item, {count} for 10'
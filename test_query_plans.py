@@ -0,0 +1,185 @@
+"""
+Query-plan regression tests for the hot queries
+
+Seeds a scratch database with ~100k ads (plus users, carts, deliveries and
+messages), runs the same queries the pages run and asserts through
+EXPLAIN QUERY PLAN (SQLite) / EXPLAIN (Postgres) that each one is served by
+the expected index, never by a full table scan or an extra sort.
+
+Set TEST_POSTGRES_URL to also check the plans on an empty Postgres database.
+"""
+import os
+import random
+import re
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask
+from sqlalchemy import event, insert, text
+
+from app import db, get_approved_ads_page, encode_ad_cursor
+from models import Ad, AdMedia, Batch, BatchAd, User, CartItem, Delivery, Message
+from src.admin_dashboard import admin_ads_query
+from src.batches import get_batch_ad_ids, unbatched_ads
+from src.cart import get_cart_items
+from src.communication import get_messages
+from src.schema import upgrade_schema
+
+N_ADS = 100_000
+N_USERS = 5_000
+N_DELIVERIES = 5_000
+N_MESSAGES = 20_000
+UNBATCHED_APPROVED = 300
+
+# (name, function run against the seeded data, index that must serve it)
+HOT_QUERIES = [
+    ('approved_first_page', lambda data: get_approved_ads_page(limit=24), 'ix_ads_status_created'),
+    ('approved_next_page', lambda data: get_approved_ads_page(data['cursor'], limit=24), 'ix_ads_status_created'),
+    ('unbatched_approved', lambda data: unbatched_ads().all(), 'ix_batch_ads_ad'),
+    ('admin_ads_by_status', lambda data: admin_ads_query(status='under_review').limit(20).offset(40).all(), 'ix_ads_status_created'),
+    ('batch_approved_ad_ids', lambda data: get_batch_ad_ids(data['batch_id'], approved_only=True),
+     'ix_batch_ads_batch_position'),
+    ('cart_items', lambda data: get_cart_items(data['user_id']), 'ix_cart_items_user_product'),
+    ('cart_item_for_product', lambda data: CartItem.query.filter_by(
+        user_id=data['user_id'], product_id=data['ad_id']).first(), 'ix_cart_items_user_product'),
+    ('user_by_whatsapp', lambda data: User.query.filter_by(whatsapp=data['whatsapp']).first(), 'ix_users_whatsapp'),
+    ('delivery_messages', lambda data: get_messages(data['delivery_id'], None, participants=()),
+     'ix_messages_delivery_id'),
+    ('delivery_messages_after', lambda data: get_messages(data['delivery_id'], None, after_id=data['message_id'],
+                                                          participants=()), 'ix_messages_delivery_id'),
+    ('deliveries_by_buyer', lambda data: Delivery.query.filter_by(buyer_whatsapp=data['whatsapp']).all(),
+     'idx_delivery_buyer'),
+    ('deliveries_by_seller', lambda data: Delivery.query.filter_by(seller_whatsapp=data['whatsapp']).all(),
+     'idx_delivery_seller'),
+]
+
+
+def _database_kinds():
+    return [
+        pytest.param('sqlite', id='sqlite'),
+        pytest.param('postgres', id='postgres', marks=pytest.mark.skipif(
+            not os.environ.get('TEST_POSTGRES_URL'), reason='TEST_POSTGRES_URL not set')),
+    ]
+
+
+def _seed():
+    """Bulk insert the fixture rows; returns the values the hot queries look up."""
+    rng = random.Random(42)
+    start = datetime(2024, 1, 1)
+    whatsapps = [f'+509{n:08d}' for n in range(N_USERS)]
+
+    ads, members = [], []
+    for n in range(N_ADS):
+        status = rng.choices(['approved', 'under_review', 'rejected'], weights=[70, 20, 10])[0]
+        batched = status == 'approved' and n >= UNBATCHED_APPROVED
+        ads.append({
+            'ad_id': f'ad-{n:06d}', 'user_whatsapp': rng.choice(whatsapps), 'media_type': 'images',
+            'description': 'Bel pwodwi', 'ad_type': 'sell', 'admin_status': status,
+            'created_at': start + timedelta(minutes=n),
+        })
+        if batched:
+            members.append({'batch_id': f'batch-{n // 20}', 'ad_id': ads[-1]['ad_id'], 'position': n % 20})
+    db.session.execute(insert(Ad), ads)
+    db.session.execute(insert(Batch), [{'batch_id': batch_id, 'ads': ''}
+                                       for batch_id in sorted({member['batch_id'] for member in members})])
+    db.session.execute(insert(BatchAd), members)
+    db.session.execute(insert(AdMedia), [{'ad_id': ad['ad_id'], 'position': position, 'filename': f"{ad['ad_id']}_{position}.jpg",
+                                          'kind': 'image'} for ad in ads for position in range(2)])
+    db.session.execute(insert(User), [{'id': n + 1, 'name': 'Itilizatè', 'whatsapp': w} for n, w in enumerate(whatsapps)])
+    db.session.execute(insert(CartItem), [
+        {'user_id': rng.randint(1, N_USERS), 'product_id': f'ad-{rng.randrange(N_ADS):06d}', 'quantity': 1}
+        for _ in range(N_USERS * 4)
+    ])
+    db.session.execute(insert(Delivery), [
+        {'delivery_id': f'del-{n:05d}', 'buyer_whatsapp': rng.choice(whatsapps), 'seller_whatsapp': rng.choice(whatsapps),
+         'total_price': 100, 'status': 'negotiating', 'created_at': start + timedelta(hours=n)}
+        for n in range(N_DELIVERIES)
+    ])
+    db.session.execute(insert(Message), [
+        {'delivery_id': f'del-{rng.randrange(N_DELIVERIES):05d}', 'sender_whatsapp': rng.choice(whatsapps),
+         'message': 'Bonjou', 'created_at': start + timedelta(minutes=n)}
+        for n in range(N_MESSAGES)
+    ])
+    db.session.commit()
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('ANALYZE'))
+        db.session.commit()
+
+    first_page, _ = get_approved_ads_page(limit=24)
+    return {
+        'cursor': encode_ad_cursor(first_page[-1]),
+        'user_id': 17,
+        'ad_id': 'ad-000042',
+        'batch_id': db.session.query(BatchAd.batch_id).order_by(BatchAd.batch_id).limit(1).scalar(),
+        'whatsapp': whatsapps[17],
+        'delivery_id': 'del-00042',
+        'message_id': db.session.query(db.func.min(Message.id)).filter_by(delivery_id='del-00042').scalar(),
+    }
+
+
+@pytest.fixture(scope='module', params=_database_kinds())
+def seeded(request):
+    scratch = Flask(__name__)
+    if request.param == 'sqlite':
+        scratch.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'plans.db')
+    else:
+        scratch.config['SQLALCHEMY_DATABASE_URI'] = os.environ['TEST_POSTGRES_URL']
+    db.init_app(scratch)
+    with scratch.app_context():
+        if request.param == 'postgres':
+            db.drop_all()
+            db.session.execute(text('DROP TABLE IF EXISTS alembic_version'))
+            db.session.commit()
+        upgrade_schema(scratch)
+        data = _seed()
+        yield data
+        db.session.remove()
+        if request.param == 'postgres':
+            db.drop_all()
+            db.session.execute(text('DROP TABLE alembic_version'))
+            db.session.commit()
+        db.engine.dispose()
+
+
+@contextmanager
+def captured_statements():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def query_plan(statement, parameters):
+    """The plan of one captured statement as a single string."""
+    connection = db.session.connection()
+    if db.engine.dialect.name == 'sqlite':
+        rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+        return '\n'.join(row[-1] for row in rows)
+    rows = connection.exec_driver_sql('EXPLAIN ' + statement, parameters).fetchall()
+    return '\n'.join(row[0] for row in rows)
+
+
+def assert_uses_index(plan, index_name):
+    assert index_name in plan, f"expected {index_name}:\n{plan}"
+    if db.engine.dialect.name == 'sqlite':
+        assert not re.search(r'^SCAN \w+$', plan, re.MULTILINE), f"full table scan:\n{plan}"
+        assert 'USE TEMP B-TREE' not in plan, f"extra sort:\n{plan}"
+    else:
+        assert 'Seq Scan' not in plan, f"sequential scan:\n{plan}"
+        assert not re.search(r'^\s*(->\s*)?Sort', plan, re.MULTILINE), f"extra sort:\n{plan}"
+
+
+@pytest.mark.parametrize('name, run, index_name', HOT_QUERIES, ids=[query[0] for query in HOT_QUERIES])
+def test_hot_query_uses_index(seeded, name, run, index_name):
+    with captured_statements() as statements:
+        run(seeded)
+    assert len(statements) == 1
+    assert_uses_index(query_plan(*statements[0]), index_name)
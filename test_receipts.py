@@ -0,0 +1,120 @@
+"""
+Tests for PDF receipts: rendered by the media worker, served from the private
+receipts folder with a signed link, and bundled into seller statements.
+"""
+import io
+import os
+import re
+import uuid
+import zipfile
+from datetime import datetime
+from urllib.parse import quote
+
+from app import app, db, Delivery, MediaJob
+from src.ledger import transfer, MINT_ACCOUNT, ESCROW_ACCOUNT
+from src.media_jobs import run_pending_jobs
+from src.receipts import receipt_url
+
+SELLER = '+50944444444'
+
+
+def _delivery(status='completed', delivered_at=None, seller=SELLER, price=40):
+    with app.app_context():
+        delivery = Delivery(delivery_id=str(uuid.uuid4()), buyer_whatsapp='+50955555555', seller_whatsapp=seller,
+                            total_price=price, delivery_cost=5, status=status, delivered_at=delivered_at,
+                            cart_items=f'[{{"title": "Atik", "quantity": 2, "price": {price // 2}}}]')
+        db.session.add(delivery)
+        db.session.commit()
+        return delivery.delivery_id
+
+
+def _signed_url(delivery_id):
+    with app.test_request_context():
+        return receipt_url(delivery_id)
+
+
+def _receipt_jobs(delivery_id):
+    with app.app_context():
+        return MediaJob.query.filter(MediaJob.kind == 'render_receipt',
+                                     MediaJob.payload.contains(delivery_id)).all()
+
+
+def _page_count(pdf):
+    return len(re.findall(rb'/Type /Page\b(?!s)', pdf))
+
+
+def _admin_client():
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['admin'] = True
+    return client
+
+
+def test_confirmation_queues_the_receipt():
+    delivery_id = _delivery(status='awaiting_delivery')
+    with app.app_context():
+        transfer([(MINT_ACCOUNT, -45), (ESCROW_ACCOUNT, 45)], 'test_fund')
+        db.session.commit()
+
+    response = app.test_client().post(f'/confirm_delivery_received/{delivery_id}')
+    assert response.status_code == 302
+    jobs = _receipt_jobs(delivery_id)
+    assert [job.status for job in jobs] == ['queued']
+    assert not os.path.exists(os.path.join('static', 'uploads', f'receipt_{delivery_id}.pdf'))
+    with app.app_context():
+        assert run_pending_jobs(kinds=['render_receipt']) == 1
+
+
+def test_receipt_is_served_once_rendered_with_an_etag():
+    delivery_id = _delivery(delivered_at=datetime(2026, 3, 2, 10, 30))
+    client = app.test_client()
+    url = _signed_url(delivery_id)
+
+    response = client.get(url)
+    assert response.status_code == 202 and response.headers['Retry-After']
+    client.get(url)  # Asking again does not queue a second job
+    assert len(_receipt_jobs(delivery_id)) == 1
+
+    with app.app_context():
+        run_pending_jobs()
+    response = client.get(url)
+    assert response.status_code == 200 and response.mimetype == 'application/pdf'
+    assert response.data.startswith(b'%PDF') and 'private' in response.headers['Cache-Control']
+    etag = response.headers['ETag']
+
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_receipt_needs_the_signed_link_or_admin():
+    delivery_id = _delivery()
+    client = app.test_client()
+    assert client.get(f'/receipts/{delivery_id}').status_code == 403
+    assert client.get(f'/receipts/{delivery_id}?token=forged').status_code == 403
+    # A link signed for another delivery does not open this one
+    other = _signed_url(_delivery()).split('token=')[1]
+    assert client.get(f'/receipts/{delivery_id}?token={other}').status_code == 403
+    assert _admin_client().get(f'/receipts/{delivery_id}').status_code == 202
+    with app.app_context():
+        run_pending_jobs(kinds=['render_receipt'])
+
+
+def test_statement_bundles_the_sellers_receipts():
+    seller = f'+509{uuid.uuid4().int % 10**8:08d}'
+    ids = [_delivery(seller=seller, delivered_at=datetime(2026, 4, day), price=10 * day) for day in (3, 10, 30)]
+    _delivery(seller=seller, delivered_at=datetime(2026, 5, 1))  # Outside the period
+    _delivery(seller=seller, status='awaiting_delivery', delivered_at=datetime(2026, 4, 5))
+    admin = _admin_client()
+    query = f'seller={quote(seller)}&start=2026-04-01&end=2026-04-30'
+
+    response = admin.get(f'/admin/receipts/statement?{query}')
+    assert response.status_code == 200 and response.mimetype == 'application/zip'
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.namelist() == [f'resi_{delivery_id}.pdf' for delivery_id in ids]
+        assert all(archive.read(name).startswith(b'%PDF') for name in archive.namelist())
+
+    # The receipts rendered for the ZIP are reused by the single-PDF statement
+    response = admin.get(f'/admin/receipts/statement?{query}&format=pdf')
+    assert response.status_code == 200 and _page_count(response.data) == 3
+
+    assert admin.get(f'/admin/receipts/statement?seller={quote(seller)}&start=2026-04-01').status_code == 400
+    assert app.test_client().get(f'/admin/receipts/statement?{query}').status_code == 302
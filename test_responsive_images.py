@@ -0,0 +1,63 @@
+"""
+Tests for responsive image variants and srcset serving
+"""
+import io
+import os
+import uuid
+
+from PIL import Image
+
+from app import app, db, Ad
+from src.ad_media import set_ad_images
+from src.image_processing import variant_name
+
+
+def _legacy_upload(width=1500, height=1000):
+    """An upload that predates the media queue: no variants on disk."""
+    filename = f"{uuid.uuid4()}_legacy.jpg"
+    Image.new('RGB', (width, height), (20, 120, 200)).save(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'JPEG')
+    return filename
+
+
+def test_variant_is_generated_on_demand_and_cached():
+    filename = _legacy_upload()
+    client = app.test_client()
+    cached = os.path.join(app.config['MEDIA_VARIANTS_FOLDER'], variant_name(filename, 640, 'webp'))
+    assert not os.path.exists(cached)
+
+    response = client.get(f'/media/640/webp/{filename}')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/webp'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert Image.open(io.BytesIO(response.get_data())).size == (640, 427)
+    assert os.path.exists(cached)
+
+    # Served from the disk cache the second time
+    mtime = os.stat(cached).st_mtime_ns
+    assert client.get(f'/media/640/webp/{filename}').get_data() == response.get_data()
+    assert os.stat(cached).st_mtime_ns == mtime
+
+
+def test_only_configured_variants_are_served():
+    filename = _legacy_upload()
+    client = app.test_client()
+    # Arbitrary sizes would let anyone fill the disk; fall back to the original instead
+    response = client.get(f'/media/777/webp/{filename}')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith(f'/static/uploads/{filename}')
+    assert client.get('/media/640/webp/does-not-exist.jpg').status_code == 404
+
+
+def test_catalog_cards_use_picture_srcset():
+    filename = _legacy_upload()
+    with app.app_context():
+        ad = Ad(ad_id=str(uuid.uuid4()), user_whatsapp='+50912345678',
+                description='d', title='Srcset', admin_status='approved')
+        set_ad_images(ad, [filename])
+        db.session.add(ad)
+        db.session.commit()
+
+    html = app.test_client().get('/achte').get_data(as_text=True)
+    assert f'<source type="image/webp" srcset="/media/320/webp/{filename} 320w, ' in html
+    assert f'src="/media/640/jpeg/{filename}"' in html
+    assert f'uploads/{filename}"' not in html
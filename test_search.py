@@ -0,0 +1,58 @@
+"""
+Tests for the /achte full-text search subsystem
+"""
+import uuid
+
+import pytest
+
+from app import app, db, Ad
+from src import search
+
+
+def _make_ad(title, description, status='approved'):
+    ad = Ad(ad_id=str(uuid.uuid4()), user_whatsapp='+50912345678', media_type='images',
+            images='x.jpg', description=description, title=title, admin_status=status)
+    db.session.add(ad)
+    search.index_ad_text(ad, commit=False)
+    db.session.commit()
+    return ad
+
+
+def test_fold_text_strips_accents():
+    assert search.tokenize('Machin à LAVE, Kreyòl!') == ['machin', 'a', 'lave', 'kreyol']
+
+
+@pytest.mark.parametrize('backend', ['fts5', 'python'])
+def test_search_ranks_approved_ads(backend, monkeypatch):
+    monkeypatch.setattr(search, '_backend', backend)
+    tag = uuid.uuid4().hex[:8]
+    with app.app_context():
+        in_title = _make_ad(f'Soulye {tag} nwa', 'bon kalite')
+        in_body = _make_ad('Chemiz', f'mache byen ak soulye {tag}')
+        _make_ad(f'Soulye {tag} wouj', 'pa apwouve', status='under_review')
+
+        ads, total = search.search_ads(f'SOULYÈ {tag}')
+        assert total == 2
+        assert [ad.ad_id for ad in ads] == [in_title.ad_id, in_body.ad_id]
+
+        # Prefix match on partial words
+        ads, total = search.search_ads(tag[:5])
+        assert total == 2
+
+        search.remove_ad_text(in_title.ad_id)
+        ads, total = search.search_ads(tag)
+        assert [ad.ad_id for ad in ads] == [in_body.ad_id]
+
+
+def test_achte_search_is_paginated(monkeypatch):
+    monkeypatch.setitem(app.config, 'SEARCH_PER_PAGE', 2)
+    tag = uuid.uuid4().hex[:8]
+    with app.app_context():
+        for i in range(3):
+            _make_ad(f'Telefòn {tag} {i}', 'nèf')
+    client = app.test_client()
+    first = client.get(f'/achte?search={tag}').get_data(as_text=True)
+    second = client.get(f'/achte?search={tag}&page=2').get_data(as_text=True)
+    assert first.count('onclick="showAdModal(') == 2
+    assert second.count('onclick="showAdModal(') == 1
+    assert '3 rezilta' in first
@@ -0,0 +1,18 @@
+"""
+Startup budget: importing the app (gunicorn --preload boot) must stay cheap
+"""
+import os
+
+from benchmark_startup import measure_import
+
+# Generous enough for a slow CI box; the eager imports alone used to add ~0.7s and ~60MB
+MAX_IMPORT_SECONDS = float(os.environ.get('STARTUP_MAX_SECONDS', 3.0))
+MAX_IMPORT_RSS_MB = float(os.environ.get('STARTUP_MAX_RSS_MB', 100))
+
+
+def test_import_app_skips_heavy_modules_and_stays_within_budget():
+    stats, _ = measure_import()
+
+    assert stats['heavy'] == [], f"import app loaded heavy modules: {stats['heavy']}"
+    assert stats['seconds'] < MAX_IMPORT_SECONDS, f"import app took {stats['seconds']:.2f}s"
+    assert stats['rss_mb'] < MAX_IMPORT_RSS_MB, f"import app peaked at {stats['rss_mb']:.0f}MB"
@@ -0,0 +1,79 @@
+"""
+Tests for video transcoding on approval
+"""
+import os
+import subprocess
+import uuid
+
+import pytest
+
+from app import app, db, Ad, MediaJob
+from image_search import _load_index
+from src.media_jobs import run_pending_jobs
+from src.video_processing import get_ffmpeg, rendition_name
+
+try:
+    FFMPEG = get_ffmpeg()
+except Exception:  # pragma: no cover - depends on the environment
+    FFMPEG = None
+
+pytestmark = pytest.mark.skipif(not FFMPEG, reason='ffmpeg not available')
+
+
+def _upload_video():
+    """A 2 second MOV with audio, like a phone upload."""
+    filename = f"{uuid.uuid4()}_clip.mov"
+    subprocess.run([FFMPEG, '-y', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', 'testsrc=size=1920x1080:rate=25:duration=2',
+                    '-f', 'lavfi', '-i', 'sine=frequency=440:duration=2',
+                    '-c:v', 'mpeg4', '-c:a', 'aac',
+                    os.path.join(app.config['UPLOAD_FOLDER'], filename)], check=True)
+    return filename
+
+
+def _admin_client():
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['admin'] = True
+    return client
+
+
+def test_approval_transcodes_video_and_indexes_poster():
+    filename = _upload_video()
+    ad_id = str(uuid.uuid4())
+    with app.app_context():
+        db.session.add(Ad(ad_id=ad_id, user_whatsapp='+50912345678', media_type='video', video=filename,
+                          images='', description='Videyo', title='Videyo', admin_status='under_review'))
+        db.session.commit()
+
+    client = app.test_client()
+    # Before transcoding the card falls back to the upload and has no poster
+    assert client.get(f'/media/video/preview/{filename}').status_code == 302
+    assert client.get(f'/media/video/poster/{filename}').status_code == 404
+
+    _admin_client().post('/admin/update_ad_status', data={'ad_id': ad_id, 'status': 'approved'})
+    with app.app_context():
+        assert MediaJob.query.filter_by(ad_id=ad_id, kind='transcode_video').one().status == 'queued'
+        run_pending_jobs()
+        job = MediaJob.query.filter_by(ad_id=ad_id, kind='transcode_video').one()
+        assert job.status == 'done', job.error
+
+        variants_folder = app.config['MEDIA_VARIANTS_FOLDER']
+        with open(os.path.join(variants_folder, rendition_name(filename, 'full')), 'rb') as f:
+            data = f.read()
+        # faststart: the moov atom comes before the media data
+        assert 0 < data.find(b'moov') < data.find(b'mdat')
+        preview_size = os.path.getsize(os.path.join(variants_folder, rendition_name(filename, 'preview')))
+        assert preview_size < len(data)
+        with open(os.path.join(variants_folder, rendition_name(filename, 'poster')), 'rb') as f:
+            assert f.read(3) == b'\xff\xd8\xff'
+
+        # The poster makes the video ad findable by image search
+        assert ad_id in _load_index()
+
+    html = client.get('/achte').get_data(as_text=True)
+    assert f'poster="/media/video/poster/{filename}"' in html
+    assert f'data-src="/media/video/preview/{filename}"' in html
+    response = client.get(f'/media/video/full/{filename}')
+    assert response.status_code == 200
+    assert response.mimetype == 'video/mp4'